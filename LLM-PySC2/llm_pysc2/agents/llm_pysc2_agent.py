@@ -17,6 +17,7 @@ from llm_pysc2.lib import llm_client, llm_observation, llm_action, llm_prompt, l
 from llm_pysc2.lib.mini_alphastar import MiniAlphaStar
 
 from pysc2.lib import actions
+from pysc2.lib import latency
 
 from shutil import copyfile
 from loguru import logger
@@ -301,6 +302,7 @@ class LLMAgent:
 
 
   # Main API Func, receive obs and get actions
+  @latency.registry.decorate("LLMAgent.query")
   def query(self, obs) -> None:
     while self.is_waiting is False:
       with self.lock:
@@ -621,6 +623,7 @@ class Customized_LLMAgent(LLMAgent):
     self.client.example_o_prompt = self.basic_prompt.eop
 
   # 如需修改Agent与LLM的交互方式，重定义接口函数act即可
+  @latency.registry.decorate("LLMAgent.query")
   def query(self, obs) -> None:
     while self.is_waiting is False:
       with self.lock:
@@ -15,12 +15,13 @@
 
 from llm_pysc2.lib.llm_communicate import communication_info_transmission
 from llm_pysc2.lib.data_recorder import DataRecorder
+from llm_pysc2.lib.unit_diff import UnitDiff
 from llm_pysc2.agents.main_agent_funcs import *
 from llm_pysc2.agents.configs import ProtossAgentConfig
 from llm_pysc2.agents.llm_pysc2_agent import LLMAgent
 
 from pysc2.agents import base_agent
-from pysc2.lib import actions
+from pysc2.lib import actions, features
 
 from collections import deque
 from shutil import copyfile
@@ -100,6 +101,11 @@ class MainAgent(base_agent.BaseAgent):
     self.unit_uid_total = list()
     self.unit_disappear_steps = dict()
 
+    # born/died unit events, updated once per step and shared with subscribers
+    self.unit_diff = UnitDiff()
+    self.self_unit_diff = UnitDiff(alliance=features.PlayerRelative.SELF, completed_only=True)
+    self.self_unit_diff.subscribe(self._on_self_unit_diff)
+
     # self.possible_disappear_unit_list = list()
     self.func_id_history = deque(maxlen=20)
     self.obs_history = deque(maxlen=5)
@@ -179,7 +185,17 @@ class MainAgent(base_agent.BaseAgent):
       self.agents[agent_name].log_id = self.log_id
 
   def _initialize_data_recorder(self):
-    self.data_recorder = DataRecorder(self.log_dir_path, save_level=0)
+    self.data_recorder = DataRecorder(self.log_dir_path, save_level=0, unit_diff=self.unit_diff)
+
+  def _on_self_unit_diff(self, event):
+    # new completed units wait in unit_uid_appear for grouping, units still in raw_units that are no longer
+    # counted (not completed / not ours) are marked as disappeared, see main_agent_func1
+    for tag in event.born.tolist():
+      if tag not in self.unit_uid_appear:
+        self.unit_uid_appear.append(tag)
+    for tag in np.intersect1d(event.died, self.unit_diff.tags, assume_unique=True).tolist():
+      self.unit_uid_disappear.append(tag)
+    self.unit_uid = event.tags.tolist()
 
   def _all_agent_query_llm_finished(self):
     for agent_name in self.AGENT_NAMES:
@@ -208,6 +224,8 @@ class MainAgent(base_agent.BaseAgent):
     # main agent control data updates
     agent_name = None
     self.obs_history.append(obs)
+    self.unit_diff.update(obs)
+    self.self_unit_diff.update(obs)
     self.data_recorder.step(obs, self.episodes, self.steps)
     if len(self.func_id_history) > 0 and self.func_id_history[-1] == 573:
       self.camera_threshold += 0.05
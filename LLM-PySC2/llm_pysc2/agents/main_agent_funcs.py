@@ -330,21 +330,7 @@ def main_agent_func1(self, obs):
 
   # region 3新生产单位编组 死亡单位的剔除
   # 检测两步之间己方新增的单位和消失的单位
-  unit_uid_ = list()
-  for unit in obs.observation.raw_units:
-    if unit.alliance == features.PlayerRelative.SELF and unit.build_progress == 100:
-      unit_uid_.append(unit.tag)
-    if unit.tag in self.unit_uid and unit.tag not in unit_uid_:
-      self.unit_uid_disappear.append(unit.tag)
-    if unit.tag not in self.unit_uid and unit.tag in unit_uid_:
-      self.unit_uid_appear.append(unit.tag)
-  # for tag in self.unit_uid:
-  #     if tag not in unit_uid_:
-  #         self.unit_uid_disappear.append(tag)
-  # for tag in unit_uid_:
-  #     if tag not in self.unit_uid:
-  #         self.unit_uid_appear.append(tag)
-  self.unit_uid = unit_uid_
+  # self.unit_uid / unit_uid_appear / unit_uid_disappear are updated by MainAgent._on_self_unit_diff()
 
   # 单位消失步数记录判断
   for tag in self.unit_uid_total:
@@ -17,10 +17,24 @@ import os
 import pickle
 import shutil
 from pysc2.env import environment
+from pysc2.lib import latency
+from llm_pysc2.lib.unit_diff import UnitDiff
+
+
+def get_terminal_record(obs):
+  """The part of a terminal TimeStep needed by log_analyse."""
+  return {
+    'step_type': obs.step_type,
+    'reward': obs.reward,
+    'discount': obs.discount,
+    'score_cumulative': obs.observation.score_cumulative,
+    'score_by_category': obs.observation.score_by_category,
+    'score_by_vital': obs.observation.score_by_vital,
+  }
 
 
 class DataRecorder():
-  def __init__(self, save_dir, save_level=0):
+  def __init__(self, save_dir, save_level=0, unit_diff=None):
     """
     Args:
       save_dir:
@@ -30,12 +44,17 @@ class DataRecorder():
         1 for important steps that unit changes,
         2 add obs that action may be important,
         3 for all obs
+      unit_diff:
+        shared UnitDiff updated by its owner every step, None to create (and update) a private one
     """
     self.obs_list = []
     self.save_dir = save_dir
     # save_level:
     self.save_level = save_level
-    self.last_step_unit_tags = []
+    self._own_unit_diff = unit_diff is None
+    self.unit_diff = UnitDiff() if unit_diff is None else unit_diff
+    self.unit_diff.subscribe(self._on_unit_diff)
+    self.last_unit_diff_event = None
     if not os.path.exists(self.save_dir):
       os.mkdir(self.save_dir)
 
@@ -62,6 +81,10 @@ class DataRecorder():
     with open(obs_save_path, 'wb') as f:
       pickle.dump(self.obs_list, f)
       print(f"Successfully save episode obs in {obs_save_path}")
+    # small index of the terminal step, so that log_analyse does not need to load the whole obs list
+    terminal_save_path = f"{self.save_dir}/terminal-episode{num_episode}{result}.pkl"
+    with open(terminal_save_path, 'wb') as f:
+      pickle.dump(get_terminal_record(obs), f)
     try:  # To avoid errors caused by insufficient permissions
       save_dir_temp = f"{self.save_dir}/obs{num_episode}"
       shutil.rmtree(save_dir_temp)
@@ -69,18 +92,16 @@ class DataRecorder():
     except:
       pass
 
+  def _on_unit_diff(self, event):
+    self.last_unit_diff_event = event
+
   def _is_unit_appear_or_disappear(self, obs):
-    step_unit_tags = []
-    unit_appear_or_disappear = False
-    for unit in obs.observation.raw_units:
-      step_unit_tags.append(unit.tag)
-      if unit.tag not in self.last_step_unit_tags:
-        unit_appear_or_disappear = True
-    if len(step_unit_tags) != len(self.last_step_unit_tags):
-      unit_appear_or_disappear = True
-    self.last_step_unit_tags = step_unit_tags
-    return unit_appear_or_disappear
+    if self._own_unit_diff:
+      self.unit_diff.update(obs)
+    event = self.last_unit_diff_event
+    return event is not None and event.changed
 
+  @latency.registry.decorate("DataRecorder.step")
   def step(self, obs, num_episode, num_step):
     if obs.step_type == environment.StepType.MID:
       if self.save_level >= 0:
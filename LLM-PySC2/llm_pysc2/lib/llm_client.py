@@ -16,6 +16,7 @@
 # from llamaapi import LlamaAPI
 from zhipuai import ZhipuAI
 import openai
+from pysc2.lib import latency
 
 from loguru import logger
 import threading
@@ -171,6 +172,7 @@ class GptClient:
         ]},
       ]
 
+  @latency.registry.decorate("GptClient.query")
   def query(self, obs_prompt, base64_image=None, stream_callback=None):
 
     self.stream_callback = stream_callback
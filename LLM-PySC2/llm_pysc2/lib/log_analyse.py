@@ -12,85 +12,185 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
+import json
 import os
 import pickle
+import re
 import shutil
 
+import numpy as np
+
 from pysc2.env import environment
+from pysc2.lib import features, named_array
+from llm_pysc2.lib.data_recorder import get_terminal_record
 
-# analyse one experiment folder
-def analyse(experiment_folder, delete_unfinished):
-  win, tie, lose = 0, 0, 0
-  score_cumulative = None
-  score_by_category = None
-  score_by_vital = None
-  obs_lists = []  # 1 experiment with several episodes
-  obs_list = []
+SUMMARY_FILE_NAME = 'log_analyse_summary.json'
+
+_SCORE_NAMES = {
+  'score_cumulative': [features.ScoreCumulative],
+  'score_by_category': [features.ScoreByCategory, features.ScoreCategories],
+  'score_by_vital': [features.ScoreByVital, features.ScoreVitals],
+}
+
+
+def _get_step_num(obs_pkl_name):
+  match = re.search(r'step(\d+)\.pkl$', obs_pkl_name)
+  return int(match.group(1)) if match else -1
 
-  # find saved obs
+
+# read only the last step of each saved episode
+def read_terminal_records(experiment_folder):
+  terminal_pkl_paths = {}
+  obs_list_pkl_paths = {}
   obs_folder_paths = []
-  obs_list_pkl_paths = []
-  for file_or_dir_name in os.listdir(experiment_folder):
+  for file_or_dir_name in sorted(os.listdir(experiment_folder)):
     file_or_dir_path = os.path.join(experiment_folder, f"{file_or_dir_name}")
     if 'obs' in file_or_dir_name and os.path.isdir(file_or_dir_path):
       obs_folder_paths.append(file_or_dir_path)
+    if 'terminal-episode' in file_or_dir_name and '.pkl' in file_or_dir_name:
+      episode = file_or_dir_name[len('terminal-episode'):].split('.')[0]
+      terminal_pkl_paths[episode] = file_or_dir_path
     if 'obs-list-episode' in file_or_dir_name and '.pkl' in file_or_dir_name:
-      obs_list_pkl_paths.append(file_or_dir_path)
+      episode = file_or_dir_name[len('obs-list-episode'):].split('.')[0]
+      obs_list_pkl_paths[episode] = file_or_dir_path
 
-  # load saved obs
+  records = []
   if len(obs_list_pkl_paths) > 0:
-    print(f"Start reading obs list")
-    for obs_list_pkl_path in obs_list_pkl_paths:
-      f = open(obs_list_pkl_path, 'rb')
-      obs_list = pickle.load(f)
-      obs_lists.append(obs_list)
-      print(f"Successfully read obs list from [{obs_list_pkl_path}]", '\n' + "--" * 25)
-  elif len(obs_list_pkl_paths) == 0 and len(obs_folder_paths) > 0:
-    print(f"Start reading obs list from obs folder")
+    for episode, obs_list_pkl_path in obs_list_pkl_paths.items():
+      if episode in terminal_pkl_paths:  # saved by DataRecorder together with the obs list
+        with open(terminal_pkl_paths[episode], 'rb') as f:
+          records.append(pickle.load(f))
+      else:  # logs saved before terminal records exist
+        with open(obs_list_pkl_path, 'rb') as f:
+          obs_list = pickle.load(f)
+        if len(obs_list) > 0:
+          records.append(get_terminal_record(obs_list[-1]))
+  elif len(obs_folder_paths) > 0:
     for obs_folder_path in obs_folder_paths:
-      for obs_pkl_name in os.listdir(obs_folder_path):
-        obs_pkl_path = os.path.join(obs_folder_path, obs_pkl_name)
-        with open(obs_pkl_path, 'rb') as f:
-          obs = pickle.load(f)
-        obs_list.append(obs)
-      print(f"Successfully read obs list from obs folder [{obs_folder_path}]", '\n' + "--" * 25)
-      obs_lists.append(obs_list)
-      obs_list = []
-  else:
+      obs_pkl_names = [name for name in os.listdir(obs_folder_path) if _get_step_num(name) >= 0]
+      if len(obs_pkl_names) == 0:
+        continue
+      with open(os.path.join(obs_folder_path, max(obs_pkl_names, key=_get_step_num)), 'rb') as f:
+        records.append(get_terminal_record(pickle.load(f)))
+  return records
+
+
+# analyse one experiment folder
+def analyse(experiment_folder, delete_unfinished):
+  win, tie, lose = 0, 0, 0
+  score_cumulative = None
+  score_by_category = None
+  score_by_vital = None
+
+  records = read_terminal_records(experiment_folder)
+  if len(records) == 0:
     print(f"\033[1;31m No saved obs found! \033[0m", '\n' + "--" * 25)
 
   # analyse
-  for obs_list in obs_lists:
-    raw_units_list = []
-
-    if len(obs_list) > 0 and obs_list[-1].step_type != environment.StepType.LAST:  # unfinished experiment
+  for record in records:
+    if record['step_type'] != environment.StepType.LAST:  # unfinished experiment
       print("Possible unfinished experiment")
       if delete_unfinished:
         shutil.rmtree(experiment_folder)
+        break
       continue
 
-    for obs in obs_list:
-      raw_units = obs.observation.raw_units
-      raw_units_list.append(raw_units)
-      if obs.step_type == environment.StepType.LAST:
-        if obs.reward == 1 and obs.discount == 0:
-          win += 1
-        if obs.reward == 0 and obs.discount == 0:
-          tie += 1
-        if obs.reward == -1 and obs.discount == 0:
-          lose += 1
-        score_c = obs.observation.score_cumulative
-        score_bc = obs.observation.score_by_category
-        score_bv = obs.observation.score_by_vital
-        score_cumulative = score_c if score_cumulative is None else score_cumulative + score_c
-        score_by_category = score_bc if score_by_category is None else score_by_category + score_bc
-        score_by_vital = score_bv if score_by_vital is None else score_by_vital + score_bv
+    if record['reward'] == 1 and record['discount'] == 0:
+      win += 1
+    if record['reward'] == 0 and record['discount'] == 0:
+      tie += 1
+    if record['reward'] == -1 and record['discount'] == 0:
+      lose += 1
+    score_c = record['score_cumulative']
+    score_bc = record['score_by_category']
+    score_bv = record['score_by_vital']
+    score_cumulative = score_c if score_cumulative is None else score_cumulative + score_c
+    score_by_category = score_bc if score_by_category is None else score_by_category + score_bc
+    score_by_vital = score_bv if score_by_vital is None else score_by_vital + score_bv
 
   return score_cumulative, score_by_category, score_by_vital, win, tie, lose
 
 
+def _get_folder_signature(experiment_folder):
+  signature = []
+  for file_or_dir_name in sorted(os.listdir(experiment_folder)):
+    stat = os.stat(os.path.join(experiment_folder, file_or_dir_name))
+    signature.append([file_or_dir_name, stat.st_mtime_ns, stat.st_size])
+  return signature
+
+
+def _analyse_to_summary(experiment_folder, delete_unfinished):
+  signature = _get_folder_signature(experiment_folder)
+  score_cumulative, score_by_category, score_by_vital, win, tie, lose = analyse(experiment_folder, delete_unfinished)
+  if not os.path.exists(experiment_folder):  # deleted as unfinished experiment
+    return None
+  return {
+    'signature': signature,
+    'win': win,
+    'tie': tie,
+    'lose': lose,
+    'score_cumulative': None if score_cumulative is None else np.asarray(score_cumulative).tolist(),
+    'score_by_category': None if score_by_category is None else np.asarray(score_by_category).tolist(),
+    'score_by_vital': None if score_by_vital is None else np.asarray(score_by_vital).tolist(),
+  }
+
+
+def _get_score_from_summary(summary, key):
+  if summary[key] is None:
+    return None
+  return named_array.NamedNumpyArray(np.array(summary[key], dtype=np.int64), _SCORE_NAMES[key])
+
+
+# analyse experiment folders in parallel, results of unchanged folders are read from the summary file
+def analyse_folders(log_dir, folder_names, delete_unfinished=False, num_workers=None):
+  summary_path = os.path.join(log_dir, SUMMARY_FILE_NAME)
+  summaries = {}
+  if os.path.exists(summary_path):
+    try:
+      with open(summary_path, 'r') as f:
+        summaries = json.load(f)
+    except (OSError, ValueError):
+      print(f"\033[1;31m Can not read summary file {summary_path}, re-analyse all folders \033[0m")
+      summaries = {}
+
+  folders_to_analyse = []
+  for folder_name in folder_names:
+    experiment_folder = os.path.join(log_dir, folder_name)
+    if folder_name in summaries and summaries[folder_name]['signature'] == _get_folder_signature(experiment_folder):
+      continue
+    folders_to_analyse.append(folder_name)
+
+  if len(folders_to_analyse) > 0:
+    print(f"Analysing {len(folders_to_analyse)} experiment folders, {len(folder_names) - len(folders_to_analyse)} cached")
+    experiment_folders = [os.path.join(log_dir, folder_name) for folder_name in folders_to_analyse]
+    if num_workers == 1 or len(folders_to_analyse) == 1:
+      results = [_analyse_to_summary(folder, delete_unfinished) for folder in experiment_folders]
+    else:
+      with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        results = list(executor.map(_analyse_to_summary, experiment_folders,
+                                    [delete_unfinished] * len(experiment_folders)))
+    for folder_name, summary in zip(folders_to_analyse, results):
+      if summary is None:
+        summaries.pop(folder_name, None)
+      else:
+        summaries[folder_name] = summary
+    with open(summary_path, 'w') as f:
+      json.dump(summaries, f)
+
+  results = {}
+  for folder_name in folder_names:
+    if folder_name in summaries:
+      summary = summaries[folder_name]
+      results[folder_name] = (_get_score_from_summary(summary, 'score_cumulative'),
+                              _get_score_from_summary(summary, 'score_by_category'),
+                              _get_score_from_summary(summary, 'score_by_vital'),
+                              summary['win'], summary['tie'], summary['lose'])
+  return results
+
+
 # analyse all experiment folder in llm_log
-def analyse_all(start_time: int, end_time=0, delete_unfinished=False):
+def analyse_all(start_time: int, end_time=0, delete_unfinished=False, log_dir=None, num_workers=None):
   num_experiments = 0
   total_score_cumulative, total_score_by_category, total_score_by_vital = None, None, None
   total_damage_dealt, total_damage_taken, total_healed = 0, 0, 0
@@ -98,12 +198,18 @@ def analyse_all(start_time: int, end_time=0, delete_unfinished=False):
   total_lost_minerals, total_lost_vespene = 0, 0
   total_win, total_tie, total_lose = 0, 0, 0
 
-  log_folder_names = os.listdir(os.path.dirname(os.path.abspath(__file__)))
-  for folder_name in log_folder_names:
+  if log_dir is None:
+    log_dir = os.path.dirname(os.path.abspath(__file__))
+  folder_names = []
+  for folder_name in sorted(os.listdir(log_dir)):
+    if '-' in folder_name and os.path.isdir(os.path.join(log_dir, folder_name)) and \
+        start_time <= int(folder_name.split('-')[0]) <= max(end_time, start_time + 1):
+      folder_names.append(folder_name)
+  folder_results = analyse_folders(log_dir, folder_names, delete_unfinished, num_workers)
 
-    if '-' in folder_name and start_time <= int(folder_name.split('-')[0]) <= max(end_time, start_time + 1):
-      experiment_folder = f'./{folder_name}'
-      score_cumulative, score_by_category, score_by_vital, win, tie, lose = analyse(experiment_folder, delete_unfinished)
+  for folder_name in folder_names:
+    if folder_name in folder_results:
+      score_cumulative, score_by_category, score_by_vital, win, tie, lose = folder_results[folder_name]
 
       if total_score_cumulative is None:
         total_score_cumulative = score_cumulative
@@ -164,9 +270,10 @@ def analyse_all(start_time: int, end_time=0, delete_unfinished=False):
     return None
 
 
-start_time = 20240000000000
-end_time   = 20250000000000
-result = analyse_all(start_time, end_time)
+if __name__ == '__main__':
+  start_time = 20240000000000
+  end_time   = 20250000000000
+  result = analyse_all(start_time, end_time)
 
-from pprint import pprint
-pprint(result)
\ No newline at end of file
+  from pprint import pprint
+  pprint(result)
\ No newline at end of file
@@ -0,0 +1,99 @@
+# Copyright 2024, LLM-PySC2 Contributors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Born/died unit detection between consecutive observations.
+
+The engine keeps the sorted tag array of the previous frame and diffs it against
+the current one with sorted numpy set operations, instead of testing every tag
+against a python list. Every update is published to the subscribers as a
+`UnitDiffEvent`, so the data recorder and the agents share one diff per step.
+"""
+
+import collections
+
+import numpy as np
+
+from pysc2.lib import features
+
+
+_TAG = features.FeatureUnit.tag
+_ALLIANCE = features.FeatureUnit.alliance
+_BUILD_PROGRESS = features.FeatureUnit.build_progress
+
+_EMPTY_TAGS = np.zeros((0,), dtype=np.int64)
+
+
+class UnitDiffEvent(collections.namedtuple(
+    "UnitDiffEvent", ["game_loop", "tags", "born", "died"])):
+  """Tags (sorted int64 arrays) of the current frame, and those born/died since the last one."""
+  __slots__ = ()
+
+  @property
+  def changed(self):
+    return len(self.born) > 0 or len(self.died) > 0
+
+
+def get_raw_unit_tags(obs, alliance=None, completed_only=False) -> np.ndarray:
+  """Return the sorted unique tags of `obs.observation.raw_units`."""
+  raw_units = np.asarray(obs.observation.raw_units)
+  if raw_units.size == 0:
+    return _EMPTY_TAGS
+  mask = None
+  if alliance is not None:
+    mask = raw_units[:, _ALLIANCE] == alliance
+  if completed_only:
+    completed = raw_units[:, _BUILD_PROGRESS] == 100
+    mask = completed if mask is None else (mask & completed)
+  tags = raw_units[:, _TAG] if mask is None else raw_units[mask, _TAG]
+  return np.unique(tags.astype(np.int64, copy=False))
+
+
+class UnitDiff:
+  def __init__(self, alliance=None, completed_only=False):
+    """
+    Args:
+      alliance:
+        features.PlayerRelative value, only track units of this alliance (None for all units)
+      completed_only:
+        only track units with build_progress == 100
+    """
+    self.alliance = alliance
+    self.completed_only = completed_only
+    self.tags = _EMPTY_TAGS
+    self.last_event = None
+    self._subscribers = []
+
+  def subscribe(self, callback):
+    """Register `callback(event)`, called on every update."""
+    if callback not in self._subscribers:
+      self._subscribers.append(callback)
+    return callback
+
+  def unsubscribe(self, callback):
+    if callback in self._subscribers:
+      self._subscribers.remove(callback)
+
+  def reset(self):
+    self.tags = _EMPTY_TAGS
+    self.last_event = None
+
+  def update(self, obs) -> UnitDiffEvent:
+    tags = get_raw_unit_tags(obs, self.alliance, self.completed_only)
+    born = np.setdiff1d(tags, self.tags, assume_unique=True)
+    died = np.setdiff1d(self.tags, tags, assume_unique=True)
+    self.tags = tags
+    self.last_event = UnitDiffEvent(int(obs.observation.game_loop[0]), tags, born, died)
+    for callback in list(self._subscribers):
+      callback(self.last_event)
+    return self.last_event
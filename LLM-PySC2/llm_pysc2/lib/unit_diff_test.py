@@ -0,0 +1,163 @@
+# Copyright 2024, LLM-PySC2 Contributors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for llm_pysc2.lib.unit_diff."""
+
+import types
+
+from absl.testing import absltest
+import numpy as np
+
+from llm_pysc2.agents import llm_pysc2_agent_main
+from llm_pysc2.lib import unit_diff
+from pysc2.lib import features
+
+_SELF = features.PlayerRelative.SELF
+_ENEMY = features.PlayerRelative.ENEMY
+
+
+def _obs(game_loop, units):
+  """A timestep-like object whose raw_units are (tag, alliance, build_progress)."""
+  raw_units = np.zeros((len(units), len(features.FeatureUnit)), dtype=np.int64)
+  for i, (tag, alliance, build_progress) in enumerate(units):
+    raw_units[i, features.FeatureUnit.tag] = tag
+    raw_units[i, features.FeatureUnit.alliance] = alliance
+    raw_units[i, features.FeatureUnit.build_progress] = build_progress
+  observation = types.SimpleNamespace(
+      game_loop=np.array([game_loop], dtype=np.int32), raw_units=raw_units)
+  return types.SimpleNamespace(observation=observation)
+
+
+class UnitDiffTest(absltest.TestCase):
+
+  def test_added_units(self):
+    diff = unit_diff.UnitDiff()
+    event = diff.update(_obs(0, [(3, _SELF, 100), (1, _ENEMY, 100)]))
+    self.assertEqual(event.game_loop, 0)
+    self.assertEqual(event.born.tolist(), [1, 3])
+    self.assertEqual(event.died.tolist(), [])
+    self.assertTrue(event.changed)
+
+    event = diff.update(_obs(8, [(3, _SELF, 100), (1, _ENEMY, 100),
+                                 (2, _SELF, 100)]))
+    self.assertEqual(event.tags.tolist(), [1, 2, 3])
+    self.assertEqual(event.born.tolist(), [2])
+    self.assertEqual(event.died.tolist(), [])
+
+  def test_removed_units(self):
+    diff = unit_diff.UnitDiff()
+    diff.update(_obs(0, [(1, _SELF, 100), (2, _SELF, 100), (3, _ENEMY, 100)]))
+    event = diff.update(_obs(8, [(2, _SELF, 100)]))
+    self.assertEqual(event.tags.tolist(), [2])
+    self.assertEqual(event.born.tolist(), [])
+    self.assertEqual(event.died.tolist(), [1, 3])
+
+  def test_unchanged_units(self):
+    diff = unit_diff.UnitDiff()
+    diff.update(_obs(0, [(1, _SELF, 100), (2, _SELF, 100)]))
+    # order and duplicates of raw_units don't matter
+    event = diff.update(_obs(8, [(2, _SELF, 100), (1, _SELF, 100),
+                                 (2, _SELF, 100)]))
+    self.assertFalse(event.changed)
+    self.assertEqual(event.tags.tolist(), [1, 2])
+
+  def test_changed_units(self):
+    diff = unit_diff.UnitDiff(alliance=_SELF, completed_only=True)
+    event = diff.update(_obs(0, [(1, _SELF, 100), (2, _SELF, 50),
+                                 (3, _ENEMY, 100)]))
+    self.assertEqual(event.born.tolist(), [1])
+
+    # 2 is completed and 1 is taken over by the enemy
+    event = diff.update(_obs(8, [(1, _ENEMY, 100), (2, _SELF, 100),
+                                 (3, _ENEMY, 100)]))
+    self.assertEqual(event.tags.tolist(), [2])
+    self.assertEqual(event.born.tolist(), [2])
+    self.assertEqual(event.died.tolist(), [1])
+
+  def test_empty_and_reset(self):
+    diff = unit_diff.UnitDiff()
+    diff.update(_obs(0, [(1, _SELF, 100)]))
+    event = diff.update(_obs(8, []))
+    self.assertEqual(event.tags.tolist(), [])
+    self.assertEqual(event.died.tolist(), [1])
+
+    diff.update(_obs(16, [(1, _SELF, 100)]))
+    diff.reset()
+    self.assertIsNone(diff.last_event)
+    event = diff.update(_obs(0, [(1, _SELF, 100)]))
+    self.assertEqual(event.born.tolist(), [1])
+
+  def test_subscribers(self):
+    diff = unit_diff.UnitDiff()
+    events = []
+    callback = diff.subscribe(events.append)
+    diff.subscribe(events.append)  # subscribed once
+    first = diff.update(_obs(0, [(1, _SELF, 100)]))
+    self.assertEqual(events, [first])
+    self.assertIs(diff.last_event, first)
+
+    diff.unsubscribe(callback)
+    diff.update(_obs(8, []))
+    self.assertLen(events, 1)
+
+
+class MainAgentUnitUidTest(absltest.TestCase):
+  """The unit_uid lists that main_agent_func1 reads, see MainAgent.step()."""
+
+  def setUp(self):
+    super().setUp()
+    agent = llm_pysc2_agent_main.MainAgent.__new__(
+        llm_pysc2_agent_main.MainAgent)
+    agent.unit_uid = []
+    agent.unit_uid_appear = []
+    agent.unit_uid_disappear = []
+    agent.unit_diff = unit_diff.UnitDiff()
+    agent.self_unit_diff = unit_diff.UnitDiff(
+        alliance=_SELF, completed_only=True)
+    agent.self_unit_diff.subscribe(agent._on_self_unit_diff)
+    self.agent = agent
+
+  def _step(self, obs):
+    self.agent.unit_diff.update(obs)
+    self.agent.self_unit_diff.update(obs)
+
+  def test_unit_uid_mapping(self):
+    agent = self.agent
+    self._step(_obs(0, [(5, _SELF, 100), (4, _SELF, 100), (9, _ENEMY, 100),
+                        (7, _SELF, 30)]))
+    self.assertEqual(agent.unit_uid, [4, 5])
+    self.assertEqual(agent.unit_uid_appear, [4, 5])
+    self.assertEqual(agent.unit_uid_disappear, [])
+
+    # grouped by main_agent_func1
+    agent.unit_uid_appear.clear()
+
+    # 7 is completed, 4 is killed and 5 is taken over by the enemy
+    self._step(_obs(8, [(5, _ENEMY, 100), (9, _ENEMY, 100), (7, _SELF, 100)]))
+    self.assertEqual(agent.unit_uid, [7])
+    self.assertEqual(agent.unit_uid_appear, [7])
+    # only units still in raw_units disappear, dead ones are not listed
+    self.assertEqual(agent.unit_uid_disappear, [5])
+
+  def test_pending_appear_is_not_duplicated(self):
+    agent = self.agent
+    self._step(_obs(0, [(1, _SELF, 100)]))
+    self._step(_obs(8, [(1, _SELF, 50)]))
+    self._step(_obs(16, [(1, _SELF, 100)]))
+    self.assertEqual(agent.unit_uid, [1])
+    self.assertEqual(agent.unit_uid_appear, [1])
+    self.assertEqual(agent.unit_uid_disappear, [1])
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -22,6 +22,7 @@ from absl import flags
 
 from pysc2 import maps
 from pysc2.env import available_actions_printer
+from pysc2.env import mock_sc2_env
 from pysc2.env import run_loop
 from pysc2.env import sc2_env
 from pysc2.lib import point_flag
@@ -78,16 +79,30 @@ flags.DEFINE_integer("parallel", 1, "How many instances to run in parallel.")
 
 flags.DEFINE_bool("save_replay", True, "Whether to save a replay at the end.")
 
+flags.DEFINE_string("mock_env", None,
+                    "Run without the game: 'synthetic' for generated "
+                    "observations, or the path of TimeSteps recorded by "
+                    "llm_pysc2's DataRecorder to replay them.")
+flags.DEFINE_integer("mock_env_units", 64,
+                     "Units per player of the synthetic observations.")
+flags.DEFINE_integer("mock_env_seed", 0, "Seed of the synthetic observations.")
+
 flags.DEFINE_string("map", None, "Name of a map to use.")
 flags.DEFINE_bool("battle_net_map", False, "Use the battle.net map version.")
 flags.mark_flag_as_required("map")
 
 
+def make_env(**kwargs):
+  """Creates an SC2Env, or an SC2SyntheticEnv if --mock_env is set."""
+  return mock_sc2_env.make_env(
+      FLAGS.mock_env, FLAGS.mock_env_units, FLAGS.mock_env_seed,
+      sc2_env_kwargs=dict(battle_net_map=FLAGS.battle_net_map), **kwargs)
+
+
 def run_thread(agent_classes, players, map_name, visualize):
   """Run one thread worth of the environment with agents."""
-  with sc2_env.SC2Env(
+  with make_env(
       map_name=map_name,
-      battle_net_map=FLAGS.battle_net_map,
       players=players,
       agent_interface_format=sc2_env.parse_agent_interface_format(
           feature_screen=FLAGS.feature_screen_size,
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark iterating over the units of an observation."""
+
+import time
+
+from absl import app
+from absl import flags
+import numpy as np
+
+from pysc2.lib import features
+from pysc2.lib import named_array
+
+
+flags.DEFINE_integer("count", 100, "How many times to iterate over the units.")
+flags.DEFINE_integer("units", 300, "How many units in the observation.")
+FLAGS = flags.FLAGS
+
+
+def read_units(units):
+  """What an agent typically reads of each unit."""
+  total = 0
+  for u in units:
+    if u.alliance == features.PlayerRelative.SELF:
+      total += u.x + u.y + u.health + u.unit_type
+    if u.tag == 0:
+      total += 1
+  return total
+
+
+def main(unused_argv):
+  rng = np.random.RandomState(0)
+  raw_units = named_array.NamedNumpyArray(
+      rng.randint(0, 200, size=(FLAGS.units, len(features.FeatureUnit))),
+      [None, features.FeatureUnit], dtype=np.int64)
+  raw_units[:, features.FeatureUnit.alliance] = rng.randint(
+      1, 5, size=FLAGS.units)
+
+  configs = [
+      ("NamedNumpyArray", lambda: raw_units),
+      ("NamedRows", lambda: named_array.NamedRows(raw_units)),
+  ]
+  results = []
+  for name, get_units in configs:
+    start = time.time()
+    for _ in range(FLAGS.count):
+      total = read_units(get_units())
+    results.append((name, total, (time.time() - start) / FLAGS.count))
+
+  print("Units:", FLAGS.units)
+  for name, total, elapsed in results:
+    print("{:<16} {:8.3f} ms per iteration (sum {})".format(
+        name, elapsed * 1000, total))
+
+
+if __name__ == "__main__":
+  app.run(main)
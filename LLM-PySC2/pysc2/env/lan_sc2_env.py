@@ -274,6 +274,10 @@ class LanSC2Env(sc2_env.SC2Env):
     self._discount = discount
     self._step_mul = step_mul or 8
     self._realtime = realtime
+    self._pipelined_observations = False
+    self._prefetch_executor = None
+    self._prefetch = None
+    self._prefetched = None
     self._last_step_time = None
     self._save_replay_episodes = 1 if replay_dir else 0
     self._replay_dir = replay_dir
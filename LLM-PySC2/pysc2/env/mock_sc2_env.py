@@ -13,6 +13,11 @@
 # limitations under the License.
 """Mocking the Starcraft II environment."""
 
+import math
+import os
+import pickle
+import re
+
 import numpy as np
 from pysc2.env import environment
 from pysc2.env import sc2_env
@@ -26,6 +31,23 @@ from s2clientprotocol import sc2api_pb2
 
 DUMMY_MAP_SIZE = 256
 
+# The unit types of the synthetic populations, by race. The first ones are the
+# most frequent.
+_SYNTHETIC_UNIT_TYPES = {
+    sc2_env.Race.protoss: (
+        units.Protoss.Probe, units.Protoss.Zealot, units.Protoss.Stalker,
+        units.Protoss.Pylon, units.Protoss.Gateway, units.Protoss.Nexus),
+    sc2_env.Race.terran: (
+        units.Terran.SCV, units.Terran.Marine, units.Terran.Marauder,
+        units.Terran.SupplyDepot, units.Terran.Barracks,
+        units.Terran.CommandCenter),
+    sc2_env.Race.zerg: (
+        units.Zerg.Drone, units.Zerg.Zergling, units.Zerg.Roach,
+        units.Zerg.Overlord, units.Zerg.SpawningPool, units.Zerg.Hatchery),
+}
+_SYNTHETIC_NEUTRAL_TYPES = (
+    units.Neutral.MineralField, units.Neutral.VespeneGeyser)
+
 
 class _TestEnvironment(environment.Base):
   """A simple generic test environment.
@@ -349,3 +371,347 @@ def _make_dummy_game_info(players, interface_formats):
 
   return game_infos
 
+
+def load_recorded_timesteps(path):
+  """Loads `TimeStep`s pickled by `llm_pysc2.lib.data_recorder.DataRecorder`.
+
+  Args:
+    path: An `obs-list-episode*.pkl` file (a list of `TimeStep`s), the pickle
+      of a single `TimeStep`, or a directory of `step*.pkl` files which are
+      ordered by their step number.
+
+  Returns:
+    A list of `TimeStep`s.
+  """
+  if os.path.isdir(path):
+    def step_number(name):
+      match = re.search(r"(\d+)", name)
+      return int(match.group(1)) if match else -1
+    names = sorted((n for n in os.listdir(path) if n.endswith(".pkl")),
+                   key=step_number)
+    return [load_recorded_timesteps(os.path.join(path, n))[0] for n in names]
+
+  with open(path, "rb") as f:
+    data = pickle.load(f)
+  if isinstance(data, environment.TimeStep):
+    return [data]
+  return list(data)
+
+
+def make_env(mock_env=None, mock_env_units=64, mock_env_seed=0,
+             sc2_env_kwargs=None, **kwargs):
+  """Creates an `SC2Env`, or an `SC2SyntheticEnv` which runs without the game.
+
+  This is what the `--mock_env` flags of the binaries select.
+
+  Args:
+    mock_env: None for an `SC2Env`, "synthetic" for generated observations,
+      or the path of recorded `TimeStep`s to replay (see
+      `load_recorded_timesteps`).
+    mock_env_units: The size of the generated population of each agent.
+    mock_env_seed: The seed of the generated populations.
+    sc2_env_kwargs: The arguments only given to an `SC2Env`, e.g.
+      `battle_net_map` or `pipelined_observations`.
+    **kwargs: The arguments of both environments.
+
+  Returns:
+    The environment.
+  """
+  if not mock_env:
+    return sc2_env.SC2Env(**dict(kwargs, **(sc2_env_kwargs or {})))
+  timesteps = None
+  if mock_env != "synthetic":
+    timesteps = load_recorded_timesteps(mock_env)
+  return SC2SyntheticEnv(
+      timesteps=timesteps,
+      num_units=mock_env_units,
+      seed=mock_env_seed,
+      **kwargs)
+
+
+class _SyntheticPopulation(object):
+  """A seeded random population of units, updated once per step."""
+
+  def __init__(self, rng, num_units, self_race, enemy_race, map_size):
+    self._rng = rng
+    self._num_units = num_units
+    self._map_size = map_size
+    self._types = {
+        features.PlayerRelative.SELF: _SYNTHETIC_UNIT_TYPES[self_race],
+        features.PlayerRelative.ENEMY: _SYNTHETIC_UNIT_TYPES[enemy_race],
+        features.PlayerRelative.NEUTRAL: _SYNTHETIC_NEUTRAL_TYPES,
+    }
+    self._next_tag = 1
+    self.units = []
+    for _ in range(num_units):
+      self._add_unit()
+
+  def _add_unit(self, alliance=None):
+    rng = self._rng
+    if alliance is None:
+      alliances = (features.PlayerRelative.SELF, features.PlayerRelative.ENEMY,
+                   features.PlayerRelative.NEUTRAL)
+      alliance = alliances[rng.choice(len(alliances), p=[0.5, 0.35, 0.15])]
+    types = self._types[alliance]
+    # Geometric weights, so the workers and the basic units are the most common.
+    weights = 0.5 ** np.arange(len(types))
+    unit_type = types[rng.choice(len(types), p=weights / weights.sum())]
+    health_max = float(rng.choice([40, 80, 100, 200, 500, 1000]))
+    owner = {features.PlayerRelative.SELF: 1,
+             features.PlayerRelative.ENEMY: 2}.get(alliance, 16)
+    self.units.append(dict(
+        tag=self._next_tag,
+        unit_type=int(unit_type),
+        alliance=int(alliance),
+        owner=owner,
+        x=float(rng.uniform(1, self._map_size - 1)),
+        y=float(rng.uniform(1, self._map_size - 1)),
+        radius=float(rng.choice([0.375, 0.5, 1.0, 2.5])),
+        health=health_max,
+        health_max=health_max,
+        shield=float(health_max / 2),
+        shield_max=float(health_max / 2),
+        build_progress=1.0 if rng.rand() < 0.9 else float(rng.rand()),
+        facing=float(rng.uniform(0, 2 * math.pi)),
+        mineral_contents=(
+            1800 if unit_type == units.Neutral.MineralField else 0),
+        vespene_contents=(
+            2250 if unit_type == units.Neutral.VespeneGeyser else 0)))
+    self._next_tag += 1
+
+  def step(self, step_mul):
+    """Moves the units, damages some of them, and replaces the dead ones."""
+    rng = self._rng
+    for unit in self.units:
+      if unit["alliance"] != features.PlayerRelative.NEUTRAL:
+        unit["x"] = float(np.clip(unit["x"] + rng.normal(0, 0.1 * step_mul),
+                                  1, self._map_size - 1))
+        unit["y"] = float(np.clip(unit["y"] + rng.normal(0, 0.1 * step_mul),
+                                  1, self._map_size - 1))
+      if unit["build_progress"] < 1:
+        unit["build_progress"] = min(1.0, unit["build_progress"] + 0.05)
+      if rng.rand() < 0.02:
+        unit["health"] = max(0.0, unit["health"] - unit["health_max"] / 4)
+
+    dead = [u for u in self.units if u["health"] <= 0]
+    self.units = [u for u in self.units if u["health"] > 0]
+    for unit in dead:
+      self._add_unit(alliance=unit["alliance"])
+    if len(self.units) < self._num_units:
+      self._add_unit()
+
+  def fill(self, raw_data):
+    for unit in self.units:
+      raw_data.units.add(
+          tag=unit["tag"],
+          unit_type=unit["unit_type"],
+          alliance=unit["alliance"],
+          owner=unit["owner"],
+          pos=common_pb2.Point(x=unit["x"], y=unit["y"], z=0),
+          radius=unit["radius"],
+          health=unit["health"],
+          health_max=unit["health_max"],
+          shield=unit["shield"],
+          shield_max=unit["shield_max"],
+          build_progress=unit["build_progress"],
+          facing=unit["facing"],
+          mineral_contents=unit["mineral_contents"],
+          vespene_contents=unit["vespene_contents"],
+          display_type=raw_pb2.Visible,
+          is_on_screen=True,
+          is_powered=True)
+
+
+class SC2SyntheticEnv(SC2TestEnv):
+  """An `SC2TestEnv` whose observations change on every step.
+
+  The observations either replay recorded `TimeStep`s (e.g. those pickled by
+  llm_pysc2's `DataRecorder`, see `load_recorded_timesteps`), or are built
+  from a seeded random population of units which move, take damage, die and
+  are replaced, while the game loop, the resources and the score advance. The
+  synthetic observations go through `features.transform_obs`, so the raw and
+  feature unit paths are exercised as with a real game.
+
+  The same `seed` gives the same stream of observations, so the environment
+  can be used to benchmark agents and learners without a StarCraft II binary.
+  The actions are ignored.
+  """
+
+  def __init__(self,
+               *,
+               timesteps=None,
+               num_units=64,
+               seed=0,
+               episode_length=None,
+               cache_episodes=0,
+               **kwargs):
+    """Initializes an SC2SyntheticEnv.
+
+    Args:
+      timesteps: The recorded `TimeStep`s to replay, one episode. Either a
+        sequence of `TimeStep`s (one agent) or a sequence of sequences of
+        `TimeStep`s (one per agent). None to generate the observations.
+      num_units: The size of the generated population of each agent.
+      seed: The seed of the generated populations.
+      episode_length: The number of transitions of an episode. Defaults to
+        the length of `timesteps`, else to `game_steps_per_episode /
+        step_mul`, else to 100.
+      cache_episodes: If > 0, only this many distinct episodes are generated,
+        they are kept in memory and replayed in turn, so that the cost of the
+        environment is nearly zero after the first ones. The cached
+        observations are shared between the repeats.
+      **kwargs: The arguments of `SC2TestEnv`.
+    """
+    self._step_mul = kwargs.get("step_mul") or 1
+    game_steps_per_episode = kwargs.get("game_steps_per_episode")
+    players = kwargs.get("players") or [sc2_env.Agent(sc2_env.Race.random)]
+    races = [p.race[0] for p in players]
+    self._races = [r if r in _SYNTHETIC_UNIT_TYPES else sc2_env.Race.protoss
+                   for r in races]
+
+    self._timesteps = None
+    if timesteps is not None:
+      self._timesteps = [
+          list(t) if isinstance(t, (list, tuple)) and
+          not isinstance(t, environment.TimeStep) else [t]
+          for t in timesteps]
+      if len(self._timesteps) < 2:
+        raise ValueError("At least 2 recorded timesteps are needed.")
+
+    self._num_units = num_units
+    self._seed = seed
+    self._cache_episodes = cache_episodes
+    self._cache = {}
+    self._episode = 0
+    self._episode_key = 0
+    self._game_loop = 0
+    self._populations = None
+
+    super(SC2SyntheticEnv, self).__init__(**kwargs)
+
+    if episode_length is None:
+      if self._timesteps is not None:
+        episode_length = len(self._timesteps) - 1
+      elif game_steps_per_episode:
+        episode_length = int(math.ceil(
+            game_steps_per_episode / self._step_mul))
+      else:
+        episode_length = 100
+    self.episode_length = episode_length
+
+  def _new_populations(self):
+    self._populations = []
+    for agent_index in range(self._num_agents):
+      if len(self._races) > 1 and agent_index < 2:
+        enemy_race = self._races[1 - agent_index]
+      else:
+        enemy_race = sc2_env.Race.terran
+      rng = np.random.RandomState(
+          (self._seed, self._episode_key, agent_index))
+      self._populations.append(_SyntheticPopulation(
+          rng, self._num_units, self._races[agent_index], enemy_race,
+          DUMMY_MAP_SIZE))
+
+  def _synthetic_observation(self, agent_index):
+    population = self._populations[agent_index]
+    obs_spec = self._observation_spec[agent_index]
+    episode_step = self._episode_steps
+    builder = (dummy_observation.Builder(obs_spec)
+               .game_loop(self._game_loop)
+               .player_common(
+                   minerals=50 + 10 * episode_step,
+                   vespene=5 * episode_step,
+                   food_used=min(200, 12 + episode_step // 8),
+                   food_cap=min(200, 15 + episode_step // 4),
+                   army_count=sum(
+                       1 for u in population.units
+                       if u["alliance"] == features.PlayerRelative.SELF))
+               .score(10 * episode_step)
+               .score_details(
+                   collected_minerals=40 * episode_step,
+                   collected_vespene=10 * episode_step,
+                   spent_minerals=30 * episode_step,
+                   spent_vespene=5 * episode_step,
+                   killed_value_units=5 * episode_step))
+    response_observation = builder.build()
+    population.fill(response_observation.observation.raw_data)
+
+    aif = self._agent_interface_formats[agent_index]
+    if not isinstance(aif, sc2_env.AgentInterfaceFormat):
+      return response_observation
+    observation = self._features[agent_index].transform_obs(
+        response_observation)
+    if hasattr(observation, "feature_minimap"):
+      minimap_camera = observation.feature_minimap.camera
+      minimap_camera.fill(0)
+      height, width = [dim // 2 for dim in minimap_camera.shape]
+      minimap_camera[:height, :width].fill(1)
+    return observation
+
+  def _synthetic_timesteps(self, step_type, step_mul):
+    cached = self._cache.get(self._episode_key)
+    if cached is not None and self._episode_steps < len(cached):
+      return cached[self._episode_steps]
+
+    if self._populations is None:
+      self._new_populations()
+    if self._episode_steps > 0:
+      step_mul = step_mul or self._step_mul
+      self._game_loop += step_mul
+      for population in self._populations:
+        population.step(step_mul)
+
+    reward = 0.
+    if step_type is environment.StepType.LAST:
+      rng = np.random.RandomState((self._seed, self._episode_key))
+      reward = float(rng.choice([-1, 0, 1]))
+    timesteps = [
+        environment.TimeStep(
+            step_type=step_type,
+            reward=reward,
+            discount=1.,
+            observation=self._synthetic_observation(i))
+        for i in range(self._num_agents)]
+
+    if self._cache_episodes:
+      self._cache.setdefault(self._episode_key, []).append(timesteps)
+    return timesteps
+
+  def step(self, actions, step_mul=None):
+    """Returns the next recorded or synthetic `TimeStep`s."""
+    if len(actions) != self._num_agents:
+      raise ValueError(
+          "Expected %d actions, received %d." % (
+              self._num_agents, len(actions)))
+    if self._episode_steps == 0:
+      step_type = environment.StepType.FIRST
+      # A new episode, with new populations (created when first needed).
+      self._episode += 1
+      self._episode_key = self._episode
+      if self._cache_episodes:
+        self._episode_key = (self._episode - 1) % self._cache_episodes
+      self._game_loop = 0
+      self._populations = None
+    elif self._episode_steps >= self.episode_length:
+      step_type = environment.StepType.LAST
+    else:
+      step_type = environment.StepType.MID
+
+    if self._timesteps is not None:
+      recorded = self._timesteps[
+          min(self._episode_steps, len(self._timesteps) - 1)]
+      timesteps = [t._replace(step_type=step_type) for t in recorded]
+    else:
+      timesteps = self._synthetic_timesteps(step_type, step_mul)
+
+    if step_type is environment.StepType.FIRST:
+      timesteps = [t._replace(reward=0., discount=0.) for t in timesteps]
+    elif step_type is environment.StepType.LAST:
+      timesteps = [t._replace(discount=0.) for t in timesteps]
+
+    if step_type is environment.StepType.LAST:
+      self._episode_steps = 0
+    else:
+      self._episode_steps += 1
+
+    return timesteps
@@ -14,6 +14,11 @@
 # limitations under the License.
 """Tests of the StarCraft2 mock environment."""
 
+import os
+import pickle
+import shutil
+import tempfile
+
 from absl.testing import absltest
 import mock
 import numpy as np
@@ -202,5 +207,137 @@ class TestSC2TestEnv(_TestMixin, absltest.TestCase):
             ]))
 
 
+
+class TestSC2SyntheticEnv(absltest.TestCase):
+
+  def _make_env(self, **kwargs):
+    return mock_sc2_env.SC2SyntheticEnv(
+        map_name='nonexistant map',
+        agent_interface_format=features.AgentInterfaceFormat(
+            feature_dimensions=features.Dimensions(screen=64, minimap=32),
+            use_raw_units=True,
+            use_feature_units=True),
+        players=[sc2_env.Agent(sc2_env.Race.protoss, 'player'),
+                 sc2_env.Bot(sc2_env.Race.terran, sc2_env.Difficulty.easy)],
+        **kwargs)
+
+  def _run_episode(self, env):
+    timesteps = [env.reset()[0]]
+    while not timesteps[-1].last():
+      timesteps.append(env.step([mock.sentinel.action])[0])
+    return timesteps
+
+  def test_episode(self):
+    env = self._make_env(num_units=20, episode_length=5, step_mul=8)
+    timesteps = self._run_episode(env)
+
+    self.assertLen(timesteps, 6)
+    self.assertTrue(timesteps[0].first())
+    for timestep in timesteps[1:-1]:
+      self.assertTrue(timestep.mid())
+    self.assertEqual(timesteps[-1].discount, 0)
+    self.assertIn(timesteps[-1].reward, (-1, 0, 1))
+    np.testing.assert_array_equal(
+        [t.observation.game_loop[0] for t in timesteps], np.arange(6) * 8)
+
+  def test_episode_length_from_game_steps(self):
+    env = self._make_env(step_mul=8, game_steps_per_episode=80)
+    self.assertEqual(env.episode_length, 10)
+
+  def test_num_units(self):
+    env = self._make_env(num_units=37)
+    raw_units = env.reset()[0].observation.raw_units
+    self.assertLen(raw_units, 37)
+    alliances = set(raw_units[:, features.FeatureUnit.alliance])
+    self.assertIn(features.PlayerRelative.SELF, alliances)
+    self.assertIn(features.PlayerRelative.ENEMY, alliances)
+
+  def test_units_move_and_keep_their_tags(self):
+    env = self._make_env(num_units=30, episode_length=3)
+    first = np.asarray(env.reset()[0].observation.raw_units)
+    second = np.asarray(
+        env.step([mock.sentinel.action])[0].observation.raw_units)
+    common = np.intersect1d(first[:, features.FeatureUnit.tag],
+                            second[:, features.FeatureUnit.tag])
+    self.assertGreater(len(common), 20)
+    self.assertFalse(np.array_equal(first[:, features.FeatureUnit.x],
+                                    second[:, features.FeatureUnit.x]))
+
+  def test_same_seed_same_observations(self):
+    first = self._run_episode(self._make_env(num_units=16, episode_length=4))
+    second = self._run_episode(self._make_env(num_units=16, episode_length=4))
+    other = self._run_episode(
+        self._make_env(num_units=16, episode_length=4, seed=1))
+    for a, b in zip(first, second):
+      np.testing.assert_array_equal(a.observation.raw_units,
+                                    b.observation.raw_units)
+      self.assertEqual(a.reward, b.reward)
+    self.assertFalse(np.array_equal(first[0].observation.raw_units,
+                                    other[0].observation.raw_units))
+
+  def test_cache_episodes(self):
+    env = self._make_env(num_units=16, episode_length=3, cache_episodes=1)
+    first = self._run_episode(env)
+    second = self._run_episode(env)
+    for a, b in zip(first, second):
+      self.assertIs(a.observation, b.observation)
+
+  def test_replay_recorded_timesteps(self):
+    recorded = self._run_episode(self._make_env(num_units=8, episode_length=4))
+    tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmp_dir)
+    list_path = os.path.join(tmp_dir, 'obs-list-episode1.pkl')
+    with open(list_path, 'wb') as f:
+      pickle.dump(recorded, f)
+    step_dir = os.path.join(tmp_dir, 'obs1')
+    os.mkdir(step_dir)
+    for i in reversed(range(len(recorded))):
+      with open(os.path.join(step_dir, 'step%d.pkl' % (i * 10)), 'wb') as f:
+        pickle.dump(recorded[i], f)
+
+    for path in (list_path, step_dir):
+      timesteps = mock_sc2_env.load_recorded_timesteps(path)
+      env = self._make_env(timesteps=timesteps)
+      self.assertEqual(env.episode_length, len(recorded) - 1)
+      for _ in range(2):
+        replayed = self._run_episode(env)
+        self.assertLen(replayed, len(recorded))
+        for a, b in zip(recorded, replayed):
+          self.assertEqual(a.step_type, b.step_type)
+          self.assertEqual(a.reward, b.reward)
+          np.testing.assert_array_equal(a.observation.raw_units,
+                                        b.observation.raw_units)
+
+  def test_make_env(self):
+    kwargs = dict(
+        map_name='nonexistant map',
+        agent_interface_format=features.AgentInterfaceFormat(
+            feature_dimensions=features.Dimensions(screen=64, minimap=32),
+            use_raw_units=True),
+        players=[sc2_env.Agent(sc2_env.Race.protoss, 'player'),
+                 sc2_env.Bot(sc2_env.Race.terran, sc2_env.Difficulty.easy)],
+        step_mul=8)
+
+    env = mock_sc2_env.make_env(
+        'synthetic', 12, 1, sc2_env_kwargs={'battle_net_map': True}, **kwargs)
+    self.assertIsInstance(env, mock_sc2_env.SC2SyntheticEnv)
+    self.assertLen(env.reset()[0].observation.raw_units, 12)
+
+    recorded = self._run_episode(self._make_env(num_units=8, episode_length=2))
+    tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmp_dir)
+    path = os.path.join(tmp_dir, 'obs-list-episode1.pkl')
+    with open(path, 'wb') as f:
+      pickle.dump(recorded, f)
+    env = mock_sc2_env.make_env(path, **kwargs)
+    self.assertEqual(env.episode_length, len(recorded) - 1)
+
+    with mock.patch.object(sc2_env, 'SC2Env') as sc2_env_cls:
+      env = mock_sc2_env.make_env(
+          None, 12, 1, sc2_env_kwargs={'battle_net_map': True}, **kwargs)
+    self.assertIs(env, sc2_env_cls.return_value)
+    sc2_env_cls.assert_called_once_with(battle_net_map=True, **kwargs)
+
+
 if __name__ == '__main__':
   absltest.main()
@@ -0,0 +1,315 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Run evaluation games concurrently on a pool of warm SC2 processes.
+
+Launching SC2 takes much longer than creating a game in a running one, so the
+games reuse the processes of a `ProcessPool`: each `PooledSC2Env` takes one,
+creates its game in it, and gives it back on close. The `EvalScheduler` runs
+the games on `num_workers` threads, one agent and one game at a time each, so
+up to `num_workers` SC2 processes simulate at once, and collects a result per
+game.
+
+Usage:
+    pool = parallel_eval.ProcessPool(run_configs.get())
+    games = [dict(map_name="Simple64", players=[...], random_seed=i, ...)
+             for i in range(16)]
+    scheduler = parallel_eval.EvalScheduler(
+        games, make_agent=lambda worker: MyAgent(), num_workers=4, pool=pool)
+    results = scheduler.run()
+    print(parallel_eval.format_results(results, scheduler.elapsed))
+    pool.close()
+"""
+
+import collections
+import queue
+import threading
+import time
+
+from absl import logging
+from pysc2.env import sc2_env
+from pysc2.lib import protocol
+
+Status = protocol.Status
+
+# The statuses a game can be created from, ie a process which can be reused.
+_REUSABLE = (Status.launched, Status.ended, Status.in_game)
+
+
+class ProcessPool(object):
+  """A thread-safe pool of warm StarcraftProcess instances.
+
+  Processes are launched on demand and kept after their game, so the number of
+  processes is the most games that were ever running at once.
+  """
+
+  def __init__(self, run_config, **start_kwargs):
+    """Create the pool.
+
+    Args:
+      run_config: The RunConfig which starts the processes, and which the
+          games read the maps with.
+      **start_kwargs: Passed to `run_config.start`, eg the version.
+    """
+    self.run_config = run_config
+    self._start_kwargs = start_kwargs
+    self._lock = threading.Lock()
+    self._idle = collections.defaultdict(list)  # By want_rgb.
+    self._procs = []
+    self.launched = 0
+    self.reused = 0
+
+  def acquire(self, want_rgb=False):
+    """Return an idle process, launching one if there is none."""
+    with self._lock:
+      idle = self._idle[want_rgb]
+      if idle:
+        self.reused += 1
+        return idle.pop()
+      self.launched += 1
+    proc = self.run_config.start(want_rgb=want_rgb, **self._start_kwargs)
+    with self._lock:
+      self._procs.append(proc)
+    return proc
+
+  def release(self, proc, want_rgb=False):
+    """Give a process back, or close it if its game can't be replaced."""
+    status = proc.controller.status
+    if status not in _REUSABLE:
+      logging.warning("Closing an SC2 process in status %s.", status)
+      self._discard(proc)
+      return
+    with self._lock:
+      self._idle[want_rgb].append(proc)
+
+  def _discard(self, proc):
+    with self._lock:
+      if proc in self._procs:
+        self._procs.remove(proc)
+    proc.close()
+
+  def __len__(self):
+    with self._lock:
+      return len(self._procs)
+
+  def close(self):
+    with self._lock:
+      procs, self._procs = self._procs, []
+      self._idle.clear()
+    for proc in procs:
+      proc.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_exception_type, unused_exc_value, unused_traceback):
+    self.close()
+
+
+class PooledSC2Env(sc2_env.SC2Env):
+  """An SC2Env which creates its game in a process of a ProcessPool.
+
+  It only supports a single agent (eg against a bot), as the processes of a
+  multiplayer game must be launched with their ports. The version of the pool
+  is the one used, not the `version` argument.
+  """
+
+  def __init__(self, *, process_pool, **kwargs):
+    self._process_pool = process_pool
+    try:
+      super(PooledSC2Env, self).__init__(**kwargs)
+    except:
+      # Eg the game couldn't be created: give the processes back to the pool.
+      self.close()
+      raise
+
+  def _launch_game(self):
+    if self._num_agents != 1:
+      raise ValueError("A PooledSC2Env only supports a single agent.")
+    self._run_config = self._process_pool.run_config
+    self._ports = []
+    self._want_rgb = [interface.HasField("render")
+                      for interface in self._interface_options]
+    self._sc2_procs = [self._process_pool.acquire(want_rgb=want_rgb)
+                       for want_rgb in self._want_rgb]
+    self._controllers = [p.controller for p in self._sc2_procs]
+    self._check_battle_net_maps()
+
+  def close(self):
+    # Give the processes back rather than quitting them.
+    procs, self._sc2_procs = getattr(self, "_sc2_procs", None), None
+    self._controllers = None
+    super(PooledSC2Env, self).close()
+    for proc, want_rgb in zip(procs or [], getattr(self, "_want_rgb", [])):
+      self._process_pool.release(proc, want_rgb=want_rgb)
+
+
+GameResult = collections.namedtuple("GameResult", [
+    "game", "worker", "map_name", "outcome", "score", "game_loop", "steps",
+    "seconds", "error"])
+
+
+def _default_make_env(game, pool):
+  return PooledSC2Env(process_pool=pool, **game)
+
+
+class EvalScheduler(object):
+  """Runs games concurrently, one per worker thread, and collects the results.
+
+  A game is a dict of the keyword arguments of the env, eg the map_name, the
+  players and the random_seed. Each worker makes its agent once with
+  `make_agent(worker)`, a pysc2 agent (`setup`, `reset` and `step`), then
+  plays the games it takes from the queue. The step_mul of each step is the
+  `step_mul` attribute of the agent if it has one, else the one of the env.
+
+  The outcome of a game is the reward of its last step, ie the win/loss on
+  maps without a score, and the score is the first of `score_cumulative`. A
+  game which raises is recorded with the error, and the worker goes on.
+  """
+
+  def __init__(self, games, make_agent, num_workers=1, pool=None,
+               make_env=None, max_steps=None):
+    """Create the scheduler.
+
+    Args:
+      games: A list of dicts of the keyword arguments of the env per game.
+      make_agent: Called with the index of a worker, returns its agent.
+      num_workers: The number of games running at once.
+      pool: The ProcessPool the games run in, for the default make_env.
+      make_env: Called with a game and the pool, returns its env, by default a
+          PooledSC2Env. Eg a mock env in the tests.
+      max_steps: Stop a game after this many agent steps, None for no limit.
+    """
+    if make_env is None and pool is None:
+      raise ValueError("A pool is needed for the default make_env.")
+    self._games = list(games)
+    self._make_agent = make_agent
+    self._num_workers = max(1, min(num_workers, len(self._games)))
+    self._pool = pool
+    self._make_env = make_env or _default_make_env
+    self._max_steps = max_steps
+    self._queue = None
+    self._results = None
+    self._lock = threading.Lock()
+    self.elapsed = 0
+
+  def run(self):
+    """Play all the games, returning their GameResults in the games order."""
+    self._queue = queue.Queue()
+    for i, game in enumerate(self._games):
+      self._queue.put((i, game))
+    self._results = [None] * len(self._games)
+
+    start = time.time()
+    threads = [threading.Thread(target=self._work, args=(w,),
+                                name="eval_worker_%d" % w)
+               for w in range(self._num_workers)]
+    for t in threads:
+      t.daemon = True
+      t.start()
+    for t in threads:
+      t.join()
+    self.elapsed = time.time() - start
+    return list(self._results)
+
+  def _work(self, worker):
+    agent = None
+    while True:
+      try:
+        i, game = self._queue.get_nowait()
+      except queue.Empty:
+        return
+      start = time.time()
+      try:
+        if agent is None:
+          agent = self._make_agent(worker)
+        result = self._play(agent, game)
+        result = result._replace(game=i, worker=worker,
+                                 seconds=time.time() - start)
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception("Game %d failed on worker %d.", i, worker)
+        result = GameResult(
+            game=i, worker=worker, map_name=_map_name(game), outcome=None,
+            score=None, game_loop=None, steps=None,
+            seconds=time.time() - start, error=repr(e))
+      with self._lock:
+        self._results[i] = result
+
+  def _play(self, agent, game):
+    """Play a game, returning its GameResult without the game and worker."""
+    with self._make_env(game, self._pool) as env:
+      agent.setup(env.observation_spec()[0], env.action_spec()[0])
+      timestep = env.reset()[0]
+      agent.reset()
+      steps = 0
+      while not timestep.last():
+        if self._max_steps and steps >= self._max_steps:
+          break
+        action = agent.step(timestep)
+        step_mul = getattr(agent, "step_mul", None)
+        timestep = env.step([action], step_mul=step_mul)[0]
+        steps += 1
+
+    obs = timestep.observation
+    return GameResult(
+        game=None, worker=None, map_name=_map_name(game),
+        outcome=timestep.reward if timestep.last() else 0,
+        score=int(obs["score_cumulative"][0]),
+        game_loop=int(obs["game_loop"][0]), steps=steps, seconds=None,
+        error=None)
+
+
+def _map_name(game):
+  map_name = game.get("map_name")
+  return getattr(map_name, "name", map_name)
+
+
+def summarize(results, elapsed):
+  """A dict of the totals over GameResults which took `elapsed` seconds."""
+  played = [r for r in results if r is not None and r.error is None]
+  outcomes = [r.outcome for r in played]
+  return {
+      "games": len(played),
+      "errors": sum(1 for r in results if r is not None and r.error),
+      "wins": sum(1 for o in outcomes if o > 0),
+      "draws": sum(1 for o in outcomes if o == 0),
+      "losses": sum(1 for o in outcomes if o < 0),
+      "win_rate": (sum(1 for o in outcomes if o > 0) / len(played)
+                   if played else 0),
+      "mean_score": (sum(r.score for r in played) / len(played)
+                     if played else 0),
+      "game_loops": sum(r.game_loop for r in played),
+      "games_per_hour": len(played) * 3600 / elapsed if elapsed else 0,
+  }
+
+
+def format_results(results, elapsed):
+  """The results as a table, one row per game, then the summary."""
+  table = [list(GameResult._fields)]
+  for r in results:
+    if r is not None:
+      table.append(["" if v is None else
+                    ("%.1f" % v if isinstance(v, float) else str(v))
+                    for v in r])
+  col_widths = [max(len(row[i]) for row in table)
+                for i in range(len(table[0]))]
+  out = ""
+  for row in table:
+    out += "  ".join(val.rjust(width) for val, width in zip(row, col_widths))
+    out += "\n"
+  summary = summarize(results, elapsed)
+  out += ("Games: %(games)d, errors: %(errors)d, wins: %(wins)d, draws: "
+          "%(draws)d, losses: %(losses)d, win rate: %(win_rate).2f, mean "
+          "score: %(mean_score).1f, games/hour: %(games_per_hour).1f\n" %
+          summary)
+  return out
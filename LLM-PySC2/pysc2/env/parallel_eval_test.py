@@ -0,0 +1,305 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for parallel_eval."""
+
+import threading
+
+from absl.testing import absltest
+import mock
+
+from pysc2.env import mock_sc2_env
+from pysc2.env import parallel_eval
+from pysc2.env import sc2_env
+from pysc2.lib import actions
+from pysc2.lib import protocol
+
+from s2clientprotocol import sc2api_pb2 as sc_pb
+
+Status = protocol.Status
+
+_PLAYERS = [sc2_env.Agent(sc2_env.Race.terran),
+            sc2_env.Bot(sc2_env.Race.zerg, sc2_env.Difficulty.very_easy)]
+_INTERFACE = sc2_env.AgentInterfaceFormat(
+    action_space=actions.ActionSpace.RAW, use_raw_units=True,
+    raw_resolution=64)
+
+
+class _NoOpAgent(object):
+
+  def __init__(self):
+    self.episodes = 0
+    self.steps = 0
+
+  def setup(self, obs_spec, action_spec):
+    del obs_spec, action_spec
+
+  def reset(self):
+    self.episodes += 1
+
+  def step(self, unused_timestep):
+    self.steps += 1
+    return actions.RAW_FUNCTIONS.no_op()
+
+
+class _Controller(object):
+  """Plays games which the agent wins after 16 game loops."""
+
+  def __init__(self):
+    self.status = Status.launched
+    self.games = 0
+    self._game_loop = 0
+
+  def create_game(self, unused_request):
+    self.games += 1
+    self._game_loop = 0
+    self.status = Status.init_game
+
+  def join_game(self, unused_request):
+    self.status = Status.in_game
+
+  def available_maps(self):
+    return sc_pb.ResponseAvailableMaps(battlenet_map_names=["Other LE"])
+
+  def game_info(self):
+    return mock_sc2_env._make_dummy_game_info(  # pylint: disable=protected-access
+        _PLAYERS, [_INTERFACE])[0]
+
+  @property
+  def status_ended(self):
+    return self.status == Status.ended
+
+  def step(self, count):
+    self._game_loop += count
+
+  def actions(self, unused_request):
+    pass
+
+  def observe(self, target_game_loop):
+    del target_game_loop
+    obs = sc_pb.ResponseObservation()
+    obs.observation.game_loop = self._game_loop
+    obs.observation.player_common.player_id = 1
+    obs.observation.score.score = self._game_loop
+    if self._game_loop >= 16:
+      obs.player_result.add(player_id=1, result=sc_pb.Victory)
+      self.status = Status.ended
+    return obs
+
+  def quit(self):
+    self.status = Status.quit
+
+
+class _Process(object):
+
+  def __init__(self):
+    self.controller = _Controller()
+    self.closed = False
+
+  def close(self):
+    self.closed = True
+
+
+def _make_pool():
+  run_config = mock.Mock()
+  run_config.map_data.return_value = b""
+  run_config.start.side_effect = lambda **kwargs: _Process()
+  return parallel_eval.ProcessPool(run_config)
+
+
+class ProcessPoolTest(absltest.TestCase):
+
+  def setUp(self):
+    super(ProcessPoolTest, self).setUp()
+    # The env reads its own run_config, though it then uses the pool's.
+    patcher = mock.patch.object(sc2_env.run_configs, "get")
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def testGamesReuseTheProcesses(self):
+    pool = _make_pool()
+    agents = []
+
+    def make_agent(unused_worker):
+      agents.append(_NoOpAgent())
+      return agents[-1]
+
+    games = [dict(map_name="Simple64", players=_PLAYERS,
+                  agent_interface_format=_INTERFACE, step_mul=8,
+                  random_seed=i) for i in range(6)]
+    scheduler = parallel_eval.EvalScheduler(games, make_agent, num_workers=2,
+                                            pool=pool)
+    results = scheduler.run()
+
+    self.assertEqual([r.game for r in results], list(range(6)))
+    for r in results:
+      self.assertIsNone(r.error)
+      self.assertEqual(r.map_name, "Simple64")
+      self.assertEqual(r.outcome, 1)
+      self.assertEqual(r.game_loop, 16)
+      self.assertEqual(r.steps, 2)
+    self.assertLen(agents, 2)
+    self.assertEqual(sum(a.episodes for a in agents), 6)
+
+    # The processes were launched once per worker, then reused.
+    self.assertLen(pool, 2)
+    self.assertEqual(pool.launched, 2)
+    self.assertEqual(pool.reused, 4)
+    self.assertEqual(pool.run_config.start.call_count, 2)
+    procs = pool._idle[False]  # pylint: disable=protected-access
+    self.assertEqual(sum(p.controller.games for p in procs), 6)
+    self.assertFalse(any(p.closed for p in procs))
+
+    pool.close()
+    self.assertTrue(all(p.closed for p in procs))
+    self.assertEmpty(pool)
+
+  def testBrokenProcessesAreClosed(self):
+    pool = _make_pool()
+    proc = pool.acquire()
+    proc.controller.status = Status.quit
+    pool.release(proc)
+    self.assertTrue(proc.closed)
+    self.assertEmpty(pool)
+    self.assertIsNot(pool.acquire(), proc)
+
+  def testFailedGamesGiveTheProcessBack(self):
+    pool = _make_pool()
+    with mock.patch.object(_Controller, "create_game",
+                           side_effect=protocol.ProtocolError("No map.")):
+      try:
+        parallel_eval.PooledSC2Env(
+            process_pool=pool, map_name="Simple64", players=_PLAYERS,
+            agent_interface_format=_INTERFACE)
+        self.fail("The game was created.")
+      except protocol.ProtocolError as e:
+        # The traceback keeps the env alive, so its __del__ doesn't close it.
+        traceback = e.__traceback__
+    self.assertIsNotNone(traceback)
+    self.assertLen(pool, 1)
+    proc = pool.acquire()
+    self.assertFalse(proc.closed)
+    self.assertEqual(pool.reused, 1)
+
+  def testFailedGamesOfTheSchedulerReuseTheProcesses(self):
+    pool = _make_pool()
+    create_game = _Controller.create_game
+
+    def create_even_games(controller, request):
+      if request.random_seed % 2:
+        raise protocol.ProtocolError("No map.")
+      create_game(controller, request)
+
+    games = [dict(map_name="Simple64", players=_PLAYERS,
+                  agent_interface_format=_INTERFACE, step_mul=8,
+                  random_seed=i) for i in range(6)]
+    scheduler = parallel_eval.EvalScheduler(
+        games, lambda unused_worker: _NoOpAgent(), num_workers=2, pool=pool)
+    with mock.patch.object(_Controller, "create_game", autospec=True,
+                           side_effect=create_even_games):
+      results = scheduler.run()
+
+    self.assertEqual([r.error is None for r in results], [True, False] * 3)
+    for r in results[1::2]:
+      self.assertIn("No map.", r.error)
+    self.assertEqual(sum(r.outcome for r in results[::2]), 3)
+
+    # The processes of the failed games were given back, and reused.
+    self.assertLen(pool, 2)
+    self.assertEqual(pool.launched, 2)
+    self.assertEqual(pool.reused, 4)
+    procs = pool._idle[False]  # pylint: disable=protected-access
+    self.assertEqual(sum(p.controller.games for p in procs), 3)
+    self.assertFalse(any(p.closed for p in procs))
+
+  def testBattleNetMapsAreChecked(self):
+    pool = _make_pool()
+    with self.assertRaisesRegex(ValueError, "battle.net"):
+      parallel_eval.PooledSC2Env(
+          process_pool=pool, map_name="Acropolis", players=_PLAYERS,
+          agent_interface_format=_INTERFACE, battle_net_map=True)
+    self.assertEqual(pool.acquire().controller.games, 0)
+    self.assertEqual(pool.reused, 1)
+
+  def testSingleAgentOnly(self):
+    with self.assertRaises(ValueError):
+      parallel_eval.PooledSC2Env(
+          process_pool=_make_pool(), map_name="Simple64",
+          players=[sc2_env.Agent(sc2_env.Race.terran),
+                   sc2_env.Agent(sc2_env.Race.zerg)],
+          agent_interface_format=_INTERFACE)
+
+
+class EvalSchedulerTest(absltest.TestCase):
+
+  def _make_env(self, game, pool):
+    del pool
+    game = dict(game)
+    outcome = game.pop("outcome")
+    if outcome is None:
+      raise RuntimeError("Can't create the game.")
+    env = mock_sc2_env.SC2TestEnv(**game)
+    env.episode_length = 3
+    env.next_timestep = [env.next_timestep[0]._replace(reward=outcome)]
+    return env
+
+  def testMockGames(self):
+    threads = set()
+    barrier = threading.Barrier(3, timeout=10)
+
+    def make_agent(unused_worker):
+      threads.add(threading.current_thread().name)
+      barrier.wait()  # Every worker plays.
+      return _NoOpAgent()
+
+    games = [dict(map_name="Simple64", players=_PLAYERS,
+                  agent_interface_format=_INTERFACE, outcome=outcome)
+             for outcome in (1, -1, 0, 1, None, 1)]
+    scheduler = parallel_eval.EvalScheduler(
+        games, make_agent, num_workers=3, make_env=self._make_env)
+    results = scheduler.run()
+
+    self.assertLen(threads, 3)
+    self.assertEqual([r.outcome for r in results], [1, -1, 0, 1, None, 1])
+    self.assertEqual([r.steps for r in results], [3, 3, 3, 3, None, 3])
+    self.assertIn("Can't create the game.", results[4].error)
+
+    summary = parallel_eval.summarize(results, elapsed=1.5)
+    self.assertEqual(summary["games"], 5)
+    self.assertEqual(summary["errors"], 1)
+    self.assertEqual((summary["wins"], summary["draws"], summary["losses"]),
+                     (3, 1, 1))
+    self.assertAlmostEqual(summary["win_rate"], 0.6)
+    self.assertAlmostEqual(summary["games_per_hour"], 12000)
+
+    table = parallel_eval.format_results(results, elapsed=1.5).splitlines()
+    self.assertLen(table, 8)
+    self.assertStartsWith(table[0].strip(), "game")
+    self.assertIn("games/hour: 12000.0", table[-1])
+
+  def testMaxSteps(self):
+    games = [dict(map_name="Simple64", players=_PLAYERS,
+                  agent_interface_format=_INTERFACE, outcome=1)]
+    scheduler = parallel_eval.EvalScheduler(
+        games, lambda _: _NoOpAgent(), make_env=self._make_env, max_steps=2)
+    [result] = scheduler.run()
+    self.assertEqual(result.steps, 2)
+    self.assertEqual(result.outcome, 0)
+
+  def testNeedsAPool(self):
+    with self.assertRaises(ValueError):
+      parallel_eval.EvalScheduler([{}], lambda _: _NoOpAgent())
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -15,6 +15,7 @@
 # pylint: disable=g-complex-comprehension
 
 import collections
+from concurrent import futures
 import copy
 import random
 import time
@@ -82,6 +83,9 @@ class Bot(collections.namedtuple("Bot", ["race", "difficulty", "build"])):
 _DelayedAction = collections.namedtuple(
     "DelayedAction", ["game_loop", "action"])
 
+_Prefetch = collections.namedtuple(
+    "Prefetch", ["target_game_loop", "future"])
+
 REALTIME_GAME_LOOP_SECONDS = 1 / 22.4
 MAX_STEP_COUNT = 524000  # The game fails above 2^19=524288 steps.
 NUM_ACTION_DELAY_BUCKETS = 10
@@ -105,6 +109,7 @@ class SC2Env(environment.Base):
                visualize=False,
                step_mul=None,
                realtime=False,
+               pipelined_observations=False,
                save_replay_episodes=0,
                replay_dir=None,
                replay_prefix=None,
@@ -156,6 +161,17 @@ class SC2Env(environment.Base):
           environment will attempt to honour step_mul, returning observations
           with that spacing as closely as possible. Game loops will be skipped
           if they cannot be retrieved and processed quickly enough.
+      pipelined_observations: Whether to request and transform the next
+          observation in the background while the agent is busy with the
+          current one. Only supported in realtime mode. The next observation is
+          requested as soon as one is returned, targeting step_mul game loops
+          later, so the observation returned by step() was taken before the
+          actions passed to that step() were sent: it lags them by one step,
+          and the actions show up in the observation after. In exchange step()
+          doesn't wait for the observation to be fetched and transformed if the
+          agent took longer than step_mul game loops. The step_mul passed to
+          step() applies to the observation requested after it. See
+          loops_saved() for how much it saved.
       save_replay_episodes: Save a replay after this many episodes. Default of 0
           means don't save replays.
       replay_dir: Directory to save replays. Required with save_replay_episodes.
@@ -217,7 +233,15 @@ class SC2Env(environment.Base):
     if save_replay_episodes and not replay_dir:
       raise ValueError("Missing replay_dir")
 
+    if pipelined_observations and not realtime:
+      raise ValueError("pipelined_observations requires realtime mode.")
+
     self._realtime = realtime
+    self._pipelined_observations = pipelined_observations
+    self._prefetch_executor = (
+        futures.ThreadPoolExecutor(1) if pipelined_observations else None)
+    self._prefetch = None
+    self._prefetched = None
     self._last_step_time = None
     self._save_replay_episodes = save_replay_episodes
     self._replay_dir = replay_dir
@@ -340,7 +364,10 @@ class SC2Env(environment.Base):
         #                      want_rgb=interface.HasField("render"))
         for interface in self._interface_options]
     self._controllers = [p.controller for p in self._sc2_procs]
+    self._check_battle_net_maps()
 
+  def _check_battle_net_maps(self):
+    """Raise if a battle.net map isn't available to the launched game."""
     if self._battle_net_map:
       available_maps = self._controllers[0].available_maps()
       available_maps = set(available_maps.battlenet_map_names)
@@ -428,6 +455,15 @@ class SC2Env(environment.Base):
         features.features_from_game_info(
             game_info=g, agent_interface_format=aif, map_name=self._map_name)
         for g, aif in zip(self._game_info, self._interface_formats)]
+    if self._pipelined_observations:
+      # The prefetched observation is transformed by a second set, as the agent
+      # may still be reading the current one, and the transform_action of its
+      # actions needs the state (eg raw unit tags) of the observation it saw.
+      self._prefetch_features = [
+          features.features_from_game_info(
+              game_info=g, agent_interface_format=aif,
+              map_name=self._map_name)
+          for g, aif in zip(self._game_info, self._interface_formats)]
 
     self._requested_races = {
         info.player_id: info.race_requested
@@ -471,6 +507,25 @@ class SC2Env(environment.Base):
 
     return self._action_delays
 
+  def loops_saved(self):
+    """The game loops saved this episode by the pipelined observations.
+
+    This is an estimate: the time step() would have spent fetching and
+    transforming the observation, less the time it waited for the prefetched
+    one, in realtime game loops.
+
+    Returns:
+      The number of game loops saved this episode.
+
+    Raises:
+      ValueError: If called without pipelined observations.
+    """
+    if not self._pipelined_observations:
+      raise ValueError("This method is only supported with "
+                       "pipelined_observations")
+
+    return int(round(self._loops_saved))
+
   def _restart(self):
     if (len(self._players) == 1 and len(self._players[0].race) == 1 and
         len(self._maps) == 1):
@@ -484,6 +539,7 @@ class SC2Env(environment.Base):
   @sw.decorate
   def reset(self):
     """Start a new episode."""
+    self._discard_prefetch()
     self._episode_steps = 0
     if self._episode_count:
       # No need to restart for the first episode.
@@ -500,9 +556,13 @@ class SC2Env(environment.Base):
     if self._realtime:
       self._last_step_time = time.time()
       self._last_obs_game_loop = None
+      self._acted_obs_game_loop = None
       self._action_delays = [[0] * NUM_ACTION_DELAY_BUCKETS] * self._num_agents
+      self._loops_saved = 0
 
-    return self._observe(target_game_loop=0)
+    timestep = self._observe(target_game_loop=0)
+    self._prefetch_observations()
+    return timestep
 
   @sw.decorate("step_env")
   def step(self, actions, step_mul=None):
@@ -529,11 +589,24 @@ class SC2Env(environment.Base):
     if not self._realtime:
       actions = self._apply_action_delays(actions)
 
-    self._parallel.run((c.actions, sc_pb.RequestAction(actions=a))
-                       for c, a in zip(self._controllers, actions))
+    game_ended = False
+    if self._prefetch:
+      # Requested before these actions, so it must be answered before they are
+      # sent. This also keeps the controllers to a single thread at a time.
+      self._wait_for_prefetch()
+      # The game may have ended meanwhile, then it takes no more actions.
+      _, prefetched_obs, _ = self._prefetched
+      game_ended = (any(o.player_result for o in prefetched_obs) or
+                    self._controllers[0].status_ended)
+
+    if not game_ended:
+      self._parallel.run((c.actions, sc_pb.RequestAction(actions=a))
+                         for c, a in zip(self._controllers, actions))
 
     self._state = environment.StepType.MID
-    return self._step(step_mul)
+    timestep = self._step(step_mul)
+    self._prefetch_observations(step_mul)
+    return timestep
 
   def _step(self, step_mul=None):
     step_mul = step_mul or self._step_mul
@@ -613,17 +686,81 @@ class SC2Env(environment.Base):
         if not self._controllers[0].status_ended:  # May already have ended.
           self._parallel.run((c.step, step_mul) for c in self._controllers)
 
-  def _get_observations(self, target_game_loop):
+  def _fetch_observations(self, target_game_loop, features_):
+    """Observe and transform, returning the obs, agent obs and service time.
+
+    The service time is the time spent transforming, plus the time observing if
+    the game was already past the target game loop, ie not counting the time
+    spent waiting for the game to get there.
+
+    Args:
+      target_game_loop: The game loop to observe at.
+      features_: The Features transforming the observations, one per agent.
+
+    Returns:
+      A tuple of the observations, the agent observations and the service time.
+    """
     # Transform in the thread so it runs while waiting for other observations.
     def parallel_observe(c, f):
+      start = time.time()
       obs = c.observe(target_game_loop=target_game_loop)
+      observed = time.time()
       agent_obs = f.transform_obs(obs)
-      return obs, agent_obs
-
+      service_time = time.time() - observed
+      if obs.observation.game_loop > target_game_loop:
+        service_time += observed - start
+      return obs, agent_obs, service_time
+
+    obs, agent_obs, service_time = zip(*self._parallel.run(
+        (parallel_observe, c, f) for c, f in zip(self._controllers, features_)))
+    return obs, agent_obs, max(service_time)
+
+  def _prefetch_observations(self, step_mul=None):
+    """Request the next observation in the background, if pipelined."""
+    if (not self._pipelined_observations or
+        self._state == environment.StepType.LAST):
+      return
+    target_game_loop = self._episode_steps + (step_mul or self._step_mul)
+    self._prefetch = _Prefetch(target_game_loop, self._prefetch_executor.submit(
+        self._fetch_observations, target_game_loop, self._prefetch_features))
+
+  def _wait_for_prefetch(self):
+    """Wait for the prefetched observation, which _get_observations uses."""
+    prefetch, self._prefetch = self._prefetch, None
+    start = time.time()
     with self._metrics.measure_observation_time():
-      self._obs, self._agent_obs = zip(*self._parallel.run(
-          (parallel_observe, c, f)
-          for c, f in zip(self._controllers, self._features)))
+      obs, agent_obs, service_time = prefetch.future.result()
+    wait_time = time.time() - start
+
+    loops_saved = max(0, service_time - wait_time) / REALTIME_GAME_LOOP_SECONDS
+    self._loops_saved += loops_saved
+    self._metrics.increment_loops_saved(loops_saved)
+
+    # The agent is done with the current observation, so swap the Features.
+    self._features, self._prefetch_features = (
+        self._prefetch_features, self._features)
+    self._prefetched = (prefetch.target_game_loop, obs, agent_obs)
+
+  def _discard_prefetch(self):
+    """Wait for any prefetched observation and drop it."""
+    prefetch, self._prefetch = self._prefetch, None
+    self._prefetched = None
+    if prefetch:
+      futures.wait([prefetch.future])
+
+  def _sync_prefetch(self):
+    """Wait for any prefetched observation, before using the controllers."""
+    if self._prefetch:
+      futures.wait([self._prefetch.future])
+
+  def _get_observations(self, target_game_loop):
+    if self._prefetched:
+      target_game_loop, self._obs, self._agent_obs = self._prefetched
+      self._prefetched = None
+    else:
+      with self._metrics.measure_observation_time():
+        self._obs, self._agent_obs, _ = self._fetch_observations(
+            target_game_loop, self._features)
 
     game_loop = _get_game_loop(self._agent_obs[0])
     if (game_loop < target_game_loop and
@@ -643,11 +780,18 @@ class SC2Env(environment.Base):
       # with action. This is difficult to avoid without changing the SC2
       # binary - e.g. send the observation game loop with each action,
       # return them in the observation action proto.
-      if self._last_obs_game_loop is not None:
+      # With pipelined observations the actions chosen from an observation are
+      # only in the one after the next, as the next was requested before them.
+      if self._pipelined_observations:
+        acted_obs_game_loop = self._acted_obs_game_loop
+        self._acted_obs_game_loop = self._last_obs_game_loop
+      else:
+        acted_obs_game_loop = self._last_obs_game_loop
+      if acted_obs_game_loop is not None:
         for i, obs in enumerate(self._obs):
           for action in obs.actions:
             if action.HasField("game_loop"):
-              delay = action.game_loop - self._last_obs_game_loop
+              delay = action.game_loop - acted_obs_game_loop
               if delay > 0:
                 num_slots = len(self._action_delays[i])
                 delay = min(delay, num_slots - 1)  # Cap to num buckets.
@@ -723,6 +867,7 @@ class SC2Env(environment.Base):
 
   def send_chat_messages(self, messages, broadcast=True):
     """Useful for logging messages into the replay."""
+    self._sync_prefetch()
     self._parallel.run(
         (c.chat,
          message,
@@ -732,6 +877,7 @@ class SC2Env(environment.Base):
   def save_replay(self, replay_dir, prefix=None):
     if prefix is None:
       prefix = self._map_name
+    self._sync_prefetch()
     replay_path = self._run_config.save_replay(
         self._controllers[0].save_replay(), replay_dir, prefix)
     logging.info("Wrote replay to: %s", replay_path)
@@ -746,6 +892,13 @@ class SC2Env(environment.Base):
       self._renderer_human.close()
       self._renderer_human = None
 
+    # Don't wait, quitting the game ends any pending observation.
+    if getattr(self, "_prefetch_executor", None):
+      self._prefetch_executor.shutdown(wait=False)
+      self._prefetch_executor = None
+    self._prefetch = None
+    self._prefetched = None
+
     # Don't use parallel since it might be broken by an exception.
     if hasattr(self, "_controllers") and self._controllers:
       for c in self._controllers:
@@ -16,8 +16,15 @@
 
 from absl.testing import absltest
 from absl.testing import parameterized
+import mock
 
+from pysc2.env import mock_sc2_env
 from pysc2.env import sc2_env
+from pysc2.lib import actions
+from pysc2.lib import protocol
+
+from s2clientprotocol import common_pb2
+from s2clientprotocol import sc2api_pb2 as sc_pb
 
 
 class TestNameCroppingAndDeduplication(parameterized.TestCase):
@@ -49,5 +56,223 @@ class TestNameCroppingAndDeduplication(parameterized.TestCase):
     self.assertEqual(sc2_env.crop_and_deduplicate_names(names), expected_output)
 
 
+class _Controller(object):
+  """Plays a game which never ends, with one unit and a growing score."""
+
+  def __init__(self, game_info):
+    self.status_ended = False
+    self._game_info = game_info
+    self._game_loop = 0
+
+  def create_game(self, unused_request):
+    pass
+
+  def join_game(self, unused_request):
+    pass
+
+  def restart(self):
+    self._game_loop = 0
+
+  def game_info(self):
+    return self._game_info
+
+  def quit(self):
+    pass
+
+  def step(self, count):
+    self._game_loop += count
+
+  def actions(self, unused_request):
+    pass
+
+  def observe(self, target_game_loop):
+    del target_game_loop
+    obs = sc_pb.ResponseObservation()
+    obs.observation.game_loop = self._game_loop
+    obs.observation.player_common.player_id = 1
+    obs.observation.score.score = self._game_loop
+    obs.observation.raw_data.units.add(
+        tag=1, unit_type=48, owner=1, alliance=1,
+        pos=common_pb2.Point(x=10, y=10))
+    return obs
+
+
+class ObservationFieldsTest(absltest.TestCase):
+
+  def test_env_fields_are_rendered(self):
+    players = [sc2_env.Agent(sc2_env.Race.terran)]
+    interface_format = sc2_env.AgentInterfaceFormat(
+        action_space=actions.ActionSpace.RAW, use_raw_units=True,
+        raw_resolution=64, observation_fields=["player", "raw_units"])
+    game_info = mock_sc2_env._make_dummy_game_info(  # pylint: disable=protected-access
+        players, [interface_format])[0]
+    run_config = mock.Mock()
+    run_config.map_data.return_value = b""
+    run_config.start.return_value.controller = _Controller(game_info)
+    with mock.patch.object(sc2_env.run_configs, "get",
+                           return_value=run_config):
+      env = sc2_env.SC2Env(
+          map_name="MoveToBeacon", players=players,
+          agent_interface_format=interface_format, step_mul=8)
+    self.addCleanup(env.close)
+
+    # The env reads the game loop and the score, so they are rendered too.
+    self.assertCountEqual(
+        env.observation_spec()[0].keys(),
+        ["player", "raw_units", "game_loop", "score_cumulative"])
+    timestep = env.reset()[0]
+    for _ in range(2):
+      timestep = env.step([actions.RAW_FUNCTIONS.no_op()])[0]
+    self.assertEqual(timestep.observation.game_loop[0], 16)
+    self.assertEqual(timestep.reward, 8)
+    self.assertEqual(timestep.observation.raw_units.shape[0], 1)
+
+
+class _RealtimeController(object):
+  """Answers like a realtime game which is already at the target game loop."""
+
+  def __init__(self, game_info, end_game_loop=None):
+    self.requests = []
+    self.status_ended = False
+    self._game_info = game_info
+    self._end_game_loop = end_game_loop
+    self._game_loop = 0
+    self._actions = []
+
+  def create_game(self, unused_request):
+    pass
+
+  def join_game(self, unused_request):
+    pass
+
+  def restart(self):
+    pass
+
+  def game_info(self):
+    return self._game_info
+
+  def quit(self):
+    pass
+
+  def observe(self, target_game_loop):
+    self.requests.append(("observe", target_game_loop))
+    self._game_loop = max(self._game_loop, target_game_loop)
+    obs = sc_pb.ResponseObservation()
+    obs.observation.game_loop = self._game_loop
+    obs.observation.player_common.player_id = 1
+    # A different unit each game loop, to tell the observations apart.
+    obs.observation.raw_data.units.add(
+        tag=self._game_loop + 1000, unit_type=48, owner=1, alliance=1,
+        pos=common_pb2.Point(x=10, y=10))
+    obs.actions.extend(self._actions)
+    self._actions = []
+    if self._end_game_loop and self._game_loop >= self._end_game_loop:
+      obs.player_result.add(player_id=1, result=sc_pb.Victory)
+      self.status_ended = True
+    return obs
+
+  def actions(self, request):
+    if self.status_ended:  # Like the RemoteController, only while in game.
+      raise protocol.ProtocolError("The game has ended.")
+    self.requests.append(("actions", self._game_loop))
+    for action in request.actions:
+      self._actions.append(sc_pb.Action(game_loop=self._game_loop + 1))
+      self._actions[-1].MergeFrom(action)
+
+
+def _make_realtime_env(test, pipelined=False, end_game_loop=None):
+  """A realtime SC2Env on a _RealtimeController, closed by the test."""
+  players = [sc2_env.Agent(sc2_env.Race.terran)]
+  interface_format = sc2_env.AgentInterfaceFormat(
+      action_space=actions.ActionSpace.RAW, use_raw_units=True,
+      raw_resolution=64)
+  game_info = mock_sc2_env._make_dummy_game_info(  # pylint: disable=protected-access
+      players, [interface_format])[0]
+  controller = _RealtimeController(game_info, end_game_loop)
+  run_config = mock.Mock()
+  run_config.map_data.return_value = b""
+  run_config.start.return_value.controller = controller
+  with mock.patch.object(sc2_env.run_configs, "get",
+                         return_value=run_config):
+    env = sc2_env.SC2Env(
+        map_name="MoveToBeacon", players=players,
+        agent_interface_format=interface_format, step_mul=8,
+        realtime=True, pipelined_observations=pipelined)
+  test.addCleanup(env.close)
+  return env, controller
+
+
+class PipelinedObservationsTest(absltest.TestCase):
+
+  def _make_env(self, pipelined, end_game_loop=None):
+    return _make_realtime_env(self, pipelined, end_game_loop)
+
+  def _run(self, env, steps):
+    timesteps = [env.reset()[0]]
+    for _ in range(steps):
+      # The first raw unit of the observation the agent is looking at.
+      action = actions.RAW_FUNCTIONS.Stop_quick("now", [0])
+      timesteps.append(env.step([action])[0])
+    return timesteps
+
+  def _stopped_tags(self, env):
+    return [list(obs.actions[0].action_raw.unit_command.unit_tags)
+            for obs in env._obs if obs.actions]  # pylint: disable=protected-access
+
+  def test_requires_realtime(self):
+    with self.assertRaises(ValueError):
+      sc2_env.SC2Env(
+          map_name="MoveToBeacon", players=[sc2_env.Agent(sc2_env.Race.terran)],
+          agent_interface_format=sc2_env.AgentInterfaceFormat(
+              action_space=actions.ActionSpace.RAW, use_raw_units=True,
+              raw_resolution=64),
+          pipelined_observations=True)
+
+  def test_sequential(self):
+    env, controller = self._make_env(pipelined=False)
+    timesteps = self._run(env, 3)
+    self.assertEqual([t.observation.game_loop[0] for t in timesteps],
+                     [0, 8, 16, 24])
+    self.assertEqual(controller.requests, [
+        ("observe", 0), ("actions", 0), ("observe", 8), ("actions", 8),
+        ("observe", 16), ("actions", 16), ("observe", 24)])
+    self.assertEqual(self._stopped_tags(env), [[1016]])
+    # Executed on the next game loop.
+    self.assertEqual(env.action_delays()[0][1], 3)
+    with self.assertRaises(ValueError):
+      env.loops_saved()
+
+  def test_pipelined(self):
+    env, controller = self._make_env(pipelined=True)
+    timesteps = self._run(env, 3)
+    env._sync_prefetch()  # pylint: disable=protected-access
+    self.assertEqual([t.observation.game_loop[0] for t in timesteps],
+                     [0, 8, 16, 24])
+    # The next observation is requested before the actions are sent.
+    self.assertEqual(controller.requests, [
+        ("observe", 0), ("observe", 8), ("actions", 8), ("observe", 16),
+        ("actions", 16), ("observe", 24), ("actions", 24), ("observe", 32)])
+    # The actions are in the observation after the next, and unit 0 was the
+    # one of the observation the agent saw, not of the prefetched one.
+    self.assertEqual(self._stopped_tags(env), [[1008]])
+    # The delay from the observation the actions were chosen from.
+    self.assertEqual(env.action_delays()[0][9], 2)
+    self.assertGreaterEqual(env.loops_saved(), 0)
+
+    # A new episode drops the prefetched observation.
+    self.assertEqual(env.reset()[0].observation.game_loop[0], 32)
+    self.assertEqual(env.loops_saved(), 0)
+
+  def test_pipelined_game_end(self):
+    env, controller = self._make_env(pipelined=True, end_game_loop=16)
+    timesteps = self._run(env, 2)
+    self.assertEqual([t.observation.game_loop[0] for t in timesteps],
+                     [0, 8, 16])
+    self.assertTrue(timesteps[-1].last())
+    # No actions once the prefetched observation ended the game.
+    self.assertEqual(controller.requests, [
+        ("observe", 0), ("observe", 8), ("actions", 8), ("observe", 16)])
+
+
 if __name__ == "__main__":
   absltest.main()
@@ -1189,6 +1189,33 @@ ABILITY_IDS = {k: frozenset(v) for k, v in ABILITY_IDS.items()}
 FUNCTIONS_AVAILABLE = {f.id: f for f in FUNCTIONS if f.avail_fn}
 
 
+def _ability_function_ids(ability_id, requires_point, hide_specific_actions):
+  """The ids of the functions an available ability makes available."""
+  function_ids = set()
+  for func in ABILITY_IDS[ability_id]:
+    if func.function_type in POINT_REQUIRED_FUNCS[requires_point]:
+      if func.general_id == 0 or not hide_specific_actions:
+        function_ids.add(func.id)
+      if func.general_id != 0:  # Always offer generic actions.
+        for general_func in ABILITY_IDS[func.general_id]:
+          if general_func.function_type is func.function_type:
+            # Only the right type. Don't want to expose the general action
+            # to minimap if only the screen version is available.
+            function_ids.add(general_func.id)
+            break
+  return frozenset(function_ids)
+
+
+# {(ability_id, requires_point, hide_specific_actions): frozenset(func ids)},
+# empty if none applies.
+ABILITY_FUNCTION_IDS = {
+    (ability_id, requires_point, hide): _ability_function_ids(
+        ability_id, requires_point, hide)
+    for ability_id in ABILITY_IDS
+    for requires_point in (False, True)
+    for hide in (False, True)}
+
+
 # pylint: disable=line-too-long
 _RAW_FUNCTIONS = [
     Function.raw_ui_func(0, "no_op", raw_no_op),
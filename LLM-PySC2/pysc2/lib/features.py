@@ -16,6 +16,7 @@
 
 import collections
 import enum
+import operator
 import random
 
 from absl import logging
@@ -35,6 +36,13 @@ sw = stopwatch.sw
 
 EPSILON = 1e-5
 
+# The number of results of `Features.available_actions` kept, by their inputs.
+AVAILABLE_ACTIONS_CACHE_SIZE = 256
+
+# The observations read by `SC2Env` itself (the game loop, the score rewards),
+# so always part of the `observation_fields`.
+ENV_OBSERVATION_FIELDS = frozenset(["game_loop", "score_cumulative"])
+
 
 class FeatureType(enum.Enum):
   SCALAR = 1
@@ -213,6 +221,82 @@ class FeatureUnit(enum.IntEnum):
   shield_upgrade_level = 45
 
 
+# The dtype of each `FeatureUnit` field in the structured units (see
+# `AgentInterfaceFormat.structured_units`). Hit points, shields and energy are
+# unsigned 16 bit, like the unit types and the ids.
+UNIT_DTYPE = np.dtype([(f.name, {
+    FeatureUnit.unit_type: np.uint16,
+    FeatureUnit.health: np.uint16,
+    FeatureUnit.shield: np.uint16,
+    FeatureUnit.energy: np.uint16,
+    FeatureUnit.x: np.int16,
+    FeatureUnit.y: np.int16,
+    FeatureUnit.radius: np.int16,
+    FeatureUnit.mineral_contents: np.uint16,
+    FeatureUnit.vespene_contents: np.uint16,
+    FeatureUnit.weapon_cooldown: np.uint16,
+    FeatureUnit.order_id_0: np.uint16,
+    FeatureUnit.order_id_1: np.uint16,
+    FeatureUnit.order_id_2: np.uint16,
+    FeatureUnit.order_id_3: np.uint16,
+    FeatureUnit.tag: np.uint64,
+    FeatureUnit.buff_id_0: np.uint16,
+    FeatureUnit.buff_id_1: np.uint16,
+    FeatureUnit.addon_unit_type: np.uint16,
+    FeatureUnit.buff_duration_remain: np.uint16,
+    FeatureUnit.buff_duration_max: np.uint16,
+}.get(f, np.uint8)) for f in FeatureUnit])
+
+# The int64 range of each field of UNIT_DTYPE.
+_UNIT_BOUNDS = [
+    (max(np.iinfo(UNIT_DTYPE[f.name]).min, np.iinfo(np.int64).min),
+     min(np.iinfo(UNIT_DTYPE[f.name]).max, np.iinfo(np.int64).max))
+    for f in FeatureUnit]
+
+
+def units_to_structured(units):
+  """Converts units of the [n, len(FeatureUnit)] layout to a UNIT_DTYPE array.
+
+  A value out of the range of its field saturates at the bounds instead of
+  wrapping around, eg the health_ratio of a unit with more health than its
+  health_max is 255.
+
+  Args:
+    units: The raw_units or feature_units, a 2-D array or an empty one.
+
+  Returns:
+    A recarray of UNIT_DTYPE records, ie `units.x` is a view of the x column
+    and `units[i].x` the x of a unit.
+  """
+  out = np.zeros((len(units),), dtype=UNIT_DTYPE)
+  if len(units):
+    units = np.asarray(units, dtype=np.int64)
+    for f, (low, high) in zip(FeatureUnit, _UNIT_BOUNDS):
+      out[f.name] = np.clip(units[:, f], low, high)
+  return out.view(np.recarray)
+
+
+def units_from_structured(units):
+  """Converts UNIT_DTYPE units back to the [n, len(FeatureUnit)] layout."""
+  if not len(units):  # No units is a (0,) array, not (0, len(FeatureUnit)).
+    return named_array.NamedNumpyArray([], [None, FeatureUnit], dtype=np.int64)
+  out = np.empty((len(units), len(FeatureUnit)), dtype=np.int64)
+  for f in FeatureUnit:
+    out[:, f] = units[f.name]
+  return named_array.NamedNumpyArray(out, [None, FeatureUnit], copy=False)
+
+
+def memory_report(observation):
+  """The bytes of each array of an observation, and their "total".
+
+  Only the fields already rendered of a `LazyNamedDict` are counted.
+  """
+  report = {name: value.nbytes for name, value in dict.items(observation)
+            if isinstance(value, np.ndarray)}
+  report["total"] = sum(report.values())
+  return report
+
+
 class EffectPos(enum.IntEnum):
   """Positions of the active effects."""
   effect = 0
@@ -284,6 +368,29 @@ class Feature(collections.namedtuple(
         data = data[:size.x * size.y]
     return data.reshape(size.y, size.x)
 
+  @staticmethod
+  @sw.decorate
+  def unpack_layer_into(plane, out):
+    """Decode the feature layer bytes into `out`, a (y, x) array of any dtype.
+
+    Args:
+      plane: The feature layer `ImageData`.
+      out: The array to write the layer to.
+
+    Returns:
+      Whether the layer was written, ie False (with `out` untouched) for a new
+      layer that isn't implemented in this SC2 version.
+    """
+    size = point.Point.build(plane.size)
+    if size == (0, 0):
+      return False
+    data = np.frombuffer(plane.data, dtype=Feature.dtypes[plane.bits_per_pixel])
+    if plane.bits_per_pixel == 1:
+      # Drop the padding bits, if the length isn't a multiple of 8.
+      data = np.unpackbits(data, count=size.x * size.y)
+    np.copyto(out, data.reshape(size.y, size.x), casting="unsafe")
+    return True
+
   @staticmethod
   @sw.decorate
   def unpack_rgb_image(plane):
@@ -488,7 +595,12 @@ class AgentInterfaceFormat(object):
       crop_to_playable_area=False,
       raw_crop_to_playable_area=False,
       allow_cheating_layers=False,
-      add_cargo_to_units=False):
+      add_cargo_to_units=False,
+      observation_fields=None,
+      lazy_observations=False,
+      feature_layer_dtype=np.int32,
+      reuse_feature_layers=False,
+      structured_units=False):
     """Initializer.
 
     Args:
@@ -551,6 +663,25 @@ class AgentInterfaceFormat(object):
           layers on the minimap.
       add_cargo_to_units: Whether to add the units that are currently in cargo
           to the feature_units and raw_units lists.
+      observation_fields: Optional. The names of the observations the agent
+          reads (eg ["player", "raw_units"]). Only these, and the
+          `ENV_OBSERVATION_FIELDS` which the environment needs, are rendered
+          and in the observation spec. Default is all of them.
+      lazy_observations: Whether an observation is only rendered from the
+          response proto when read: the observations are `LazyNamedDict`s,
+          whose fields are rendered (and memoized) when first accessed.
+      feature_layer_dtype: The dtype of the feature_screen and feature_minimap
+          observations. None keeps the dtype of the layers' bits per pixel,
+          the largest of each set (eg uint8 if they are all 8 bit or less),
+          instead of widening them.
+      reuse_feature_layers: Whether the feature layers are decoded into arrays
+          preallocated by `Features`, instead of new ones for each observation.
+          The feature_screen and feature_minimap of an observation are then
+          overwritten by the next one: copy them to keep a frame.
+      structured_units: Whether the raw_units and feature_units are recarrays
+          of `UNIT_DTYPE` records (a compact dtype per field) instead of int64
+          [n, len(FeatureUnit)] arrays. See `units_to_structured` and
+          `units_from_structured` to convert between the two.
 
     Raises:
       ValueError: if the parameters are inconsistent.
@@ -626,6 +757,13 @@ class AgentInterfaceFormat(object):
     self._crop_to_playable_area = crop_to_playable_area
     self._raw_crop_to_playable_area = raw_crop_to_playable_area
     self._allow_cheating_layers = allow_cheating_layers
+    self._observation_fields = (
+        frozenset(observation_fields) | ENV_OBSERVATION_FIELDS
+        if observation_fields is not None else None)
+    self._lazy_observations = lazy_observations
+    self._feature_layer_dtype = feature_layer_dtype
+    self._reuse_feature_layers = reuse_feature_layers
+    self._structured_units = structured_units
 
     if action_space == actions.ActionSpace.FEATURES:
       self._action_dimensions = feature_dimensions
@@ -728,6 +866,26 @@ class AgentInterfaceFormat(object):
   def allow_cheating_layers(self):
     return self._allow_cheating_layers
 
+  @property
+  def observation_fields(self):
+    return self._observation_fields
+
+  @property
+  def lazy_observations(self):
+    return self._lazy_observations
+
+  @property
+  def feature_layer_dtype(self):
+    return self._feature_layer_dtype
+
+  @property
+  def reuse_feature_layers(self):
+    return self._reuse_feature_layers
+
+  @property
+  def structured_units(self):
+    return self._structured_units
+
 
 def parse_agent_interface_format(
     feature_screen=None,
@@ -917,6 +1075,153 @@ def _init_valid_raw_functions(raw_resolution, max_selected_units):
   return actions.ValidActions(types, functions)
 
 
+# The fields of the raw units which are read in bulk by `unit_columns`, with the
+# `FeatureUnit` columns they are copied into as they are (None for the fields
+# which the other columns are computed from).
+_UNIT_FIELDS = (
+    ("unit_type", FeatureUnit.unit_type),
+    # Self = 1, Ally = 2, Neutral = 3, Enemy = 4
+    ("alliance", FeatureUnit.alliance),
+    ("health", FeatureUnit.health),
+    ("shield", FeatureUnit.shield),
+    ("energy", FeatureUnit.energy),
+    ("cargo_space_taken", FeatureUnit.cargo_space_taken),
+    ("build_progress", None),
+    ("health_max", None),
+    ("shield_max", None),
+    ("energy_max", None),
+    # Visible = 1, Snapshot = 2, Hidden = 3
+    ("display_type", FeatureUnit.display_type),
+    ("owner", FeatureUnit.owner),  # 1-15, 16 = neutral
+    ("pos.x", None),
+    ("pos.y", None),
+    ("facing", FeatureUnit.facing),
+    ("radius", None),
+    # Cloaked = 1, CloakedDetected = 2, NotCloaked = 3
+    ("cloak", FeatureUnit.cloak),
+    ("is_selected", FeatureUnit.is_selected),
+    ("is_blip", FeatureUnit.is_blip),
+    ("is_powered", FeatureUnit.is_powered),
+    ("mineral_contents", FeatureUnit.mineral_contents),
+    ("vespene_contents", FeatureUnit.vespene_contents),
+    # Not populated for enemies or neutral
+    ("cargo_space_max", FeatureUnit.cargo_space_max),
+    ("assigned_harvesters", FeatureUnit.assigned_harvesters),
+    ("ideal_harvesters", FeatureUnit.ideal_harvesters),
+    ("weapon_cooldown", FeatureUnit.weapon_cooldown),
+    ("is_hallucination", FeatureUnit.hallucination),
+    ("is_active", FeatureUnit.active),
+    ("is_on_screen", FeatureUnit.is_on_screen),
+    ("buff_duration_remain", FeatureUnit.buff_duration_remain),
+    ("buff_duration_max", FeatureUnit.buff_duration_max),
+    ("attack_upgrade_level", FeatureUnit.attack_upgrade_level),
+    ("armor_upgrade_level", FeatureUnit.armor_upgrade_level),
+    ("shield_upgrade_level", FeatureUnit.shield_upgrade_level),
+)
+_UNIT_FIELD_INDEX = {name: i for i, (name, _) in enumerate(_UNIT_FIELDS)}
+_UNIT_COPIED_FIELDS = [i for i, (_, c) in enumerate(_UNIT_FIELDS)
+                       if c is not None]
+_UNIT_COPIED_COLUMNS = [c for _, c in _UNIT_FIELDS if c is not None]
+_get_unit_fields = operator.attrgetter(*[name for name, _ in _UNIT_FIELDS])
+# The ones which aren't numbers (or don't fit in a float64).
+_get_unit_other_fields = operator.attrgetter(
+    "tag", "add_on_tag", "orders", "buff_ids")
+
+_UNIT_RATIOS = (
+    (FeatureUnit.health_ratio, "health", "health_max"),
+    (FeatureUnit.shield_ratio, "shield", "shield_max"),
+    (FeatureUnit.energy_ratio, "energy", "energy_max"),
+)
+_UNIT_ORDER_IDS = (FeatureUnit.order_id_0, FeatureUnit.order_id_1,
+                   FeatureUnit.order_id_2, FeatureUnit.order_id_3)
+_UNIT_ORDER_PROGRESS = (FeatureUnit.order_progress_0,
+                        FeatureUnit.order_progress_1)
+_UNIT_BUFF_IDS = (FeatureUnit.buff_id_0, FeatureUnit.buff_id_1)
+
+
+class UnitColumns(object):
+  """The `FeatureUnit` columns of the raw units, computed in one pass.
+
+  The fields of all the units are read at once (one attrgetter per unit) into
+  a float64 array, and the columns are computed from them as vectorized ops.
+  Only the units with orders, buffs or an add-on are visited again. The columns
+  which depend on a world to screen or minimap transform (x, y and radius) are
+  filled by `to_array`, so the raw and the on screen units share the pass.
+
+  The values are exactly the ones of the per unit computation: the same float64
+  ops in the same order, truncated to int64 as `np.array(..., dtype=np.int64)`
+  does with python floats.
+  """
+
+  def __init__(self, units):
+    num_units = len(units)
+    values = []
+    tags = []
+    others = []
+    for i, u in enumerate(units):
+      values.append(_get_unit_fields(u))
+      tag, add_on_tag, orders, buff_ids = _get_unit_other_fields(u)
+      tags.append(tag)
+      if add_on_tag or orders or buff_ids:
+        others.append((i, add_on_tag, orders, buff_ids))
+    values = np.array(values, dtype=np.float64).reshape(
+        (num_units, len(_UNIT_FIELDS)))
+
+    columns = np.zeros((num_units, len(FeatureUnit)), dtype=np.int64)
+    columns[:, _UNIT_COPIED_COLUMNS] = values[:, _UNIT_COPIED_FIELDS]
+    columns[:, FeatureUnit.tag] = tags
+    columns[:, FeatureUnit.build_progress] = (
+        values[:, _UNIT_FIELD_INDEX["build_progress"]] * 100)  # discretize
+    for column, value, value_max in _UNIT_RATIOS:
+      value_max = values[:, _UNIT_FIELD_INDEX[value_max]]
+      ratio = np.zeros(num_units, dtype=np.float64)
+      np.divide(values[:, _UNIT_FIELD_INDEX[value]], value_max, out=ratio,
+                where=value_max > 0)
+      columns[:, column] = ratio * 255
+
+    tag_types = {}  # Only populate the cache if it's needed.
+    for i, add_on_tag, orders, buff_ids in others:
+      row = columns[i]
+      if orders:
+        row[FeatureUnit.order_length] = len(orders)
+        for column, order in zip(_UNIT_ORDER_IDS, orders):
+          # TODO(tewalds): Return a generalized func id.
+          row[column] = actions.RAW_ABILITY_ID_TO_FUNC_ID.get(
+              order.ability_id, 0)
+        for column, order in zip(_UNIT_ORDER_PROGRESS, orders):
+          row[column] = int(order.progress * 100)
+      for column, buff_id in zip(_UNIT_BUFF_IDS, buff_ids):
+        row[column] = buff_id
+      if add_on_tag:
+        if not tag_types:
+          tag_types = dict(zip(columns[:, FeatureUnit.tag].tolist(),
+                               columns[:, FeatureUnit.unit_type].tolist()))
+        row[FeatureUnit.addon_unit_type] = tag_types.get(add_on_tag, 0)
+
+    self.columns = columns
+    self.positions = values[:, [_UNIT_FIELD_INDEX["pos.x"],
+                                _UNIT_FIELD_INDEX["pos.y"]]]
+    self.radius = values[:, _UNIT_FIELD_INDEX["radius"]]
+    self.on_screen = columns[:, FeatureUnit.is_on_screen] != 0
+
+  def __len__(self):
+    return len(self.columns)
+
+  def to_array(self, pos_transform, on_screen_only=False):
+    """The [num_units, len(FeatureUnit)] int64 array, positions transformed."""
+    if on_screen_only:
+      columns = self.columns[self.on_screen]
+      positions = self.positions[self.on_screen]
+      radius = self.radius[self.on_screen]
+    else:
+      columns = self.columns.copy()
+      positions, radius = self.positions, self.radius
+    columns[:, [FeatureUnit.x, FeatureUnit.y]] = pos_transform.fwd_pts(
+        positions)
+    columns[:, FeatureUnit.radius] = pos_transform.fwd_dist(radius)
+    return columns
+
+
 class Features(object):
   """Render feature layers from SC2 Observation protos into numpy arrays.
 
@@ -944,6 +1249,7 @@ class Features(object):
       ValueError: if agent_interface_format isn't specified.
       ValueError: if map_size isn't specified when use_feature_units or
           use_camera_position is.
+      ValueError: if the observation_fields aren't observations of this format.
     """
     if not agent_interface_format:
       raise ValueError("Please specify agent_interface_format")
@@ -975,6 +1281,11 @@ class Features(object):
     self._requested_races = requested_races
     if requested_races is not None:
       assert len(requested_races) <= 2
+    self._lazy_raw_units = None  # The latest lazy observation with raw_units.
+    self._feature_layer_buffers = {}  # For reuse_feature_layers.
+    self._available_actions_cache = collections.OrderedDict()
+    if aif.observation_fields is not None:
+      self.observation_spec()  # Validates the fields.
 
   def init_camera(
       self, feature_dimensions, map_size, camera_width_world_units,
@@ -1013,6 +1324,8 @@ class Features(object):
           self._world_tl_to_world_camera_rel,
           world_camera_rel_to_feature_screen,
           transform.PixelToCoord())
+      self._world_camera_rel_to_feature_screen = (
+          world_camera_rel_to_feature_screen)
 
     # If we don't have a specified raw resolution, we do no transform.
     world_tl_to_feature_minimap = transform.Linear(
@@ -1030,6 +1343,20 @@ class Features(object):
         -self._world_to_world_tl.fwd_pt(camera_center) *
         self._world_tl_to_world_camera_rel.scale)
 
+  def _camera_transform(self, camera_center):
+    """The world to feature screen transform of a camera center.
+
+    Unlike `_update_camera` this leaves the camera of `self` as it is, so a lazy
+    observation is rendered with the camera it was built with.
+    """
+    scale = self._world_tl_to_world_camera_rel.scale
+    return transform.Chain(
+        self._world_to_world_tl,
+        transform.Linear(
+            scale, -self._world_to_world_tl.fwd_pt(camera_center) * scale),
+        self._world_camera_rel_to_feature_screen,
+        transform.PixelToCoord())
+
   def observation_spec(self):
     """The observation spec for the SC2 environment.
 
@@ -1083,12 +1410,13 @@ class Features(object):
       obs_spec["rgb_minimap"] = (aif.rgb_dimensions.minimap.y,
                                  aif.rgb_dimensions.minimap.x,
                                  3)
+    units_spec = (0,) if aif.structured_units else (0, len(FeatureUnit))
     if aif.use_feature_units:
-      obs_spec["feature_units"] = (0, len(FeatureUnit))  # pytype: disable=wrong-arg-types
+      obs_spec["feature_units"] = units_spec
       obs_spec["feature_effects"] = (0, len(EffectPos))
 
     if aif.use_raw_units:
-      obs_spec["raw_units"] = (0, len(FeatureUnit))
+      obs_spec["raw_units"] = units_spec
       obs_spec["raw_effects"] = (0, len(EffectPos))
 
     if aif.use_feature_units or aif.use_raw_units:
@@ -1108,6 +1436,15 @@ class Features(object):
 
     obs_spec["home_race_requested"] = (1,)
     obs_spec["away_race_requested"] = (1,)
+
+    fields = self._agent_interface_format.observation_fields
+    if fields is not None:
+      unknown = fields.difference(obs_spec)
+      if unknown:
+        raise ValueError("Unknown observation_fields: %s, must be in: %s" % (
+            sorted(unknown), sorted(obs_spec)))
+      obs_spec = named_array.NamedDict(
+          (name, shape) for name, shape in obs_spec.items() if name in fields)
     return obs_spec
 
   def action_spec(self):
@@ -1124,111 +1461,142 @@ class Features(object):
 
   @sw.decorate
   def transform_obs(self, obs):
-    """Render some SC2 observations into something an agent can handle."""
-    empty_unit = np.array([], dtype=np.int32).reshape((0, len(UnitLayer)))
-    out = named_array.NamedDict({  # Fill out some that are sometimes empty.
-        "single_select": empty_unit,
-        "multi_select": empty_unit,
-        "build_queue": empty_unit,
-        "cargo": empty_unit,
-        "production_queue": np.array([], dtype=np.int32).reshape(
-            (0, len(ProductionQueue))),
-        "last_actions": np.array([], dtype=np.int32),
-        "cargo_slots_available": np.array([0], dtype=np.int32),
-        "home_race_requested": np.array([0], dtype=np.int32),
-        "away_race_requested": np.array([0], dtype=np.int32),
-        "map_name": self._map_name,
-    })
+    """Render some SC2 observations into something an agent can handle.
 
-    def or_zeros(layer, size):
-      if layer is not None:
-        return layer.astype(np.int32, copy=False)
+    Only the `observation_fields` of the agent interface format are rendered.
+    With `lazy_observations` this returns a `LazyNamedDict`, which renders each
+    group of fields from `obs` when one of them is first read.
+    """
+    aif = self._agent_interface_format
+    fields = aif.observation_fields
+    if aif.lazy_observations:
+      out = named_array.LazyNamedDict()
+    else:
+      out = named_array.NamedDict()
+
+    def add(names, render):
+      """Adds the observations `names`, all in the dict returned by render."""
+      if fields is not None:
+        names = [name for name in names if name in fields]
+        if not names:
+          return
+      if aif.lazy_observations:
+        out.set_lazy(names, render)
       else:
-        return np.zeros((size.y, size.x), dtype=np.int32)
+        values = render()
+        for name in names:
+          out[name] = values[name]
 
-    aif = self._agent_interface_format
+    def add_one(name, render):
+      add([name], lambda: {name: render()})
 
-    if aif.feature_dimensions:
+    empty_unit = np.array([], dtype=np.int32).reshape((0, len(UnitLayer)))
+
+    def feature_layers(name, layer_features, size):
+      """Decodes the layers into one (len(layer_features), y, x) array."""
+      planes = getattr(obs.observation.feature_layer_data,
+                       layer_features[0].layer_set)
+      layers = [getattr(planes, f.name) for f in layer_features]
+      dtype = aif.feature_layer_dtype
+      if dtype is None:
+        dtype = Feature.dtypes[max(
+            [l.bits_per_pixel for l in layers if l.size.x] or [8])]
+      shape = (len(layers), size.y, size.x)
+      if aif.reuse_feature_layers:
+        out = self._feature_layer_buffers.get(name)
+        if out is None or out.shape != shape or out.dtype != dtype:
+          out = np.empty(shape, dtype=dtype)
+          self._feature_layer_buffers[name] = out
+      else:
+        out = np.empty(shape, dtype=dtype)
+      for layer, plane in zip(layers, out):
+        if not Feature.unpack_layer_into(layer, plane):
+          plane.fill(0)
+      return out
+
+    def feature_screen():
       with sw("feature_screen"):
-        out["feature_screen"] = named_array.NamedNumpyArray(
-            np.stack([or_zeros(f.unpack(obs.observation),
-                               aif.feature_dimensions.screen)
-                      for f in SCREEN_FEATURES]),
-            names=[ScreenFeatures, None, None])
+        return named_array.NamedNumpyArray(
+            feature_layers("feature_screen", SCREEN_FEATURES,
+                           aif.feature_dimensions.screen),
+            names=[ScreenFeatures, None, None], copy=False)
+
+    def feature_minimap():
       with sw("feature_minimap"):
-        out["feature_minimap"] = named_array.NamedNumpyArray(
-            np.stack([or_zeros(f.unpack(obs.observation),
-                               aif.feature_dimensions.minimap)
-                      for f in MINIMAP_FEATURES]),
-            names=[MinimapFeatures, None, None])
+        return named_array.NamedNumpyArray(
+            feature_layers("feature_minimap", MINIMAP_FEATURES,
+                           aif.feature_dimensions.minimap),
+            names=[MinimapFeatures, None, None], copy=False)
 
-    if aif.rgb_dimensions:
+    def rgb_screen():
       with sw("rgb_screen"):
-        out["rgb_screen"] = Feature.unpack_rgb_image(
+        return Feature.unpack_rgb_image(
             obs.observation.render_data.map).astype(np.int32)
+
+    def rgb_minimap():
       with sw("rgb_minimap"):
-        out["rgb_minimap"] = Feature.unpack_rgb_image(
+        return Feature.unpack_rgb_image(
             obs.observation.render_data.minimap).astype(np.int32)
 
-    if not self._raw:
+    def last_actions():
+      if self._raw:
+        return np.array([], dtype=np.int32)
       with sw("last_actions"):
-        out["last_actions"] = np.array(
+        return np.array(
             [self.reverse_action(a).function for a in obs.actions],
             dtype=np.int32)
 
-    out["action_result"] = np.array([o.result for o in obs.action_errors],
-                                    dtype=np.int32)
-
-    out["alerts"] = np.array(obs.observation.alerts, dtype=np.int32)
-
-    out["game_loop"] = np.array([obs.observation.game_loop], dtype=np.int32)
-
-    with sw("score"):
-      score_details = obs.observation.score.score_details
-      out["score_cumulative"] = named_array.NamedNumpyArray([
-          obs.observation.score.score,
-          score_details.idle_production_time,
-          score_details.idle_worker_time,
-          score_details.total_value_units,
-          score_details.total_value_structures,
-          score_details.killed_value_units,
-          score_details.killed_value_structures,
-          score_details.collected_minerals,
-          score_details.collected_vespene,
-          score_details.collection_rate_minerals,
-          score_details.collection_rate_vespene,
-          score_details.spent_minerals,
-          score_details.spent_vespene,
-      ], names=ScoreCumulative, dtype=np.int32)
-
-      def get_score_details(key, details, categories):
-        row = getattr(details, key.name)
-        return [getattr(row, category.name) for category in categories]
-
-      out["score_by_category"] = named_array.NamedNumpyArray([
-          get_score_details(key, score_details, ScoreCategories)
-          for key in ScoreByCategory
-      ], names=[ScoreByCategory, ScoreCategories], dtype=np.int32)
-
-      out["score_by_vital"] = named_array.NamedNumpyArray([
-          get_score_details(key, score_details, ScoreVitals)
-          for key in ScoreByVital
-      ], names=[ScoreByVital, ScoreVitals], dtype=np.int32)
+    def score():
+      with sw("score"):
+        out = {}
+        score_details = obs.observation.score.score_details
+        out["score_cumulative"] = named_array.NamedNumpyArray([
+            obs.observation.score.score,
+            score_details.idle_production_time,
+            score_details.idle_worker_time,
+            score_details.total_value_units,
+            score_details.total_value_structures,
+            score_details.killed_value_units,
+            score_details.killed_value_structures,
+            score_details.collected_minerals,
+            score_details.collected_vespene,
+            score_details.collection_rate_minerals,
+            score_details.collection_rate_vespene,
+            score_details.spent_minerals,
+            score_details.spent_vespene,
+        ], names=ScoreCumulative, dtype=np.int32)
+
+        def get_score_details(key, details, categories):
+          row = getattr(details, key.name)
+          return [getattr(row, category.name) for category in categories]
+
+        out["score_by_category"] = named_array.NamedNumpyArray([
+            get_score_details(key, score_details, ScoreCategories)
+            for key in ScoreByCategory
+        ], names=[ScoreByCategory, ScoreCategories], dtype=np.int32)
+
+        out["score_by_vital"] = named_array.NamedNumpyArray([
+            get_score_details(key, score_details, ScoreVitals)
+            for key in ScoreByVital
+        ], names=[ScoreByVital, ScoreVitals], dtype=np.int32)
+        return out
 
     player = obs.observation.player_common
-    out["player"] = named_array.NamedNumpyArray([
-        player.player_id,
-        player.minerals,
-        player.vespene,
-        player.food_used,
-        player.food_cap,
-        player.food_army,
-        player.food_workers,
-        player.idle_worker_count,
-        player.army_count,
-        player.warp_gate_count,
-        player.larva_count,
-    ], names=Player, dtype=np.int32)
+
+    def player_common():
+      return named_array.NamedNumpyArray([
+          player.player_id,
+          player.minerals,
+          player.vespene,
+          player.food_used,
+          player.food_cap,
+          player.food_army,
+          player.food_workers,
+          player.idle_worker_count,
+          player.army_count,
+          player.warp_gate_count,
+          player.larva_count,
+      ], names=Player, dtype=np.int32)
 
     def unit_vec(u):
       return np.array((
@@ -1241,173 +1609,64 @@ class Features(object):
           int(u.build_progress * 100),  # discretize
       ), dtype=np.int32)
 
-    ui = obs.observation.ui_data
-
-    with sw("ui"):
-      groups = np.zeros((10, 2), dtype=np.int32)
-      for g in ui.groups:
-        groups[g.control_group_index, :] = (g.leader_unit_type, g.count)
-      out["control_groups"] = groups
-
-      if ui.HasField("single"):
-        out["single_select"] = named_array.NamedNumpyArray(
-            [unit_vec(ui.single.unit)], [None, UnitLayer])
-      elif ui.HasField("multi"):
-        out["multi_select"] = named_array.NamedNumpyArray(
-            [unit_vec(u) for u in ui.multi.units], [None, UnitLayer])
-      elif ui.HasField("cargo"):
-        out["single_select"] = named_array.NamedNumpyArray(
-            [unit_vec(ui.cargo.unit)], [None, UnitLayer])
-        out["cargo"] = named_array.NamedNumpyArray(
-            [unit_vec(u) for u in ui.cargo.passengers], [None, UnitLayer])
-        out["cargo_slots_available"] = np.array([ui.cargo.slots_available],
-                                                dtype=np.int32)
-      elif ui.HasField("production"):
-        out["single_select"] = named_array.NamedNumpyArray(
-            [unit_vec(ui.production.unit)], [None, UnitLayer])
-        if ui.production.build_queue:
-          out["build_queue"] = named_array.NamedNumpyArray(
-              [unit_vec(u) for u in ui.production.build_queue],
-              [None, UnitLayer], dtype=np.int32)
-        if ui.production.production_queue:
-          out["production_queue"] = named_array.NamedNumpyArray(
-              [(item.ability_id, item.build_progress * 100)
-               for item in ui.production.production_queue],
-              [None, ProductionQueue], dtype=np.int32)
-
-    tag_types = {}  # Only populate the cache if it's needed.
-    def get_addon_type(tag):
-      if not tag_types:
-        for u in raw.units:
-          tag_types[u.tag] = u.unit_type
-      return tag_types.get(tag, 0)
-
-    def full_unit_vec(u, pos_transform, is_raw=False):
-      """Compute unit features."""
-      screen_pos = pos_transform.fwd_pt(
-          point.Point.build(u.pos))
-      screen_radius = pos_transform.fwd_dist(u.radius)
-      def raw_order(i):
-        if len(u.orders) > i:
-          # TODO(tewalds): Return a generalized func id.
-          return actions.RAW_ABILITY_ID_TO_FUNC_ID.get(
-              u.orders[i].ability_id, 0)
-        return 0
-      features = [
-          # Match unit_vec order
-          u.unit_type,
-          u.alliance,  # Self = 1, Ally = 2, Neutral = 3, Enemy = 4
-          u.health,
-          u.shield,
-          u.energy,
-          u.cargo_space_taken,
-          int(u.build_progress * 100),  # discretize
-
-          # Resume API order
-          int(u.health / u.health_max * 255) if u.health_max > 0 else 0,
-          int(u.shield / u.shield_max * 255) if u.shield_max > 0 else 0,
-          int(u.energy / u.energy_max * 255) if u.energy_max > 0 else 0,
-          u.display_type,  # Visible = 1, Snapshot = 2, Hidden = 3
-          u.owner,  # 1-15, 16 = neutral
-          screen_pos.x,
-          screen_pos.y,
-          u.facing,
-          screen_radius,
-          u.cloak,  # Cloaked = 1, CloakedDetected = 2, NotCloaked = 3
-          u.is_selected,
-          u.is_blip,
-          u.is_powered,
-          u.mineral_contents,
-          u.vespene_contents,
-
-          # Not populated for enemies or neutral
-          u.cargo_space_max,
-          u.assigned_harvesters,
-          u.ideal_harvesters,
-          u.weapon_cooldown,
-          len(u.orders),
-          raw_order(0),
-          raw_order(1),
-          # u.tag if is_raw else 0,
-          u.tag,
-          u.is_hallucination,
-          u.buff_ids[0] if len(u.buff_ids) >= 1 else 0,
-          u.buff_ids[1] if len(u.buff_ids) >= 2 else 0,
-          get_addon_type(u.add_on_tag) if u.add_on_tag else 0,
-          u.is_active,
-          u.is_on_screen,
-          int(u.orders[0].progress * 100) if len(u.orders) >= 1 else 0,
-          int(u.orders[1].progress * 100) if len(u.orders) >= 2 else 0,
-          raw_order(2),
-          raw_order(3),
-          0,
-          u.buff_duration_remain,
-          u.buff_duration_max,
-          u.attack_upgrade_level,
-          u.armor_upgrade_level,
-          u.shield_upgrade_level,
-      ]
-      return features
+    def ui_data():
+      ui = obs.observation.ui_data
+      with sw("ui"):
+        out = {  # Fill out some that are sometimes empty.
+            "single_select": empty_unit,
+            "multi_select": empty_unit,
+            "build_queue": empty_unit,
+            "cargo": empty_unit,
+            "production_queue": np.array([], dtype=np.int32).reshape(
+                (0, len(ProductionQueue))),
+            "cargo_slots_available": np.array([0], dtype=np.int32),
+        }
+
+        groups = np.zeros((10, 2), dtype=np.int32)
+        for g in ui.groups:
+          groups[g.control_group_index, :] = (g.leader_unit_type, g.count)
+        out["control_groups"] = groups
+
+        if ui.HasField("single"):
+          out["single_select"] = named_array.NamedNumpyArray(
+              [unit_vec(ui.single.unit)], [None, UnitLayer])
+        elif ui.HasField("multi"):
+          out["multi_select"] = named_array.NamedNumpyArray(
+              [unit_vec(u) for u in ui.multi.units], [None, UnitLayer])
+        elif ui.HasField("cargo"):
+          out["single_select"] = named_array.NamedNumpyArray(
+              [unit_vec(ui.cargo.unit)], [None, UnitLayer])
+          out["cargo"] = named_array.NamedNumpyArray(
+              [unit_vec(u) for u in ui.cargo.passengers], [None, UnitLayer])
+          out["cargo_slots_available"] = np.array([ui.cargo.slots_available],
+                                                  dtype=np.int32)
+        elif ui.HasField("production"):
+          out["single_select"] = named_array.NamedNumpyArray(
+              [unit_vec(ui.production.unit)], [None, UnitLayer])
+          if ui.production.build_queue:
+            out["build_queue"] = named_array.NamedNumpyArray(
+                [unit_vec(u) for u in ui.production.build_queue],
+                [None, UnitLayer], dtype=np.int32)
+          if ui.production.production_queue:
+            out["production_queue"] = named_array.NamedNumpyArray(
+                [(item.ability_id, item.build_progress * 100)
+                 for item in ui.production.production_queue],
+                [None, ProductionQueue], dtype=np.int32)
+        return out
 
     raw = obs.observation.raw_data
 
-    if aif.use_feature_units:
-      with sw("feature_units"):
-        # Update the camera location so we can calculate world to screen pos
-        self._update_camera(point.Point.build(raw.player.camera))
-        feature_units = [full_unit_vec(u, self._world_to_feature_screen_px)
-                         for u in raw.units if u.is_on_screen]
-        out["feature_units"] = named_array.NamedNumpyArray(
-            feature_units, [None, FeatureUnit], dtype=np.int64)
+    unit_columns = []  # Computed once for the raw and the feature units.
+    def get_unit_columns():
+      if not unit_columns:
+        unit_columns.append(UnitColumns(raw.units))
+      return unit_columns[0]
 
-        feature_effects = []
-        feature_screen_size = aif.feature_dimensions.screen
-        for effect in raw.effects:
-          for pos in effect.pos:
-            screen_pos = self._world_to_feature_screen_px.fwd_pt(
-                point.Point.build(pos))
-            if (0 <= screen_pos.x < feature_screen_size.x and
-                0 <= screen_pos.y < feature_screen_size.y):
-              feature_effects.append([
-                  effect.effect_id,
-                  effect.alliance,
-                  effect.owner,
-                  effect.radius,
-                  screen_pos.x,
-                  screen_pos.y,
-              ])
-        out["feature_effects"] = named_array.NamedNumpyArray(
-            feature_effects, [None, EffectPos], dtype=np.int32)
-
-    if aif.use_raw_units:
-      with sw("raw_units"):
-        with sw("to_list"):
-          raw_units = [full_unit_vec(u, self._world_to_minimap_px, is_raw=True)
-                       for u in raw.units]
-        with sw("to_numpy"):
-          out["raw_units"] = named_array.NamedNumpyArray(
-              raw_units, [None, FeatureUnit], dtype=np.int64)
-        if raw_units:
-          self._raw_tags = out["raw_units"][:, FeatureUnit.tag]
-        else:
-          self._raw_tags = np.array([])
-
-        raw_effects = []
-        for effect in raw.effects:
-          for pos in effect.pos:
-            raw_pos = self._world_to_minimap_px.fwd_pt(point.Point.build(pos))
-            raw_effects.append([
-                effect.effect_id,
-                effect.alliance,
-                effect.owner,
-                effect.radius,
-                raw_pos.x,
-                raw_pos.y,
-            ])
-        out["raw_effects"] = named_array.NamedNumpyArray(
-            raw_effects, [None, EffectPos], dtype=np.int32)
-
-    out["upgrades"] = np.array(raw.player.upgrade_ids, dtype=np.int32)
+    def units_array(pos_transform, on_screen_only=False):
+      units = get_unit_columns().to_array(pos_transform, on_screen_only)
+      # No units is a (0,) array, not (0, len(FeatureUnit)).
+      return named_array.NamedNumpyArray(
+          units if len(units) else [], [None, FeatureUnit], dtype=np.int64)
 
     def cargo_units(u, pos_transform, is_raw=False):
       """Compute unit features."""
@@ -1465,16 +1724,45 @@ class Features(object):
         ])
       return features
 
-    if aif.add_cargo_to_units:
-      with sw("add_cargo_to_units"):
-        if aif.use_feature_units:
+    if aif.use_feature_units:
+      # The camera of this observation, even if it is rendered later.
+      world_to_feature_screen_px = self._camera_transform(
+          point.Point.build(raw.player.camera))
+
+    def feature_units():
+      out = {}
+      with sw("feature_units"):
+        out["feature_units"] = units_array(world_to_feature_screen_px,
+                                           on_screen_only=True)
+
+        feature_effects = []
+        feature_screen_size = aif.feature_dimensions.screen
+        for effect in raw.effects:
+          for pos in effect.pos:
+            screen_pos = world_to_feature_screen_px.fwd_pt(
+                point.Point.build(pos))
+            if (0 <= screen_pos.x < feature_screen_size.x and
+                0 <= screen_pos.y < feature_screen_size.y):
+              feature_effects.append([
+                  effect.effect_id,
+                  effect.alliance,
+                  effect.owner,
+                  effect.radius,
+                  screen_pos.x,
+                  screen_pos.y,
+              ])
+        out["feature_effects"] = named_array.NamedNumpyArray(
+            feature_effects, [None, EffectPos], dtype=np.int32)
+
+      if aif.add_cargo_to_units:
+        with sw("add_cargo_to_units"):
           with sw("feature_units"):
             with sw("to_list"):
               feature_cargo_units = []
               for u in raw.units:
                 if u.is_on_screen:
                   feature_cargo_units += cargo_units(
-                      u, self._world_to_feature_screen_px)
+                      u, world_to_feature_screen_px)
             with sw("to_numpy"):
               if feature_cargo_units:
                 all_feature_units = np.array(
@@ -1483,7 +1771,35 @@ class Features(object):
                     [out["feature_units"], feature_cargo_units], axis=0)
                 out["feature_units"] = named_array.NamedNumpyArray(
                     all_feature_units, [None, FeatureUnit], dtype=np.int64)
-        if aif.use_raw_units:
+      if aif.structured_units:
+        out["feature_units"] = units_to_structured(out["feature_units"])
+      return out
+
+    def raw_units():
+      out = {}
+      with sw("raw_units"):
+        with sw("to_list"):
+          get_unit_columns()
+        with sw("to_numpy"):
+          out["raw_units"] = units_array(self._world_to_minimap_px)
+
+        raw_effects = []
+        for effect in raw.effects:
+          for pos in effect.pos:
+            raw_pos = self._world_to_minimap_px.fwd_pt(point.Point.build(pos))
+            raw_effects.append([
+                effect.effect_id,
+                effect.alliance,
+                effect.owner,
+                effect.radius,
+                raw_pos.x,
+                raw_pos.y,
+            ])
+        out["raw_effects"] = named_array.NamedNumpyArray(
+            raw_effects, [None, EffectPos], dtype=np.int32)
+
+      if aif.add_cargo_to_units:
+        with sw("add_cargo_to_units"):
           with sw("raw_units"):
             with sw("to_list"):
               raw_cargo_units = []
@@ -1497,78 +1813,135 @@ class Features(object):
                     [out["raw_units"], raw_cargo_units], axis=0)
                 out["raw_units"] = named_array.NamedNumpyArray(
                     all_raw_units, [None, FeatureUnit], dtype=np.int64)
-                self._raw_tags = out["raw_units"][:, FeatureUnit.tag]
 
-    if aif.use_unit_counts:
+      # The raw actions refer to the units of the latest observation.
+      if not aif.lazy_observations or self._lazy_raw_units is lazy_out:
+        if len(out["raw_units"]):
+          self._raw_tags = out["raw_units"][:, FeatureUnit.tag]
+        else:
+          self._raw_tags = np.array([])
+      if aif.structured_units:
+        out["raw_units"] = units_to_structured(out["raw_units"])
+      return out
+
+    def unit_counts():
       with sw("unit_counts"):
         unit_counts = collections.defaultdict(int)
         for u in raw.units:
           if u.alliance == sc_raw.Self:
             unit_counts[u.unit_type] += 1
-        out["unit_counts"] = named_array.NamedNumpyArray(
+        return named_array.NamedNumpyArray(
             sorted(unit_counts.items()), [None, UnitCounts], dtype=np.int32)
 
-    if aif.use_camera_position:
+    def camera():
       camera_position = self._world_to_minimap_px.fwd_pt(
           point.Point.build(raw.player.camera))
-      out["camera_position"] = np.array((camera_position.x, camera_position.y),
-                                        dtype=np.int32)
-      out["camera_size"] = np.array((self._camera_size.x, self._camera_size.y),
-                                    dtype=np.int32)
-
+      return {
+          "camera_position": np.array(
+              (camera_position.x, camera_position.y), dtype=np.int32),
+          "camera_size": np.array(
+              (self._camera_size.x, self._camera_size.y), dtype=np.int32),
+      }
+
+    def requested_races():
+      out = {
+          "home_race_requested": np.array([0], dtype=np.int32),
+          "away_race_requested": np.array([0], dtype=np.int32),
+      }
+      if self._requested_races is not None:
+        out["home_race_requested"] = np.array(
+            (self._requested_races[player.player_id],), dtype=np.int32)
+        for player_id, race in self._requested_races.items():
+          if player_id != player.player_id:
+            out["away_race_requested"] = np.array((race,), dtype=np.int32)
+      return out
+
+    def transform_radar(radar):
+      p = self._world_to_minimap_px.fwd_pt(point.Point.build(radar.pos))
+      return p.x, p.y, radar.radius
+
+    add_one("map_name", lambda: self._map_name)
+    if aif.feature_dimensions:
+      add_one("feature_screen", feature_screen)
+      add_one("feature_minimap", feature_minimap)
+    if aif.rgb_dimensions:
+      add_one("rgb_screen", rgb_screen)
+      add_one("rgb_minimap", rgb_minimap)
+    add_one("last_actions", last_actions)
+    add_one("action_result", lambda: np.array(
+        [o.result for o in obs.action_errors], dtype=np.int32))
+    add_one("alerts", lambda: np.array(obs.observation.alerts, dtype=np.int32))
+    add_one("game_loop", lambda: np.array(
+        [obs.observation.game_loop], dtype=np.int32))
+    add(["score_cumulative", "score_by_category", "score_by_vital"], score)
+    add_one("player", player_common)
+    add(["single_select", "multi_select", "build_queue", "cargo",
+         "production_queue", "cargo_slots_available", "control_groups"],
+        ui_data)
+    if aif.use_feature_units:
+      add(["feature_units", "feature_effects"], feature_units)
+    if aif.use_raw_units:
+      lazy_out = out
+      if aif.lazy_observations:
+        self._lazy_raw_units = lazy_out
+      add(["raw_units", "raw_effects"], raw_units)
+    add_one("upgrades", lambda: np.array(
+        raw.player.upgrade_ids, dtype=np.int32))
+    if aif.use_unit_counts:
+      add_one("unit_counts", unit_counts)
+    if aif.use_camera_position:
+      add(["camera_position", "camera_size"], camera)
     if not self._raw:
-      out["available_actions"] = np.array(
-          self.available_actions(obs.observation), dtype=np.int32)
-
-    if self._requested_races is not None:
-      out["home_race_requested"] = np.array(
-          (self._requested_races[player.player_id],), dtype=np.int32)
-      for player_id, race in self._requested_races.items():
-        if player_id != player.player_id:
-          out["away_race_requested"] = np.array((race,), dtype=np.int32)
-
+      add_one("available_actions", lambda: np.array(
+          self.available_actions(obs.observation), dtype=np.int32))
+    add(["home_race_requested", "away_race_requested"], requested_races)
     if aif.use_feature_units or aif.use_raw_units:
-      def transform_radar(radar):
-        p = self._world_to_minimap_px.fwd_pt(point.Point.build(radar.pos))
-        return p.x, p.y, radar.radius
-      out["radar"] = named_array.NamedNumpyArray(
+      add_one("radar", lambda: named_array.NamedNumpyArray(
           list(map(transform_radar, obs.observation.raw_data.radar)),
-          [None, Radar], dtype=np.int32)
+          [None, Radar], dtype=np.int32))
 
     # Send the entire proto as well (in a function, so it isn't copied).
     if self._send_observation_proto:
-      out["_response_observation"] = lambda: obs
+      add_one("_response_observation", lambda: lambda: obs)
 
     return out
 
   @sw.decorate
   def available_actions(self, obs):
-    """Return the list of available action ids."""
-    available_actions = set()
+    """Return the list of available action ids.
+
+    They only depend on the `avail_fn`s of the functions and the abilities, so
+    the latest `AVAILABLE_ACTIONS_CACHE_SIZE` results are kept by those.
+    """
     hide_specific_actions = self._agent_interface_format.hide_specific_actions
-    for i, func in actions.FUNCTIONS_AVAILABLE.items():
-      if func.avail_fn(obs):
-        available_actions.add(i)
-    for a in obs.abilities:
-      if a.ability_id not in actions.ABILITY_IDS:
-        logging.warning("Unknown ability %s seen as available.", a.ability_id)
+    available_fns = tuple(i for i, func in actions.FUNCTIONS_AVAILABLE.items()
+                          if func.avail_fn(obs))
+    abilities = frozenset((a.ability_id, a.requires_point)
+                          for a in obs.abilities)
+    key = (available_fns, abilities)
+
+    cache = self._available_actions_cache
+    available_actions = cache.get(key)
+    if available_actions is not None:
+      cache.move_to_end(key)
+      return list(available_actions)
+
+    available_actions = set(available_fns)
+    for ability_id, requires_point in sorted(abilities):
+      function_ids = actions.ABILITY_FUNCTION_IDS.get(
+          (ability_id, requires_point, hide_specific_actions))
+      if function_ids is None:
+        logging.warning("Unknown ability %s seen as available.", ability_id)
         continue
-      found_applicable = False
-      for func in actions.ABILITY_IDS[a.ability_id]:
-        if func.function_type in actions.POINT_REQUIRED_FUNCS[a.requires_point]:
-          if func.general_id == 0 or not hide_specific_actions:
-            available_actions.add(func.id)
-            found_applicable = True
-          if func.general_id != 0:  # Always offer generic actions.
-            for general_func in actions.ABILITY_IDS[func.general_id]:
-              if general_func.function_type is func.function_type:
-                # Only the right type. Don't want to expose the general action
-                # to minimap if only the screen version is available.
-                available_actions.add(general_func.id)
-                found_applicable = True
-                break
-      if not found_applicable:
-        raise ValueError("Failed to find applicable action for {}".format(a))
+      if not function_ids:
+        raise ValueError(
+            "Failed to find applicable action for ability_id: {}, "
+            "requires_point: {}".format(ability_id, requires_point))
+      available_actions |= function_ids
+
+    cache[key] = available_actions = frozenset(available_actions)
+    if len(cache) > AVAILABLE_ACTIONS_CACHE_SIZE:
+      cache.popitem(last=False)
     return list(available_actions)
 
   @sw.decorate
@@ -1657,6 +2030,9 @@ class Features(object):
     if self._raw:
       if "world" in kwargs:
         kwargs["world"] = self._world_to_minimap_px.back_pt(kwargs["world"])
+      if (self._lazy_raw_units is not None and
+          "raw_units" in self._lazy_raw_units):
+        self._lazy_raw_units.get("raw_units")  # Renders them, and the tags.
       def find_original_tag(position):
         if position >= len(self._raw_tags):  # Assume it's a real unit tag.
           return position
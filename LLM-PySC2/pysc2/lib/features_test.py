@@ -22,9 +22,11 @@ from absl.testing import parameterized
 import numpy
 from pysc2.lib import actions
 from pysc2.lib import features
+from pysc2.lib import named_array
 from pysc2.lib import point
 
 from google.protobuf import text_format
+from s2clientprotocol import raw_pb2 as sc_raw
 from s2clientprotocol import sc2api_pb2 as sc_pb
 
 
@@ -205,6 +207,61 @@ class AvailableActionsTest(absltest.TestCase):
         "Stop_quick",
     ])
 
+  def testMatchesAbilityLoop(self):
+    for hide_specific_actions in [True, False]:
+      self.hideSpecificActions(hide_specific_actions)
+      for ability_id in sorted(actions.ABILITY_IDS):
+        for requires_point in [False, True]:
+          del self.obs.abilities[:]
+          self.obs.abilities.add(ability_id=ability_id,
+                                 requires_point=requires_point)
+          try:
+            expected = reference_available_actions(
+                self.obs, hide_specific_actions)
+          except ValueError:
+            with self.assertRaises(ValueError):
+              self.features.available_actions(self.obs)
+            continue
+          self.assertCountEqual(
+              self.features.available_actions(self.obs), expected)
+
+  def testCacheFollowsObservation(self):
+    self.obs.abilities.add(ability_id=421, requires_point=True)
+    first = set(self.features.available_actions(self.obs))
+    self.obs.player_common.army_count = 3
+    self.obs.abilities.add(ability_id=32)
+    second = set(self.features.available_actions(self.obs))
+    self.assertEqual(second - first, {actions.FUNCTIONS.select_army.id,
+                                      actions.FUNCTIONS.Effect_Salvage_quick.id})
+    self.obs.player_common.army_count = 0
+    del self.obs.abilities[1:]
+    self.assertCountEqual(self.features.available_actions(self.obs), first)
+    self.assertLen(self.features._available_actions_cache, 2)
+
+
+def reference_available_actions(obs, hide_specific_actions):
+  """The available actions, by walking the functions of each ability."""
+  available_actions = set()
+  for i, func in actions.FUNCTIONS_AVAILABLE.items():
+    if func.avail_fn(obs):
+      available_actions.add(i)
+  for a in obs.abilities:
+    found_applicable = False
+    for func in actions.ABILITY_IDS[a.ability_id]:
+      if func.function_type in actions.POINT_REQUIRED_FUNCS[a.requires_point]:
+        if func.general_id == 0 or not hide_specific_actions:
+          available_actions.add(func.id)
+          found_applicable = True
+        if func.general_id != 0:
+          for general_func in actions.ABILITY_IDS[func.general_id]:
+            if general_func.function_type is func.function_type:
+              available_actions.add(general_func.id)
+              found_applicable = True
+              break
+    if not found_applicable:
+      raise ValueError("Failed to find applicable action for {}".format(a))
+  return list(available_actions)
+
 
 class ToPointTest(absltest.TestCase):
 
@@ -586,5 +643,412 @@ class FeaturesTest(absltest.TestCase):
     self.assertEqual(obs_spec["rgb_minimap"], (77, 74, 3))
 
 
+def reference_unit_vec(u, pos_transform, tag_types):
+  """The features of a unit as `transform_obs` computed them, one by one."""
+  screen_pos = pos_transform.fwd_pt(point.Point.build(u.pos))
+  screen_radius = pos_transform.fwd_dist(u.radius)
+  def raw_order(i):
+    if len(u.orders) > i:
+      return actions.RAW_ABILITY_ID_TO_FUNC_ID.get(u.orders[i].ability_id, 0)
+    return 0
+  return [
+      u.unit_type,
+      u.alliance,
+      u.health,
+      u.shield,
+      u.energy,
+      u.cargo_space_taken,
+      int(u.build_progress * 100),
+      int(u.health / u.health_max * 255) if u.health_max > 0 else 0,
+      int(u.shield / u.shield_max * 255) if u.shield_max > 0 else 0,
+      int(u.energy / u.energy_max * 255) if u.energy_max > 0 else 0,
+      u.display_type,
+      u.owner,
+      screen_pos.x,
+      screen_pos.y,
+      u.facing,
+      screen_radius,
+      u.cloak,
+      u.is_selected,
+      u.is_blip,
+      u.is_powered,
+      u.mineral_contents,
+      u.vespene_contents,
+      u.cargo_space_max,
+      u.assigned_harvesters,
+      u.ideal_harvesters,
+      u.weapon_cooldown,
+      len(u.orders),
+      raw_order(0),
+      raw_order(1),
+      u.tag,
+      u.is_hallucination,
+      u.buff_ids[0] if len(u.buff_ids) >= 1 else 0,
+      u.buff_ids[1] if len(u.buff_ids) >= 2 else 0,
+      tag_types.get(u.add_on_tag, 0) if u.add_on_tag else 0,
+      u.is_active,
+      u.is_on_screen,
+      int(u.orders[0].progress * 100) if len(u.orders) >= 1 else 0,
+      int(u.orders[1].progress * 100) if len(u.orders) >= 2 else 0,
+      raw_order(2),
+      raw_order(3),
+      0,
+      u.buff_duration_remain,
+      u.buff_duration_max,
+      u.attack_upgrade_level,
+      u.armor_upgrade_level,
+      u.shield_upgrade_level,
+  ]
+
+
+class TransformUnitsTest(parameterized.TestCase):
+
+  def _observation(self, num_units, seed=0, on_screen=0.5):
+    rng = numpy.random.RandomState(seed)
+    obs = text_format.Parse(observation_text_proto, sc_pb.Observation())
+    obs.raw_data.player.camera.x = 40.5
+    obs.raw_data.player.camera.y = 61.25
+    ability_ids = sorted(actions.RAW_ABILITY_ID_TO_FUNC_ID) + [1, 99999]
+    tags = rng.randint(1, 2**40, size=num_units)
+    for i in range(num_units):
+      def value(high, p_zero=0.2):
+        return 0. if rng.rand() < p_zero else float(rng.uniform(0, high))
+      u = obs.raw_data.units.add(
+          display_type=rng.randint(1, 5),
+          alliance=rng.randint(1, 5),
+          tag=int(tags[i]),
+          unit_type=rng.randint(0, 2000),
+          owner=rng.randint(1, 17),
+          facing=value(6.3),
+          radius=value(5),
+          build_progress=value(1),
+          cloak=rng.randint(0, 5),
+          is_selected=rng.rand() < 0.3,
+          is_on_screen=rng.rand() < on_screen,
+          is_blip=rng.rand() < 0.1,
+          is_powered=rng.rand() < 0.5,
+          is_active=rng.rand() < 0.5,
+          attack_upgrade_level=rng.randint(0, 4),
+          armor_upgrade_level=rng.randint(0, 4),
+          shield_upgrade_level=rng.randint(0, 4),
+          health=value(500),
+          health_max=value(500),
+          shield=value(300),
+          shield_max=value(300),
+          energy=value(200),
+          energy_max=value(200),
+          mineral_contents=rng.randint(0, 1800),
+          vespene_contents=rng.randint(0, 2250),
+          is_hallucination=rng.rand() < 0.1,
+          cargo_space_taken=rng.randint(0, 8),
+          cargo_space_max=rng.randint(0, 8),
+          assigned_harvesters=rng.randint(0, 16),
+          ideal_harvesters=rng.randint(0, 16),
+          weapon_cooldown=value(30),
+          buff_duration_remain=rng.randint(0, 100),
+          buff_duration_max=rng.randint(0, 100))
+      u.pos.x = rng.uniform(-1, 101)
+      u.pos.y = rng.uniform(-1, 101)
+      u.buff_ids.extend(rng.randint(1, 300, size=rng.randint(0, 4)).tolist())
+      for _ in range(rng.choice([0, 0, 1, 2, 5])):
+        u.orders.add(ability_id=int(rng.choice(ability_ids)),
+                     progress=value(1, p_zero=0.5))
+      if rng.rand() < 0.2:
+        u.add_on_tag = int(rng.choice(tags)) if rng.rand() < 0.8 else 7
+    return sc_pb.ResponseObservation(observation=obs)
+
+  def _features(self, raw_resolution=None, **kwargs):
+    return features.Features(
+        features.AgentInterfaceFormat(
+            feature_dimensions=RECTANGULAR_DIMENSIONS,
+            use_feature_units=True,
+            use_raw_units=True,
+            raw_resolution=raw_resolution,
+            **kwargs),
+        map_size=point.Point(100, 100))
+
+  def _reference(self, feats, obs):
+    raw = obs.observation.raw_data
+    tag_types = {u.tag: u.unit_type for u in raw.units}
+    feats._update_camera(point.Point.build(raw.player.camera))
+    feature_units = [
+        reference_unit_vec(u, feats._world_to_feature_screen_px, tag_types)
+        for u in raw.units if u.is_on_screen]
+    raw_units = [
+        reference_unit_vec(u, feats._world_to_minimap_px, tag_types)
+        for u in raw.units]
+    return (numpy.array(feature_units, dtype=numpy.int64),
+            numpy.array(raw_units, dtype=numpy.int64))
+
+  @parameterized.named_parameters(
+      ("no_raw_resolution", None, 300),
+      ("raw_resolution", 64, 300),
+      ("one_unit", 64, 1),
+  )
+  def testUnitsMatchPerUnitFeatures(self, raw_resolution, num_units):
+    feats = self._features(raw_resolution)
+    obs = self._observation(num_units)
+    out = feats.transform_obs(obs)
+    feature_units, raw_units = self._reference(feats, obs)
+
+    self.assertEqual(out["raw_units"].dtype, numpy.int64)
+    numpy.testing.assert_array_equal(out["raw_units"], raw_units)
+    numpy.testing.assert_array_equal(out["feature_units"], feature_units)
+    numpy.testing.assert_array_equal(
+        feats._raw_tags, raw_units[:, features.FeatureUnit.tag])
+    self.assertEqual(out["raw_units"][0].tag, raw_units[0, 29])
+
+  def testNoUnits(self):
+    feats = self._features(64)
+    out = feats.transform_obs(self._observation(0))
+    self.assertEqual(out["raw_units"].shape, (0,))
+    self.assertEqual(out["feature_units"].shape, (0,))
+    self.assertEqual(len(feats._raw_tags), 0)
+
+  def testNoUnitsOnScreen(self):
+    feats = self._features(64)
+    out = feats.transform_obs(self._observation(10, on_screen=0))
+    self.assertEqual(out["raw_units"].shape, (10, len(features.FeatureUnit)))
+    self.assertEqual(out["feature_units"].shape, (0,))
+
+  def testUnitsWithCargo(self):
+    feats = features.Features(
+        features.AgentInterfaceFormat(
+            use_raw_units=True, add_cargo_to_units=True,
+            action_space=actions.ActionSpace.RAW),
+        map_size=point.Point(100, 100))
+    obs = self._observation(5)
+    obs.observation.raw_data.units[2].passengers.add(
+        tag=5, unit_type=48, health=45, health_max=45)
+    out = feats.transform_obs(obs)
+    self.assertEqual(out["raw_units"].shape, (6, len(features.FeatureUnit)))
+    self.assertEqual(out["raw_units"][5].is_in_cargo, 1)
+    self.assertEqual(out["raw_units"][5].x, out["raw_units"][2].x)
+
+  def testPositionsTransformAsPoints(self):
+    feats = self._features(64)
+    feats._update_camera(point.Point(40.5, 61.25))
+    pts = numpy.random.RandomState(1).uniform(-1, 101, size=(50, 2))
+    for pos_transform in [feats._world_to_minimap_px,
+                          feats._world_to_feature_screen_px]:
+      expected = [pos_transform.fwd_pt(point.Point(x, y)) for x, y in pts]
+      numpy.testing.assert_array_equal(pos_transform.fwd_pts(pts), expected)
+
+  def testLazyObservationsMatchEager(self):
+    obs = self._observation(50)
+    eager = self._features(64, use_unit_counts=True, use_camera_position=True)
+    lazy = self._features(64, use_unit_counts=True, use_camera_position=True,
+                          lazy_observations=True)
+    expected = eager.transform_obs(obs)
+    out = lazy.transform_obs(obs)
+    self.assertIsInstance(out, named_array.LazyNamedDict)
+    self.assertCountEqual(out.keys(), expected.keys())
+    for name, value in expected.items():
+      numpy.testing.assert_array_equal(out[name], value, err_msg=name)
+
+  def testLazyObservationsRenderOnRead(self):
+    feats = self._features(64, lazy_observations=True)
+    obs = self._observation(20)
+    out = feats.transform_obs(obs)
+    self.assertIn("feature_screen", out)
+    self.assertNotIn("feature_screen", dict.keys(out))
+    self.assertEqual(out.game_loop[0], obs.observation.game_loop)
+    self.assertEqual(out["raw_units"].shape, (20, len(features.FeatureUnit)))
+    # Rendered with its group, and only once.
+    self.assertIn("raw_effects", dict.keys(out))
+    self.assertIs(out["raw_units"], out.raw_units)
+    self.assertNotIn("feature_screen", dict.keys(out))
+
+    restored = pickle.loads(pickle.dumps(out))
+    self.assertIsInstance(restored, named_array.NamedDict)
+    self.assertCountEqual(restored.keys(), out.keys())
+    numpy.testing.assert_array_equal(
+        restored.feature_screen, out.feature_screen)
+
+  def testLazyFeatureUnitsUseTheirCamera(self):
+    eager = self._features(64)
+    lazy = self._features(64, lazy_observations=True)
+    camera = lazy._world_tl_to_world_camera_rel.offset
+    obs = self._observation(50)
+    moved = self._observation(50)
+    moved.observation.raw_data.player.camera.x = 60
+    moved.observation.raw_data.player.camera.y = 30
+    first = lazy.transform_obs(obs)
+    later = lazy.transform_obs(moved)
+    later.feature_units  # pylint: disable=pointless-statement
+
+    expected = eager.transform_obs(obs)
+    for name in ["feature_units", "feature_effects"]:
+      numpy.testing.assert_array_equal(first[name], expected[name])
+      numpy.testing.assert_array_equal(
+          later[name], eager.transform_obs(moved)[name])
+    x = features.FeatureUnit.x
+    self.assertFalse(numpy.array_equal(later.feature_units[:, x],
+                                       first.feature_units[:, x]))
+    self.assertEqual(lazy._world_tl_to_world_camera_rel.offset, camera)
+
+  def testLazyRawTagsAreTheLatest(self):
+    feats = features.Features(
+        features.AgentInterfaceFormat(
+            use_raw_units=True, action_space=actions.ActionSpace.RAW,
+            lazy_observations=True),
+        map_size=point.Point(100, 100))
+    first = feats.transform_obs(self._observation(5, seed=1))
+    latest = feats.transform_obs(self._observation(5, seed=2))
+    first.raw_units  # pylint: disable=pointless-statement
+    self.assertEmpty(feats._raw_tags)
+
+    action = feats.transform_action(None, actions.FunctionCall(
+        actions.RAW_FUNCTIONS.Attack_unit.id, [[0], [2], [3]]))
+    numpy.testing.assert_array_equal(
+        feats._raw_tags, latest.raw_units[:, features.FeatureUnit.tag])
+    command = action.action_raw.unit_command
+    self.assertEqual(command.unit_tags, [latest.raw_units[2].tag])
+    self.assertEqual(command.target_unit_tag, latest.raw_units[3].tag)
+
+  def testObservationFields(self):
+    fields = ["player", "raw_units", "feature_minimap"]
+    feats = self._features(64, observation_fields=fields)
+    fields += ["game_loop", "score_cumulative"]  # Needed by SC2Env.
+    self.assertCountEqual(feats.observation_spec().keys(), fields)
+    out = feats.transform_obs(self._observation(10))
+    self.assertCountEqual(out.keys(), fields)
+    self.assertEqual(out["raw_units"].shape, (10, len(features.FeatureUnit)))
+
+  def testStructuredUnits(self):
+    obs = self._observation(100)
+    expected = self._features(64).transform_obs(obs)
+    feats = self._features(64, structured_units=True)
+    self.assertEqual(feats.observation_spec()["raw_units"], (0,))
+    out = feats.transform_obs(obs)
+
+    # Some units have more health than health_max, their ratios don't fit in a
+    # uint8 and saturate.
+    ratios = [features.FeatureUnit.health_ratio,
+              features.FeatureUnit.shield_ratio,
+              features.FeatureUnit.energy_ratio]
+    self.assertGreater(expected["raw_units"][:, ratios].max(), 255)
+    for name in ["raw_units", "feature_units"]:
+      self.assertEqual(out[name].dtype, features.UNIT_DTYPE)
+      saturated = numpy.array(expected[name])
+      saturated[:, ratios] = numpy.minimum(saturated[:, ratios], 255)
+      numpy.testing.assert_array_equal(
+          features.units_from_structured(out[name]), saturated)
+      numpy.testing.assert_array_equal(
+          features.units_to_structured(expected[name]), out[name])
+    self.assertTrue(numpy.shares_memory(out["raw_units"].x, out["raw_units"]))
+    self.assertEqual(out["raw_units"][3].tag, expected["raw_units"][3].tag)
+    numpy.testing.assert_array_equal(
+        feats._raw_tags, out["raw_units"].tag.astype(numpy.int64))
+
+    report = features.memory_report(out)
+    self.assertEqual(report["raw_units"], 100 * features.UNIT_DTYPE.itemsize)
+    self.assertLess(5 * report["raw_units"],
+                    features.memory_report(expected)["raw_units"])
+    self.assertEqual(report["total"], sum(
+        v for k, v in report.items() if k != "total"))
+
+  def testStructuredUnitsSaturate(self):
+    units = numpy.zeros((2, len(features.FeatureUnit)), dtype=numpy.int64)
+    units[:, features.FeatureUnit.health_ratio] = [-1, 256]
+    units[:, features.FeatureUnit.health] = [-5, 70000]
+    units[:, features.FeatureUnit.x] = [-40000, 40000]
+    units[:, features.FeatureUnit.tag] = [-1, 2**62]
+    out = features.units_to_structured(units)
+    self.assertEqual(out.health_ratio.tolist(), [0, 255])
+    self.assertEqual(out.health.tolist(), [0, 65535])
+    self.assertEqual(out.x.tolist(), [-32768, 32767])
+    self.assertEqual(out.tag.tolist(), [0, 2**62])
+
+  def testStructuredNoUnits(self):
+    out = self._features(64, structured_units=True).transform_obs(
+        self._observation(0))
+    self.assertEqual(out["raw_units"].shape, (0,))
+    self.assertEqual(features.units_from_structured(out["raw_units"]).shape,
+                     (0,))
+
+  def testUnknownObservationFields(self):
+    with self.assertRaisesRegex(ValueError, "unit_counts"):
+      self._features(64, observation_fields=["player", "unit_counts"])
+
+
+class FeatureLayersTest(absltest.TestCase):
+
+  def _observation(self, seed, bits=(1, 8, 16, 32), size=(13, 11)):
+    """Random layers of the given bits per pixel, and a missing one."""
+    rng = numpy.random.RandomState(seed)
+    obs = sc_pb.ResponseObservation()
+    for layer_features, layer_set in [
+        (features.SCREEN_FEATURES, obs.observation.feature_layer_data.renders),
+        (features.MINIMAP_FEATURES,
+         obs.observation.feature_layer_data.minimap_renders)]:
+      for f in layer_features[:-1]:
+        plane = getattr(layer_set, f.name)
+        plane.bits_per_pixel = bits[f.index % len(bits)]
+        plane.size.x, plane.size.y = size
+        dtype = features.Feature.dtypes[plane.bits_per_pixel]
+        if plane.bits_per_pixel == 1:
+          plane.data = numpy.packbits(
+              rng.randint(0, 2, size=size[0] * size[1])).tobytes()
+        else:
+          plane.data = rng.randint(
+              0, 2**min(plane.bits_per_pixel, 31) - 1,
+              size=size[0] * size[1]).astype(dtype).tobytes()
+    return obs
+
+  def _features(self, **kwargs):
+    return features.Features(features.AgentInterfaceFormat(
+        feature_dimensions=features.Dimensions(screen=(13, 11),
+                                               minimap=(13, 11)),
+        **kwargs))
+
+  def _reference(self, obs, layer_features):
+    layers = [f.unpack(obs.observation) for f in layer_features]
+    return numpy.stack([
+        l if l is not None else numpy.zeros((11, 13), dtype=numpy.int32)
+        for l in layers]).astype(numpy.int32)
+
+  def testDecodeLikeUnpack(self):
+    obs = self._observation(1)
+    out = self._features().transform_obs(obs)
+    self.assertEqual(out["feature_screen"].dtype, numpy.int32)
+    numpy.testing.assert_array_equal(
+        out["feature_screen"], self._reference(obs, features.SCREEN_FEATURES))
+    numpy.testing.assert_array_equal(
+        out["feature_minimap"],
+        self._reference(obs, features.MINIMAP_FEATURES))
+    self.assertEqual(out["feature_screen"].placeholder.sum(), 0)
+
+  def testNativeDtype(self):
+    feats = self._features(feature_layer_dtype=None)
+    out = feats.transform_obs(self._observation(2, bits=(1, 8)))
+    self.assertEqual(out["feature_minimap"].dtype, numpy.uint8)
+    obs = self._observation(2, bits=(1, 8, 16))
+    out = feats.transform_obs(obs)
+    self.assertEqual(out["feature_screen"].dtype, numpy.uint16)
+    numpy.testing.assert_array_equal(
+        out["feature_screen"], self._reference(obs, features.SCREEN_FEATURES))
+    self.assertEqual(out["feature_screen"].height_map.dtype, numpy.uint16)
+
+  def testReuseFeatureLayers(self):
+    feats = self._features(reuse_feature_layers=True)
+    first = feats.transform_obs(self._observation(3))
+    kept = first["feature_screen"].copy()
+    obs = self._observation(4)
+    second = feats.transform_obs(obs)
+    self.assertTrue(numpy.shares_memory(first["feature_screen"],
+                                        second["feature_screen"]))
+    numpy.testing.assert_array_equal(
+        second["feature_screen"],
+        self._reference(obs, features.SCREEN_FEATURES))
+    numpy.testing.assert_array_equal(
+        kept, self._reference(self._observation(3), features.SCREEN_FEATURES))
+
+    fresh = self._features()
+    self.assertFalse(numpy.shares_memory(
+        fresh.transform_obs(obs)["feature_screen"],
+        fresh.transform_obs(obs)["feature_screen"]))
+
+
 if __name__ == "__main__":
   absltest.main()
@@ -0,0 +1,320 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Latency histograms with percentiles, and exporters for them.
+
+Usage:
+    from pysc2.lib import latency
+
+    @latency.registry.decorate("agent.step")
+    def step(obs):
+      ...
+
+    with latency.registry("agent.think"):
+      think()
+
+    print(latency.registry["agent.step"].percentile(99))
+    latency.write_jsonl("/tmp/latency.jsonl")
+    latency.serve_prometheus(9090)  # http://localhost:9090/metrics
+
+A StopWatch can also feed a registry, see `StopWatch.record_histograms`.
+"""
+
+import functools
+import http.server
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+
+# The histograms keep this many significant bits of the latency in
+# microseconds, ie are accurate to within 2**-(SUB_BUCKET_BITS - 1) = 1.6%.
+SUB_BUCKET_BITS = 7
+_SUB_BUCKET_MASK = (1 << SUB_BUCKET_BITS) - 1
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def _bucket(micros):
+  """The bucket of a latency in microseconds."""
+  shift = micros.bit_length() - SUB_BUCKET_BITS
+  if shift <= 0:
+    return micros
+  return (shift << SUB_BUCKET_BITS) + (micros >> shift)
+
+
+def _bucket_range(bucket):
+  """The lowest and highest latency in microseconds of a bucket."""
+  shift = bucket >> SUB_BUCKET_BITS
+  if not shift:
+    return bucket, bucket
+  sub_bucket = bucket & _SUB_BUCKET_MASK
+  return sub_bucket << shift, ((sub_bucket + 1) << shift) - 1
+
+
+class Histogram(object):
+  """A latency histogram in log-linear buckets, like an HdrHistogram.
+
+  The buckets are exact below 2**SUB_BUCKET_BITS microseconds, then each power
+  of two is split in 2**(SUB_BUCKET_BITS - 1) buckets. The memory is bounded by
+  the range of the latencies rather than their number: under 3000 buckets for
+  anything up to a day, and only the buckets used are stored.
+  """
+  __slots__ = ("counts", "num", "sum", "min", "max")
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.counts = {}
+    self.num = 0
+    self.sum = 0
+    self.min = 0
+    self.max = 0
+
+  def add(self, seconds):
+    """Add a latency in seconds."""
+    bucket = _bucket(max(0, int(seconds * 1e6)))
+    self.counts[bucket] = self.counts.get(bucket, 0) + 1
+    if not self.num or self.min > seconds:
+      self.min = seconds
+    if not self.num or self.max < seconds:
+      self.max = seconds
+    self.num += 1
+    self.sum += seconds
+
+  @property
+  def avg(self):
+    return 0 if self.num == 0 else self.sum / self.num
+
+  def percentile(self, percent):
+    """The latency in seconds below which `percent` % of them are."""
+    if not self.num:
+      return 0
+    rank = max(1, math.ceil(self.num * percent / 100))
+    seen = 0
+    for bucket in sorted(self.counts):
+      seen += self.counts[bucket]
+      if seen >= rank:
+        low, high = _bucket_range(bucket)
+        value = (low + high) / 2e6
+        return min(max(value, self.min), self.max)
+    return self.max
+
+  def merge(self, other):
+    for bucket, count in other.counts.items():
+      self.counts[bucket] = self.counts.get(bucket, 0) + count
+    if other.num:
+      self.min = min(self.min, other.min) if self.num else other.min
+      self.max = max(self.max, other.max)
+    self.num += other.num
+    self.sum += other.sum
+
+  def copy(self):
+    out = Histogram()
+    out.merge(self)
+    return out
+
+  def summary(self, percentiles=PERCENTILES):
+    """A dict of the count, sum, avg, min, max and the percentiles."""
+    out = {"count": self.num, "sum": self.sum, "avg": self.avg,
+           "min": self.min, "max": self.max}
+    for p in percentiles:
+      out["p%g" % p] = self.percentile(p)
+    return out
+
+  def __str__(self):
+    return ", ".join("%s: %.4f" % (k, v) if isinstance(v, float) else
+                     "%s: %d" % (k, v) for k, v in self.summary().items())
+
+
+class _Timer(object):
+  """Time a call into a registry."""
+  __slots__ = ("_registry", "_name", "_start")
+
+  def __init__(self, registry, name):
+    self._registry = registry
+    self._name = name
+
+  def __enter__(self):
+    self._start = time.time()
+
+  def __exit__(self, unused_exception_type, unused_exc_value, unused_traceback):
+    self._registry.add(self._name, time.time() - self._start)
+
+
+class Registry(object):
+  """A thread-safe set of latency histograms by name.
+
+  Usage is like a StopWatch, but the names aren't nested:
+      with registry("foo"):
+        foo()
+      @registry.decorate("bar")
+      def bar():
+        pass
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._histograms = {}
+
+  def __call__(self, name):
+    return _Timer(self, name)
+
+  def decorate(self, name_or_func):
+    """Decorate a function/method to record its latency, see StopWatch."""
+    if os.environ.get("SC2_NO_STOPWATCH"):
+      return name_or_func if callable(name_or_func) else lambda func: func
+
+    def decorator(name, func):
+      @functools.wraps(func)
+      def _latency(*args, **kwargs):
+        with self(name):
+          return func(*args, **kwargs)
+      return _latency
+    if callable(name_or_func):
+      return decorator(name_or_func.__qualname__, name_or_func)
+    else:
+      return lambda func: decorator(name_or_func, func)
+
+  def add(self, name, seconds):
+    with self._lock:
+      histogram = self._histograms.get(name)
+      if histogram is None:
+        histogram = self._histograms[name] = Histogram()
+      histogram.add(seconds)
+
+  def __getitem__(self, name):
+    """A copy of the histogram of a name."""
+    with self._lock:
+      histogram = self._histograms.get(name)
+      return histogram.copy() if histogram else Histogram()
+
+  def __contains__(self, name):
+    with self._lock:
+      return name in self._histograms
+
+  def snapshot(self):
+    """A copy of all the histograms, by name."""
+    with self._lock:
+      return {k: v.copy() for k, v in sorted(self._histograms.items())}
+
+  def merge(self, other):
+    for name, histogram in other.snapshot().items():
+      with self._lock:
+        self._histograms.setdefault(name, Histogram()).merge(histogram)
+
+  def clear(self):
+    with self._lock:
+      self._histograms.clear()
+
+
+# The global registry, which the instrumented code records to.
+registry = Registry()
+
+
+def to_jsonl(registry_=None, percentiles=PERCENTILES, timestamp=None):
+  """The summaries of the histograms, as one json line per name."""
+  registry_ = registry_ or registry
+  timestamp = time.time() if timestamp is None else timestamp
+  lines = []
+  for name, histogram in registry_.snapshot().items():
+    line = {"time": timestamp, "name": name}
+    line.update(histogram.summary(percentiles))
+    lines.append(json.dumps(line) + "\n")
+  return "".join(lines)
+
+
+def write_jsonl(path, registry_=None, percentiles=PERCENTILES):
+  """Append the summaries of the histograms to a jsonl file."""
+  with open(path, "a") as f:
+    f.write(to_jsonl(registry_, percentiles))
+
+
+def _escape(name):
+  return name.replace("\\", "\\\\").replace("\"", "\\\"")
+
+
+def to_prometheus(registry_=None, percentiles=PERCENTILES,
+                  metric="sc2_latency_seconds"):
+  """The histograms as prometheus summaries, in the text exposition format."""
+  registry_ = registry_ or registry
+  lines = [
+      "# HELP %s Latency of the instrumented scopes." % metric,
+      "# TYPE %s summary" % metric,
+  ]
+  for name, histogram in registry_.snapshot().items():
+    scope = "scope=\"%s\"" % _escape(name)
+    for p in percentiles:
+      lines.append("%s{%s,quantile=\"%g\"} %.9g" % (
+          metric, scope, p / 100, histogram.percentile(p)))
+    lines.append("%s_sum{%s} %.9g" % (metric, scope, histogram.sum))
+    lines.append("%s_count{%s} %d" % (metric, scope, histogram.num))
+  return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path, registry_=None, percentiles=PERCENTILES):
+  """Write the histograms to a file, eg for a node exporter textfile collector.
+
+  The file is replaced atomically, so a collector never reads half of it.
+
+  Args:
+    path: The file to write.
+    registry_: The registry to export, the global one by default.
+    percentiles: The percentiles to export.
+  """
+  text = to_prometheus(registry_, percentiles)
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".")
+  with os.fdopen(fd, "w") as f:
+    f.write(text)
+  os.replace(tmp_path, path)
+
+
+def serve_prometheus(port, host="localhost", registry_=None,
+                     percentiles=PERCENTILES):
+  """Serve the histograms for prometheus to scrape at http://host:port/metrics.
+
+  Args:
+    port: The port to listen on, 0 to pick an unused one.
+    host: The interface to listen on, only the local one by default.
+    registry_: The registry to export, the global one by default.
+    percentiles: The percentiles to export.
+
+  Returns:
+    The server, serving in a daemon thread. Call `shutdown()` to stop it, and
+    `server_address` has the port.
+  """
+
+  class Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):  # pylint: disable=invalid-name
+      if self.path.split("?")[0] != "/metrics":
+        self.send_error(404)
+        return
+      body = to_prometheus(registry_, percentiles).encode("utf-8")
+      self.send_response(200)
+      self.send_header("Content-Type", "text/plain; version=0.0.4")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, *args):
+      pass
+
+  server = http.server.ThreadingHTTPServer((host, port), Handler)
+  thread = threading.Thread(target=server.serve_forever, name="latency_server")
+  thread.daemon = True
+  thread.start()
+  return server
@@ -0,0 +1,173 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for latency."""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import urllib.request
+
+from absl.testing import absltest
+import mock
+import numpy as np
+
+from pysc2.lib import latency
+from pysc2.lib import stopwatch
+
+
+class HistogramTest(absltest.TestCase):
+
+  def testBuckets(self):
+    last = -1
+    for micros in list(range(1000)) + [2**k + d for k in range(10, 40)
+                                       for d in (-1, 0, 1)]:
+      bucket = latency._bucket(micros)
+      low, high = latency._bucket_range(bucket)
+      self.assertBetween(micros, low, high)
+      self.assertLessEqual(high - low, max(0, high * 2**-6))
+      self.assertGreaterEqual(bucket, last)
+      last = bucket
+
+  def testPercentiles(self):
+    rng = np.random.RandomState(0)
+    values = rng.lognormal(-4, 1, size=10000)
+    histogram = latency.Histogram()
+    for v in values:
+      histogram.add(v)
+    self.assertEqual(histogram.num, 10000)
+    self.assertAlmostEqual(histogram.sum, values.sum())
+    self.assertEqual(histogram.min, values.min())
+    self.assertEqual(histogram.max, values.max())
+    for p in (1, 50, 90, 99, 99.9):
+      self.assertAlmostEqual(histogram.percentile(p),
+                             np.percentile(values, p, method="higher"),
+                             delta=np.percentile(values, p) * 0.02)
+    self.assertEqual(histogram.percentile(100), values.max())
+    self.assertLess(len(histogram.counts), 1000)
+
+  def testEmpty(self):
+    histogram = latency.Histogram()
+    self.assertEqual(histogram.percentile(99), 0)
+    self.assertEqual(histogram.summary()["count"], 0)
+
+  def testMerge(self):
+    a, b, both = latency.Histogram(), latency.Histogram(), latency.Histogram()
+    for i in range(100):
+      (a if i % 3 else b).add(i / 1000)
+      both.add(i / 1000)
+    a.merge(b)
+    self.assertEqual(a.counts, both.counts)
+    self.assertEqual(a.summary(), both.summary())
+
+
+class RegistryTest(absltest.TestCase):
+
+  @mock.patch("time.time")
+  def testDecorate(self, mock_time):
+    mock_time.return_value = 0
+    registry = latency.Registry()
+
+    @registry.decorate("one")
+    def one():
+      mock_time.return_value += 0.002
+
+    with registry("two"):
+      mock_time.return_value += 0.004
+    one()
+    one()
+
+    self.assertEqual(sorted(registry.snapshot()), ["one", "two"])
+    self.assertEqual(registry["one"].num, 2)
+    self.assertAlmostEqual(registry["one"].percentile(50), 0.002, delta=1e-4)
+    self.assertAlmostEqual(registry["two"].sum, 0.004)
+    self.assertNotIn("three", registry)
+    self.assertEqual(registry["three"].num, 0)
+
+  def testThreads(self):
+    registry = latency.Registry()
+
+    def add():
+      for _ in range(1000):
+        registry.add("one", 0.001)
+
+    threads = [threading.Thread(target=add) for _ in range(4)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(registry["one"].num, 4000)
+
+  def testStopwatch(self):
+    registry = latency.Registry()
+    sw = stopwatch.StopWatch()
+    sw.record_histograms(registry)
+    with sw("one"):
+      with sw("two"):
+        pass
+    self.assertEqual(sorted(registry.snapshot()), ["one", "one.two"])
+    self.assertEqual(registry["one"].num, sw["one"].num)
+
+
+class ExportTest(absltest.TestCase):
+
+  def setUp(self):
+    super(ExportTest, self).setUp()
+    self.registry = latency.Registry()
+    for i in range(1, 101):
+      self.registry.add("agent.step", i / 1000)
+    self.registry.add("with \"quotes\"", 1)
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+  def testJsonl(self):
+    path = os.path.join(self.tmp_dir, "latency.jsonl")
+    latency.write_jsonl(path, self.registry)
+    latency.write_jsonl(path, self.registry)
+    with open(path) as f:
+      lines = [json.loads(line) for line in f]
+    self.assertLen(lines, 4)
+    self.assertEqual(lines[0]["name"], "agent.step")
+    self.assertEqual(lines[0]["count"], 100)
+    self.assertAlmostEqual(lines[0]["p99"], 0.099, delta=0.002)
+    self.assertEqual(lines[0]["max"], 0.1)
+
+  def testPrometheus(self):
+    text = latency.to_prometheus(self.registry)
+    self.assertIn("# TYPE sc2_latency_seconds summary\n", text)
+    self.assertIn(
+        "sc2_latency_seconds_count{scope=\"agent.step\"} 100\n", text)
+    self.assertIn(
+        "sc2_latency_seconds{scope=\"agent.step\",quantile=\"0.99\"} 0.09",
+        text)
+    self.assertIn("sc2_latency_seconds_sum{scope=\"with \\\"quotes\\\"\"} 1\n",
+                  text)
+
+    path = os.path.join(self.tmp_dir, "latency.prom")
+    latency.write_prometheus(path, self.registry)
+    with open(path) as f:
+      self.assertEqual(f.read(), text)
+
+  def testServe(self):
+    server = latency.serve_prometheus(0, registry_=self.registry)
+    self.addCleanup(server.shutdown)
+    url = "http://localhost:%d/metrics" % server.server_address[1]
+    with urllib.request.urlopen(url) as response:
+      self.assertEqual(response.read().decode("utf-8"),
+                       latency.to_prometheus(self.registry))
+
+
+if __name__ == "__main__":
+  absltest.main()
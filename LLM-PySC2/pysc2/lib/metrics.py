@@ -45,6 +45,10 @@ class Metrics(object):
     """Return a context manager to measure the time to get an observation."""
     return _EventTimer()
 
+  def increment_loops_saved(self, num_loops):
+    """Count the (fractional) game loops saved by pipelined observations."""
+    del num_loops
+
   def close(self):
     pass
 
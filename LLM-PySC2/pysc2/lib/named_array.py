@@ -17,6 +17,7 @@ https://docs.scipy.org/doc/numpy/user/basics.rec.html are not enough since they
 actually change the type and don't interoperate well with tensorflow.
 """
 
+import collections
 import enum
 import numbers
 import re
@@ -32,6 +33,116 @@ class NamedDict(dict):
     self.__dict__ = self
 
 
+class LazyNamedDict(NamedDict):
+  """A `NamedDict` where some values are only computed when first read.
+
+  `set_lazy(names, render)` adds keys whose values are those of the dict
+  returned by `render()`, which is called the first time any of them is read
+  (`d["element"]`, `d.element`, `d.get`, `d.values()`, ...), and memoized. The
+  keys are there before then: `in`, `len()` and `keys()` don't render them.
+
+  Copies and pickles render everything, and are plain `NamedDict`s.
+  """
+  __slots__ = ("_lazy",)
+
+  def __init__(self, *args, **kwargs):
+    self._lazy = {}  # name -> render, for the values not rendered yet.
+    super(LazyNamedDict, self).__init__(*args, **kwargs)
+
+  def set_lazy(self, names, render):
+    for name in names:
+      dict.pop(self, name, None)
+      self._lazy[name] = render
+
+  def _render(self, render):
+    values = render()
+    for name in [k for k, r in self._lazy.items() if r is render]:
+      del self._lazy[name]
+      if not dict.__contains__(self, name):  # Unless set since.
+        dict.__setitem__(self, name, values[name])
+
+  def _pending(self):
+    return [k for k in self._lazy if not dict.__contains__(self, k)]
+
+  def render_all(self):
+    """Renders all the pending values."""
+    while self._lazy:
+      self._render(next(iter(self._lazy.values())))
+
+  def __missing__(self, key):
+    if key in self._lazy:
+      self._render(self._lazy[key])
+      return dict.__getitem__(self, key)
+    raise KeyError(key)
+
+  def __getattr__(self, name):
+    if name != "_lazy" and name in self._lazy:
+      return self[name]
+    raise AttributeError("'%s' object has no attribute '%s'" % (
+        type(self).__name__, name))
+
+  def __setitem__(self, key, value):
+    self._lazy.pop(key, None)
+    dict.__setitem__(self, key, value)
+
+  def __delitem__(self, key):
+    if self._lazy.pop(key, None) is None or dict.__contains__(self, key):
+      dict.__delitem__(self, key)
+
+  def __contains__(self, key):
+    return dict.__contains__(self, key) or key in self._lazy
+
+  def __len__(self):
+    return dict.__len__(self) + len(self._pending())
+
+  def __iter__(self):
+    return iter(list(dict.keys(self)) + self._pending())
+
+  def keys(self):
+    return dict.fromkeys(self).keys()
+
+  def get(self, key, default=None):
+    return self[key] if key in self else default
+
+  def pop(self, key, *default):
+    if key in self._lazy:
+      self[key]  # pylint: disable=pointless-statement
+    return dict.pop(self, key, *default)
+
+  def setdefault(self, key, default=None):
+    if key not in self:
+      self[key] = default
+    return self[key]
+
+  def items(self):
+    self.render_all()
+    return dict.items(self)
+
+  def values(self):
+    self.render_all()
+    return dict.values(self)
+
+  def copy(self):
+    return NamedDict(self.items())
+
+  def __eq__(self, other):
+    self.render_all()
+    return dict.__eq__(self, other)
+
+  def __ne__(self, other):
+    self.render_all()
+    return dict.__ne__(self, other)
+
+  __hash__ = None
+
+  def __repr__(self):
+    self.render_all()
+    return dict.__repr__(self)
+
+  def __reduce__(self):
+    return NamedDict, (dict(self.items()),)
+
+
 _NULL_SLICE = slice(None, None, None)
 
 
@@ -130,7 +241,7 @@ class NamedNumpyArray(np.ndarray):
 
   def __getattr__(self, name):
     try:
-      return self[name]
+      return self._get_single(name)
     except KeyError:
       raise AttributeError("Bad attribute name: %s" % name)
 
@@ -142,6 +253,8 @@ class NamedNumpyArray(np.ndarray):
 
   def __getitem__(self, indices):
     """Get by indexing lookup."""
+    if type(indices) in (int, str):  # pylint: disable=unidiomatic-typecheck
+      return self._get_single(indices)
     indices = self._indices(indices)
     obj = super(NamedNumpyArray, self).__getitem__(indices)
 
@@ -198,6 +311,16 @@ class NamedNumpyArray(np.ndarray):
             len(obj.shape), len(obj._index_names)))
     return obj
 
+  def _get_single(self, index):
+    """Get by an int or a name of the first axis, eg a row of the units.
+
+    The fast path of `__getitem__`, without the reindexing of the names.
+    """
+    obj = super(NamedNumpyArray, self).__getitem__(self._get_index(0, index))
+    if isinstance(obj, np.ndarray):
+      obj._index_names = self._index_names[1:]
+    return obj
+
   def __setitem__(self, indices, value):
     super(NamedNumpyArray, self).__setitem__(self._indices(indices), value)
 
@@ -270,3 +393,90 @@ class NamedNumpyArray(np.ndarray):
             "Trying to access an unnamed axis %s by name: '%s'" % (dim, index))
     else:
       return index
+
+
+_ROW_TYPES = {}  # {names: namedtuple}, shared by the NamedRows of a layout.
+
+
+class NamedRows(object):
+  """The rows of a 2-D array with named columns, as light records.
+
+  Iterating over a `NamedNumpyArray` (eg `obs.observation.raw_units`) makes a
+  view per row, and `u.x` maps the name and makes a numpy scalar. Here the rows
+  are namedtuples of python values, made in one pass over the array, and the
+  columns are views of it:
+
+    units = named_array.NamedRows(obs.observation.raw_units)
+    for u in units:
+      u.x, u.tag, u[FeatureUnit.health]
+    units.x  # All the x, as an ndarray view.
+
+  The rows are a copy: writing to the array afterwards doesn't change them.
+  """
+
+  def __init__(self, array, names=None):
+    """Initializer.
+
+    Args:
+      array: A 2-D array, or an empty one.
+      names: The names of the columns: a list of strings, a namedtuple or an
+          IntEnum. Default is the names of the last axis of the
+          `NamedNumpyArray`, which an empty `raw_units` doesn't have.
+
+    Raises:
+      ValueError: if the array has no column names and none are given.
+    """
+    if names is None:
+      index_names = getattr(array, "_index_names", None)
+      names = index_names[-1] if index_names else None
+      if names is None and len(array):
+        raise ValueError("The columns of the array must be named.")
+      names = sorted(names, key=names.get) if names else ()
+    elif isinstance(names, enum.EnumMeta):
+      names = names._member_names_
+    elif isinstance(names, type):
+      names = names._fields
+    names = tuple(names)
+    self._array = np.asarray(array)
+    self._columns = {n: j for j, n in enumerate(names)}
+    self._row_type = _ROW_TYPES.get(names)
+    if self._row_type is None:
+      self._row_type = collections.namedtuple("Row", names, rename=True)
+      _ROW_TYPES[names] = self._row_type
+    self._rows = None
+
+  @property
+  def rows(self):
+    """The list of rows, made when first read."""
+    if self._rows is None:
+      make = tuple.__new__
+      row_type = self._row_type
+      self._rows = [make(row_type, r) for r in self._array.tolist()]
+    return self._rows
+
+  def __len__(self):
+    return len(self._array)
+
+  def __iter__(self):
+    return iter(self.rows)
+
+  def __getitem__(self, index):
+    return self.rows[index]
+
+  def column(self, name):
+    """The column `name`, as a view of the array."""
+    try:
+      j = self._columns[name]
+    except KeyError:
+      raise KeyError("Name '%s' isn't a column." % name)
+    if not len(self._array):
+      return np.zeros((0,), dtype=self._array.dtype)
+    return self._array[:, j]
+
+  def __getattr__(self, name):
+    if name.startswith("_"):
+      raise AttributeError(name)
+    try:
+      return self.column(name)
+    except KeyError:
+      raise AttributeError("Bad attribute name: %s" % name)
@@ -37,6 +37,49 @@ class NamedDictTest(absltest.TestCase):
     self.assertEqual(a["c"], 3)
 
 
+class LazyNamedDictTest(absltest.TestCase):
+
+  def test_lazy_named_dict(self):
+    renders = []
+    def render():
+      renders.append(1)
+      return {"b": (1, 2), "c": 3}
+
+    a = named_array.LazyNamedDict(a=2)
+    a.set_lazy(["b", "c"], render)
+    self.assertIn("b", a)
+    self.assertLen(a, 3)
+    self.assertCountEqual(a.keys(), ["a", "b", "c"])
+    self.assertEmpty(renders)
+    self.assertEqual(a.b, (1, 2))
+    self.assertIs(a["b"], a.b)
+    self.assertEqual(a.get("c"), 3)
+    self.assertLen(renders, 1)
+    self.assertIsNone(a.get("d"))
+    with self.assertRaises(KeyError):
+      a["d"]  # pylint: disable=pointless-statement
+    with self.assertRaises(AttributeError):
+      a.d  # pylint: disable=pointless-statement
+
+  def test_set_before_render(self):
+    a = named_array.LazyNamedDict()
+    a.set_lazy(["b", "c"], lambda: {"b": 1, "c": 2})
+    a["b"] = 5
+    a.c = 6
+    del a["c"]
+    self.assertEqual(a, {"b": 5})
+    self.assertLen(a, 1)
+
+  def test_pickle(self):
+    a = named_array.LazyNamedDict(a=2)
+    a.set_lazy(["b"], lambda: {"b": 1})
+    unpickled = pickle.loads(pickle.dumps(a))
+    self.assertIs(type(unpickled), named_array.NamedDict)
+    self.assertEqual(unpickled, {"a": 2, "b": 1})
+    self.assertEqual(unpickled.b, 1)
+    self.assertEqual(named_array.NamedDict(a), unpickled)
+
+
 class TestEnum(enum.IntEnum):
   a = 0
   b = 1
@@ -354,5 +397,48 @@ NamedNumpyArray([ 0,  0,  0, 50,  0,  0,  0,  0,  0,  0,  0,  0,  0],
     self.assertEqual(repr(pickled),
                      "NamedNumpyArray([1, 3, 6], ['a', 'b', 'c'])")
 
+  def test_single_index_keeps_names(self):
+    a = named_array.NamedNumpyArray([[1, 3, 6], [2, 4, 7]],
+                                    [["x", "y"], TestEnum])
+    for row in [a[1], a["y"], a.y, a[np.int64(1)], a[TestEnum.b]]:
+      self.assertIsInstance(row, named_array.NamedNumpyArray)
+      self.assertEqual(row.c, 7)
+      self.assertEqual(row["b"], 4)
+    self.assertEqual(a[0].a, a["x", "a"])
+    self.assertEqual(a[0]._index_names, a[0:1][0]._index_names)
+    with self.assertRaises(KeyError):
+      a["z"]  # pylint: disable=pointless-statement
+
+
+class NamedRowsTest(absltest.TestCase):
+
+  def test_named_rows(self):
+    a = named_array.NamedNumpyArray([[1, 3, 6], [2, 4, 7]], [None, TestEnum])
+    rows = named_array.NamedRows(a)
+    self.assertLen(rows, 2)
+    self.assertEqual([r.b for r in rows], [3, 4])
+    self.assertEqual(rows[1].c, 7)
+    self.assertEqual(rows[1][TestEnum.a], 2)
+    self.assertEqual(rows[0], (1, 3, 6))
+    self.assertIs(type(rows[0]), type(named_array.NamedRows(a)[0]))
+    np.testing.assert_array_equal(rows.c, [6, 7])
+    self.assertTrue(np.shares_memory(rows.c, a))
+    with self.assertRaises(AttributeError):
+      rows.d  # pylint: disable=pointless-statement
+
+  def test_names(self):
+    for names in [TestEnum, TestNamedTuple, ["a", "b", "c"]]:
+      rows = named_array.NamedRows(np.array([[1, 3, 6]]), names)
+      self.assertEqual(rows[0].c, 6)
+      self.assertEqual(rows.b[0], 3)
+    with self.assertRaises(ValueError):
+      named_array.NamedRows(np.array([[1, 3, 6]]))
+
+  def test_empty(self):
+    a = named_array.NamedNumpyArray([], [None, TestEnum])
+    self.assertEmpty(list(named_array.NamedRows(a)))
+    self.assertEqual(named_array.NamedRows(a, TestEnum).b.shape, (0,))
+
+
 if __name__ == "__main__":
   absltest.main()
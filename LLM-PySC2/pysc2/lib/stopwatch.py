@@ -147,12 +147,16 @@ class StopWatch(object):
         pass
       func()
       print(sw)
+
+  The Stats only keep the moments, `record_histograms` also records each
+  timing in a `latency.Registry` for the percentiles.
   """
-  __slots__ = ("_times", "_local", "_factory")
+  __slots__ = ("_times", "_local", "_factory", "_histograms")
 
   def __init__(self, enabled=True, trace=False):
     self._times = collections.defaultdict(Stat)
     self._local = threading.local()
+    self._histograms = None
     if trace:
       self.trace()
     elif enabled:
@@ -172,6 +176,10 @@ class StopWatch(object):
   def custom(self, factory):
     self._factory = factory
 
+  def record_histograms(self, registry):
+    """Also record the timings in a `latency.Registry`, or stop if None."""
+    self._histograms = registry
+
   def __call__(self, name):
     return self._factory(name)
 
@@ -230,6 +238,8 @@ class StopWatch(object):
 
   def add(self, name, duration):
     self._times[name].add(duration)
+    if self._histograms is not None:
+      self._histograms.add(name, duration)
 
   def __getitem__(self, name):
     return self._times[name]
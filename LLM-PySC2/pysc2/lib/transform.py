@@ -25,6 +25,7 @@ transform to create `a_to_c`.
 
 import numbers
 
+import numpy as np
 from pysc2.lib import point
 
 
@@ -37,6 +38,10 @@ class Transform(object):
   def fwd_pt(self, pt):
     raise NotImplementedError()
 
+  def fwd_pts(self, pts):
+    """`fwd_pt` of an array of points, with x and y in the last dimension."""
+    raise NotImplementedError()
+
   def back_dist(self, dist):
     raise NotImplementedError()
 
@@ -63,6 +68,9 @@ class Linear(Transform):
   def fwd_pt(self, pt):
     return pt * self.scale + self.offset
 
+  def fwd_pts(self, pts):
+    return pts * tuple(self.scale) + tuple(self.offset)
+
   def back_dist(self, dist):
     return dist / self.scale.x
 
@@ -89,6 +97,11 @@ class Chain(Transform):
       pt = transform.fwd_pt(pt)
     return pt
 
+  def fwd_pts(self, pts):
+    for transform in self.transforms:
+      pts = transform.fwd_pts(pts)
+    return pts
+
   def back_dist(self, dist):
     for transform in reversed(self.transforms):
       dist = transform.back_dist(dist)
@@ -112,6 +125,9 @@ class PixelToCoord(Transform):
   def fwd_pt(self, pt):
     return pt.floor()
 
+  def fwd_pts(self, pts):
+    return np.floor(pts)
+
   def back_dist(self, dist):
     return dist
 
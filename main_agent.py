@@ -7,8 +7,8 @@ import traceback
 import numpy as np
 import torch
 from absl import app, flags
-from pysc2.env import sc2_env
-from pysc2.lib import actions, features, units
+from pysc2.env import mock_sc2_env, sc2_env
+from pysc2.lib import actions, features, latency, units
 
 # Add paths to sys.path
 sys.path.append(os.path.join(os.path.dirname(__file__), "mini-AlphaStar"))
@@ -30,6 +30,17 @@ flags.DEFINE_string("map", "Simple64", "Name of a map to use.")
 flags.DEFINE_string("agent_race", "P", "Agent race.")
 flags.DEFINE_string("bot_race", "T", "Bot race.")
 flags.DEFINE_string("difficulty", "1", "Bot difficulty.")
+flags.DEFINE_bool("pipelined_observations", False,
+                  "Fetch the next observation while the agent thinks.")
+flags.DEFINE_string("latency_file", None,
+                    "Append the latency percentiles to this jsonl file on exit.")
+flags.DEFINE_integer("latency_port", 0,
+                     "Serve the latency percentiles for prometheus on this localhost port.")
+flags.DEFINE_string("mock_env", None,
+                    "Run without the game: 'synthetic' for generated observations, "
+                    "or the path of TimeSteps recorded by llm_pysc2's DataRecorder to replay them.")
+flags.DEFINE_integer("mock_env_units", 64, "Units per player of the synthetic observations.")
+flags.DEFINE_integer("mock_env_seed", 0, "Seed of the synthetic observations.")
 
 OVERLAY_FILE = "overlay_data.json"
 MODEL_FILE = "models/alphastar_model.pth"
@@ -54,6 +65,13 @@ class VisualCue:
         d.update(self.data)
         return d
 
+def make_env(**kwargs):
+    """Creates the realtime SC2Env, or an SC2SyntheticEnv if --mock_env is set."""
+    return mock_sc2_env.make_env(
+        FLAGS.mock_env, FLAGS.mock_env_units, FLAGS.mock_env_seed,
+        sc2_env_kwargs=dict(realtime=True, pipelined_observations=FLAGS.pipelined_observations),
+        **kwargs)
+
 class SimpleObserver:
     def __init__(self):
         pass
@@ -144,8 +162,11 @@ def main(unused_argv):
     # We need to define observation and action specs.
     # SC2Env will provide these.
     
+    if FLAGS.latency_port:
+        latency.serve_prometheus(FLAGS.latency_port)
+
     try:
-        with sc2_env.SC2Env(
+        with make_env(
             map_name=FLAGS.map,
             players=[sc2_env.Agent(sc2_env.Race.protoss),
                      sc2_env.Bot(sc2_env.Race.terran, sc2_env.Difficulty.very_easy)],
@@ -154,11 +175,12 @@ def main(unused_argv):
                 raw_resolution=64,
                 use_feature_units=True,
                 use_raw_units=True,
-                use_unit_counts=True),
+                use_unit_counts=True,
+                # only the fields read by the agent and the overlay are rendered, e.g. not the screen layers
+                lazy_observations=True),
             step_mul=8,
             game_steps_per_episode=0,
             visualize=False,
-            realtime=True,
             random_seed=1) as env:
             
             agent.setup(env.observation_spec(), env.action_spec())
@@ -350,6 +372,7 @@ def main(unused_argv):
                      pass
                 
                 step_end = time.time()
+                latency.registry.add("main_agent.loop", step_end - step_start)
                 # print(f"Loop time: {(step_end - step_start)*1000:.2f}ms")
 
                 
@@ -364,6 +387,9 @@ def main(unused_argv):
     except Exception as e:
         print(f"Error: {e}")
         traceback.print_exc()
+    finally:
+        if FLAGS.latency_file:
+            latency.write_jsonl(FLAGS.latency_file)
 
 if __name__ == "__main__":
     app.run(main)
@@ -32,6 +32,7 @@ from alphastarmini.lib.hyper_parameters import StarCraft_Hyper_Parameters as SCH
 from alphastarmini.lib.hyper_parameters import Scalar_Feature_Size as SFS
 
 from pysc2.lib.units import get_unit_type
+from pysc2.lib.features import units_from_structured
 
 __author__ = "Ruo-Ze Liu"
 
@@ -110,6 +111,9 @@ class Agent(object):
         t = time()
 
         raw_units = obs["raw_units"]
+        if raw_units.dtype.names:
+            # the structured units of AgentInterfaceFormat(structured_units=True)
+            raw_units = units_from_structured(raw_units)
         entities_array, entity_pos = ArchModel.preprocess_entity_numpy(raw_units, return_entity_pos=return_entity_pos)
         batch_entities_array = np.expand_dims(entities_array, axis=0) 
 
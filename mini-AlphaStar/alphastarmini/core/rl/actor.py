@@ -16,6 +16,7 @@ from pysc2.env.sc2_env import SC2Env, AgentInterfaceFormat, Agent, Race
 from alphastarmini.core.rl.rl_utils import Trajectory, get_supervised_agent
 from alphastarmini.core.rl.learner import Learner
 from alphastarmini.core.rl import rl_utils as U
+from alphastarmini.core.rl.mock_env import create_mock_env
 
 from alphastarmini.lib import utils as L
 
@@ -36,6 +37,10 @@ GAME_STEPS_PER_EPISODE = 1800    # 9000
 MAX_EPISODES = 5      # 100   
 MAIN_PLAYER_NUMS = 1
 
+# None to play with the game, else the source of the mock env, see mock_env.create_mock_env
+MOCK_ENV = None
+MOCK_ENV_UNITS = 64
+
 
 class ActorLoop:
     """A single actor loop that generates trajectories.
@@ -47,7 +52,7 @@ class ActorLoop:
     def __init__(self, player, coordinator, max_time_for_training = 60 * 60 * 24,
                  max_time_per_one_opponent=60 * 60 * 2,
                  max_frames_per_episode=22.4 * 60 * 15, max_frames=22.4 * 60 * 60 * 24, 
-                 max_episodes=MAX_EPISODES):
+                 max_episodes=MAX_EPISODES, mock_env=MOCK_ENV, mock_env_units=MOCK_ENV_UNITS):
 
         self.player = player
         self.player.add_actor(self)
@@ -64,6 +69,9 @@ class ActorLoop:
         self.max_frames = max_frames
         self.max_episodes = max_episodes
 
+        self.mock_env = mock_env
+        self.mock_env_units = mock_env_units
+
         self.thread = threading.Thread(target=self.run, args=())
         self.thread.daemon = True                            # Daemonize thread
 
@@ -268,6 +276,11 @@ class ActorLoop:
         print('player.race:', player.race)
         print('opponent.race:', opponent.race)
 
+        if self.mock_env is not None:
+            return create_mock_env([Agent(player.race, player.name), Agent(opponent.race, opponent.name)],
+                                   agent_interface_format, source=self.mock_env, num_units=self.mock_env_units,
+                                   seed=random_seed, step_mul=step_mul, game_steps_per_episode=game_steps_per_episode)
+
         env = SC2Env(map_name=map_name,
                      players=[Agent(player.race, player.name),
                               Agent(opponent.race, opponent.name)],
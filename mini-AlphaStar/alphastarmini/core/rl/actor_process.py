@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" Actors hosted in spawned processes, connected to the learner by the trajectory and parameter channels "
+
+import sys
+import queue
+import pickle
+import threading
+import traceback
+
+from time import time, sleep
+
+import torch
+import torch.multiprocessing as mp
+
+from alphastarmini.core.ma.player import Player
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+# the segments which can wait in the channel, the actors block beyond it
+CHANNEL_SIZE = 64
+
+# the interval of the shared counters of the actors, in seconds
+COUNTER_INTERVAL = 1.
+
+
+class TrajectoryChannel(object):
+    '''
+        Queue of trajectory segments from the actor processes to the learner.
+
+        A segment is encoded by the codec of the learner (if any) in the actor process,
+        and pickled into bytes, so it crosses the pipe as one buffer (instead of one
+        shared memory file per tensor). The learner side puts them into the ring buffer
+        of the learner as encoded segments.
+    '''
+
+    def __init__(self, codec=None, maxsize=CHANNEL_SIZE, ctx=None):
+        super().__init__()
+        ctx = ctx if ctx is not None else mp.get_context('spawn')
+        self.queue = ctx.Queue(maxsize=maxsize)
+        self.codec = codec
+
+    def put(self, trajectory, timeout=None):
+        if self.codec is not None:
+            trajectory = self.codec.encode(trajectory)
+        self.queue.put(pickle.dumps(trajectory, protocol=pickle.HIGHEST_PROTOCOL), timeout=timeout)
+
+    def get(self, timeout=None):
+        return pickle.loads(self.queue.get(timeout=timeout))
+
+
+class RemoteLearner(object):
+    '''
+        The learner as seen by an actor in another process: the trajectories are sent
+        through the channel, and the parameters are pulled from the shared publisher.
+    '''
+
+    def __init__(self, channel, publisher, learner_stopped, stop_event):
+        super().__init__()
+        self.channel = channel
+        self.publisher = publisher
+        self.learner_stopped = learner_stopped
+        self.stop_event = stop_event
+
+    @property
+    def is_running(self):
+        return not self.stop_event.is_set() and not self.learner_stopped.value
+
+    def send_trajectory(self, trajectory):
+        # do not block forever on a full channel when the learner is gone
+        while self.is_running:
+            try:
+                self.channel.put(trajectory, timeout=1.)
+                return
+            except queue.Full:
+                pass
+
+
+class RemotePlayer(Player):
+    '''
+        The player of an actor process, which only has the race, the name and the
+        remote learner (the actor has its own agent).
+    '''
+
+    def __init__(self, race, name, learner):
+        self.agent = None
+        self._race = race
+        self.name = name
+        self._learner = learner
+        self._actors = []
+
+
+def _run_actor(idx, race, name, device, kwargs, channel, publisher, learner_stopped, stop_event,
+               counters, q_winloss, q_points, use_teacher, num_threads):
+    # the entry of an actor process
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(idx)
+
+    from alphastarmini.core.rl import rl_vs_inner_bot_mp as RVB
+    from alphastarmini.core.rl.rl_utils import get_supervised_agent
+
+    player = RemotePlayer(race, name, RemoteLearner(channel, publisher, learner_stopped, stop_event))
+
+    teacher = None
+    if use_teacher:
+        teacher = get_supervised_agent(race, model_type="sl", restore=RVB.RESTORE, device=device)
+        teacher.set_rl_training(kwargs.get('is_training', RVB.IS_TRAINING))
+
+    # the outcomes are dropped if there is nobody to read them
+    q_winloss = q_winloss if q_winloss is not None else queue.Queue()
+    q_points = q_points if q_points is not None else queue.Queue()
+
+    actor = RVB.ActorVSComputer(player, q_winloss, q_points, torch.device(device), None, None, teacher, idx,
+                                inference_server=None, **kwargs)
+    actor.start()
+    while actor.thread.is_alive():
+        actor.thread.join(COUNTER_INTERVAL)
+        counters[0], counters[1] = actor.total_frames, actor.total_steps
+
+    # a crash of the actor makes the process restarted
+    if actor.exception is not None and not stop_event.is_set():
+        sys.exit(1)
+
+
+class ActorProcess(object):
+    '''
+        An actor (ActorVSComputer) in a spawned process, with the interface of the actor
+        threads for the learner and the worker (is_start, is_running, start, thread).
+
+        The thread here monitors the process: it is restarted if it exits abnormally
+        (an exception of the actor loop, or a crash or kill of the process), at most
+        max_restarts times. stop() asks the actor to return at its next trajectory, and
+        terminates the process if it does not in time.
+    '''
+
+    def __init__(self, pool, idx, max_restarts=3):
+        super().__init__()
+        self.pool = pool
+        self.idx = idx
+        self.name = 'agent_process_' + str(idx)
+        self.max_restarts = max_restarts
+        self.restarts = 0
+
+        self.process = None
+        self.counters = torch.zeros(2, dtype=torch.float64).share_memory_()
+        self.base_counters = [0., 0.]
+
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+
+        self.is_start = False
+        self.is_running = False
+
+    @property
+    def total_frames(self):
+        return self.base_counters[0] + float(self.counters[0])
+
+    @property
+    def total_steps(self):
+        return self.base_counters[1] + float(self.counters[1])
+
+    def _spawn(self):
+        pool = self.pool
+        args = (self.idx, pool.race, pool.name, pool.device, pool.actor_kwargs, pool.channel, pool.publisher,
+                pool.learner_stopped, pool.stop_event, self.counters, pool.q_winloss, pool.q_points,
+                pool.use_teacher, pool.num_threads)
+        process = pool.ctx.Process(target=_run_actor, args=args, name=self.name, daemon=True)
+        process.start()
+
+        return process
+
+    def start(self):
+        self.is_start = True
+        self.is_running = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                self.process = self._spawn()
+                self.process.join()
+
+                exitcode = self.process.exitcode
+                self.base_counters = [b + float(c) for b, c in zip(self.base_counters, self.counters)]
+                self.counters.zero_()
+
+                if exitcode == 0 or self.pool.stop_event.is_set():
+                    break
+                if self.restarts >= self.max_restarts:
+                    print(self.name, "exits with", exitcode, "and is not restarted again")
+                    break
+
+                self.restarts += 1
+                print(self.name, "exits with", exitcode, "restart", self.restarts)
+
+        except Exception as e:
+            print("ActorProcess.run() Exception cause return, Detials of the Exception:", e)
+            print(traceback.format_exc())
+
+        finally:
+            self.is_running = False
+
+    def kill(self):
+        # e.g., to test the restart
+        if self.process is not None and self.process.is_alive():
+            self.process.kill()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+        # still running after the timeout
+        if self.thread.is_alive() and self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.thread.join()
+
+
+class ActorProcessPool(object):
+    '''
+        Hosts num_actors actors of a player in spawned processes, for the learner in this
+        process. It replaces the actor threads of a worker, whose numpy featurization,
+        python env glue and forward passes serialize on the GIL: each process takes its
+        own core (num_threads torch threads).
+
+        The channels are the ones a process can share: the trajectories come through a
+        TrajectoryChannel (encoded by the codec of the learner), which a thread here puts
+        into the ring buffer of the learner, and the actors pull the parameters from the
+        publisher of the learner, which must be in shared memory (share_memory_buffer=True).
+
+        The actors play with their own agent (no inference server), and their own teacher
+        unless use_teacher is False (e.g., the learner computes the teacher logits).
+    '''
+
+    def __init__(self, learner, num_actors, actor_kwargs=None, device='cpu', first_idx=0, use_teacher=True,
+                 q_winloss=None, q_points=None, max_restarts=3, num_threads=1, channel_size=CHANNEL_SIZE):
+        super().__init__()
+        assert learner.publisher.header.is_shared(), "the publisher of the learner must be in shared memory"
+
+        self.ctx = mp.get_context('spawn')
+        self.learner = learner
+        self.publisher = learner.publisher
+        self.race = learner.player.race
+        self.name = learner.player.name
+        self.device = str(device)
+        self.actor_kwargs = dict(actor_kwargs or {})
+        self.use_teacher = use_teacher
+        self.q_winloss = q_winloss
+        self.q_points = q_points
+        self.num_threads = num_threads
+
+        self.channel = TrajectoryChannel(codec=learner.trajectories.codec, maxsize=channel_size, ctx=self.ctx)
+        self.learner_stopped = self.ctx.Value('b', 0)
+        self.stop_event = self.ctx.Event()
+
+        self.actors = [ActorProcess(self, first_idx + i, max_restarts=max_restarts) for i in range(num_actors)]
+        for actor in self.actors:
+            learner.player.add_actor(actor)
+
+        self.received = 0
+        self.thread = threading.Thread(target=self.receive, args=())
+        self.thread.daemon = True
+
+    def start(self):
+        for actor in self.actors:
+            actor.start()
+        self.thread.start()
+
+    def is_running(self):
+        return any(actor.is_running for actor in self.actors)
+
+    def receive(self):
+        # puts the trajectories of the actors into the ring buffer of the learner
+        thread = self.learner.thread
+        while self.is_running() or not self.channel.queue.empty():
+            if thread.ident is not None and not thread.is_alive():
+                self.learner_stopped.value = 1
+            try:
+                trajectory = self.channel.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            self.learner.trajectories.put(trajectory, encoded=True)
+            self.received += 1
+
+    @property
+    def total_frames(self):
+        return sum(actor.total_frames for actor in self.actors)
+
+    @property
+    def total_steps(self):
+        return sum(actor.total_steps for actor in self.actors)
+
+    def join(self, timeout=None):
+        for actor in self.actors:
+            actor.join(timeout)
+        self.thread.join(timeout)
+
+    def stop(self, timeout=60.):
+        """Asks the actors to return, and terminates the ones which do not in timeout."""
+        self.stop_event.set()
+        self.join(timeout)
+
+
+def test():
+    from pysc2.env.sc2_env import Race
+
+    from alphastarmini.core.rl.learner import Learner
+    from alphastarmini.core.rl.rl_utils import get_supervised_agent
+    from alphastarmini.core.rl.trajectory_codec import TrajectoryCodec
+    from alphastarmini.core.ma.league import League
+
+    league = League(initial_agents={race: get_supervised_agent(race, restore=False, device='cpu') for race in [Race.protoss]},
+                    main_players=1, main_exploiters=0, league_exploiters=0)
+    player = league.get_learning_player(0)
+
+    learner = Learner(player, 0, mp.Value('d', 0.0), 'cpu', optimizer=None, global_model=None,
+                      is_training=False, buffer_size=1, need_save_result=False,
+                      share_memory_buffer=True, codec=TrajectoryCodec())
+    learner.publisher.publish(player.agent.agent_nn.model)
+
+    actor_kwargs = dict(max_time_for_training=90., max_time_per_one_opponent=90., max_frames=None,
+                        max_episodes=None, is_training=True, need_save_result=False,
+                        mock_env='synthetic', mock_env_units=32, mock_env_episode_length=32)
+    pool = ActorProcessPool(learner, 2, actor_kwargs=actor_kwargs, use_teacher=False, max_restarts=1)
+    pool.start()
+
+    # a killed actor is restarted
+    start_time = time()
+    while pool.received < 2 and time() - start_time < 60.:
+        sleep(0.5)
+    pool.actors[0].kill()
+    sleep(5.)
+    assert pool.actors[0].restarts == 1 and pool.actors[0].is_running
+
+    while pool.received < 4 and time() - start_time < 80.:
+        sleep(0.5)
+    pool.stop(timeout=30.)
+
+    assert not pool.is_running() and not pool.thread.is_alive()
+    assert pool.received >= 4, pool.received
+    assert len(learner.trajectories) == min(pool.received, learner.trajectories.capacity)
+    trajectories = learner.trajectories.sample(2)
+    assert trajectories[0].state[0].entity_state.shape[-2:] == (512, 1856)
+    print('ActorProcessPool frames', pool.total_frames, 'steps', pool.total_steps, 'segments', pool.received)
+
+
+if __name__ == '__main__':
+    test()
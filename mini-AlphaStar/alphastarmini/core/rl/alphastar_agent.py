@@ -6,6 +6,7 @@
 # modified from pysc2 code
 
 import gc
+import collections
 
 from time import time
 
@@ -13,6 +14,7 @@ import numpy as np
 import torch
 
 from pysc2.lib import actions
+from pysc2.lib import latency
 from pysc2.env import sc2_env
 from pysc2.env import environment as E
 
@@ -27,6 +29,11 @@ __author__ = "Ruo-Ze Liu"
 debug = False
 speed = False
 
+# the trajectories of a batch stacked as [batch_size x seq_length x ...], see collate_unroll
+UnrollBatch = collections.namedtuple('UnrollBatch', ['entity_state', 'statistical_state', 'map_state',
+                                                     'baseline_state', 'baseline_state_op', 'hidden', 'cell',
+                                                     'action', 'select_units_num', 'entity_num'])
+
 
 class BaseAgent(object):
     """A base agent to write custom scripted agents.
@@ -164,6 +171,7 @@ class AlphaStarAgent(RandomAgent):
 
         return state
 
+    @latency.registry.decorate("AlphaStarAgent.step_nn")
     def step_nn(self, observation, last_state):
         """Performs inference on the observation, given hidden state last_state."""
 
@@ -247,21 +255,75 @@ class AlphaStarAgent(RandomAgent):
 
         return action_logits
 
-    def rl_unroll(self, trajectories, use_opponent_state=True, show=False):
+    @staticmethod
+    def collate_unroll(trajectories, use_opponent_state=True, device=None, staging=None, non_blocking=False):
+        """Stacks the states, the memory, the actions, the select_units_num and the entity_num
+        of the trajectories into tensors of [batch_size x seq_length x ...] on device, as
+        rl_unroll uses them.
+
+        With staging (see StagingBuffers) the stacking is written into its preallocated
+        tensors (pinned for a cuda device) and then copied to device.
+        """
+        batch_size = len(trajectories)
+        seq_length = len(trajectories[0].state)
+
+        def stack(name, tensors, dim=0):
+            if staging is not None and tensors[0].device.type == 'cpu':
+                shape = list(tensors[0].shape)
+                shape[dim] = sum(t.shape[dim] for t in tensors)
+                out = torch.cat(tensors, dim=dim, out=staging.get(name, shape, tensors[0].dtype))
+            else:
+                out = torch.cat([t.to(device) if device is not None else t for t in tensors], dim=dim)
+            if device is not None:
+                out = out.to(device, non_blocking=non_blocking)
+            return out
+
+        def stack_steps(name, tensors):
+            out = stack(name, tensors)
+            return out.view(batch_size, seq_length, *tuple(out.shape[1:]))
+
+        def steps(field):
+            return [step for traj in trajectories for step in getattr(traj, field)]
+
+        states = steps('state')
+        entity_state = stack_steps('entity_state', [s.entity_state for s in states])
+        statistical_state = [stack_steps('statistical_state_' + str(i), list(l))
+                             for i, l in enumerate(zip(*[s.statistical_state for s in states]))]
+        map_state = stack_steps('map_state', [s.map_state for s in states])
+        del states
+
+        # note, hidden has the size of [num_of_lstm_layers, batch_size, hidden_size]
+        memory = steps('memory')
+        hidden = stack('hidden', [m[0] for m in memory], dim=1).transpose(0, 1)
+        hidden = hidden.view(batch_size, seq_length, *tuple(hidden.shape[1:]))
+        cell = stack('cell', [m[1] for m in memory], dim=1).transpose(0, 1)
+        cell = cell.view(batch_size, seq_length, *tuple(cell.shape[1:]))
+        del memory
+
+        action = ArgsAction(*[stack_steps('action_' + str(i), list(l))
+                              for i, l in enumerate(zip(*[a.toList() for a in steps('action')]))])
+
+        baseline_state = [stack_steps('baseline_state_' + str(i), list(l))
+                          for i, l in enumerate(zip(*steps('baseline_state')))]
+        baseline_state_op = None
+        if use_opponent_state:
+            baseline_state_op = [stack_steps('baseline_state_op_' + str(i), list(l))
+                                 for i, l in enumerate(zip(*steps('baseline_state_op')))]
+
+        select_units_num = stack_steps('select_units_num', steps('player_select_units_num'))
+        entity_num = stack_steps('entity_num', steps('entity_num'))
+
+        return UnrollBatch(entity_state=entity_state, statistical_state=statistical_state, map_state=map_state,
+                           baseline_state=baseline_state, baseline_state_op=baseline_state_op, hidden=hidden,
+                           cell=cell, action=action, select_units_num=select_units_num, entity_num=entity_num)
+
+    def rl_unroll(self, trajectories, use_opponent_state=True, show=False, batch=None):
         """Unrolls the network over the trajectory.
 
         The actions taken by the agent and the initial state of the unroll are
-        dictated by trajectory.
+        dictated by trajectory. batch is the result of collate_unroll on the
+        trajectories, if it is already collated (e.g., by a BatchPrefetcher).
         """
-        ACTION_FIELDS = [
-            'action_type',  
-            'delay',
-            'queue',
-            'units',
-            'target_unit',
-            'target_location',
-        ]
-
         device = self.agent_nn.device()
         print("unroll device:", device) if debug else None
 
@@ -269,130 +331,21 @@ class AlphaStarAgent(RandomAgent):
         policy_logits = None
         baselines = None
 
-        hidden_traj = []  # traj.memory
-        cell_traj = []
-
-        state_traj = []  # traj.state
-        baseline_state_traj = []  # traj.baseline_state
-        baseline_state_op_traj = []  # traj.baseline_state_op
-        actions_traj = []
-        select_units_num_traj = []
-        entity_nums_traj = []
-
-        batch_size = len(trajectories)
-        for i, traj in enumerate(trajectories):
-            seq_length = len(traj.state)
-
-            hidden = list(zip(*traj.memory))[0]
-            print('hidden', hidden) if debug else None
-
-            hidden_traj.extend(hidden)
-
-            cell = list(zip(*traj.memory))[1]
-            print('cell', cell) if debug else None
-
-            cell_traj.extend(cell)
-            del hidden, cell
-
-            state_traj.extend(traj.state)
-            baseline_state_traj.extend(traj.baseline_state)
-            if use_opponent_state:
-                baseline_state_op_traj.extend(traj.baseline_state_op)
-
-            actions_traj.extend(traj.action)
-            select_units_num_traj.extend(traj.player_select_units_num)
-            entity_nums_traj.extend(traj.entity_num)
-            del traj
+        if batch is None:
+            batch = self.collate_unroll(trajectories, use_opponent_state, device=device)
 
+        batch_size, seq_length = batch.entity_state.shape[:2]
         print('batch_size', batch_size) if debug else None
         print('seq_length', seq_length) if debug else None
 
-        # add the state
-        entity_state_list = []
-        statistical_state_list = []
-        map_state_list = []
-        for s in state_traj:
-            entity_state_list.append(s.entity_state)
-            statistical_state_list.append(s.statistical_state)
-            map_state_list.append(s.map_state)
-
-        action_type_list = []
-        delay_list = []
-        queue_list = []
-        units_list = []
-        target_unit_list = []
-        target_location_list = []
-        for a in actions_traj:
-            action_type_list.append(a.action_type)
-            delay_list.append(a.delay)
-            queue_list.append(a.queue)
-            units_list.append(a.units)
-            target_unit_list.append(a.target_unit)
-            target_location_list.append(a.target_location)
-
-        entity_state_all = torch.cat([l.to(device) for l in entity_state_list], dim=0)
-        entity_state_all = entity_state_all.view(batch_size, seq_length, *tuple(entity_state_all.shape[1:]))
-        del entity_state_list, state_traj
-
-        statistical_state_all = [torch.cat([l.to(device) for l in statis], dim=0) for statis in zip(*statistical_state_list)]
-        statistical_state_all = [l.view(batch_size, seq_length, *tuple(l.shape[1:])) for l in statistical_state_all]
-        del statistical_state_list
-
-        map_state_all = torch.cat([l.to(device) for l in map_state_list], dim=0).to(device)
-        map_state_all = map_state_all.view(batch_size, seq_length, *tuple(map_state_all.shape[1:]))
-        del map_state_list
-
-        select_units_num_all = torch.cat([l.to(device) for l in select_units_num_traj], dim=0)
-        select_units_num_all = select_units_num_all.view(batch_size, seq_length, *tuple(select_units_num_all.shape[1:]))
-        del select_units_num_traj
-
-        entity_nums_all = torch.cat([l.to(device) for l in entity_nums_traj], dim=0)
-        entity_nums_all = entity_nums_all.view(batch_size, seq_length, *tuple(entity_nums_all.shape[1:]))
-        del entity_nums_traj
-
-        # # note, hidden has the size of [num_of_lstm_layers, batch_size, hidden_size]
-        hidden_all = torch.cat([l.to(device) for l in hidden_traj], dim=1)
-        hidden_all = hidden_all.transpose(0, 1)
-        hidden_all = hidden_all.view(batch_size, seq_length, *tuple(hidden_all.shape[1:]))
-        del hidden_traj
-
-        cell_all = torch.cat([l.to(device) for l in cell_traj], dim=1)
-        cell_all = cell_all.transpose(0, 1)
-        cell_all = cell_all.view(batch_size, seq_length, *tuple(cell_all.shape[1:]))
-        del cell_traj
-
-        action_type_all = torch.cat([l.to(device) for l in action_type_list], dim=0)
-        action_type_all = action_type_all.view(batch_size, seq_length, *tuple(action_type_all.shape[1:]))
-        del action_type_list
-
-        delay_all = torch.cat([l.to(device) for l in delay_list], dim=0)
-        delay_all = delay_all.view(batch_size, seq_length, *tuple(delay_all.shape[1:]))
-        del delay_list
-
-        queue_all = torch.cat([l.to(device) for l in queue_list], dim=0)
-        queue_all = queue_all.view(batch_size, seq_length, *tuple(queue_all.shape[1:]))
-        del queue_list
-
-        units_all = torch.cat([l.to(device) for l in units_list], dim=0)
-        units_all = units_all.view(batch_size, seq_length, *tuple(units_all.shape[1:]))
-        del units_list
-
-        target_unit_all = torch.cat([l.to(device) for l in target_unit_list], dim=0)
-        target_unit_all = target_unit_all.view(batch_size, seq_length, *tuple(target_unit_all.shape[1:]))
-        del target_unit_list
-
-        target_location_all = torch.cat([l.to(device) for l in target_location_list], dim=0)
-        target_location_all = target_location_all.view(batch_size, seq_length, *tuple(target_location_all.shape[1:]))
-        del target_location_list
-
-        baseline_state_all = [torch.cat([l.to(device) for l in statis], dim=0) for statis in zip(*baseline_state_traj)]
-        baseline_state_all = [l.view(batch_size, seq_length, *tuple(l.shape[1:])) for l in baseline_state_all]
-        del baseline_state_traj
-
+        entity_state_all, statistical_state_all, map_state_all = batch.entity_state, batch.statistical_state, batch.map_state
+        select_units_num_all, entity_nums_all = batch.select_units_num, batch.entity_num
+        hidden_all, cell_all = batch.hidden, batch.cell
+        action_type_all, delay_all, queue_all, units_all, target_unit_all, target_location_all = batch.action.toList()
+        baseline_state_all = batch.baseline_state
         if use_opponent_state:
-            baseline_state_op_all = [torch.cat([l.to(device) for l in statis], dim=0) for statis in zip(*baseline_state_op_traj)]
-            baseline_state_op_all = [l.view(batch_size, seq_length, *tuple(l.shape[1:])) for l in baseline_state_op_all]
-            del baseline_state_op_traj
+            baseline_state_op_all = batch.baseline_state_op
+        del batch
 
         logits_list = []
         baseline_list = []
@@ -482,3 +435,51 @@ class AlphaStarAgent(RandomAgent):
         del logits_list
 
         return policy_logits, baseline_list, select_units_num_all, entity_nums_all
+
+    def rl_teacher_logits(self, trajectories, max_batch_size=None):
+        """Computes the logits of this (supervised) agent on the actions of the trajectories.
+
+        This is the same as step_based_on_actions at each step of the actors, but done at
+        learner time. Each step starts from its own memory in the trajectory, so all the
+        steps are run as one batch (or as batches of max_batch_size steps). The logits are
+        ordered as [seq_size x batch_size], the same as the teacher logits in the loss.
+        """
+        device = self.agent_nn.device()
+
+        steps = [(traj, i) for i in range(len(trajectories[0].state)) for traj in trajectories]
+        if max_batch_size is None:
+            max_batch_size = len(steps)
+
+        logits_list = []
+        with torch.no_grad():
+            for begin in range(0, len(steps), max_batch_size):
+                batch = steps[begin:begin + max_batch_size]
+
+                states = [traj.state[i] for traj, i in batch]
+                entity_state = torch.cat([s.entity_state.to(device) for s in states], dim=0).float()
+                statistical_state = [torch.cat([l.to(device) for l in statis], dim=0).float()
+                                     for statis in zip(*[s.statistical_state for s in states])]
+                map_state = torch.cat([s.map_state.to(device) for s in states], dim=0).float()
+                state = MsState(entity_state=entity_state, statistical_state=statistical_state, map_state=map_state)
+                del states, entity_state, statistical_state, map_state
+
+                action = ArgsAction(*[torch.cat([l.to(device) for l in field], dim=0)
+                                      for field in zip(*[traj.action[i].toList() for traj, i in batch])])
+                select_units_num = torch.cat([traj.player_select_units_num[i].to(device) for traj, i in batch], dim=0)
+
+                # the hidden state of the lstm has the size of [num_of_lstm_layers, batch_size, hidden_size]
+                memory = tuple(torch.cat([h.to(device) for h in l], dim=1)
+                               for l in zip(*[traj.memory[i] for traj, i in batch]))
+
+                logits, _, _ = self.agent_nn.action_logits_based_on_actions(state, action_gt=action, 
+                                                                            gt_select_units_num=select_units_num,
+                                                                            hidden_state=memory,
+                                                                            batch_size=len(batch), 
+                                                                            sequence_length=1)
+                logits_list.append(logits)
+                del state, action, select_units_num, memory, logits, batch
+
+        teacher_logits = ArgsActionLogits(*[torch.cat(l, dim=0) for l in zip(*[a.toList() for a in logits_list])])
+        del logits_list, steps
+
+        return teacher_logits
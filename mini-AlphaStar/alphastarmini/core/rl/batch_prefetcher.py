@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" Collates the next batch of the learner in the background, while the current one is trained "
+
+import queue
+import threading
+
+from time import time
+
+import torch
+
+from alphastarmini.core.rl.alphastar_agent import AlphaStarAgent
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+
+class StagingBuffers(object):
+    '''
+        Preallocated tensors by name, which the collation of the batches reuses (one is
+        only reallocated if its shape or dtype changes). They are pinned for a cuda
+        device, so the copies to the device can be asynchronous.
+    '''
+
+    def __init__(self, pin_memory=False):
+        super().__init__()
+        self.pin_memory = pin_memory
+        self.tensors = {}
+
+    def get(self, name, shape, dtype):
+        t = self.tensors.get(name)
+        if t is None or tuple(t.shape) != tuple(shape) or t.dtype != dtype:
+            t = torch.empty(tuple(shape), dtype=dtype, pin_memory=self.pin_memory)
+            self.tensors[name] = t
+        return t
+
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for t in self.tensors.values())
+
+
+def _tensors(batch):
+    for value in batch:
+        if isinstance(value, torch.Tensor):
+            yield value
+        elif value is not None:
+            for t in (value.toList() if hasattr(value, 'toList') else value):
+                yield t
+
+
+class BatchPrefetcher(object):
+    '''
+        Iterates over the (trajectories, UnrollBatch) of the batches of the learner.
+
+        A thread collates the next batch (AlphaStarAgent.collate_unroll) into one of
+        num_buffers StagingBuffers, while the learner runs the loss, the backward pass and
+        the optimizer step on the current batch. A buffer is reused only when the batch
+        collated into it is done, i.e., when the learner asks for the next one (on cpu the
+        batch tensors are the staging tensors, and autograd keeps them until the backward).
+        For a cuda device the copies run on a side stream.
+
+        collate_time is the time of the thread, wait_time the time the learner waited for it.
+    '''
+
+    def __init__(self, batches, use_opponent_state=True, device=None, num_buffers=2):
+        super().__init__()
+        self.batches = batches
+        self.use_opponent_state = use_opponent_state
+        self.device = torch.device(device) if device is not None else torch.device('cpu')
+
+        self.cuda = self.device.type == 'cuda'
+        self.stream = torch.cuda.Stream(self.device) if self.cuda else None
+
+        self.free = queue.Queue()
+        for _ in range(num_buffers):
+            self.free.put(StagingBuffers(pin_memory=self.cuda))
+        self.ready = queue.Queue()
+        self.current = None
+        self.closed = False
+
+        self.collate_time = 0.
+        self.wait_time = 0.
+
+        self.thread = threading.Thread(target=self.run, args=(), name='batch_prefetcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            for trajectories in self.batches:
+                staging = self.free.get()
+                if self.closed:
+                    break
+
+                t = time()
+                event = None
+                if self.cuda:
+                    with torch.cuda.stream(self.stream):
+                        batch = AlphaStarAgent.collate_unroll(trajectories, self.use_opponent_state, device=self.device,
+                                                              staging=staging, non_blocking=True)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                else:
+                    batch = AlphaStarAgent.collate_unroll(trajectories, self.use_opponent_state, device=self.device,
+                                                          staging=staging)
+                self.collate_time += time() - t
+
+                self.ready.put((trajectories, batch, staging, event))
+
+        except Exception as e:
+            self.ready.put(e)
+
+        finally:
+            self.ready.put(None)
+
+    def _release(self):
+        if self.current is not None:
+            self.free.put(self.current)
+            self.current = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # the previous batch is done
+        self._release()
+
+        t = time()
+        item = self.ready.get()
+        self.wait_time += time() - t
+
+        if item is None:
+            self.ready.put(None)
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+
+        trajectories, batch, staging, event = item
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            # the tensors allocated on the side stream are used on this one
+            for t in _tensors(batch):
+                t.record_stream(stream)
+            # the copies from the staging buffers are done
+            event.synchronize()
+            self.free.put(staging)
+            staging = None
+
+        self.current = staging
+
+        return trajectories, batch
+
+    def close(self):
+        self.closed = True
+        self._release()
+        # wakes up the thread if it waits for a buffer
+        self.free.put(StagingBuffers())
+        self.thread.join()
+
+
+def test():
+    import numpy as np
+
+    from alphastarmini.core.rl.rl_utils import Trajectory, stack_namedtuple
+    from alphastarmini.core.rl.state import MsState
+    from alphastarmini.core.rl.action import ArgsAction
+
+    sequence_length, batch_size = 3, 2
+
+    def get_step(i):
+        state = MsState(entity_state=torch.full((1, 5, 3), float(i)),
+                        statistical_state=[torch.full((1, 2), float(i)), torch.full((1, 4), float(i))],
+                        map_state=torch.full((1, 2, 8, 8), float(i)))
+        action = ArgsAction(*[torch.full((1, 1), i, dtype=torch.long) for _ in range(6)])
+        memory = (torch.full((1, 1, 4), float(i)), torch.full((1, 1, 4), -float(i)))
+        return Trajectory(state=state, baseline_state=[torch.full((1, 2), float(i))], baseline_state_op=None,
+                          memory=memory, z=None, is_final=False, masks=[1, 1, 0, 0, 0, 1],
+                          unit_type_entity_mask=np.ones(5, dtype=bool), action=action,
+                          behavior_logits=None, teacher_logits=None, reward=0.,
+                          player_select_units_num=torch.tensor([i]), entity_num=torch.tensor([5]),
+                          build_order=[], z_build_order=None, unit_counts=None,
+                          z_unit_counts=None, game_loop=i * 8, last_list=[0, 0, 0])
+
+    trajectories = [stack_namedtuple([get_step(k * sequence_length + t) for t in range(sequence_length)])
+                    for k in range(batch_size * 3)]
+    batches = [trajectories[b * batch_size:(b + 1) * batch_size] for b in range(3)]
+
+    prefetcher = BatchPrefetcher(batches, use_opponent_state=False)
+    count = 0
+    for trajs, batch in prefetcher:
+        expected = AlphaStarAgent.collate_unroll(trajs, use_opponent_state=False)
+        for a, b in zip(_tensors(batch), _tensors(expected)):
+            assert torch.equal(a, b)
+        assert batch.hidden.shape == (batch_size, sequence_length, 1, 4)
+        assert batch.entity_state[1, 2, 0, 0] == trajs[1].state[2].entity_state[0, 0, 0]
+        count += 1
+    prefetcher.close()
+    assert count == 3
+
+    # the staging buffers are reused
+    assert len(set(id(b.tensors['map_state']) for b in list(prefetcher.free.queue) if 'map_state' in b.tensors)) == 2
+    print('BatchPrefetcher collate {:.2f} ms, wait {:.2f} ms'.format(1000 * prefetcher.collate_time,
+                                                                    1000 * prefetcher.wait_time))
+
+
+if __name__ == '__main__':
+    test()
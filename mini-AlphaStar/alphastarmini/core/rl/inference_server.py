@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" Batched inference server for the actors of one worker, in the SEED-RL way "
+
+import time
+import queue
+import threading
+import traceback
+import collections
+
+import torch
+
+from alphastarmini.core.rl.state import MsState
+from alphastarmini.core.rl.action import ArgsAction, ArgsActionLogits
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+
+def cat_states(states):
+    entity_state = torch.cat([s.entity_state for s in states], dim=0)
+    statistical_state = [torch.cat(l, dim=0) for l in zip(*[s.statistical_state for s in states])]
+    map_state = torch.cat([s.map_state for s in states], dim=0)
+
+    return MsState(entity_state=entity_state, statistical_state=statistical_state, map_state=map_state)
+
+
+def cat_hidden_states(hidden_states):
+    # the hidden state of the lstm has the size of [num_of_lstm_layers, batch_size, hidden_size]
+    return tuple(torch.cat(l, dim=1) for l in zip(*hidden_states))
+
+
+def split_logits(logits, i):
+    return ArgsActionLogits(*[l[i:i + 1] for l in logits.toList()])
+
+
+def split_action(action, i):
+    return ArgsAction(*[l[i:i + 1] for l in action.toList()])
+
+
+def split_hidden_state(hidden_state, i):
+    return tuple(h[:, i:i + 1] for h in hidden_state)
+
+
+class InferenceRequest(object):
+    '''
+        One pending step of an actor, the result is set by the server thread.
+    '''
+    __slots__ = ('state', 'hidden_state', 'obs', 'put_time', 'event', 'result', 'error')
+
+    def __init__(self, state, hidden_state, obs=None):
+        super().__init__()
+        self.state = state
+        self.hidden_state = hidden_state
+        self.obs = obs
+        self.put_time = time.time()
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class InferenceStats(object):
+    '''
+        Queue time of the requests, histogram of the batch sizes and the throughput of the server.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.time()
+        self.request_num = 0
+        self.batch_num = 0
+        self.queue_time = 0.
+        self.max_queue_time = 0.
+        self.forward_time = 0.
+        self.batch_size_hist = collections.Counter()
+
+    def add(self, queue_times, forward_time):
+        self.request_num += len(queue_times)
+        self.batch_num += 1
+        self.queue_time += sum(queue_times)
+        self.max_queue_time = max([self.max_queue_time] + queue_times)
+        self.forward_time += forward_time
+        self.batch_size_hist[len(queue_times)] += 1
+
+    def report(self):
+        elapse_time = max(time.time() - self.start_time, 1e-9)
+        return {'requests_per_second': self.request_num / elapse_time,
+                'batches_per_second': self.batch_num / elapse_time,
+                'mean_batch_size': self.request_num / max(self.batch_num, 1),
+                'mean_queue_time_ms': self.queue_time / max(self.request_num, 1) * 1000,
+                'max_queue_time_ms': self.max_queue_time * 1000,
+                'mean_forward_time_ms': self.forward_time / max(self.batch_num, 1) * 1000,
+                'batch_size_hist': dict(sorted(self.batch_size_hist.items()))}
+
+    def __str__(self):
+        r = self.report()
+        return 'requests/s: {:.2f} | mean batch: {:.2f} | queue: {:.2f} ms (max {:.2f}) | forward: {:.2f} ms | batch sizes: {}'.format(
+            r['requests_per_second'], r['mean_batch_size'], r['mean_queue_time_ms'], r['max_queue_time_ms'],
+            r['mean_forward_time_ms'], r['batch_size_hist'])
+
+
+class InferenceServer(object):
+    '''
+        The actors of one worker put their steps here instead of running the model
+        at batch size 1 in each actor thread.
+
+        The server thread waits for the first request, then collects more requests
+        until max_batch_size requests are pending or max_wait_ms has passed. It runs
+        one batched forward of the agent (and one batched pass of the teacher on the
+        sampled actions), and scatters the results back to the actors.
+
+        The agent of the server is the only inference copy of the model in the worker.
+        With a param_subscriber, its parameters are swapped in between two batches whenever
+        the learner publishes a new version; else its weights are copied from the learning
+        player every update_params_interval seconds.
+    '''
+
+    def __init__(self, agent, teacher=None, player=None, max_batch_size=4, max_wait_ms=5.,
+                 update_params_interval=None, writer=None, report_interval=60., param_subscriber=None):
+        super().__init__()
+        self.agent = agent
+        self.teacher = teacher
+        self.player = player
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max_wait_ms
+        self.update_params_interval = update_params_interval
+        self.param_subscriber = param_subscriber
+        self.writer = writer
+        self.report_interval = report_interval
+
+        self.stats = InferenceStats()
+        self.request_queue = queue.Queue()
+
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.is_running = False
+
+    def start(self):
+        self.is_running = True
+        self.thread.start()
+
+    def stop(self):
+        self.is_running = False
+        self.request_queue.put(None)
+        self.thread.join()
+
+    def infer(self, state, hidden_state, obs=None):
+        """Called by an actor thread, blocks until its step is computed.
+
+        Returns:
+            the same as AlphaStarAgent.step_from_state, followed by the teacher logits
+            (None if the server has no teacher) and the version of the parameters (None if
+            the server has no param_subscriber).
+        """
+        request = InferenceRequest(state, hidden_state, obs)
+        self.request_queue.put(request)
+        request.event.wait()
+
+        if request.error is not None:
+            raise request.error
+
+        return request.result
+
+    def _collect(self):
+        first = self.request_queue.get()
+        if first is None:
+            return None
+
+        requests = [first]
+        deadline = time.time() + self.max_wait_ms / 1000.
+        while len(requests) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.request_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self.is_running = False
+                break
+            requests.append(request)
+
+        return requests
+
+    def _forward(self, requests):
+        batch_size = len(requests)
+        device = self.agent.agent_nn.device()
+
+        state = cat_states([r.state for r in requests])
+        state.to(device)
+        hidden_state = cat_hidden_states([tuple(h.to(device) for h in r.hidden_state) for r in requests])
+        obs_list = [r.obs for r in requests] if all(r.obs is not None for r in requests) else None
+
+        action_logits, action, new_hidden_state, select_units_num, entity_num = self.agent.agent_nn.model.forward(
+            state, batch_size=batch_size, sequence_length=1, hidden_state=hidden_state,
+            return_logits=True, obs_list=obs_list)
+
+        teacher_logits = None
+        if self.teacher is not None:
+            teacher_device = self.teacher.agent_nn.device()
+            state.to(teacher_device)
+            action.to(teacher_device)
+            teacher_logits, _, _ = self.teacher.agent_nn.action_logits_based_on_actions(
+                state, action_gt=action, gt_select_units_num=select_units_num.to(teacher_device),
+                hidden_state=tuple(h.to(teacher_device) for h in hidden_state),
+                batch_size=batch_size, sequence_length=1)
+            action.to(device)
+
+        del state, hidden_state, obs_list
+
+        policy_version = self.param_subscriber.version if self.param_subscriber is not None else None
+
+        for i, r in enumerate(requests):
+            r_action = split_action(action, i)
+            r_select_units_num = select_units_num[i:i + 1]
+            func_call = self.agent.agent_nn.action_to_func_call(r_action, r_select_units_num, self.agent.action_spec)
+            r.result = (func_call, r_action, split_logits(action_logits, i), split_hidden_state(new_hidden_state, i),
+                        r_select_units_num, entity_num[i:i + 1],
+                        split_logits(teacher_logits, i) if teacher_logits is not None else None, policy_version)
+
+    def _update_params(self):
+        print("inference server update params") if debug else None
+        self.agent.set_weights(self.player.agent.get_weights())
+
+    def _report(self, step):
+        print('inference server', self.stats)
+        if self.writer is not None:
+            for k, v in self.stats.report().items():
+                if k != 'batch_size_hist':
+                    self.writer.add_scalar('InferenceServer/' + k, v, step)
+
+    def run(self):
+        update_params_timer = time.time()
+        report_timer = time.time()
+        report_step = 0
+
+        with torch.no_grad():
+            while self.is_running:
+                requests = self._collect()
+                if requests is None:
+                    break
+
+                start = time.time()
+                queue_times = [start - r.put_time for r in requests]
+                try:
+                    self._forward(requests)
+                except Exception as e:
+                    print("InferenceServer.run() Exception, Detials of the Exception:", e)
+                    print(traceback.format_exc())
+                    for r in requests:
+                        r.error = e
+                self.stats.add(queue_times, time.time() - start)
+
+                for r in requests:
+                    r.event.set()
+                del requests
+
+                # only change the weights between two batches
+                if self.param_subscriber is not None:
+                    self.param_subscriber.update()
+                elif self.player is not None and self.update_params_interval is not None:
+                    if time.time() - update_params_timer > self.update_params_interval:
+                        self._update_params()
+                        update_params_timer = time.time()
+
+                if self.report_interval is not None and time.time() - report_timer > self.report_interval:
+                    report_step += 1
+                    self._report(report_step)
+                    report_timer = time.time()
+
+        # wake up the actors still waiting
+        while not self.request_queue.empty():
+            r = self.request_queue.get()
+            if r is not None:
+                r.error = RuntimeError("InferenceServer stopped")
+                r.event.set()
+
+
+def test():
+    from alphastarmini.core.rl.rl_utils import get_supervised_agent
+
+    from pysc2.env import mock_sc2_env
+    from pysc2.env.sc2_env import Race, AgentInterfaceFormat, Agent, Bot, Difficulty, BotBuild
+    from pysc2.lib import features, point
+
+    from alphastarmini.lib.hyper_parameters import AlphaStar_Agent_Interface_Format_Params as AAIFP
+
+    torch.manual_seed(0)
+
+    agent = get_supervised_agent(Race.protoss, restore=False, device='cpu')
+    teacher = get_supervised_agent(Race.protoss, restore=False, device='cpu')
+    agent_interface_format = AgentInterfaceFormat(**AAIFP._asdict())
+    action_spec = features.Features(agent_interface_format, map_size=point.Point(64, 64)).action_spec()
+    agent.setup(None, action_spec)
+    agent.agent_nn.model.eval()
+    teacher.agent_nn.model.eval()
+
+    actor_nums, steps = 4, 5
+
+    # the states of the observations of the pysc2 test env, the same for every run
+    players = [Agent(Race.protoss, 'player'), Bot([Race.terran], Difficulty(1), [BotBuild.random])]
+    env = mock_sc2_env.SC2TestEnv(players=players, agent_interface_format=[agent_interface_format])
+    env.episode_length = steps
+    timesteps = [env.reset()[0]]
+    while not timesteps[-1].last():
+        timesteps.append(env.step([None])[0])
+    env.close()
+    states = [agent.agent_nn.preprocess_state_all(t.observation, build_order=[], last_list=[0, 0, 0])
+              for t in timesteps[:steps]]
+
+    server = InferenceServer(agent, teacher, max_batch_size=actor_nums, max_wait_ms=20., report_interval=None)
+    server.start()
+
+    errors = []
+
+    def actor_loop(idx):
+        try:
+            hidden_state = agent.initial_state()
+            for state in states:
+                func_call, action, logits, new_hidden_state, select_units_num, entity_num, teacher_logits, _ = \
+                    server.infer(state.clone(), hidden_state)
+
+                # the batched teacher logits equal the ones of a single inference on the same actions
+                with torch.no_grad():
+                    single_teacher_logits = teacher.step_based_on_actions(state.clone(), hidden_state,
+                                                                          action.clone(), select_units_num)
+                assert torch.allclose(teacher_logits.action_type, single_teacher_logits.action_type, atol=1e-4)
+                assert new_hidden_state[0].shape == hidden_state[0].shape
+                hidden_state = new_hidden_state
+        except Exception as e:
+            print(traceback.format_exc())
+            errors.append(e)
+
+    threads = [threading.Thread(target=actor_loop, args=(i,)) for i in range(actor_nums)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    server.stop()
+
+    assert not errors
+    assert server.stats.request_num == actor_nums * steps
+    print('inference server', server.stats)
+
+
+if __name__ == '__main__':
+    test()
@@ -25,9 +25,14 @@ from torch.optim import Adam, RMSprop
 
 from tensorboardX import SummaryWriter
 
+from pysc2.lib import latency
+
 from alphastarmini.core.rl.rl_loss import loss_function
 from alphastarmini.core.rl import rl_utils as RU
 from alphastarmini.core.rl import shared_adam as SA
+from alphastarmini.core.rl import trajectory_buffer as TB
+from alphastarmini.core.rl.param_broadcast import ParameterPublisher
+from alphastarmini.core.rl.batch_prefetcher import BatchPrefetcher
 
 from alphastarmini.lib.hyper_parameters import Arch_Hyper_Parameters as AHP
 from alphastarmini.lib.hyper_parameters import RL_Training_Hyper_Parameters as THP
@@ -56,7 +61,8 @@ class Learner:
                  buffer_size=10, use_random_sample=False,
                  only_update_baseline=False,
                  need_save_result=True, process_lock=None,
-                 update_params_interval=10):
+                 update_params_interval=10, sample_mode=None, share_memory_buffer=False,
+                 teacher=None, codec=None, prefetch_batches=True):
         self.player = player
         self.player.set_learner(self)
 
@@ -66,7 +72,13 @@ class Learner:
 
         self.name = 'learner_' + str(self.rank)
 
-        self.trajectories = []
+        # preallocated ring buffer of the trajectories, the oldest ones are overwritten beyond max_size,
+        # encoded by the codec (see TrajectoryCodec) if any
+        if sample_mode is None:
+            sample_mode = TB.UNIFORM if use_random_sample else TB.FIFO
+        max_size = 1 * count_of_batches * AHP.batch_size * buffer_size
+        self.trajectories = TB.TrajectoryRingBuffer(max_size, AHP.sequence_length, mode=sample_mode,
+                                                    share_memory=share_memory_buffer, codec=codec)
         self.final_trajectories = []
         self.win_trajectories = []
 
@@ -80,6 +92,11 @@ class Learner:
         self.optimizer = optimizer
         self.global_model = global_model
 
+        # the actors pull the parameters of the learner from here, only when its version changes
+        self.publisher = ParameterPublisher(player.agent.agent_nn.model, share_memory=share_memory_buffer)
+        # the v_steps of the global model when the learner model is synchronized with it last time
+        self.synced_steps = None
+
         self.thread = threading.Thread(target=self.run, args=())
         self.thread.daemon = True                            # Daemonize thread
 
@@ -104,11 +121,45 @@ class Learner:
         self.baseline_weight = baseline_weight
         self.process_lock = process_lock
 
+        # the supervised agent on the learner device, if given the teacher logits are
+        # computed by the loss, instead of being sent by the actors with the trajectories
+        self.teacher = teacher
+
+        # the next batch is collated by a thread during the update of the current one
+        self.prefetch_batches = prefetch_batches
+
+        # the time of the updates (loss, backward and optimizer step), e.g., for the benchmarks
+        self.update_time = 0.
+        self.update_count = 0
+
+        # the time of update_parameters, of the collation of the batches (in the background
+        # with prefetch_batches), and of the waits for it, and the trained steps
+        self.learn_time = 0.
+        self.collate_time = 0.
+        self.collate_wait_time = 0.
+        self.samples = 0
+
     def get_parameters(self):
         return self.player.agent.get_parameters()
 
+    def sync_with_global_model(self):
+        """Loads the global model only if it is updated (by any learner) since the last time,
+        and publishes the new parameters to the actors."""
+        if self.global_model is None:
+            return False
+
+        steps = self.v_steps.value
+        if steps == self.synced_steps:
+            return False
+
+        self.player.agent.agent_nn.model.load_state_dict(self.global_model.state_dict())
+        self.synced_steps = steps
+        self.publisher.publish(self.player.agent.agent_nn.model)
+
+        return True
+
     def send_trajectory(self, trajectory):
-        self.trajectories.append(trajectory)
+        self.trajectories.put(trajectory)
 
     def send_final_trajectory(self, trajectory):
         self.final_trajectories.append(trajectory)
@@ -116,37 +167,24 @@ class Learner:
     def send_win_trajectory(self, trajectory):
         self.win_trajectories.append(trajectory)        
 
+    def report(self):
+        """The trained steps per second, and the time split of the updates."""
+        learn_time = max(self.learn_time, 1e-9)
+        count = max(self.update_count, 1)
+        return {'samples_per_second': self.samples / learn_time,
+                'update_ms': 1000. * self.update_time / count,
+                'collate_ms': 1000. * self.collate_time / count,
+                'collate_wait_ms': 1000. * self.collate_wait_time / count,
+                'compute_ratio': self.update_time / learn_time,
+                'collate_wait_ratio': self.collate_wait_time / learn_time}
+
     def get_normal_trajectories(self):
         batch_size = AHP.batch_size
         sample_size = self.count_of_batches * batch_size
-        max_size = 1 * sample_size * self.buffer_size
-
-        trajectories = []
 
-        # TODO: change the sampling method
-        # if self.use_random_sample:
-        #     random.shuffle(self.trajectories)
-
-        if self.use_random_sample:
-            sample_index = np.random.choice(len(self.trajectories), sample_size, replace=False)
-            trajectories_reduced = [self.trajectories[i] for i in sample_index]
-        else:
-            trajectories_reduced = self.trajectories[:sample_size]
-
-        trajectories = trajectories_reduced
-        del trajectories_reduced
-
-        # assert len(trajectories) == sample_size
-
-        # update self.trajectories
-        if len(self.trajectories) > 0 and len(self.trajectories) <= max_size:
-            # first-in first out
-            self.trajectories = self.trajectories[sample_size:]
-        elif len(self.trajectories) > max_size:
-            print(self.name, 'len(self.trajectories) larger than max_size, begin to drop!')
-            drop_size = len(self.trajectories) - max_size + sample_size
-            self.trajectories = self.trajectories[drop_size:]
-            print(self.name, 'len(self.trajectories)', len(self.trajectories))
+        # the ring buffer consumes (or, in the prioritized mode, keeps) the sampled
+        # trajectories by moving its indices, instead of slicing the list
+        trajectories = self.trajectories.sample(sample_size)
 
         return trajectories
 
@@ -189,20 +227,15 @@ class Learner:
             if len(self.final_trajectories) > 64:
                 self.final_trajectories = self.final_trajectories[sample_final:]
 
-        if self.use_random_sample:
-            random.shuffle(self.trajectories)
-        trajectories_reduced = self.trajectories[:reduce_sample_size]
+        trajectories_reduced = self.trajectories.sample(reduce_sample_size)
         trajectories.extend(trajectories_reduced)
         del trajectories_reduced
 
         assert len(trajectories) == sample_size
 
-        # update self.trajectories
-        if len(self.trajectories) > 0:
-            self.trajectories = self.trajectories[reduce_sample_size:]
-
         return trajectories
 
+    @latency.registry.decorate("Learner.update_parameters")
     def update_parameters(self):
         if not self.is_rl_training:
             return 
@@ -214,9 +247,16 @@ class Learner:
 
         print(learner_name, 'len(self.trajectories)', len(self.trajectories)) if 1 else None
 
+        learn_start_time = time()
         trajectories = self.get_normal_trajectories()
         print(learner_name, 'len(trajectories)', len(trajectories)) if debug else None
 
+        prefetcher = None
+        if self.prefetch_batches:
+            batches = [trajectories[batch_id * batch_size: (batch_id + 1) * batch_size]
+                       for ep_id in range(self.num_epochs) for batch_id in range(self.count_of_batches)]
+            prefetcher = BatchPrefetcher(batches, self.use_opponent_state, device=agent.agent_nn.device())
+
         # agent.agent_nn.model.train()  # for BN and dropout
         print(learner_name, "begin rl update") if debug else None
 
@@ -228,7 +268,11 @@ class Learner:
         for ep_id in range(self.num_epochs):
 
             for batch_id in range(self.count_of_batches):
-                update_trajectories = trajectories[batch_id * batch_size: (batch_id + 1) * batch_size]
+                unroll_batch = None
+                if prefetcher is not None:
+                    update_trajectories, unroll_batch = next(prefetcher)
+                else:
+                    update_trajectories = trajectories[batch_id * batch_size: (batch_id + 1) * batch_size]
                 print(learner_name, 'len(update_trajectories)', len(update_trajectories)) if debug else None
 
                 loss_dict_items = None
@@ -241,12 +285,14 @@ class Learner:
                     SA.show_grads(agent.agent_nn.model, self.global_model, debug)
 
                     print(learner_name, "begin synchronize") if debug else None
-                    agent.agent_nn.model.load_state_dict(self.global_model.state_dict())
+                    self.sync_with_global_model()
                     SA.show_datas(agent.agent_nn.model, self.global_model, debug)
 
+                    update_start_time = time()
                     loss, loss_dict = loss_function(agent, update_trajectories, self.use_opponent_state, 
                                                     self.no_replay_learn, self.only_update_baseline,
-                                                    self.baseline_weight)
+                                                    self.baseline_weight, policy_version=self.publisher.version,
+                                                    teacher=self.teacher, batch=unroll_batch)
                     loss_dict_items = loss_dict.items()
                     loss_item = loss.item()
 
@@ -266,6 +312,9 @@ class Learner:
                     self.optimizer.step()
                     SA.show_datas(agent.agent_nn.model, self.global_model, debug)
 
+                    self.update_time += time() - update_start_time
+                    self.update_count += 1
+
                     # print(learner_name, "begin load_state_dict") if debug else None
                     # agent.agent_nn.model.load_state_dict(self.global_model.state_dict())
                     # SA.show_datas(agent.agent_nn.model, self.global_model, debug)
@@ -273,7 +322,7 @@ class Learner:
                     del loss, loss_dict
                     print(learner_name, "end update") if debug else None
 
-                del update_trajectories
+                del update_trajectories, unroll_batch
                 print(learner_name, "loss:", loss_item) if debug else None
 
                 for i, k in loss_dict_items:
@@ -289,6 +338,22 @@ class Learner:
 
                 agent.steps += AHP.batch_size * AHP.sequence_length
                 self.v_steps.value += AHP.batch_size * AHP.sequence_length
+                self.samples += AHP.batch_size * AHP.sequence_length
+
+        if prefetcher is not None:
+            prefetcher.close()
+            self.collate_time += prefetcher.collate_time
+            self.collate_wait_time += prefetcher.wait_time
+            del prefetcher
+
+        # publish the result of the last update
+        self.sync_with_global_model()
+
+        self.learn_time += time() - learn_start_time
+        r = self.report()
+        print(learner_name, 'samples/s: {:.2f} | update: {:.0f} ms | collate: {:.0f} ms (wait {:.0f} ms) | '
+              'compute {:.1%}'.format(r['samples_per_second'], r['update_ms'], r['collate_ms'],
+                                      r['collate_wait_ms'], r['compute_ratio'])) if 1 else None
 
         # agent.agent_nn.model.eval()
         print(learner_name, "end rl update") if debug else None
@@ -313,6 +378,9 @@ class Learner:
             update_params_timer = time()
             self.is_running = True
 
+            # the first version, so the actors start from the parameters of the learner
+            self.publisher.publish(self.player.agent.agent_nn.model)
+
             while time() - start_time < self.max_time_for_training:
                 try:
                     # if at least one actor is running, the learner would not stop
@@ -330,7 +398,7 @@ class Learner:
                         print('learner trajectories size:', len(self.trajectories)) if debug else None
 
                         if time() - update_params_timer > self.update_params_interval:
-                            self.player.agent.agent_nn.model.load_state_dict(self.global_model.state_dict())
+                            self.sync_with_global_model()
                             update_params_timer = time()
 
                         if len(self.trajectories) >= self.buffer_size * self.count_of_batches * AHP.batch_size:
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" Deterministic mock env in place of SC2Env, and a frames/s benchmark of the actor and learner loop without the game "
+
+import gc
+import os
+import pickle
+import queue
+
+from time import time, sleep
+
+import numpy as np
+
+import torch
+
+from pysc2.env import environment
+from pysc2.env import mock_sc2_env
+from pysc2.env.sc2_env import AgentInterfaceFormat, Agent, Race, Bot, Difficulty, BotBuild
+from pysc2.lib import features
+from pysc2.lib import named_array
+from pysc2.tests import dummy_observation
+
+from alphastarmini.lib.hyper_parameters import AlphaStar_Agent_Interface_Format_Params as AAIFP
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+SYNTHETIC = 'synthetic'
+
+# the units of each player in the synthetic observations
+NUM_UNITS = 64
+SEED = 1
+
+# the keys of a step dict of the replay pickles made by transform_replay_data (SaveType.python_pickle)
+SL_OBS_KEYS = ['raw_units', 'player', 'last_actions', 'upgrades', 'unit_counts',
+               'feature_effects', 'raw_effects', 'game_loop']
+SL_MINIMAP_KEYS = ['height_map', 'camera', 'visibility_map', 'creep', 'player_relative',
+                   'alerts', 'pathable', 'buildable']
+
+
+def load_sl_replay_timesteps(pickle_path, obs_spec, agent_interface_format):
+    '''
+        Makes TimeSteps of the step dicts saved by transform_replay_data. The fields
+        which are not saved there (e.g. the score) keep the values of a default
+        observation of the mock env.
+    '''
+    with open(pickle_path, 'rb') as handle:
+        step_dict = pickle.load(handle)
+
+    feats = features.Features(agent_interface_format, map_size=(mock_sc2_env.DUMMY_MAP_SIZE,) * 2)
+    default_obs = feats.transform_obs(dummy_observation.Builder(obs_spec).build())
+
+    timesteps = []
+    keys = sorted(step_dict.keys())
+    for i, key in enumerate(keys):
+        d = step_dict[key]
+        obs = named_array.NamedDict(default_obs)
+
+        for k in SL_OBS_KEYS:
+            if k in d:
+                obs[k] = d[k]
+
+        feature_minimap = np.array(default_obs['feature_minimap'])
+        for k in SL_MINIMAP_KEYS:
+            if k in d:
+                feature_minimap[features.MINIMAP_FEATURES[k].index] = d[k]
+        obs['feature_minimap'] = named_array.NamedNumpyArray(feature_minimap, default_obs['feature_minimap']._index_names)
+
+        if i == 0:
+            step_type = environment.StepType.FIRST
+        elif i == len(keys) - 1:
+            step_type = environment.StepType.LAST
+        else:
+            step_type = environment.StepType.MID
+        timesteps.append(environment.TimeStep(step_type=step_type, reward=0., discount=1., observation=obs))
+
+    return timesteps
+
+
+def create_mock_env(players, agent_interface_format, source=SYNTHETIC, num_units=NUM_UNITS,
+                    seed=SEED, step_mul=8, game_steps_per_episode=None, episode_length=None,
+                    cache_episodes=0):
+    '''
+        Returns a SC2SyntheticEnv which stands in for the SC2Env of the actors.
+
+        source is SYNTHETIC for seeded random units (num_units for each player), the
+        path of the TimeSteps recorded by the DataRecorder of llm_pysc2 (a pkl file or
+        a directory of them), or the path of a replay pickle of transform_replay_data.
+    '''
+    timesteps = None
+    if source != SYNTHETIC:
+        if source.endswith('.pickle'):
+            feats = features.Features(agent_interface_format[0], map_size=(mock_sc2_env.DUMMY_MAP_SIZE,) * 2)
+            timesteps = load_sl_replay_timesteps(source, feats.observation_spec(), agent_interface_format[0])
+        else:
+            timesteps = mock_sc2_env.load_recorded_timesteps(source)
+
+    env = mock_sc2_env.SC2SyntheticEnv(timesteps=timesteps, num_units=num_units, seed=seed,
+                                       episode_length=episode_length, cache_episodes=cache_episodes,
+                                       players=players, agent_interface_format=agent_interface_format,
+                                       step_mul=step_mul, game_steps_per_episode=game_steps_per_episode)
+
+    return env
+
+
+def benchmark(max_time=60., actor_nums=1, num_units=NUM_UNITS, episode_length=64,
+              use_inference_server=False, cache_episodes=2, train=True, lazy_teacher=False, compact=False,
+              actor_processes=False):
+    '''
+        Frames/s of the whole actor -> learner loop of rl_vs_inner_bot_mp, with the
+        mock env in place of the game: ActorVSComputers on one player and its learner,
+        in this process, on cpu, from a random initial model.
+
+        With lazy_teacher the teacher logits are computed by the learner (see
+        LAZY_TEACHER_LOGITS) instead of the actors or the inference server. With compact
+        the learner buffers the trajectories by a TrajectoryCodec. With actor_processes the
+        actors run in spawned processes (see ActorProcessPool), with their own agents.
+    '''
+    import torch.multiprocessing as mp
+
+    from alphastarmini.core.rl import rl_vs_inner_bot_mp as RVB
+    from alphastarmini.core.rl import shared_adam as SA
+    from alphastarmini.core.rl.rl_utils import get_supervised_agent
+    from alphastarmini.core.rl.learner import Learner
+    from alphastarmini.core.rl.inference_server import InferenceServer
+    from alphastarmini.core.rl.param_broadcast import ParameterSubscriber
+    from alphastarmini.core.rl.trajectory_codec import TrajectoryCodec
+    from alphastarmini.core.rl.actor_process import ActorProcessPool
+    from alphastarmini.core.ma.league import League
+    from alphastarmini.lib.hyper_parameters import Arch_Hyper_Parameters as AHP
+    from alphastarmini.lib.hyper_parameters import RL_Training_Hyper_Parameters as THP
+
+    device = torch.device('cpu')
+    league = League(initial_agents={race: get_supervised_agent(race, device=device, restore=False)
+                                    for race in [Race.protoss]},
+                    main_players=1, main_exploiters=0, league_exploiters=0)
+    player = league.get_learning_player(0)
+    player.agent.set_rl_training(train)
+
+    global_model = get_supervised_agent(player.race, device=device, restore=False).agent_nn.model
+    global_model.load_state_dict(player.agent.agent_nn.model.state_dict())
+    optimizer = SA.IkostrikovSharedAdam(global_model.parameters(), lr=RVB.LR, betas=(THP.beta1, THP.beta2),
+                                        eps=THP.epsilon, weight_decay=RVB.WEIGHT_DECAY)
+    v_steps = mp.Value('d', 0.0)
+
+    teacher = get_supervised_agent(player.race, device=device, restore=False)
+    teacher.set_rl_training(train)
+
+    learner = Learner(player, 0, v_steps, 'cpu', optimizer=optimizer, global_model=global_model,
+                      max_time_for_training=max_time, is_training=train, writer=None,
+                      use_opponent_state=False, no_replay_learn=True, num_epochs=1, count_of_batches=1,
+                      buffer_size=1, need_save_result=False, teacher=teacher if lazy_teacher else None,
+                      codec=TrajectoryCodec() if compact else None, share_memory_buffer=actor_processes)
+    if lazy_teacher:
+        teacher = None
+
+    inference_server = None
+    if use_inference_server and not actor_processes:
+        server_agent = get_supervised_agent(player.race, device=device, restore=False)
+        inference_server = InferenceServer(server_agent, teacher=teacher, player=player, max_batch_size=actor_nums,
+                                           max_wait_ms=RVB.INFERENCE_MAX_WAIT_MS,
+                                           param_subscriber=ParameterSubscriber(learner.publisher, server_agent.agent_nn.model))
+
+    actor_kwargs = dict(max_time_for_training=max_time, max_time_per_one_opponent=max_time,
+                        max_frames=None, max_episodes=None, is_training=train, need_save_result=False,
+                        mock_env=SYNTHETIC, mock_env_units=num_units,
+                        mock_env_episode_length=episode_length, mock_env_cache_episodes=cache_episodes)
+    q_winloss, q_points = queue.Queue(), queue.Queue()
+    if actor_processes:
+        pool = ActorProcessPool(learner, actor_nums, actor_kwargs=actor_kwargs, use_teacher=teacher is not None)
+        actors = pool.actors
+    else:
+        actors = [RVB.ActorVSComputer(player, q_winloss, q_points, device, global_model, None, teacher, idx,
+                                      inference_server=inference_server, **actor_kwargs)
+                  for idx in range(actor_nums)]
+
+    start_time = time()
+    if train:
+        learner.start()
+    if inference_server is not None:
+        inference_server.start()
+    if actor_processes:
+        pool.start()
+    else:
+        for actor in actors:
+            actor.start()
+    for actor in actors:
+        actor.thread.join()
+    if inference_server is not None:
+        inference_server.stop()
+    elapse_time = time() - start_time
+    if actor_processes:
+        pool.stop()
+    if train:
+        learner.thread.join()
+
+    frames = sum(actor.total_frames for actor in actors)
+    steps = sum(actor.total_steps for actor in actors)
+    samples = v_steps.value
+
+    r = {'frames_per_second': frames / elapse_time,
+         'steps_per_second': steps / elapse_time,
+         'learner_samples_per_second': samples / elapse_time,
+         'learner_update_ms': 1000. * learner.update_time / max(learner.update_count, 1),
+         'buffer_kb_per_step': learner.trajectories.bytes_per_step() / 1024}
+    print('mock env benchmark: actors {} | processes {} | units {} | lazy teacher {} | compact {} | frames/s {:.1f} | '
+          'actor steps/s {:.2f} | learner samples/s {:.2f} | learner update {:.0f} ms | buffer {:.1f} KB/step'.format(
+              actor_nums, actor_processes, num_units, lazy_teacher, compact, r['frames_per_second'], r['steps_per_second'],
+              r['learner_samples_per_second'], r['learner_update_ms'], r['buffer_kb_per_step']))
+
+    return r
+
+
+def benchmark_teacher_logits(max_time=60., actor_nums=1, use_inference_server=False, **kwargs):
+    '''
+        Actor frames/s and learner update time with the teacher logits computed by the
+        actors at each step, and by the learner over the sampled trajectories.
+    '''
+    results = {}
+    for lazy_teacher in [False, True]:
+        gc.collect()
+        results[lazy_teacher] = benchmark(max_time=max_time, actor_nums=actor_nums,
+                                          use_inference_server=use_inference_server,
+                                          lazy_teacher=lazy_teacher, **kwargs)
+
+    print('teacher logits by actors: frames/s {:.1f} | learner update {:.0f} ms; by learner: frames/s {:.1f} | '
+          'learner update {:.0f} ms'.format(results[False]['frames_per_second'], results[False]['learner_update_ms'],
+                                            results[True]['frames_per_second'], results[True]['learner_update_ms']))
+
+    return results
+
+
+def test():
+    player_aif = AgentInterfaceFormat(**AAIFP._asdict())
+    players = [Agent(Race.protoss, 'player'), Bot([Race.terran], Difficulty(1), [BotBuild.random])]
+
+    streams = []
+    for _ in range(2):
+        env = create_mock_env(players, [player_aif], num_units=32, episode_length=5)
+        timesteps = [env.reset()[0]]
+        while not timesteps[-1].last():
+            timesteps.append(env.step([None])[0])
+        streams.append(timesteps)
+
+    assert len(streams[0]) == 6
+    for a, b in zip(*streams):
+        assert np.array_equal(a.observation['raw_units'], b.observation['raw_units'])
+
+    # the observations can be featurized by the agent
+    from alphastarmini.core.arch.agent import Agent as ASAgent
+    state = ASAgent.preprocess_state_all(streams[0][1].observation, build_order=[], last_list=[0, 0, 0])
+    print('mock env state', state.entity_state.shape, state.map_state.shape)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" Versioned parameter snapshots published by the learner and pulled by the actors "
+
+import threading
+
+import torch
+import torch.multiprocessing as mp
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+# [version, active buffer]
+VERSION, ACTIVE = 0, 1
+
+
+class ParameterPublisher(object):
+    '''
+        Double-buffered snapshot of the model parameters with a monotonic version.
+
+        The learner publishes into the inactive buffer, then flips the active buffer
+        and increments the version. Each buffer has a sequence counter which is odd
+        while it is written, so a subscriber can detect (and retry) a copy which was
+        overlapped by a publish, without taking any lock.
+
+        With share_memory=True the buffers live in shared memory (on cpu), so the
+        actors in other processes can subscribe too.
+    '''
+
+    def __init__(self, model, share_memory=False, device=None, lock=None):
+        super().__init__()
+        state_dict = model.state_dict()
+        if device is None:
+            device = 'cpu' if share_memory else next(model.parameters()).device
+
+        self.names = list(state_dict.keys())
+        self.buffers = [[t.detach().to(device).clone() for t in state_dict.values()] for _ in range(2)]
+
+        self.header = torch.zeros(2, dtype=torch.int64)
+        self.sequences = torch.zeros(2, dtype=torch.int64)
+
+        if share_memory:
+            for buffer in self.buffers:
+                for t in buffer:
+                    t.share_memory_()
+            self.header.share_memory_()
+            self.sequences.share_memory_()
+
+        if lock is None:
+            # a spawn context lock can also be shared with the spawned processes
+            lock = mp.get_context('spawn').Lock() if share_memory else threading.Lock()
+        self.lock = lock
+
+    @property
+    def version(self):
+        return int(self.header[VERSION])
+
+    def publish(self, model):
+        """Copies the parameters of model into the inactive buffer and makes it active."""
+        with self.lock:
+            target = 1 - int(self.header[ACTIVE])
+            self.sequences[target] += 1
+
+            with torch.no_grad():
+                for buffer, t in zip(self.buffers[target], model.state_dict().values()):
+                    buffer.copy_(t)
+
+            self.sequences[target] += 1
+            self.header[ACTIVE] = target
+            self.header[VERSION] += 1
+
+            version = int(self.header[VERSION])
+
+        print('ParameterPublisher publish version', version) if debug else None
+
+        return version
+
+
+class ParameterSubscriber(object):
+    '''
+        Keeps a model up to date with a ParameterPublisher.
+
+        update() is cheap when nothing is published (one version compare), else the
+        active snapshot is copied in place into the existing parameters and buffers
+        of the model, without building or loading a new state dict.
+    '''
+
+    def __init__(self, publisher, model, max_retries=3):
+        super().__init__()
+        self.publisher = publisher
+        self.targets = list(model.state_dict().values())
+        self.max_retries = max_retries
+        self.version = 0
+
+    @property
+    def staleness(self):
+        """The policy lag, in versions, of the model."""
+        return self.publisher.version - self.version
+
+    def update(self):
+        """Returns True if new parameters are copied into the model."""
+        publisher = self.publisher
+        version = publisher.version
+        if version == self.version:
+            return False
+
+        for _ in range(self.max_retries):
+            active = int(publisher.header[ACTIVE])
+            sequence = int(publisher.sequences[active])
+            if sequence % 2 == 1:
+                continue
+
+            with torch.no_grad():
+                for target, buffer in zip(self.targets, publisher.buffers[active]):
+                    target.copy_(buffer)
+
+            # the buffer is not rewritten during the copy
+            if int(publisher.sequences[active]) == sequence:
+                self.version = version
+                return True
+
+        print('ParameterSubscriber update is overlapped by the publisher, try next time') if debug else None
+
+        return False
+
+
+def test():
+    model = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.BatchNorm1d(8), torch.nn.Linear(8, 2))
+    actor_model = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.BatchNorm1d(8), torch.nn.Linear(8, 2))
+
+    publisher = ParameterPublisher(model)
+    subscriber = ParameterSubscriber(publisher, actor_model)
+    assert not subscriber.update()
+
+    for i in range(3):
+        with torch.no_grad():
+            for p in model.parameters():
+                p.add_(1.)
+        publisher.publish(model)
+
+    assert subscriber.staleness == 3
+    assert subscriber.update()
+    assert subscriber.staleness == 0
+    assert not subscriber.update()
+    for p, q in zip(model.state_dict().values(), actor_model.state_dict().values()):
+        assert torch.equal(p, q)
+
+    # a copy overlapped by a publish is retried
+    publisher.sequences[int(publisher.header[ACTIVE])] += 1
+    publisher.header[VERSION] += 1
+    assert not subscriber.update()
+    publisher.sequences[int(publisher.header[ACTIVE])] += 1
+    assert subscriber.update()
+
+    print('ParameterPublisher version', publisher.version, 'staleness', subscriber.staleness)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" Actor-side observation preprocessing pool and a per-stage profile of the actor loop "
+
+import threading
+import contextlib
+import concurrent.futures
+
+from time import time
+
+import numpy as np
+
+import torch
+import torch.multiprocessing as mp
+
+from alphastarmini.core.arch.agent import Agent
+from alphastarmini.core.rl.state import MsState
+
+from alphastarmini.lib.hyper_parameters import Arch_Hyper_Parameters as AHP
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+# the order of the arrays returned by featurize
+ENTITY, MAP, CUMULATIVE_SCORE, SCALAR = 0, 1, 2, 3
+
+# see Agent.get_baseline_state_from_multi_source_state
+BASELINE_INDEX = [0, 3, 7, 9, 10, 11, 12]
+
+
+def featurize(obs, build_order=None, last_list=None):
+    """The numpy part of Agent.preprocess_state_all, and the cumulative score used by the baseline state."""
+    entities, entity_pos = Agent.preprocess_state_entity_numpy(obs, return_entity_pos=True)
+    map_data = Agent.preprocess_state_spatial_numpy(obs, entity_pos_list=entity_pos)
+    scalar_list = Agent.preprocess_state_scalar_numpy(obs, build_order=build_order, last_list=last_list)
+    cumulative_score = np.array(obs['score_cumulative'], dtype=np.float32).reshape(1, -1)
+
+    return [entities, map_data, cumulative_score] + list(scalar_list)
+
+
+def to_states(tensors):
+    """Returns the (state, baseline_state) of the tensors ordered as the arrays of featurize."""
+    scalar_list = list(tensors[SCALAR:])
+    state = MsState(entity_state=tensors[ENTITY], statistical_state=scalar_list, map_state=tensors[MAP])
+    baseline_state = [scalar_list[i] for i in BASELINE_INDEX] + [tensors[CUMULATIVE_SCORE]]
+
+    return state, baseline_state
+
+
+class StateSegmentBuffer(object):
+    '''
+        Preallocated storage for the states of `length` steps. A state is a view of one
+        row, so the states of a trajectory share a few large tensors instead of being
+        allocated step by step. A new segment is used when this one is full, and the
+        old one is freed with the last trajectory step which refers to it.
+    '''
+
+    def __init__(self, arrays, length):
+        super().__init__()
+        self.tensors = [torch.empty((length,) + a.shape, dtype=torch.from_numpy(a).dtype) for a in arrays]
+        self.length = length
+        self.size = 0
+
+    def full(self):
+        return self.size >= self.length
+
+    def match(self, arrays):
+        return len(arrays) == len(self.tensors) and all(t.shape[1:] == a.shape for t, a in zip(self.tensors, arrays))
+
+    def take(self):
+        rows = [t[self.size] for t in self.tensors]
+        self.size += 1
+        return rows
+
+
+class PreprocessFuture(object):
+    '''
+        Result of PreprocessPool.submit, result() returns (state, baseline_state).
+    '''
+
+    def __init__(self, pool, future=None, arrays=None):
+        super().__init__()
+        self.pool = pool
+        self.future = future
+        self.arrays = arrays
+        self.states = None
+
+    def result(self):
+        if self.states is None:
+            if self.future is not None:
+                out = self.future.result()
+                self.future = None
+            else:
+                out = self.arrays
+                self.arrays = None
+
+            # the threads store the arrays by themselves
+            self.states = out if isinstance(out, tuple) else self.pool.store(out)
+
+        return self.states
+
+
+class PreprocessPool(object):
+    '''
+        Runs featurize for the actor on a thread pool (or a process pool), so the
+        featurization of the next observation overlaps with the rest of the current
+        step (the teacher pass and the bookkeeping).
+
+        The arrays are copied into preallocated StateSegmentBuffers and handed over as
+        torch views, which replaces the torch.tensor copies of preprocess_state_all.
+        The numpy featurization holds the GIL for most of its time, so with several
+        actors per process use_process=True gives the real overlap, at the price of
+        pickling the observation and the arrays.
+
+        num_workers=0 featurizes in the calling thread, which is the same as
+        preprocess_state_all plus get_baseline_state_from_multi_source_state.
+    '''
+
+    def __init__(self, num_workers=1, use_process=False, segment_length=AHP.sequence_length):
+        super().__init__()
+        self.num_workers = num_workers
+        self.use_process = use_process
+        self.segment_length = max(1, segment_length)
+        self.segment = None
+        self.lock = threading.Lock()
+
+        self.executor = None
+        if num_workers > 0:
+            if use_process:
+                self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers,
+                                                                       mp_context=mp.get_context('spawn'))
+            else:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers,
+                                                                      thread_name_prefix='preprocess')
+
+    def store(self, arrays):
+        with self.lock:
+            if self.segment is None or self.segment.full() or not self.segment.match(arrays):
+                self.segment = StateSegmentBuffer(arrays, self.segment_length)
+            rows = self.segment.take()
+
+        for row, a in zip(rows, arrays):
+            row.copy_(torch.from_numpy(a))
+
+        return to_states(rows)
+
+    def _run(self, obs, build_order, last_list):
+        return self.store(featurize(obs, build_order, last_list))
+
+    def submit(self, obs, build_order=None, last_list=None):
+        # the actor keeps appending to its build order
+        build_order = list(build_order) if build_order is not None else None
+        last_list = list(last_list) if last_list is not None else None
+
+        if self.executor is None:
+            return PreprocessFuture(self, arrays=featurize(obs, build_order, last_list))
+        if self.use_process:
+            return PreprocessFuture(self, future=self.executor.submit(featurize, obs, build_order, last_list))
+        return PreprocessFuture(self, future=self.executor.submit(self._run, obs, build_order, last_list))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+class StageProfiler(object):
+    '''
+        Accumulates the wall time of the stages of the actor loop, to be reported (and
+        reset) at the end of each episode.
+    '''
+
+    STAGES = ('env_wait', 'preprocess', 'infer', 'teacher', 'bookkeeping')
+
+    def __init__(self, stages=STAGES):
+        super().__init__()
+        self.stages = stages
+        self.reset()
+
+    def reset(self):
+        self.start_time = time()
+        self.steps = 0
+        self.times = dict.fromkeys(self.stages, 0.)
+
+    def add(self, name, t):
+        self.times[name] += t
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        t = time()
+        try:
+            yield
+        finally:
+            self.add(name, time() - t)
+
+    def step(self):
+        self.steps += 1
+
+    def report(self):
+        elapse_time = max(time() - self.start_time, 1e-9)
+        steps = max(self.steps, 1)
+        r = {'steps': self.steps, 'steps_per_second': self.steps / elapse_time}
+        for name, t in self.times.items():
+            r[name + '_ms'] = 1000. * t / steps
+            r[name + '_ratio'] = t / elapse_time
+
+        return r
+
+    def __str__(self):
+        r = self.report()
+        stages = ' | '.join('{}: {:.2f} ms ({:.1%})'.format(name, r[name + '_ms'], r[name + '_ratio'])
+                            for name in self.stages)
+        return 'steps: {} | steps/s: {:.2f} | {}'.format(r['steps'], r['steps_per_second'], stages)
+
+
+def test():
+    from pysc2.lib import features, point, units
+    from pysc2.env.sc2_env import AgentInterfaceFormat
+    from pysc2.tests import dummy_observation
+
+    from s2clientprotocol import common_pb2
+
+    from alphastarmini.lib.hyper_parameters import AlphaStar_Agent_Interface_Format_Params as AAIFP
+
+    feats = features.Features(AgentInterfaceFormat(**AAIFP._asdict()), map_size=point.Point(64, 64))
+    builder = dummy_observation.Builder(feats.observation_spec())
+    rng = np.random.RandomState(1)
+    builder.feature_units([dummy_observation.FeatureUnit(unit_type=int(units.Protoss.Probe), alliance=1, owner=1,
+                                                         pos=common_pb2.Point(x=rng.randint(1, 60), y=rng.randint(1, 60)),
+                                                         radius=0.5, health=20, health_max=20, is_on_screen=True)
+                           for _ in range(50)])
+    obs = feats.transform_obs(builder.build())
+    build_order, last_list = [1, 2], [3, 4, 0]
+
+    state = Agent.preprocess_state_all(obs, build_order=build_order, last_list=last_list)
+    baseline_state = Agent.get_baseline_state_from_multi_source_state(obs, state)
+
+    profiler = StageProfiler()
+    for num_workers, use_process in [(0, False), (2, False), (1, True)]:
+        pool = PreprocessPool(num_workers=num_workers, use_process=use_process, segment_length=3)
+        futures = []
+        for _ in range(4):
+            with profiler.stage('preprocess'):
+                futures.append(pool.submit(obs, build_order=build_order, last_list=last_list))
+        for future in futures:
+            with profiler.stage('env_wait'):
+                s, b = future.result()
+            profiler.step()
+
+            assert torch.equal(s.entity_state, state.entity_state)
+            assert torch.equal(s.map_state, state.map_state)
+            assert len(s.statistical_state) == len(state.statistical_state)
+            for x, y in zip(s.statistical_state, state.statistical_state):
+                assert x.dtype == y.dtype and torch.equal(x, y)
+            assert len(b) == len(baseline_state)
+            for x, y in zip(b, baseline_state):
+                assert x.dtype == y.dtype and torch.equal(x, y)
+        pool.close()
+
+    # the states of segment_length steps share one buffer
+    assert futures[0].result()[0].entity_state.untyped_storage().data_ptr() == \
+        futures[2].result()[0].entity_state.untyped_storage().data_ptr()
+
+    print('StageProfiler', profiler)
+
+
+if __name__ == '__main__':
+    test()
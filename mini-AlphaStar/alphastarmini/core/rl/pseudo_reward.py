@@ -16,6 +16,8 @@ import Levenshtein
 
 from alphastarmini.core.rl import rl_utils as U
 from alphastarmini.lib.hyper_parameters import StarCraft_Hyper_Parameters as SCHP
+from alphastarmini.lib.hyper_parameters import Arch_Hyper_Parameters as AHP
+from alphastarmini.lib.hyper_parameters import Scalar_Feature_Size as SFS
 import alphastarmini.lib.edit_distance as ED
 
 
@@ -85,8 +87,160 @@ def time_decay_scale(game_loop):
     return scale
 
 
+def time_decay_scale_batch(game_loop):
+    # time_decay_scale of a tensor of game loops
+    time_minutes = torch.trunc(torch.trunc(game_loop / 22.4) / 60)
+
+    scale = torch.ones_like(game_loop)
+    scale[time_minutes > 8] = 0.5
+    scale[time_minutes > 16] = 0.25
+    scale[time_minutes > 24] = 0.
+
+    return scale
+
+
+def get_reward_weights(reward_name):
+    # mAS: note we use scale to make the reward of leven and hamming not to much
+    scale_leven = 0.05
+    scale_hamming = 0.05
+
+    weight_leven = 1.0 * scale_leven
+    weight_hamming = 1.0 * scale_hamming
+
+    # in order to distinguish between build_order and built_units 
+    if reward_name == 'build_order_baseline':
+        weight_hamming = 0.0
+    if reward_name == 'built_units_baseline':
+        weight_leven = 0.0    
+
+    # AlphaStar: The built units reward is the Hamming distance between the effects in some human replay 
+    # and the effects the agent has created. After 8 minutes, the reward is multiplied by 0.5. 
+    # After 16 minutes, the reward is multiplied by an additional 0.5. After 24 minutes, there are no more rewards.
+    if reward_name == 'effects_baseline':
+        # now we don't separate the effects from the unit, 
+        # so we ignore this reward now
+        weight_hamming = 0.0
+        weight_leven = 0.0
+
+    # AlphaStar: The built units reward is the Hamming distance between the upgrades in some human replay and the upgrades 
+    # the agent has researched. After 8 minutes, the reward is multiplied by 0.5. After 16 minutes, the reward is 
+    # multiplied by an additional 0.5. After 24 minutes, there are no more rewards.
+    if reward_name == 'upgrades_baseline':
+        # now we don't separate the upgrades from the unit, 
+        # so we ignore this reward now
+        weight_hamming = 0.0
+        weight_leven = 0.0
+
+    return weight_leven, weight_hamming
+
+
+def _longer(seq, other):
+    # the longer one of seq and other if the shorter is a prefix of it, else None
+    if len(other) > len(seq):
+        seq, other = other, seq
+    return seq if seq[:len(other)] == other else None
+
+
+def build_order_distances(build_order, z_build_order):
+    '''
+        The Levenshtein distances between the [T][B] build orders and the ones of z, as a
+        [T, B] array. Along a trajectory the build orders only grow (see calculate_build_order),
+        so its pairs are the prefixes of its last pair, whose distances are given by the
+        pass of ED.levenshtein_batch over it. A pair which does not extend the previous
+        ones (e.g. after the end of an episode) starts a new chain of prefixes.
+    '''
+    seqs_1, seqs_2, prefixes = [], [], []
+    index = np.zeros((len(build_order), len(build_order[0])), dtype=np.int64)
+
+    for b, (bo_b, z_bo_b) in enumerate(zip(zip(*build_order), zip(*z_build_order))):
+        chain = None
+        for t, (bo, z_bo) in enumerate(zip(bo_b, z_bo_b)):
+            bo, z_bo = list(bo), list(z_bo)
+            if chain is not None:
+                seq_1, seq_2 = _longer(seqs_1[chain], bo), _longer(seqs_2[chain], z_bo)
+                if seq_1 is not None and seq_2 is not None:
+                    seqs_1[chain], seqs_2[chain] = seq_1, seq_2
+                else:
+                    chain = None
+            if chain is None:
+                chain = len(seqs_1)
+                seqs_1.append(bo)
+                seqs_2.append(z_bo)
+
+            index[t, b] = len(prefixes)
+            prefixes.append((chain, len(bo), len(z_bo)))
+
+    dist = ED.levenshtein_batch(seqs_1, seqs_2, prefixes)
+
+    return dist[index]
+
+
+def stack_unit_counts(unit_counts):
+    '''
+        The [T][B] unit counts (lists) as a [T, B, unit_counts_bow] array. They only change
+        when a unit is made or lost, so the ones equal to the previous step of the
+        trajectory are not converted again.
+    '''
+    rows = []
+    index = np.zeros((len(unit_counts), len(unit_counts[0])), dtype=np.int64)
+
+    for b, ucb_b in enumerate(zip(*unit_counts)):
+        last = None
+        for t, ucb in enumerate(ucb_b):
+            ucb = list(ucb)
+            if ucb != last:
+                rows.append(ucb)
+                last = ucb
+            index[t, b] = len(rows) - 1
+
+    return np.array(rows, dtype=np.float64)[index]
+
+
 def compute_pseudoreward(trajectories, reward_name, device):
-    """Computes the relevant pseudoreward from trajectories.
+    """Computes the relevant pseudoreward from trajectories, for all the steps at once.
+
+    The rewards are the ones of compute_pseudoreward_loop (see there), as a
+    [T, B] tensor: the edit distances of the build orders by one batched (bit-parallel)
+    Levenshtein (see build_order_distances), and the Hamming distances of the unit counts on the [T, B, unit_counts_bow]
+    tensors on the device. A distance whose weight is 0 for reward_name is not computed.
+    """
+
+    print("reward name:", reward_name) if debug else None
+
+    if reward_name == 'winloss_baseline':
+        rewards_tensor = torch.tensor(trajectories.reward, dtype=torch.float32, device=device)
+        return rewards_tensor
+
+    weight_leven, weight_hamming = get_reward_weights(reward_name)
+
+    game_loop = torch.tensor(np.array(trajectories.game_loop, dtype=np.float64), device=device)
+    rewards = torch.zeros_like(game_loop)
+
+    if weight_leven != 0.:
+        dist = torch.tensor(build_order_distances(trajectories.build_order, trajectories.z_build_order),
+                            dtype=torch.float64, device=device)
+        print('leven dist:', dist) if debug else None
+
+        # see reward_by_build_order
+        reward = torch.clamp(dist * dist, max=50) / 50.0 * 0.8
+        rewards += weight_leven * -reward
+
+    if weight_hamming != 0.:
+        unit_counts = torch.tensor(stack_unit_counts(trajectories.unit_counts), device=device)
+        z_unit_counts = torch.tensor(stack_unit_counts(trajectories.z_unit_counts), device=device)
+        dist = ED.hamming_batch(unit_counts, z_unit_counts).double()
+        print('hamming dist:', dist) if debug else None
+
+        # see reward_by_unit_counts
+        rewards += weight_hamming * (-dist * time_decay_scale_batch(game_loop))
+
+    print('rewards:', rewards) if debug else None
+
+    return rewards.float()
+
+
+def compute_pseudoreward_loop(trajectories, reward_name, device):
+    """Computes the relevant pseudoreward from trajectories, step by step.
 
     See Methods and detailed_architecture.txt for details.
 
@@ -154,36 +308,7 @@ def compute_pseudoreward(trajectories, reward_name, device):
     print("trajectories.z_unit_counts", trajectories.z_unit_counts) if debug else None
     print("trajectories.game_loop", trajectories.game_loop) if debug else None
 
-    # mAS: note we use scale to make the reward of leven and hamming not to much
-    scale_leven = 0.05
-    scale_hamming = 0.05
-
-    weight_leven = 1.0 * scale_leven
-    weight_hamming = 1.0 * scale_hamming
-
-    # in order to distinguish between build_order and built_units 
-    if reward_name == 'build_order_baseline':
-        weight_hamming = 0.0
-    if reward_name == 'built_units_baseline':
-        weight_leven = 0.0    
-
-    # AlphaStar: The built units reward is the Hamming distance between the effects in some human replay 
-    # and the effects the agent has created. After 8 minutes, the reward is multiplied by 0.5. 
-    # After 16 minutes, the reward is multiplied by an additional 0.5. After 24 minutes, there are no more rewards.
-    if reward_name == 'effects_baseline':
-        # now we don't separate the effects from the unit, 
-        # so we ignore this reward now
-        weight_hamming = 0.0
-        weight_leven = 0.0
-
-    # AlphaStar: The built units reward is the Hamming distance between the upgrades in some human replay and the upgrades 
-    # the agent has researched. After 8 minutes, the reward is multiplied by 0.5. After 16 minutes, the reward is 
-    # multiplied by an additional 0.5. After 24 minutes, there are no more rewards.
-    if reward_name == 'upgrades_baseline':
-        # now we don't separate the upgrades from the unit, 
-        # so we ignore this reward now
-        weight_hamming = 0.0
-        weight_leven = 0.0
+    weight_leven, weight_hamming = get_reward_weights(reward_name)
 
     rewards_traj = []
     for t1, t2, t3, t4, t5 in zip(trajectories.build_order, trajectories.z_build_order,
@@ -254,8 +379,82 @@ def test():
 
     print("hamming distance between 'l_1', 'l_2'", Levenshtein.hamming(s_1, s_2))  
 
+    # the batched rewards are the ones of the loop
+    for seq_len, batch_size in [(AHP.sequence_length, AHP.batch_size), (16, 5)]:
+        trajectories = get_random_trajectories(seq_len, batch_size, seed=seq_len)
+        for reward_name in REWARD_NAMES:
+            rewards = compute_pseudoreward(trajectories, reward_name, 'cpu')
+            expected = compute_pseudoreward_loop(trajectories, reward_name, 'cpu')
+            assert rewards.shape == (seq_len, batch_size)
+            assert torch.equal(rewards, expected), reward_name
+
+    game_loop = torch.tensor([0., 8 * 60 * 22.4, 9 * 60 * 22.4, 17 * 60 * 22.4, 25 * 60 * 22.4], dtype=torch.float64)
+    assert time_decay_scale_batch(game_loop).tolist() == [time_decay_scale(gl) for gl in game_loop.tolist()]
+
+    # the build order reward does not need the unit counts
+    trajectories = trajectories._replace(unit_counts=None, z_unit_counts=None)
+    compute_pseudoreward(trajectories, 'build_order_baseline', 'cpu')
+
     return
 
 
+REWARD_NAMES = ['winloss_baseline', 'build_order_baseline', 'built_units_baseline',
+                'upgrades_baseline', 'effects_baseline', 'all']
+
+
+def get_random_trajectories(seq_len, batch_size, seed=1, max_build_order=120):
+    '''
+        [seq_len][batch_size] fields of trajectories (namedtuple_zip of the learner), whose
+        build orders grow by a unit now and then, as the ones of calculate_build_order.
+    '''
+    rng = np.random.RandomState(seed)
+    unit_types = SFS.unit_counts_bow
+
+    fields = {k: [[] for _ in range(seq_len)] for k in ['build_order', 'z_build_order', 'unit_counts',
+                                                       'z_unit_counts', 'game_loop', 'reward']}
+    for _ in range(batch_size):
+        start = rng.randint(0, max_build_order)
+        bo = rng.randint(0, unit_types, size=start).tolist()
+        z_bo = rng.randint(0, unit_types, size=max(start + rng.randint(-10, 10), 0)).tolist()
+        ucb = rng.randint(0, 4, size=unit_types)
+        z_ucb = rng.randint(0, 4, size=unit_types)
+        game_loop = rng.randint(0, 30 * 60 * 22)
+        for t in range(seq_len):
+            if rng.rand() < 0.2:
+                bo = bo + [rng.randint(0, unit_types)]
+                ucb = ucb.copy()
+                ucb[bo[-1]] += 1
+            if rng.rand() < 0.2:
+                z_bo = z_bo + [rng.randint(0, unit_types)]
+                z_ucb = z_ucb.copy()
+                z_ucb[z_bo[-1]] += 1
+            game_loop += 8
+            for k, v in [('build_order', bo), ('z_build_order', z_bo), ('unit_counts', ucb.tolist()),
+                         ('z_unit_counts', z_ucb.tolist()), ('game_loop', game_loop), ('reward', 0.)]:
+                fields[k][t].append(v)
+
+    trajectories = U.Trajectory._make([None] * len(U.Trajectory._fields))
+
+    return trajectories._replace(**fields)
+
+
+def benchmark(repeat=5):
+    '''
+        Time of the pseudo-rewards of a learner batch, by the loop and batched, for
+        the batch size of mAS and for larger ones.
+    '''
+    for seq_len, batch_size in [(AHP.sequence_length, AHP.batch_size), (32, 32), (64, 128)]:
+        trajectories = get_random_trajectories(seq_len, batch_size)
+        for reward_name in ['build_order_baseline', 'built_units_baseline', 'all']:
+            times = []
+            for compute in [compute_pseudoreward_loop, compute_pseudoreward]:
+                begin = time.time()
+                for _ in range(repeat):
+                    compute(trajectories, reward_name, 'cpu')
+                times.append((time.time() - begin) / repeat)
+            print('pseudoreward [{} x {}] {}: loop {:.2f} ms | batched {:.2f} ms'.format(
+                seq_len, batch_size, reward_name, 1000 * times[0], 1000 * times[1]))
+
+
 if __name__ == '__main__':
     test()
@@ -99,6 +99,30 @@ def multistep_forward_view(rewards, pcontinues, state_values, lambda_,):
     return scan_discounted_sum(sequence, discount, state_values[-1], reverse=True)
 
 
+def _discounted_sum_doubling(sequence, decay, initial_value):
+    """result[k] = sequence[k] + decay[k] * result[k - 1], result[-1] = initial_value, along dim 0.
+
+    Each step is the affine map x -> decay[t] * x + sequence[t]. The maps are composed by
+    recursive doubling (Hillis-Steele), so the python loop has ceil(log2(T)) iterations of
+    whole-tensor ops instead of T. Only products are used (no division), so decays of 0
+    (episode ends) are exact.
+    """
+    T = sequence.shape[0]
+    acc = sequence.clone()
+    acc[0] = acc[0] + decay[0] * initial_value
+    scale = decay
+
+    shift = 1
+    while shift < T:
+        # compose the map ending at t with the one ending at t - shift
+        acc = torch.cat([acc[:shift], acc[shift:] + scale[shift:] * acc[:-shift]], dim=0)
+        if shift * 2 < T:
+            scale = torch.cat([scale[:shift], scale[shift:] * scale[:-shift]], dim=0)
+        shift *= 2
+
+    return acc
+
+
 def scan_discounted_sum(sequence, decay, initial_value, reverse=False):
     """Evaluates a cumulative discounted sum along dimension 0.
       ```python
@@ -119,6 +143,44 @@ def scan_discounted_sum(sequence, decay, initial_value, reverse=False):
     Returns:
       Cumulative sum with discount. Same shape and type as `sequence`.
     """
+    sequence, decay = torch.broadcast_tensors(sequence, decay)
+
+    # as in the former scan, no gradient flows into the initial value
+    initial_value = initial_value.detach().expand(sequence.shape[1:])
+
+    if reverse:
+        sequence, decay = reverse_seq(sequence), reverse_seq(decay)
+
+    result = _discounted_sum_doubling(sequence, decay, initial_value)
+
+    if reverse:
+        result = reverse_seq(result)
+
+    return result
+
+
+def scan_discounted_sum_loop(sequence, decay, initial_value, reverse=False):
+    """Evaluates a cumulative discounted sum along dimension 0 by a python loop.
+
+    The former implementation of scan_discounted_sum, kept as the reference for test and benchmark.
+      ```python
+      if reverse = False:
+        result[1] = sequence[1] + decay[1] * initial_value
+        result[k] = sequence[k] + decay[k] * result[k - 1]
+      if reverse = True:
+        result[last] = sequence[last] + decay[last] * initial_value
+        result[k] = sequence[k] + decay[k] * result[k + 1]
+      ```
+    Respective dimensions T, B and ... have to be the same for all input tensors.
+    T: temporal dimension of the sequence; B: batch dimension of the sequence.
+    Args:
+      sequence: Tensor of shape `[T, B, ...]` containing values to be summed.
+      decay: Tensor of shape `[T, B, ...]` containing decays/discounts.
+      initial_value: Tensor of shape `[B, ...]` containing initial value.
+      reverse: Whether to process the sum in a reverse order.
+    Returns:
+      Cumulative sum with discount. Same shape and type as `sequence`.
+    """
 
     elems = [sequence, decay]
     if reverse:
@@ -220,45 +282,15 @@ def vtrace_from_importance_weights(
         [values[1:], bootstrap_value.unsqueeze(0)], axis=0)
 
     deltas = clipped_rhos * (rewards + discounts * values_t_plus_1 - values)
-    flip_discounts = torch.flip(discounts, dims=[0])
-    flip_cs = torch.flip(cs, dims=[0])
-    flip_deltas = torch.flip(deltas, dims=[0])
-
-    sequences = [item for item in zip(flip_discounts, flip_cs, flip_deltas)]
 
-    del flip_discounts, flip_cs, flip_deltas, deltas, values_t_plus_1, cs
-
-    # V-trace vs are calculated through a 
+    # V-trace vs are calculated through a
     # scan from the back to the beginning
-    # of the given trajectory.
-    def scanfunc(acc, sequence_item):
-        discount_t, c_t, delta_t = sequence_item
-        return delta_t + lamda * discount_t * c_t * acc
-
+    # of the given trajectory:
+    #   vs_minus_v_xs[t] = deltas[t] + lamda * discounts[t] * cs[t] * vs_minus_v_xs[t + 1]
     initial_values = torch.zeros_like(bootstrap_value, device=bootstrap_value.device)
+    vs_minus_v_xs = scan_discounted_sum(deltas, lamda * discounts * cs, initial_values, reverse=True)
 
-    # our implemented scan function for pytorch
-    def scan(foo, x, initial_value):
-        res = []
-        a_ = initial_value.clone().detach()
-        res.append(foo(a_, x[0]).unsqueeze(0))
-
-        # should not miss this line
-        a_ = foo(a_, x[0])
-
-        for i in range(1, len(x)):
-            res.append(foo(a_, x[i]).unsqueeze(0))
-            a_ = foo(a_, x[i])
-
-        del a_
-
-        return torch.cat(res)
-
-    vs_minus_v_xs = scan(foo=scanfunc, x=sequences, initial_value=initial_values)
-    del scanfunc, sequences, initial_values
-
-    # Reverse the results back to original order.
-    vs_minus_v_xs = torch.flip(vs_minus_v_xs, dims=[0])
+    del deltas, values_t_plus_1, cs, initial_values
 
     # Add V(x_s) to get v_s.
     vs = torch.add(vs_minus_v_xs, values)
@@ -591,7 +623,7 @@ def test(debug=True):
         baselines = torch.tensor(baselines, dtype=torch.float, device=device)
         rewards = torch.tensor(rewards, dtype=torch.float, device=device)
 
-        discounts = ~np.array(is_final[:-1], dtype=np.bool)  # don't forget dtype=np.bool!, or '~' ouput -1 instead of 1
+        discounts = ~np.array(is_final[:-1], dtype=bool)  # don't forget dtype=bool!, or '~' ouput -1 instead of 1
         discounts = torch.tensor(discounts, dtype=torch.float, device=device)
 
         print("discounts:", discounts) if debug else None
@@ -644,7 +676,7 @@ def test(debug=True):
         baselines = torch.tensor(baselines, dtype=torch.float, device=device)
         rewards = torch.tensor(rewards, dtype=torch.float, device=device)
 
-        discounts = ~np.array(is_final[:-1], dtype=np.bool)  # note the discount is not the similar indicies as in lamda returns
+        discounts = ~np.array(is_final[:-1], dtype=bool)  # note the discount is not the similar indicies as in lamda returns
         discounts = torch.tensor(discounts, dtype=torch.float, device=device)
 
         rewards_short = rewards[:-1]
@@ -677,7 +709,7 @@ def test(debug=True):
         baselines = torch.tensor(baselines, dtype=torch.float, device=device)
         rewards = torch.tensor(rewards, dtype=torch.float, device=device)
 
-        discounts = ~np.array(is_final[:-1], dtype=np.bool)  # note the discount is not the similar indicies as in lamda returns
+        discounts = ~np.array(is_final[:-1], dtype=bool)  # note the discount is not the similar indicies as in lamda returns
         discounts = torch.tensor(discounts, dtype=torch.float, device=device)
 
         rewards_short = rewards[:-1]
@@ -701,3 +733,91 @@ def test(debug=True):
 
             print('weighted_advantage_2', weighted_advantage) if debug else None
             print('weighted_advantage_2.shape', weighted_advantage.shape) if debug else None            
+
+
+def test_scan(debug=False):
+    """Checks the vectorized scans against the former python loops, on random inputs with episode ends."""
+    torch.manual_seed(0)
+
+    def loop_vtrace(rhos, discounts, rewards, values, bootstrap_value, lamda=0.8):
+        cs = torch.clamp(rhos, max=1.)
+        values_t_plus_1 = torch.cat([values[1:], bootstrap_value.unsqueeze(0)], axis=0)
+        deltas = torch.clamp(rhos, max=1.) * (rewards + discounts * values_t_plus_1 - values)
+        acc = torch.zeros_like(bootstrap_value)
+        result = []
+        for t in reversed(range(deltas.shape[0])):
+            acc = deltas[t] + lamda * discounts[t] * cs[t] * acc
+            result.append(acc)
+        vs = torch.stack(result[::-1], dim=0) + values
+        vs_t_plus_1 = torch.cat([vs[1:], bootstrap_value.unsqueeze(0)], axis=0)
+        return vs, torch.clamp(rhos, max=1.) * (rewards + discounts * vs_t_plus_1 - values)
+
+    for seq_len, batch_size in [(1, 1), (3, 2), (5, 3), (16, 4), (64, 8), (100, 2)]:
+        rewards = torch.randn(seq_len, batch_size)
+        values = torch.randn(seq_len, batch_size)
+        bootstrap = torch.randn(batch_size)
+        discounts = (torch.rand(seq_len, batch_size) > 0.2).float() * 0.99
+        rhos = torch.rand(seq_len, batch_size) * 1.5
+
+        sequence = torch.randn(seq_len, batch_size, 3)
+        decay = (discounts.unsqueeze(-1) * 0.9).expand_as(sequence)
+        initial = torch.randn(batch_size, 3)
+        for reverse in (False, True):
+            expected = scan_discounted_sum_loop(sequence, decay, initial, reverse=reverse)
+            result = scan_discounted_sum(sequence, decay, initial, reverse=reverse)
+            assert torch.allclose(result, expected, atol=1e-5), (seq_len, reverse)
+
+        # lambda returns by the recurrence in its docstring
+        lambdas = 0.8
+        expected = torch.empty_like(rewards)
+        expected[-1] = rewards[-1] + discounts[-1] * values[-1]
+        for t in reversed(range(seq_len - 1)):
+            expected[t] = rewards[t] + discounts[t] * (lambdas * expected[t + 1] + (1 - lambdas) * values[t])
+        assert torch.allclose(lambda_returns(values, rewards, discounts, lambdas), expected, atol=1e-5)
+
+        # upgo is a lambda return with per-step lambdas
+        next_values = torch.cat([values[1:], bootstrap.unsqueeze(0)], dim=0)
+        upgo_lambdas = ((rewards + discounts * next_values) >= values).float()
+        upgo_lambdas = torch.cat([upgo_lambdas[1:], torch.ones_like(upgo_lambdas[-1:])], dim=0)
+        expected = scan_discounted_sum_loop(rewards + discounts * next_values * (1 - upgo_lambdas),
+                                            discounts * upgo_lambdas, next_values[-1], reverse=True)
+        assert torch.allclose(upgo_returns(values, rewards, discounts, bootstrap), expected, atol=1e-5)
+
+        vs, pg_advantages = vtrace_from_importance_weights(rhos, discounts, rewards, values, bootstrap,
+                                                           clip_rho_threshold=1.0, clip_pg_rho_threshold=1.0)
+        expected_vs, expected_pg = loop_vtrace(rhos, discounts, rewards, values, bootstrap)
+        assert torch.allclose(vs, expected_vs, atol=1e-5)
+        assert torch.allclose(pg_advantages, expected_pg, atol=1e-5)
+
+        print('test_scan passed, seq_len', seq_len, 'batch_size', batch_size) if debug else None
+
+    print('test_scan passed')
+
+
+def benchmark_scan(seq_lens=(8, 16, 32, 64, 128, 256), batch_size=32, repeat=50, device='cpu'):
+    """Times the former python loop and the vectorized scan of lambda returns / vtrace sizes."""
+    import time
+
+    results = []
+    for seq_len in seq_lens:
+        sequence = torch.randn(seq_len, batch_size, device=device)
+        decay = (torch.rand(seq_len, batch_size, device=device) > 0.05).float() * 0.99
+        initial = torch.randn(batch_size, device=device)
+
+        timings = []
+        for func in (scan_discounted_sum_loop, scan_discounted_sum):
+            func(sequence, decay, initial, reverse=True)
+            if device != 'cpu':
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                func(sequence, decay, initial, reverse=True)
+            if device != 'cpu':
+                torch.cuda.synchronize(device)
+            timings.append((time.perf_counter() - start) / repeat * 1000)
+
+        print('seq_len: {:4d} | loop: {:.3f} ms | vectorized: {:.3f} ms | speedup: {:.1f}x'.format(
+            seq_len, timings[0], timings[1], timings[0] / max(timings[1], 1e-9)))
+        results.append((seq_len, timings[0], timings[1]))
+
+    return results
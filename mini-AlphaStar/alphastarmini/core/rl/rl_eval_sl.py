@@ -14,6 +14,8 @@ import numpy as np
 import torch
 
 from pysc2.env.sc2_env import SC2Env, AgentInterfaceFormat, Agent, Race, Bot, Difficulty, BotBuild
+from pysc2.env import parallel_eval
+from pysc2 import run_configs
 from pysc2.lib import actions as sc2_actions
 from pysc2.lib import units as sc2_units
 
@@ -467,6 +469,119 @@ def show_sth(home_obs, player_action):
     print('unit_type_list', unit_type_list) if not SAVE_STATISTIC else None     
 
 
+class EvalAgent(object):
+    '''
+    A pysc2 agent playing the policy of an AlphaStarAgent, for the parallel_eval.EvalScheduler.
+
+    The steps are the ones of ActorEval.run. The scheduler runs each worker in its own thread,
+    and the AlphaStarAgent is not thread-safe, so each worker gets an EvalAgent with its own
+    AlphaStarAgent (see parallel_test).
+    '''
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.step_mul = STEP_MUL
+        self.episodes = 0
+
+    def setup(self, obs_spec, action_spec):
+        self.agent.setup(obs_spec, action_spec)
+
+    def reset(self):
+        self.episodes += 1
+        self.memory = self.agent.initial_state()
+        self.build_order = []
+        self.last_list = [0, 0, 0]
+        self.prev_obs = None
+        self.step_mul = STEP_MUL
+
+    def step(self, timestep):
+        obs = timestep.observation
+        if self.prev_obs is not None:
+            self.build_order = L.calculate_build_order(self.build_order, self.prev_obs, obs)
+        self.prev_obs = obs
+
+        with torch.no_grad():
+            state = self.agent.agent_nn.preprocess_state_all(obs, build_order=self.build_order,
+                                                             last_list=self.last_list)
+            function_call, action, _, new_memory, _, _ = self.agent.step_from_state(state, self.memory, obs=obs)
+
+        expected_delay = action.delay.item()
+        if USE_PREDICT_STEP_MUL:
+            self.step_mul = max(1, expected_delay)
+
+        self.memory = tuple(h.detach() for h in new_memory)
+        self.last_list = [expected_delay, action.action_type.item(), action.queue.item()]
+
+        return function_call
+
+
+def make_eval_games(player, num_games, game_steps_per_episode=GAME_STEPS_PER_EPISODE,
+                    map_name=MAP_NAME):
+    # the kwargs of the env per game, like the ones of ActorEval.create_env_one_player
+    player_aif = AgentInterfaceFormat(**AAIFP._asdict())
+
+    return [dict(map_name=map_name,
+                 players=[Agent(player.race, player.name),
+                          Bot([Race.terran], Difficulty(DIFFICULTY), [BotBuild.random])],
+                 step_mul=STEP_MUL,
+                 game_steps_per_episode=game_steps_per_episode,
+                 agent_interface_format=[player_aif],
+                 random_seed=RANDOM_SEED + i) for i in range(num_games)]
+
+
+def parallel_test(num_workers=ACTOR_NUMS, num_games=MAX_EPISODES, on_mock=False,
+                  game_steps_per_episode=GAME_STEPS_PER_EPISODE):
+    # play num_games evaluation games on num_workers warm SC2 processes at once,
+    # instead of launching a new SC2 for each game of each ActorEval
+    def make_agent():
+        agent = get_supervised_agent(Race.protoss, path=MODEL_PATH, model_type=MODEL_TYPE,
+                                     restore=RESTORE, device=DEVICE)
+        agent.set_rl_training(False)
+        if ON_GPU:
+            agent.agent_nn.to(DEVICE)
+        return agent
+
+    # the league player only wraps the agent here, as in test()
+    league = League(initial_agents={Race.protoss: make_agent()}, main_players=1,
+                    main_exploiters=0, league_exploiters=0)
+    main_player = league.get_learning_player(0)
+
+    # the first worker plays with the agent of the player, the others with their own copies
+    def make_eval_agent(worker):
+        return EvalAgent(main_player.agent if worker == 0 else make_agent())
+
+    games = make_eval_games(main_player, num_games, game_steps_per_episode=game_steps_per_episode)
+
+    make_env = None
+    if on_mock:
+        from alphastarmini.core.rl import mock_env
+
+        def make_env(game, pool):
+            return mock_env.create_mock_env(game['players'], game['agent_interface_format'],
+                                            seed=game['random_seed'], step_mul=STEP_MUL,
+                                            episode_length=game['game_steps_per_episode'] // STEP_MUL)
+
+    pool = None if on_mock else parallel_eval.ProcessPool(run_configs.get(version=VERSION))
+    try:
+        scheduler = parallel_eval.EvalScheduler(games, make_eval_agent,
+                                                num_workers=num_workers, pool=pool,
+                                                make_env=make_env)
+        results = scheduler.run()
+    finally:
+        if pool is not None:
+            print('launched SC2 processes:', pool.launched, 'reused:', pool.reused)
+            pool.close()
+
+    table = parallel_eval.format_results(results, scheduler.elapsed)
+    print(table)
+
+    with open(OUTPUT_FILE, 'a') as file:
+        file.write(strftime("%Y-%m-%d %H:%M:%S", localtime(time())) + " parallel eval\n")
+        file.write(table)
+
+    return results
+
+
 def test(on_server=False, replay_path=None):
     device = DEVICE
 
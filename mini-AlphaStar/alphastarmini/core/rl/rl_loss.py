@@ -76,7 +76,16 @@ def entropy_loss(target_logits, trajectories, selected_mask, entity_mask):
     return loss
 
 
-def human_policy_kl_loss(target_logits, trajectories, selected_mask, entity_mask):
+def get_teacher_logits(field, trajectories, device, teacher_logits=None):
+    """The teacher logits of field in [seq_size x batch_size], computed by the learner if
+    teacher_logits is given, else the ones stored in the trajectories by the actors."""
+    if teacher_logits is not None:
+        return getattr(teacher_logits, field).to(device)
+
+    return filter_by_for_lists(field, trajectories.teacher_logits, device)
+
+
+def human_policy_kl_loss(target_logits, trajectories, selected_mask, entity_mask, teacher_logits=None):
     """Computes the KL loss to the human policy."""
 
     device = target_logits.action_type.device
@@ -87,7 +96,7 @@ def human_policy_kl_loss(target_logits, trajectories, selected_mask, entity_mask
     loss = 0  
     loss_dict = {}
     for i, field in enumerate(ACTION_FIELDS):
-        t_logits = filter_by_for_lists(field, trajectories.teacher_logits, device) 
+        t_logits = get_teacher_logits(field, trajectories, device, teacher_logits)
         x = get_kl_or_entropy(target_logits, field, RA.kl, mask, selected_mask, entity_mask, unit_type_entity_mask, t_logits)
         x = x * FIELDS_WEIGHT_2[i]
 
@@ -136,7 +145,7 @@ def get_kl_or_entropy(target_logits, field, func, mask, selected_mask, entity_ma
     return x
 
 
-def human_policy_kl_loss_action(target_logits, trajectories):
+def human_policy_kl_loss_action(target_logits, trajectories, teacher_logits=None):
 
     device = target_logits.action_type.device
     seconds = torch.tensor(trajectories.game_loop, device=device).view(AHP.sequence_length * AHP.batch_size) / 22.4
@@ -147,7 +156,7 @@ def human_policy_kl_loss_action(target_logits, trajectories):
 
     logits = getattr(target_logits, field) 
     logits = logits.view(AHP.sequence_length * AHP.batch_size, *tuple(logits.shape[2:]))
-    t_logits = filter_by_for_lists(field, trajectories.teacher_logits, device) 
+    t_logits = get_teacher_logits(field, trajectories, device, teacher_logits)
 
     kl = RA.kl([logits, t_logits]).sum(dim=-1) * flag
     kl = torch.mean(kl * mask)
@@ -258,8 +267,11 @@ def get_useful_masks(select_units_num, entity_num, device):
     return selected_mask, entity_mask
 
 
-def sum_vtrace_loss(target_logits_all, trajectories, baselines, rewards, selected_mask, entity_mask, device):
-    """Computes the split v-trace policy gradient loss."""
+def sum_vtrace_loss(target_logits_all, trajectories, baselines, rewards, selected_mask, entity_mask, device, rho_dict=None):
+    """Computes the split v-trace policy gradient loss.
+
+    If rho_dict is given, the mean clipped importance ratio of each field is put in it.
+    """
     print('sum_vtrace_pg_loss') if debug else None
 
     trajectories = Trajectory(*tuple(item[:-1] for item in trajectories))
@@ -277,6 +289,8 @@ def sum_vtrace_loss(target_logits_all, trajectories, baselines, rewards, selecte
     loss = 0.
     for i, field in enumerate(ACTION_FIELDS):
         target_log_prob, clipped_rhos, masks = get_logprob_and_rhos(target_logits_all, field, trajectories, mask_provided)
+        if rho_dict is not None:
+            rho_dict[field] = clipped_rhos.mean().item()
         with torch.no_grad():
             weighted_advantage = RA.vtrace_advantages(clipped_rhos, rewards, discounts, values, baselines[-1])[1].reshape(-1)
 
@@ -438,15 +452,36 @@ def get_logprob_and_rhos(target_logits_all, field, trajectories, mask_provided):
     return target_log_prob, clipped_rhos, masks
 
 
+def get_policy_lag(trajectories, policy_version):
+    """The staleness (in parameter versions) of the policy which generates the trajectories."""
+    versions = [v for v in itertools.chain(*trajectories.policy_version) if v is not None]
+    if len(versions) == 0:
+        return None
+
+    lags = policy_version - np.array(versions, dtype=np.float64)
+
+    return float(lags.mean()), float(lags.max())
+
+
 def loss_function(agent, trajectories, use_opponent_state=True, 
                   no_replay_learn=False, only_update_baseline=False,
-                  learner_baseline_weight=1, show=False):
-    """Computes the loss of trajectories given weights."""
+                  learner_baseline_weight=1, show=False, policy_version=None, teacher=None, batch=None):
+    """Computes the loss of trajectories given weights.
+
+    policy_version is the version of the learner parameters, if given the policy lag
+    of the trajectories is put into the loss dict, next to the v-trace importance ratios.
+
+    teacher is the supervised agent on the learner device, if given the teacher logits
+    are computed here in one batch over the trajectories, so the actors need not store them.
+
+    batch is the result of AlphaStarAgent.collate_unroll on the trajectories, if it is
+    already collated (e.g., by a BatchPrefetcher).
+    """
 
     # target_logits: ArgsActionLogits
     target_logits, baselines, select_units_num, entity_num = agent.rl_unroll(trajectories, 
                                                                              use_opponent_state, 
-                                                                             show=show)
+                                                                             show=show, batch=batch)
     device = target_logits.action_type.device
 
     # transpose to [seq_size x batch_size x -1]
@@ -461,6 +496,9 @@ def loss_function(agent, trajectories, use_opponent_state=True,
     selected_mask, entity_mask = get_useful_masks(select_units_num, entity_num, device)
     del select_units_num, entity_num
 
+    # shape: [seq_size x batch_size x -1], batch_size steps at a time as the unroll
+    teacher_logits = teacher.rl_teacher_logits(trajectories, max_batch_size=AHP.batch_size) if teacher is not None else None
+
     # note, we change the structure of the trajectories
     # shape before: [dict_name x batch_size x seq_size]
     trajectories = RU.stack_namedtuple(trajectories) 
@@ -476,6 +514,11 @@ def loss_function(agent, trajectories, use_opponent_state=True,
     loss_all = 0.
     loss_dict = {}
 
+    if policy_version is not None:
+        policy_lag = get_policy_lag(trajectories, policy_version)
+        if policy_lag is not None:
+            loss_dict.update({"policy_lag_mean:": policy_lag[0], "policy_lag_max:": policy_lag[1]})
+
     # Vtrace Loss:
     reward_index = 0
     loss_actor_critic = 0.
@@ -503,7 +546,11 @@ def loss_function(agent, trajectories, use_opponent_state=True,
 
         # we add vtrace loss
         vtrace_weight = 0 if only_update_baseline else 1
-        loss_vtrace = sum_vtrace_loss(target_logits, trajectories, baseline, rewards, selected_mask, entity_mask, device)
+        rho_dict = {}
+        loss_vtrace = sum_vtrace_loss(target_logits, trajectories, baseline, rewards, selected_mask, entity_mask, device,
+                                      rho_dict=rho_dict)
+        for field, rho in rho_dict.items():
+            loss_dict.update({reward_name + "-vtrace_rho_" + field + ":": rho})
         loss_vtrace = vtrace_cost * loss_vtrace
         #loss_vtrace = vtrace_weight * loss_vtrace
         loss_vtrace = vtrace_weight * loss_vtrace
@@ -534,20 +581,21 @@ def loss_function(agent, trajectories, use_opponent_state=True,
     ACTION_TYPE_KL_COST = 1e-1
 
     # for all arguments
-    all_kl_loss, all_kl_loss_dict = human_policy_kl_loss(target_logits, trajectories, selected_mask, entity_mask)
+    all_kl_loss, all_kl_loss_dict = human_policy_kl_loss(target_logits, trajectories, selected_mask, entity_mask,
+                                                         teacher_logits=teacher_logits)
     all_kl_loss = ALL_KL_COST * all_kl_loss
     loss_dict.update({"all_kl_loss:": all_kl_loss.item()})
     for key, value in all_kl_loss_dict.items():
         loss_dict.update({"all_kl_loss_" + key + ":": value})
 
-    action_type_kl_loss = human_policy_kl_loss_action(target_logits, trajectories)
+    action_type_kl_loss = human_policy_kl_loss_action(target_logits, trajectories, teacher_logits=teacher_logits)
     action_type_kl_loss = ACTION_TYPE_KL_COST * action_type_kl_loss
     loss_dict.update({"action_type_kl_loss:": action_type_kl_loss.item()})
 
     loss_kl = all_kl_loss + action_type_kl_loss
     #loss_kl = 0 * loss_kl
     loss_dict.update({"loss_kl:": loss_kl.item()})
-    del all_kl_loss, action_type_kl_loss
+    del all_kl_loss, action_type_kl_loss, teacher_logits
 
     # Entropy Loss:
     # There is an entropy loss with weight 1e-4 on all action arguments, masked by which arguments are possible for a given action type.
@@ -568,5 +616,75 @@ def loss_function(agent, trajectories, use_opponent_state=True,
 
 
 def test():
-
-    pass
+    from pysc2.env.sc2_env import AgentInterfaceFormat, Agent, Race, Bot, Difficulty, BotBuild
+
+    from alphastarmini.core.rl.mock_env import create_mock_env
+    from alphastarmini.lib.hyper_parameters import AlphaStar_Agent_Interface_Format_Params as AAIFP
+
+    torch.manual_seed(1)
+    agent = RU.get_supervised_agent(Race.protoss, device='cpu', restore=False)
+    teacher = RU.get_supervised_agent(Race.protoss, device='cpu', restore=False)
+    agent.set_rl_training(False)
+    teacher.set_rl_training(False)
+    agent.agent_nn.model.eval()
+    teacher.agent_nn.model.eval()
+
+    players = [Agent(Race.protoss, 'player'), Bot([Race.terran], Difficulty(1), [BotBuild.random])]
+    env = create_mock_env(players, [AgentInterfaceFormat(**AAIFP._asdict())], num_units=16, 
+                          episode_length=AHP.sequence_length + 1)
+    agent.setup(env.observation_spec()[0], env.action_spec()[0])
+    teacher.setup(env.observation_spec()[0], env.action_spec()[0])
+
+    # one trajectory of the actors, with the teacher logits computed at each step
+    trajectory = []
+    home_obs = env.reset()[0]
+    memory = agent.initial_state()
+    with torch.no_grad():
+        for i in range(AHP.sequence_length):
+            obs = home_obs.observation
+            state = agent.agent_nn.preprocess_state_all(obs, build_order=[], last_list=[0, 0, 0])
+            baseline_state = agent.agent_nn.get_baseline_state_from_multi_source_state(obs, state)
+            func_call, action, logits, new_memory, select_units_num, entity_num = agent.step_from_state(state, memory, obs=obs)
+            teacher_logits = teacher.step_based_on_actions(state, memory, action, select_units_num)
+            home_obs = env.step([func_call])[0]
+
+            trajectory.append(Trajectory(state=state, baseline_state=baseline_state, baseline_state_op=None, 
+                                         memory=memory, z=None, is_final=home_obs.last(),
+                                         masks=RU.get_mask(action, agent.action_spec),
+                                         unit_type_entity_mask=RU.get_unit_type_mask(action, obs),
+                                         action=action, behavior_logits=logits, teacher_logits=teacher_logits,
+                                         reward=float(home_obs.reward), player_select_units_num=select_units_num,
+                                         entity_num=entity_num, build_order=[], z_build_order=None, unit_counts=None,
+                                         z_unit_counts=None, game_loop=obs.game_loop[0], last_list=[0, 0, 0]))
+            memory = new_memory
+
+    trajectories = [RU.stack_namedtuple(trajectory)] * AHP.batch_size
+    lazy_trajectories = [t._replace(teacher_logits=[None] * len(t.teacher_logits)) for t in trajectories]
+
+    # the logits computed in one batch by the learner are the ones of the actors, except the 
+    # units logits beyond the selected units, which are masked by the loss
+    lazy_logits = teacher.rl_teacher_logits(lazy_trajectories, max_batch_size=AHP.sequence_length * 3)
+    stored = RU.namedtuple_zip(RU.stack_namedtuple(trajectories))
+    select_units_num = torch.cat([n for l in stored.player_select_units_num for n in l], dim=0)
+    for field in ACTION_FIELDS:
+        x, y = getattr(lazy_logits, field), filter_by_for_lists(field, stored.teacher_logits, 'cpu')
+        if field == "units":
+            selected = torch.arange(x.shape[1]).unsqueeze(0) < select_units_num.view(-1, 1)
+            x, y = x[selected], y[selected]
+        assert torch.allclose(x, y, atol=1e-4), field
+
+    loss, loss_dict = loss_function(agent, trajectories, use_opponent_state=False, no_replay_learn=True)
+    lazy_loss, lazy_loss_dict = loss_function(agent, lazy_trajectories, use_opponent_state=False, 
+                                              no_replay_learn=True, teacher=teacher)
+    assert abs(loss_dict["loss_kl:"] - lazy_loss_dict["loss_kl:"]) < 1e-4 * max(1., abs(loss_dict["loss_kl:"]))
+
+    print('loss_kl by the actors', loss_dict["loss_kl:"], 'by the learner', lazy_loss_dict["loss_kl:"])
+
+    # the same loss on a batch collated into the staging buffers of a BatchPrefetcher
+    from alphastarmini.core.rl.batch_prefetcher import BatchPrefetcher
+    prefetcher = BatchPrefetcher([trajectories], use_opponent_state=False)
+    prefetched_trajectories, batch = next(prefetcher)
+    prefetched_loss, _ = loss_function(agent, prefetched_trajectories, use_opponent_state=False,
+                                       no_replay_learn=True, batch=batch)
+    prefetcher.close()
+    assert torch.allclose(loss, prefetched_loss), (loss, prefetched_loss)
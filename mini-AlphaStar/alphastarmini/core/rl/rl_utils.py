@@ -49,9 +49,10 @@ TRAJECTORY_FIELDS = [
     'z_unit_counts',  # the unit_counts for the sampled replay
     'game_loop',  # seconds = int(game_loop / 22.4) 
     'last_list',  # [last_delay, last_action_type, last_repeat_queued]
+    'policy_version',  # the version of the parameters which generates this step, None if unknown
 ]
 
-Trajectory = collections.namedtuple('Trajectory', TRAJECTORY_FIELDS)
+Trajectory = collections.namedtuple('Trajectory', TRAJECTORY_FIELDS, defaults=(None,))
 
 
 def get_supervised_agent(race, device, path="./model/", model_type="sl", restore=True):
@@ -30,6 +30,12 @@ from alphastarmini.core.rl.rl_utils import Trajectory, get_supervised_agent
 from alphastarmini.core.rl.learner import Learner
 from alphastarmini.core.rl import rl_utils as RU
 from alphastarmini.core.rl import shared_adam as SA
+from alphastarmini.core.rl.inference_server import InferenceServer
+from alphastarmini.core.rl.param_broadcast import ParameterSubscriber
+from alphastarmini.core.rl.preprocess_pool import PreprocessPool, StageProfiler
+from alphastarmini.core.rl.trajectory_codec import TrajectoryCodec
+from alphastarmini.core.rl.actor_process import ActorProcessPool
+from alphastarmini.core.rl.mock_env import create_mock_env
 
 from alphastarmini.lib import utils as L
 
@@ -99,6 +105,37 @@ else:
 STEP_MUL = 8
 UPDATE_PARAMS_INTERVAL = 10
 
+# the actors of a worker send their steps to one batched inference server
+USE_INFERENCE_SERVER = True
+INFERENCE_MAX_WAIT_MS = 5.
+
+# the learner computes the teacher logits in batch over the sampled trajectories, 
+# instead of the actors (or the inference server) running the teacher at each step
+LAZY_TEACHER_LOGITS = False
+
+# the learner buffers the trajectories with sparse entities, uint8 map planes, top-k behavior
+# logits and float16 teacher logits (see TrajectoryCodec)
+COMPACT_TRAJECTORIES = True
+
+# featurize the next observation in a pool, during the teacher pass and the bookkeeping of this step
+USE_PREPROCESS_POOL = True
+PREPROCESS_WORKERS = 1
+PREPROCESS_USE_PROCESS = False
+
+# print the time of env_wait / preprocess / infer / teacher / bookkeeping per episode
+PROFILE_ACTOR_STAGES = True
+
+# host the actors of a worker in spawned processes (see ActorProcessPool) instead of threads,
+# they take one core each and are restarted up to ACTOR_PROCESS_MAX_RESTARTS times on a crash
+ACTOR_PROCESSES = False
+ACTOR_PROCESS_MAX_RESTARTS = 3
+ACTOR_PROCESS_THREADS = 1
+
+# None to play with the game, else the source of the mock env: 'synthetic' for seeded random units,
+# or the path of recorded TimeSteps (DataRecorder) or of a replay pickle (transform_replay_data)
+MOCK_ENV = None
+MOCK_ENV_UNITS = 64
+
 RESTORE = True
 SAVE_STATISTIC = True
 RANDOM_SEED = 1
@@ -144,10 +181,22 @@ if torch.backends.cudnn.is_available():
 # TODO: fix the bug ValueError: The game didn't advance to the expected game loop. Expected: 2512, got: 2507
 
 
+class ActorFinished(Exception):
+    '''Ends the loop of an actor which reaches its max_frames or max_episodes.'''
+    pass
+
+
 class ActorVSComputer:
     """A single actor loop that generates trajectories by playing with built-in AI (computer).
 
-    We don't use batched inference here, but it was used in practice.
+    When an inference_server is given, the model and the teacher are run by the batched
+    inference server of the worker, instead of at batch size 1 in this thread.
+
+    When a preprocess_pool is given, the next observation is featurized by the pool while
+    this thread runs the teacher and the bookkeeping of the current step.
+
+    When the teacher is None, the trajectories have no teacher logits, and the learner
+    computes them by its own teacher.
     """
 
     def __init__(self, player, q_winloss, q_points, device, global_model, coordinator, 
@@ -158,7 +207,9 @@ class ActorVSComputer:
                  max_episodes=MAX_EPISODES, is_training=IS_TRAINING,
                  replay_dir="./added_simple64_replays/",
                  update_params_interval=UPDATE_PARAMS_INTERVAL,
-                 need_save_result=NEED_SAVE_RESULT):
+                 need_save_result=NEED_SAVE_RESULT, inference_server=None, preprocess_pool=None,
+                 mock_env=MOCK_ENV, mock_env_units=MOCK_ENV_UNITS, mock_env_episode_length=None,
+                 mock_env_cache_episodes=0):
         self.player = player
         self.player.add_actor(self)
         self.idx = idx
@@ -172,7 +223,18 @@ class ActorVSComputer:
         self.coordinator = coordinator
 
         # self.agent = self.player.agent
-        self.agent = get_supervised_agent(player.race, path=MODEL_PATH, model_type=MODEL_TYPE, restore=RESTORE, device=device)
+        self.inference_server = inference_server
+        if self.inference_server is not None:
+            # the server owns the only inference copy of the model in this worker
+            self.agent = self.inference_server.agent
+        else:
+            self.agent = get_supervised_agent(player.race, path=MODEL_PATH, model_type=MODEL_TYPE, restore=RESTORE, device=device)
+
+        # pull the parameters only when the learner publishes a new version
+        self.param_subscriber = None
+        learner = getattr(self.player, 'learner', None)
+        if self.inference_server is None and learner is not None:
+            self.param_subscriber = ParameterSubscriber(learner.publisher, self.agent.agent_nn.model)
         # self.agent = get_supervised_agent(player.race, path=MODEL_PATH, model_type=MODEL_TYPE, restore=RESTORE, device=device)
         # if ON_GPU:
         #     self.agent.agent_nn.to(device)
@@ -198,6 +260,26 @@ class ActorVSComputer:
         self.update_params_interval = update_params_interval
         self.need_save_result = need_save_result
 
+        # the actor closes the pool only if it is created here
+        self.preprocess_pool = preprocess_pool
+        self.own_preprocess_pool = preprocess_pool is None and USE_PREPROCESS_POOL
+        if self.own_preprocess_pool:
+            self.preprocess_pool = PreprocessPool(num_workers=PREPROCESS_WORKERS, use_process=PREPROCESS_USE_PROCESS,
+                                                  segment_length=AHP.sequence_length)
+        self.profiler = StageProfiler()
+
+        self.mock_env = mock_env
+        self.mock_env_units = mock_env_units
+        self.mock_env_episode_length = mock_env_episode_length
+        self.mock_env_cache_episodes = mock_env_cache_episodes
+
+        # the counters of all the episodes, e.g., for the benchmarks
+        self.total_frames = 0
+        self.total_steps = 0
+
+        # the exception which stopped the loop, if any
+        self.exception = None
+
     def start(self):
         self.is_start = True
         self.thread.start()
@@ -240,7 +322,8 @@ class ActorVSComputer:
                         for agent, obs_spec, act_spec in zip(agents, observation_spec, action_spec):
                             agent.setup(obs_spec, act_spec)
 
-                        self.teacher.setup(self.agent.obs_spec, self.agent.action_spec)
+                        if self.teacher is not None:
+                            self.teacher.setup(self.agent.obs_spec, self.agent.action_spec)
 
                         print('player:', self.player) if debug else None
                         print('opponent:', "Computer bot") if debug else None
@@ -283,6 +366,10 @@ class ActorVSComputer:
                             # initial last list
                             last_list = [0, 0, 0]
 
+                            # the featurization of the next observation, submitted to the preprocess pool
+                            next_states = None
+                            self.profiler.reset()
+
                             # points for defined reward
                             points, last_points = 0, None
 
@@ -305,22 +392,44 @@ class ActorVSComputer:
                                 #     self.agent.agent_nn.model.load_state_dict(self.global_model.state_dict())
                                 #     update_params_timer = time()
 
-                                # every 10s, the actor get the params from the learner
-                                if time() - update_params_timer > self.update_params_interval:
+                                policy_version = None
+                                if self.param_subscriber is not None:
+                                    self.param_subscriber.update()
+                                    policy_version = self.param_subscriber.version
+
+                                # every 10s, the actor get the params from the learner (the inference server does it by itself)
+                                elif self.inference_server is None and time() - update_params_timer > self.update_params_interval:
                                     print("agent_{:d} update params".format(self.idx)) if debug else None
                                     self.agent.set_weights(self.player.agent.get_weights())
                                     update_params_timer = time()
 
-                                state = self.agent.agent_nn.preprocess_state_all(home_obs.observation, 
-                                                                                 build_order=player_bo, 
-                                                                                 last_list=last_list)
-                                baseline_state = self.agent.agent_nn.get_baseline_state_from_multi_source_state(home_obs.observation, state)
-
-                                with torch.no_grad():
-                                    player_function_call, player_action, player_logits, \
-                                        player_new_memory, player_select_units_num, entity_num = self.agent.step_from_state(state, 
-                                                                                                                            player_memory, 
-                                                                                                                            obs=home_obs.observation)
+                                with self.profiler.stage('preprocess'):
+                                    if next_states is not None:
+                                        state, baseline_state = next_states.result()
+                                        next_states = None
+                                    elif self.preprocess_pool is not None:
+                                        state, baseline_state = self.preprocess_pool.submit(home_obs.observation, 
+                                                                                            build_order=player_bo, 
+                                                                                            last_list=last_list).result()
+                                    else:
+                                        state = self.agent.agent_nn.preprocess_state_all(home_obs.observation, 
+                                                                                         build_order=player_bo, 
+                                                                                         last_list=last_list)
+                                        baseline_state = self.agent.agent_nn.get_baseline_state_from_multi_source_state(home_obs.observation, state)
+
+                                with self.profiler.stage('infer'):
+                                    if self.inference_server is not None:
+                                        # the server also runs the teacher on the sampled action in the same batch
+                                        player_function_call, player_action, player_logits, \
+                                            player_new_memory, player_select_units_num, entity_num, \
+                                            teacher_logits, policy_version = self.inference_server.infer(state, player_memory, 
+                                                                                                         obs=home_obs.observation)
+                                    else:
+                                        with torch.no_grad():
+                                            player_function_call, player_action, player_logits, \
+                                                player_new_memory, player_select_units_num, entity_num = self.agent.step_from_state(state, 
+                                                                                                                                    player_memory, 
+                                                                                                                                    obs=home_obs.observation)
 
                                 print("player_function_call:", player_function_call) if debug else None
                                 print("player_action.delay:", player_action.delay) if debug else None
@@ -336,12 +445,42 @@ class ActorVSComputer:
                                 step_mul = max(1, expected_delay)
                                 print("step_mul:", step_mul) if debug else None
 
-                                with torch.no_grad():
-                                    teacher_logits = self.teacher.step_based_on_actions(state, player_memory, player_action, player_select_units_num)
-                                    print("teacher_logits:", teacher_logits) if debug else None
-
                                 env_actions = [player_function_call]
 
+                                # the teacher is run after the env step, so it overlaps with the preprocessing 
+                                # of the next observation
+                                with self.profiler.stage('env_wait'):
+                                    timesteps = env.step(env_actions, step_mul=STEP_MUL)  # STEP_MUL step_mul
+                                [home_next_obs] = timesteps
+                                total_frames += 1 * STEP_MUL
+                                episode_frames += 1 * STEP_MUL
+                                self.total_frames += 1 * STEP_MUL
+                                self.total_steps += 1
+                                del env_actions, timesteps
+
+                                is_final = home_next_obs.last()
+
+                                # calculate the build order
+                                player_bo = L.calculate_build_order(player_bo, home_obs.observation, home_next_obs.observation)
+                                print("player build order:", player_bo) if debug else None
+
+                                # the last list of the next step
+                                next_last_list = [expected_delay, player_action.action_type.item(), player_action.queue.item()]
+
+                                if self.preprocess_pool is not None and not is_final:
+                                    next_states = self.preprocess_pool.submit(home_next_obs.observation, 
+                                                                              build_order=player_bo, 
+                                                                              last_list=next_last_list)
+
+                                if self.inference_server is None:
+                                    teacher_logits = None
+                                    if self.teacher is not None:
+                                        with self.profiler.stage('teacher'), torch.no_grad():
+                                            teacher_logits = self.teacher.step_based_on_actions(state, player_memory, player_action, player_select_units_num)
+                                print("teacher_logits:", teacher_logits) if debug else None
+
+                                bookkeeping_time = time()
+
                                 player_action_spec = action_spec[0]
                                 action_masks = RU.get_mask(player_action, player_action_spec)
                                 unit_type_entity_mask = RU.get_unit_type_mask(player_action, home_obs.observation)
@@ -349,12 +488,6 @@ class ActorVSComputer:
 
                                 z = None
 
-                                timesteps = env.step(env_actions, step_mul=STEP_MUL)  # STEP_MUL step_mul
-                                [home_next_obs] = timesteps
-                                total_frames += 1 * STEP_MUL
-                                episode_frames += 1 * STEP_MUL
-                                del env_actions, timesteps
-
                                 # fix the action delay
                                 # player_action.delay = torch.tensor([[STEP_MUL]], dtype=player_action.delay.dtype,
                                 #                                    device=player_action.delay.device)
@@ -362,12 +495,6 @@ class ActorVSComputer:
                                 reward = float(home_next_obs.reward)
                                 print("reward: ", reward) if 0 else None
 
-                                is_final = home_next_obs.last()
-
-                                # calculate the build order
-                                player_bo = L.calculate_build_order(player_bo, home_obs.observation, home_next_obs.observation)
-                                print("player build order:", player_bo) if debug else None
-
                                 # calculate the unit counts of bag
                                 player_ucb = None  # L.calculate_unit_counts_bow(home_obs.observation).reshape(-1).numpy().tolist()
 
@@ -465,7 +592,7 @@ class ActorVSComputer:
                                     behavior_logits=player_logits,
                                     teacher_logits=teacher_logits,      
                                     is_final=is_final,                                          
-                                    reward=reward,
+                                    reward=float(reward),  # the final outcome is an int, see TrajectoryRingBuffer
                                     player_select_units_num=player_select_units_num,
                                     entity_num=entity_num,
                                     build_order=player_bo,
@@ -474,6 +601,7 @@ class ActorVSComputer:
                                     z_unit_counts=None,  # player_ucb,  # we change it to the sampled unit counts
                                     game_loop=game_loop,
                                     last_list=last_list,
+                                    policy_version=policy_version,
                                 )
 
                                 del state, baseline_state, player_memory, z
@@ -493,12 +621,9 @@ class ActorVSComputer:
                                 del home_obs
                                 home_obs = home_next_obs
                                 del home_next_obs
-                                last_delay = expected_delay
-                                last_action_type = player_action.action_type.item()
-                                last_repeat_queued = player_action.queue.item()
-                                last_list = [last_delay, last_action_type, last_repeat_queued]
+                                last_list = next_last_list
 
-                                del last_delay, last_action_type, last_repeat_queued
+                                del next_last_list
                                 del player_action, player_new_memory
 
                                 if self.is_training and len(trajectory) >= AHP.sequence_length:                    
@@ -530,17 +655,24 @@ class ActorVSComputer:
                                     is_final_trajectory = False
                                     is_win_trajectory = False
 
+                                self.profiler.add('bookkeeping', time() - bookkeeping_time)
+                                self.profiler.step()
+                                del bookkeeping_time
+
                                 # use max_frames to end the loop
                                 # whether to stop the run
                                 if self.max_frames and total_frames >= self.max_frames:
                                     print("Beyond the max_frames, return!")
-                                    raise Exception
+                                    raise ActorFinished
 
                                 # use max_frames_per_episode to end the episode
                                 if self.max_frames_per_episode and episode_frames >= self.max_frames_per_episode:
                                     print("Beyond the max_frames_per_episode, break!")
                                     break
 
+                            if PROFILE_ACTOR_STAGES:
+                                print(self.name, "episode stages:", self.profiler)
+
                             # if False:
                             #     with self.results_lock:
                             #         self.coordinator.only_send_outcome(self.player, outcome)
@@ -548,10 +680,12 @@ class ActorVSComputer:
                             # use max_frames_per_episode to end the episode
                             if self.max_episodes and total_episodes >= self.max_episodes:
                                 print("Beyond the max_episodes, return!")
-                                raise Exception
+                                raise ActorFinished
 
         except Exception as e:
             print("ActorLoop.run() Exception cause return, Detials of the Exception:", e) if debug else None
+            if not isinstance(e, ActorFinished):
+                self.exception = e
             print(traceback.format_exc()) if 1 else None
             pass
 
@@ -560,6 +694,9 @@ class ActorVSComputer:
             # print("win rate: ", results[2] / (1e-9 + sum(results))) if debug else None
 
             total_time = time() - training_start_time
+
+            if self.own_preprocess_pool:
+                self.preprocess_pool.close()
             # print('agent_', self.idx, "total_time: ", total_time / 60.0, "min") if debug else None
 
             # if debug and SAVE_STATISTIC: 
@@ -596,6 +733,13 @@ class ActorVSComputer:
                            Difficulty(DIFFICULTY),
                            [BotBuild.random])
 
+        if self.mock_env is not None:
+            return create_mock_env([Agent(player.race, player.name), sc2_computer], agent_interface_format,
+                                   source=self.mock_env, num_units=self.mock_env_units, seed=random_seed + self.idx,
+                                   step_mul=step_mul, game_steps_per_episode=game_steps_per_episode,
+                                   episode_length=self.mock_env_episode_length,
+                                   cache_episodes=self.mock_env_cache_episodes)
+
         env = SC2Env(map_name=map_name,
                      players=[Agent(player.race, player.name),
                               sc2_computer],
@@ -680,9 +824,18 @@ def Worker(synchronizer, rank, optimizer, q_winloss, q_points, v_steps, use_cuda
 
     learners = []
     actors = []
+    inference_servers = []
+    actor_pools = []
 
     process_lock = synchronizer if USE_UPDATE_LOCK else None
 
+    # the same for the actor threads and the actor processes (which import this module again)
+    actor_kwargs = dict(max_time_for_training=MAX_TIME_FOR_TRAINING, max_time_per_one_opponent=MAX_TIME_FOR_TRAINING,
+                        max_frames_per_episode=22.4 * MAX_TIME_FOR_TRAINING, max_frames=MAX_FRAMES,
+                        max_episodes=MAX_EPISODES, is_training=IS_TRAINING,
+                        update_params_interval=UPDATE_PARAMS_INTERVAL, need_save_result=NEED_SAVE_RESULT,
+                        mock_env=MOCK_ENV, mock_env_units=MOCK_ENV_UNITS)
+
     try:
 
         for idx in range(league.get_learning_players_num()):
@@ -695,6 +848,13 @@ def Worker(synchronizer, rank, optimizer, q_winloss, q_points, v_steps, use_cuda
 
             player.agent.set_rl_training(IS_TRAINING)
 
+            teacher = get_supervised_agent(player.race, model_type="sl", restore=True, device=cuda_device)
+            teacher.set_rl_training(IS_TRAINING)
+
+            # teacher.agent_nn.model = model_teacher
+            if use_cuda_device:
+                teacher.agent_nn.model.to(cuda_device)
+
             buffer_lock = threading.Lock()
             learner = Learner(player, rank, v_steps, cuda_device, optimizer=optimizer, global_model=model_learner, 
                               max_time_for_training=MAX_TIME_FOR_TRAINING, lr=LR, 
@@ -704,20 +864,43 @@ def Worker(synchronizer, rank, optimizer, q_winloss, q_points, v_steps, use_cuda
                               count_of_batches=COUNT_OF_BATCHES, buffer_size=BUFFER_SIZE,
                               use_random_sample=USE_RANDOM_SAMPLE, only_update_baseline=ONLY_UPDATE_BASELINE,
                               need_save_result=need_save_result, process_lock=process_lock,
-                              update_params_interval=UPDATE_PARAMS_INTERVAL)
+                              update_params_interval=UPDATE_PARAMS_INTERVAL,
+                              share_memory_buffer=ACTOR_PROCESSES,
+                              teacher=teacher if LAZY_TEACHER_LOGITS else None,
+                              codec=TrajectoryCodec() if COMPACT_TRAJECTORIES else None)
             learners.append(learner)
 
-            teacher = get_supervised_agent(player.race, model_type="sl", restore=True, device=cuda_device)
-            teacher.set_rl_training(IS_TRAINING)
-
-            # teacher.agent_nn.model = model_teacher
-            if use_cuda_device:
-                teacher.agent_nn.model.to(cuda_device)
+            # the teacher is on the learner device, the actors and the server no longer run it
+            if LAZY_TEACHER_LOGITS:
+                teacher = None
+
+            # the actors (with their own agents and teachers) in other processes
+            if ACTOR_PROCESSES:
+                actor_pools.append(ActorProcessPool(learner, ACTOR_NUMS, actor_kwargs=actor_kwargs, device=cuda_device,
+                                                    first_idx=rank * ACTOR_NUMS,
+                                                    use_teacher=not LAZY_TEACHER_LOGITS, q_winloss=q_winloss,
+                                                    q_points=q_points, max_restarts=ACTOR_PROCESS_MAX_RESTARTS,
+                                                    num_threads=ACTOR_PROCESS_THREADS))
+                continue
+
+            inference_server = None
+            if USE_INFERENCE_SERVER:
+                server_agent = get_supervised_agent(player.race, path=MODEL_PATH, model_type=MODEL_TYPE, 
+                                                    restore=RESTORE, device=cuda_device)
+                if use_cuda_device:
+                    server_agent.agent_nn.model.to(cuda_device)
+                param_subscriber = ParameterSubscriber(learner.publisher, server_agent.agent_nn.model)
+                inference_server = InferenceServer(server_agent, teacher=teacher, player=player, 
+                                                   max_batch_size=ACTOR_NUMS, max_wait_ms=INFERENCE_MAX_WAIT_MS, 
+                                                   update_params_interval=UPDATE_PARAMS_INTERVAL, writer=writer,
+                                                   param_subscriber=param_subscriber)
+                inference_servers.append(inference_server)
 
             for z in range(ACTOR_NUMS):
                 device = torch.device(cuda_device if use_cuda_device else "cpu")
                 agent_id = rank * ACTOR_NUMS + z
-                actor = ActorVSComputer(player, q_winloss, q_points, device, model_learner, None, teacher, agent_id, None, None, None)
+                actor = ActorVSComputer(player, q_winloss, q_points, device, model_learner, None, teacher, agent_id, None, None, None,
+                                        inference_server=inference_server, **actor_kwargs)
                 actors.append(actor)
 
         threads = []
@@ -725,15 +908,26 @@ def Worker(synchronizer, rank, optimizer, q_winloss, q_points, v_steps, use_cuda
             l.start()
             threads.append(l.thread)
             sleep(1)
+        for s in inference_servers:
+            s.start()
         for a in actors:
             a.start()
             threads.append(a.thread)
             sleep(1)
+        for p in actor_pools:
+            p.start()
+            threads.extend(a.thread for a in p.actors)
 
         # Wait for training to finish.
         for t in threads:
             t.join()
 
+        for s in inference_servers:
+            print("inference server of worker", rank, s.stats)
+            s.stop()
+        for p in actor_pools:
+            p.stop()
+
         # coordinator.write_eval_results()
 
     except Exception as e:
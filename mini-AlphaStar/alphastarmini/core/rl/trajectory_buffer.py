@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" Preallocated ring buffer of trajectory segments between the actors and the learner "
+
+import pickle
+import threading
+import time
+
+import numpy as np
+
+import torch
+import torch.multiprocessing as mp
+
+from alphastarmini.core.rl.rl_utils import Trajectory, TRAJECTORY_FIELDS
+from alphastarmini.core.rl.state import MsState
+from alphastarmini.core.rl.action import ArgsAction, ArgsActionLogits
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+FIFO, UNIFORM, PRIORITIZED = 'fifo', 'uniform', 'prioritized'
+
+# a slot which is reserved by a writer but not written yet
+WRITING = -1
+# a slot which was never written, or whose writer failed
+EMPTY = -2
+
+
+def _flatten(value, leaves):
+    '''
+        Flattens one step of a trajectory field into the tensor leaves, returns the spec
+        to rebuild it, or None if the value is not made of tensors (then it is pickled).
+    '''
+    if value is None:
+        return ('none',)
+    if isinstance(value, torch.Tensor):
+        leaves.append(value.detach())
+        return ('tensor',)
+    if isinstance(value, np.ndarray):
+        leaves.append(torch.from_numpy(np.ascontiguousarray(value)))
+        return ('numpy',)
+    if isinstance(value, (bool, np.bool_)):
+        leaves.append(torch.tensor(bool(value)))
+        return ('scalar', type(value))
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        leaves.append(torch.tensor(value.item() if isinstance(value, np.generic) else value, dtype=torch.float64))
+        return ('scalar', type(value))
+    if isinstance(value, MsState):
+        specs = [_flatten(v, leaves) for v in [value.entity_state, value.map_state] + list(value.statistical_state)]
+        return ('msstate', tuple(specs)) if None not in specs else None
+    if isinstance(value, (ArgsAction, ArgsActionLogits)):
+        # e.g., the behavior logits encoded by a TrajectoryCodec are pickled
+        specs = [_flatten(v, leaves) for v in value.toList()]
+        return (type(value).__name__, tuple(specs)) if None not in specs else None
+    if isinstance(value, (tuple, list)) and len(value) > 0 and all(isinstance(v, torch.Tensor) for v in value):
+        specs = [_flatten(v, leaves) for v in value]
+        return (type(value).__name__, tuple(specs))
+
+    return None
+
+
+def _unflatten(spec, leaves):
+    kind = spec[0]
+    if kind == 'none':
+        return None
+    if kind == 'tensor':
+        return next(leaves)
+    if kind == 'numpy':
+        return next(leaves).numpy()
+    if kind == 'scalar':
+        return spec[1](next(leaves).item())
+    if kind == 'msstate':
+        values = [_unflatten(s, leaves) for s in spec[1]]
+        return MsState(entity_state=values[0], statistical_state=values[2:], map_state=values[1])
+    if kind == 'ArgsAction':
+        return ArgsAction(*[_unflatten(s, leaves) for s in spec[1]])
+    if kind == 'ArgsActionLogits':
+        return ArgsActionLogits(*[_unflatten(s, leaves) for s in spec[1]])
+    if kind == 'tuple':
+        return tuple(_unflatten(s, leaves) for s in spec[1])
+    if kind == 'list':
+        return [_unflatten(s, leaves) for s in spec[1]]
+
+    raise ValueError("unknown spec kind: " + str(kind))
+
+
+def _scalar_rank(scalar_type):
+    if issubclass(scalar_type, (bool, np.bool_)):
+        return 0
+    if issubclass(scalar_type, (int, np.integer)):
+        return 1
+    return 2
+
+
+def _matches(layout_spec, spec):
+    '''
+        Whether a step with spec can be written into the storages of layout_spec, i.e., it has
+        the same structure and its scalars are cast to the declared type without loss (an int
+        reward to a float one, but not the reverse).
+    '''
+    if spec is None or layout_spec[0] != spec[0]:
+        return False
+    if spec[0] == 'scalar':
+        return _scalar_rank(spec[1]) <= _scalar_rank(layout_spec[1])
+    if len(spec) > 1:
+        return len(spec[1]) == len(layout_spec[1]) and all(_matches(l, s) for l, s in zip(layout_spec[1], spec[1]))
+
+    return True
+
+
+class TrajectoryRingBuffer(object):
+    '''
+        Fixed-capacity ring buffer of trajectory segments (a stacked Trajectory of
+        sequence_length steps, as the actors send to the learner).
+
+        Every field made of tensors (MsState, ArgsAction, ArgsActionLogits, the lstm
+        memory, rewards, is_final, ...) has its own typed storage of shape
+        [capacity, sequence_length, ...], allocated once from the first segment. The
+        small python fields (build_order, masks, last_list, ...) are pickled into a
+        fixed-size byte storage. So the whole buffer can be put into shared memory
+        and written directly by the actors in other processes.
+
+        The first segment declares the layout. The later ones are cast to it (so the
+        producers should give e.g. the reward as a float in every step), and a segment
+        which can't be cast without loss, or whose python fields don't fit into
+        max_object_bytes, raises a ValueError.
+
+        The writers only hold the lock to reserve a slot, and copy their data
+        outside of it; the reader takes the slots which are completely written.
+        A slot has one writer at a time: when the buffer is overrun, the writer
+        which gets a slot still being copied into waits for the former one.
+
+        With a codec (see TrajectoryCodec), the segments are encoded by put, so the
+        sparse states are pickled with the python fields, and the sampled ones are
+        decoded in one batch. max_object_bytes is then codec.max_step_bytes per step
+        by default.
+
+        Sampling modes:
+            fifo: the oldest segments, which are consumed.
+            uniform: random segments, and the oldest ones are consumed (the same
+                as the former random sampling of the learner).
+            prioritized: random segments weighted by priority ** alpha, nothing is
+                consumed, the oldest segments are overwritten when the buffer is full.
+    '''
+
+    def __init__(self, capacity, sequence_length, mode=FIFO, share_memory=False,
+                 max_object_bytes=None, alpha=0.6, lock=None, codec=None):
+        super().__init__()
+        assert mode in (FIFO, UNIFORM, PRIORITIZED)
+        self.capacity = capacity
+        self.sequence_length = sequence_length
+        self.mode = mode
+        self.share_memory = share_memory
+        self.codec = codec
+
+        if max_object_bytes is None:
+            max_object_bytes = 1 << 16 if codec is None else sequence_length * codec.max_step_bytes
+        self.max_object_bytes = max_object_bytes
+        self.alpha = alpha
+
+        if lock is None:
+            # a spawn context lock can also be shared with the spawned processes
+            lock = mp.get_context('spawn').Lock() if share_memory else threading.Lock()
+        self.lock = lock
+
+        # [write_count, read_count], the slot of a count is count % capacity
+        self.counts = torch.zeros(2, dtype=torch.int64)
+        # the write_count of the segment in the slot, WRITING or EMPTY
+        self.slot_seq = torch.full((capacity,), EMPTY, dtype=torch.int64)
+        self.priorities = torch.zeros(capacity, dtype=torch.float64)
+        self.max_priority = torch.ones(1, dtype=torch.float64)
+
+        self.object_storage = torch.zeros(capacity, max_object_bytes, dtype=torch.uint8)
+        self.object_lengths = torch.zeros(capacity, dtype=torch.int64)
+
+        self.specs = None
+        self.storages = None
+
+        if share_memory:
+            for t in self._control_tensors():
+                t.share_memory_()
+
+    def _control_tensors(self):
+        return [self.counts, self.slot_seq, self.priorities, self.max_priority,
+                self.object_storage, self.object_lengths]
+
+    @property
+    def is_allocated(self):
+        return self.storages is not None
+
+    def _flatten_segment(self, trajectory):
+        # returns {field: (spec, [step leaves])} of the tensor fields and {field: steps} of the others,
+        # after the allocation the tensor fields are the ones of the layout
+        tensor_fields, object_fields = {}, {}
+        for field in TRAJECTORY_FIELDS:
+            steps = getattr(trajectory, field)
+            assert len(steps) == self.sequence_length, (field, len(steps))
+
+            if self.is_allocated and field not in self.specs:
+                object_fields[field] = list(steps)
+                continue
+
+            specs, step_leaves = [], []
+            for value in steps:
+                leaves = []
+                specs.append(_flatten(value, leaves))
+                step_leaves.append(leaves)
+
+            if self.is_allocated:
+                self._check_layout(field, specs, step_leaves)
+                tensor_fields[field] = (self.specs[field], step_leaves)
+            elif specs[0] is not None and all(s == specs[0] for s in specs):
+                tensor_fields[field] = (specs[0], step_leaves)
+            else:
+                object_fields[field] = list(steps)
+
+        return tensor_fields, object_fields
+
+    def _check_layout(self, field, specs, step_leaves):
+        storages = self.storages[field]
+        for t, (spec, leaves) in enumerate(zip(specs, step_leaves)):
+            if not _matches(self.specs[field], spec):
+                raise ValueError("step {} of the field {} does not match the layout of the buffer: {} is not {}".format(
+                                 t, field, spec, self.specs[field]))
+            for storage, leaf in zip(storages, leaves):
+                if tuple(leaf.shape) != tuple(storage.shape[2:]) or \
+                        torch.promote_types(leaf.dtype, storage.dtype) != storage.dtype:
+                    raise ValueError("step {} of the field {} does not match the layout of the buffer: {} {} is not {} {}".format(
+                                     t, field, leaf.dtype, tuple(leaf.shape), storage.dtype, tuple(storage.shape[2:])))
+
+    def _object_bytes(self, object_fields):
+        object_bytes = np.frombuffer(pickle.dumps(object_fields, protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+        if len(object_bytes) > self.max_object_bytes:
+            raise ValueError("the python fields {} of the trajectory need {} bytes, more than max_object_bytes {}".format(
+                             sorted(object_fields.keys()), len(object_bytes), self.max_object_bytes))
+
+        return object_bytes
+
+    def allocate(self, trajectory):
+        """Allocates the storages by an example segment, which declares the layout.
+
+        It must be called before the buffer is sent to other processes. Raises a ValueError
+        if the python fields of the example don't fit into max_object_bytes.
+        """
+        tensor_fields, object_fields = self._flatten_segment(trajectory)
+        self._object_bytes(object_fields)
+
+        specs, storages = {}, {}
+        for field, (spec, step_leaves) in tensor_fields.items():
+            specs[field] = spec
+            storages[field] = []
+            for leaf in step_leaves[0]:
+                storage = torch.zeros((self.capacity, self.sequence_length) + tuple(leaf.shape), dtype=leaf.dtype)
+                if self.share_memory:
+                    storage.share_memory_()
+                storages[field].append(storage)
+
+        # the writers of other threads only see a completely allocated buffer
+        self.specs = specs
+        self.storages = storages
+
+        print('TrajectoryRingBuffer allocate', self.nbytes() / 1024 ** 2, 'MB') if debug else None
+
+    def nbytes(self):
+        storages = [s for l in self.storages.values() for s in l] if self.is_allocated else []
+        return sum(t.numel() * t.element_size() for t in storages + self._control_tensors())
+
+    def bytes_per_step(self):
+        """The bytes used by a step: its tensor storages and the mean of its pickled fields."""
+        if not self.is_allocated:
+            return 0.
+        storage_bytes = sum(s[0].numel() * s.element_size() for l in self.storages.values() for s in l)
+        written = self.object_lengths[self.slot_seq >= 0]
+        object_bytes = float(written.float().mean()) if len(written) > 0 else 0.
+
+        return (storage_bytes + object_bytes) / self.sequence_length
+
+    def __len__(self):
+        """The number of segments which can be sampled, i.e., not the ones still being written."""
+        with self.lock:
+            counts, ready = self._ready_counts()
+            return self._num_ready(ready)
+
+    def _reserve(self):
+        while True:
+            with self.lock:
+                write_count, read_count = int(self.counts[0]), int(self.counts[1])
+                slot = write_count % self.capacity
+                # the former writer of the slot is still copying, so the data of both would be mixed
+                if int(self.slot_seq[slot]) != WRITING:
+                    self.counts[0] = write_count + 1
+                    if write_count + 1 - read_count > self.capacity:
+                        # drop the oldest segment
+                        self.counts[1] = write_count + 1 - self.capacity
+                    self.slot_seq[slot] = WRITING
+
+                    return slot, write_count
+
+            time.sleep(1e-4)
+
+    def _publish(self, slot, write_count, priority=None):
+        with self.lock:
+            if priority is None:
+                priority = float(self.max_priority[0])
+            self.priorities[slot] = priority
+            self.max_priority[0] = max(float(self.max_priority[0]), priority)
+            # no other writer can get the slot before, so it is still ours
+            self.slot_seq[slot] = write_count
+
+    def put(self, trajectory, priority=None, encoded=False):
+        """Writes a segment, encoded=True if it is already encoded by the codec (e.g., by an actor process)."""
+        if self.codec is not None and not encoded:
+            trajectory = self.codec.encode(trajectory)
+
+        if not self.is_allocated:
+            with self.lock:
+                if not self.is_allocated:
+                    self.allocate(trajectory)
+
+        # checked before a slot is reserved, so a wrong segment leaves the buffer as it is
+        tensor_fields, object_fields = self._flatten_segment(trajectory)
+        object_bytes = self._object_bytes(object_fields)
+
+        slot, write_count = self._reserve()
+
+        try:
+            for field, (spec, step_leaves) in tensor_fields.items():
+                for t, leaves in enumerate(step_leaves):
+                    for storage, leaf in zip(self.storages[field], leaves):
+                        storage[slot, t].copy_(leaf)
+
+            self.object_storage[slot, :len(object_bytes)] = torch.from_numpy(object_bytes.copy())
+            self.object_lengths[slot] = len(object_bytes)
+        except BaseException:
+            # frees the slot for the next writer
+            with self.lock:
+                self.slot_seq[slot] = EMPTY
+            raise
+
+        self._publish(slot, write_count, priority)
+
+        return slot
+
+    def _ready_counts(self):
+        write_count, read_count = int(self.counts[0]), int(self.counts[1])
+        counts = torch.arange(read_count, write_count, dtype=torch.int64)
+        ready = self.slot_seq[counts % self.capacity] == counts
+
+        return counts, ready
+
+    def _num_ready(self, ready):
+        if self.mode == FIFO:
+            # only the oldest segments which are completely written
+            not_ready = torch.nonzero(~ready)
+            return int(not_ready[0]) if len(not_ready) > 0 else len(ready)
+
+        return int(ready.sum())
+
+    def sample(self, sample_size):
+        """Returns a list of sample_size Trajectory (fewer if not enough are written).
+
+        The tensors are views of one gathered copy, so they stay valid when the slots are overwritten.
+        """
+        if not self.is_allocated:
+            return []
+
+        with self.lock:
+            counts, ready = self._ready_counts()
+
+            if self.mode == FIFO:
+                chosen = counts[:min(self._num_ready(ready), sample_size)]
+                self.counts[1] = int(self.counts[1]) + len(chosen)
+            elif self.mode == UNIFORM:
+                ready_counts = counts[ready]
+                num = min(len(ready_counts), sample_size)
+                chosen = ready_counts[torch.randperm(len(ready_counts))[:num]]
+                self.counts[1] = int(self.counts[1]) + min(sample_size, len(counts))
+            else:
+                ready_counts = counts[ready]
+                num = min(len(ready_counts), sample_size)
+                chosen = ready_counts[:0]
+                if num > 0:
+                    weights = self.priorities[ready_counts % self.capacity].clamp(min=1e-8) ** self.alpha
+                    chosen = ready_counts[torch.multinomial(weights, num, replacement=False)]
+
+            slots = chosen % self.capacity
+            batch = {field: [s.index_select(0, slots) for s in storages] for field, storages in self.storages.items()}
+            object_bytes = [bytes(self.object_storage[s, :int(self.object_lengths[s])].numpy()) for s in slots.tolist()]
+
+        self.last_sampled_slots = slots
+
+        return self._to_trajectories(batch, object_bytes)
+
+    def update_priorities(self, slots, priorities):
+        with self.lock:
+            for slot, priority in zip(slots.tolist(), list(priorities)):
+                self.priorities[slot] = float(priority)
+                self.max_priority[0] = max(float(self.max_priority[0]), float(priority))
+
+    def _to_trajectories(self, batch, object_bytes):
+        trajectories = []
+        for b, data in enumerate(object_bytes):
+            objects = pickle.loads(data)
+            fields = []
+            for field in TRAJECTORY_FIELDS:
+                if field in objects:
+                    steps = objects[field]
+                else:
+                    spec = self.specs[field]
+                    steps = [_unflatten(spec, iter([s[b, t] for s in batch[field]]))
+                             for t in range(self.sequence_length)]
+                fields.append(steps)
+            trajectories.append(Trajectory._make(fields))
+
+        if self.codec is not None:
+            trajectories = self.codec.decode(trajectories)
+
+        return trajectories
+
+
+def test():
+    from alphastarmini.core.rl.rl_utils import stack_namedtuple
+
+    sequence_length, capacity = 4, 6
+
+    def get_step(i):
+        state = MsState(entity_state=torch.full((1, 5, 3), float(i)),
+                        statistical_state=[torch.full((1, 2), float(i)), torch.full((1, 4), float(i))],
+                        map_state=torch.full((1, 2, 8, 8), float(i)))
+        action = ArgsAction(*[torch.full((1, 1), i, dtype=torch.long) for _ in range(6)])
+        logits = ArgsActionLogits(*[torch.full((1, 3), float(i)) for _ in range(6)])
+        memory = (torch.full((1, 1, 4), float(i)), torch.full((1, 1, 4), float(i)))
+        return Trajectory(state=state, baseline_state=[torch.full((1, 2), float(i))], baseline_state_op=None,
+                          memory=memory, z=None, is_final=(i % 5 == 4), masks=[1, 1, 0, 0, 0, 1],
+                          unit_type_entity_mask=np.ones(5, dtype=bool), action=action,
+                          behavior_logits=logits, teacher_logits=logits.clone(), reward=float(i),
+                          player_select_units_num=torch.tensor([i]), entity_num=torch.tensor([5]),
+                          build_order=list(range(i % 3)), z_build_order=None, unit_counts=None,
+                          z_unit_counts=None, game_loop=np.int64(i * 8), last_list=[8, i, 0])
+
+    def get_segment(k):
+        return stack_namedtuple([get_step(k * sequence_length + t) for t in range(sequence_length)])
+
+    for mode in (FIFO, UNIFORM, PRIORITIZED):
+        buffer = TrajectoryRingBuffer(capacity, sequence_length, mode=mode)
+        for k in range(8):
+            buffer.put(get_segment(k))
+        assert len(buffer) == capacity
+
+        trajectories = buffer.sample(3)
+        assert len(trajectories) == 3
+        for traj in trajectories:
+            first = traj.reward[0]
+            for t in range(sequence_length):
+                i = int(first) + t
+                expected = get_step(i)
+                assert traj.reward[t] == expected.reward and isinstance(traj.reward[t], float)
+                assert traj.is_final[t] == expected.is_final
+                assert traj.build_order[t] == expected.build_order
+                assert traj.game_loop[t] == expected.game_loop
+                assert torch.equal(traj.state[t].map_state, expected.state.map_state)
+                assert torch.equal(traj.state[t].statistical_state[1], expected.state.statistical_state[1])
+                assert torch.equal(traj.memory[t][1], expected.memory[1])
+                assert torch.equal(traj.action[t].units, expected.action.units)
+                assert np.array_equal(traj.unit_type_entity_mask[t], expected.unit_type_entity_mask)
+
+        if mode == FIFO:
+            # the two oldest segments are dropped, the next three are consumed in order
+            assert [t.reward[0] for t in trajectories] == [8., 12., 16.]
+            assert len(buffer) == capacity - 3
+        elif mode == PRIORITIZED:
+            assert len(buffer) == capacity
+            buffer.update_priorities(buffer.last_sampled_slots, [0.] * 3)
+
+    # the python fields of the segments take this many bytes
+    buffer = TrajectoryRingBuffer(capacity, sequence_length, mode=FIFO)
+    buffer.put(get_segment(0))
+    buffer.put(get_segment(1))
+    object_size = int(buffer.object_lengths[1])
+    assert int(buffer.object_lengths[0]) <= object_size
+
+    # the python fields of the first segment don't fit, so the layout is refused at once
+    buffer = TrajectoryRingBuffer(capacity, sequence_length, mode=FIFO, max_object_bytes=object_size - 1)
+    try:
+        buffer.put(get_segment(1))
+        assert False
+    except ValueError:
+        assert not buffer.is_allocated and int(buffer.counts[0]) == 0
+
+    # a field which does not match the layout, e.g., an int final reward among the float ones,
+    # is cast to it instead of being pickled, so it does not grow the python fields
+    buffer = TrajectoryRingBuffer(capacity, sequence_length, mode=FIFO, max_object_bytes=object_size)
+    buffer.put(get_segment(0))
+    steps = [get_step(sequence_length + t) for t in range(sequence_length)]
+    steps[-1] = steps[-1]._replace(reward=1, is_final=np.bool_(True), game_loop=int(steps[-1].game_loop))
+    steps[-2] = steps[-2]._replace(player_select_units_num=torch.tensor([6], dtype=torch.int32))
+    buffer.put(stack_namedtuple(steps))
+    assert int(buffer.object_lengths[1]) == object_size
+    trajectories = buffer.sample(2)
+    assert list(trajectories[1].reward) == [4., 5., 6., 1.] and all(isinstance(r, float) for r in trajectories[1].reward)
+    assert trajectories[1].is_final[-1] is True and isinstance(trajectories[1].game_loop[-1], np.int64)
+    assert trajectories[1].player_select_units_num[2].dtype == torch.int64
+    assert torch.equal(trajectories[1].state[0].map_state, steps[0].state.map_state)
+
+    # a field which can't be cast without loss raises before a slot is reserved
+    for wrong in [dict(reward=np.zeros(1)), dict(is_final=0.5), dict(z=torch.zeros(1)),
+                  dict(player_select_units_num=torch.tensor([0.5])), dict(memory=(torch.zeros(1, 1, 5),) * 2),
+                  dict(unit_type_entity_mask=np.ones(5, dtype=np.uint8))]:
+        steps = [get_step(t) for t in range(sequence_length)]
+        steps[1] = steps[1]._replace(**wrong)
+        try:
+            buffer.put(stack_namedtuple(steps))
+            assert False, wrong
+        except ValueError:
+            pass
+    assert int(buffer.counts[0]) == 2 and len(buffer) == 0
+
+    # a writer which overruns the buffer waits for the slow writer of its slot, whose segment is dropped
+    buffer = TrajectoryRingBuffer(2, sequence_length, mode=FIFO)
+    buffer.put(get_segment(0))
+    slot, write_count = buffer._reserve()
+    writer = threading.Thread(target=lambda: [buffer.put(get_segment(k)) for k in (2, 3)])
+    writer.start()
+    writer.join(0.2)
+    assert writer.is_alive() and int(buffer.counts[0]) == 3
+    buffer._publish(slot, write_count)
+    writer.join()
+    assert [t.reward[0] for t in buffer.sample(2)] == [8., 12.]
+
+    print('TrajectoryRingBuffer', buffer.nbytes() / 1024, 'KB')
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" Compact encoding of the trajectory segments, with sparse entity storage "
+
+import math
+import pickle
+import collections
+
+import numpy as np
+
+import torch
+
+from alphastarmini.core.rl.rl_utils import Trajectory
+from alphastarmini.core.rl.state import MsState
+from alphastarmini.core.rl.action import ArgsAction, ArgsActionLogits
+from alphastarmini.core.rl.preprocess_pool import BASELINE_INDEX
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+ACTION_FIELDS = ['action_type', 'delay', 'queue', 'units', 'target_unit', 'target_location']
+
+# the one-hot planes of the map state as (first channel, depth), and the channel of
+# height_map / 255., in the order of SpatialEncoder.get_map_data
+MAP_CHANNELS = 24
+MAP_ONE_HOT_PLANES = [(4, 2), (7, 4), (11, 2), (13, 5), (18, 2), (20, 2), (22, 2)]
+MAP_HEIGHT_CHANNEL = 6
+
+# the index of a pixel which is in none of the classes of a one-hot plane
+NONE_INDEX = 255
+
+# the behavior logits kept for each head, besides the one of the taken action
+TOP_K = 16
+
+# the bound of float16, the logits beyond it (the masked ones, (logit - 1e9) / temperature)
+# are kept in float16 scaled by LARGE_SCALE, as the KL loss stops on the outliers of the
+# difference of the teacher and the student logits
+FLOAT16_MAX = 65504.
+LARGE_SCALE = 2. ** 16
+MASKED_LOGIT = -1e9
+
+# the budget of the pickled fields of one step in the ring buffer, enough for
+# all the 512 entities
+MAX_STEP_BYTES = 1 << 18
+
+
+Sparse = collections.namedtuple('Sparse', ['shape', 'indices', 'values'])
+
+CompactMap = collections.namedtuple('CompactMap', ['planes', 'height', 'residual'])
+
+CompactState = collections.namedtuple('CompactState', ['entity_state', 'map_state', 'statistical_state'])
+
+# the baseline state which is the scalars of the state at BASELINE_INDEX, and the cumulative score
+BaselineRef = collections.namedtuple('BaselineRef', ['cumulative_score'])
+
+TopKLogits = collections.namedtuple('TopKLogits', ['shape', 'indices', 'values', 'lse'])
+
+# the logits in float16, and the packed bits of the ones which are scaled by LARGE_SCALE (or None)
+HalfLogits = collections.namedtuple('HalfLogits', ['values', 'large'])
+
+
+def encode_sparse(tensor, rows=None):
+    """The flat indices and the values of the non-zero elements of tensor. With rows, only
+    the first rows of tensor[0] are searched if all the other rows are zero."""
+    a = tensor.detach().cpu().numpy()
+    flat = a.reshape(-1)
+
+    if rows is not None and a.ndim > 2:
+        end = int(rows) * int(np.prod(a.shape[2:]))
+        if not flat[end:].any():
+            flat = flat[:end]
+
+    indices = np.flatnonzero(flat)
+    indices = indices.astype(np.int32 if a.size < 2 ** 31 else np.int64)
+
+    return Sparse(shape=a.shape, indices=indices, values=flat[indices])
+
+
+def decode_sparse(sparses):
+    """Decodes a list of Sparse of one shape [1, ...] into a batched tensor [len(sparses), ...]."""
+    shape = sparses[0].shape
+    assert all(s.shape == shape for s in sparses)
+    numel = int(np.prod(shape))
+
+    out = torch.zeros((len(sparses),) + tuple(shape[1:]), dtype=torch.from_numpy(sparses[0].values[:0]).dtype)
+    indices = np.concatenate([s.indices.astype(np.int64) + i * numel for i, s in enumerate(sparses)])
+    values = np.concatenate([s.values for s in sparses])
+    out.view(-1)[torch.from_numpy(indices)] = torch.from_numpy(values)
+
+    return out
+
+
+def encode_map(map_state):
+    """The one-hot planes of the map as uint8 class indices, the height map as uint8, and
+    the others (and any plane which does not round trip exactly) as a Sparse."""
+    m = map_state.detach().cpu().numpy()
+    if m.shape[1] != MAP_CHANNELS or m.dtype != np.float32:
+        return CompactMap(planes=None, height=None, residual=encode_sparse(map_state))
+
+    residual = m.copy()
+    planes = np.full((len(MAP_ONE_HOT_PLANES),) + m.shape[2:], NONE_INDEX, dtype=np.uint8)
+    for i, (first, depth) in enumerate(MAP_ONE_HOT_PLANES):
+        p = residual[0, first:first + depth]
+        s = p.sum(axis=0)
+        if ((p == 0) | (p == 1)).all() and (s <= 1).all():
+            index = p.argmax(axis=0).astype(np.uint8)
+            index[s == 0] = NONE_INDEX
+            planes[i] = index
+            residual[0, first:first + depth] = 0
+
+    height = np.zeros(m.shape[2:], dtype=np.uint8)
+    h = residual[0, MAP_HEIGHT_CHANNEL]
+    v = np.clip(np.rint(h * 255.), 0, 255).astype(np.uint8)
+    if np.array_equal((v / 255.0).astype(np.float32), h):
+        height = v
+        residual[0, MAP_HEIGHT_CHANNEL] = 0
+
+    return CompactMap(planes=planes, height=height, residual=encode_sparse(torch.from_numpy(residual)))
+
+
+def decode_map(maps):
+    """Decodes a list of CompactMap into a batched map state."""
+    out = decode_sparse([m.residual for m in maps])
+    if maps[0].planes is None:
+        return out
+
+    planes = torch.from_numpy(np.stack([m.planes for m in maps])).long()
+    for i, (first, depth) in enumerate(MAP_ONE_HOT_PLANES):
+        one_hot = torch.zeros((len(maps), depth + 1) + tuple(out.shape[2:]), dtype=out.dtype)
+        one_hot.scatter_(1, planes[:, i:i + 1].clamp(max=depth), 1.)
+        out[:, first:first + depth] += one_hot[:, :depth]
+
+    # the same as the float32 of uint8 / 255.0 in get_map_data
+    height = torch.from_numpy(np.stack([m.height for m in maps]))
+    out[:, MAP_HEIGHT_CHANNEL] += (height.double() / 255.0).to(out.dtype)
+
+    return out
+
+
+def _logits_rows(field, logits):
+    # the loss views the location logits as one row of world_size * world_size
+    if field == 'target_location':
+        return logits.reshape(logits.shape[0], -1)
+    return logits.reshape(-1, logits.shape[-1])
+
+
+def _action_index(field, action, width):
+    if action is None:
+        return None
+    if field == 'target_location':
+        # [x, y] -> world_size * y + x, as the loss
+        action = action.reshape(-1, 2)
+        return (action[:, 1] * width + action[:, 0]).reshape(-1, 1)
+    return action.reshape(-1, 1)
+
+
+def encode_top_k(field, logits, action, top_k=TOP_K):
+    """The top_k logits and the one of the taken action in each row, and the logsumexp
+    of the rows, so the log probabilities of these actions are kept exactly."""
+    rows = _logits_rows(field, logits.detach().cpu())
+    size = rows.shape[-1]
+    if size <= top_k + 1:
+        return logits
+
+    index = _action_index(field, action.cpu() if action is not None else None, logits.shape[-1])
+    if index is None or index.shape[0] != rows.shape[0] or not ((index >= 0) & (index < size)).all():
+        return logits
+
+    kept = torch.cat([rows.topk(top_k, dim=-1).indices, index.long()], dim=-1)
+    values = rows.gather(-1, kept)
+    lse = torch.logsumexp(rows.double(), dim=-1, keepdim=True)
+
+    return TopKLogits(shape=tuple(logits.shape), indices=kept.numpy().astype(np.int16 if size < 2 ** 15 else np.int32),
+                      values=values.numpy(), lse=lse.numpy())
+
+
+def decode_top_k(field, encoded):
+    """Decodes a list of TopKLogits of one field into batched logits. The dropped logits
+    share the rest of the probability mass, so the log_softmax of the kept ones is exact."""
+    shape = encoded[0].shape
+    indices = torch.from_numpy(np.concatenate([e.indices for e in encoded])).long()
+    values = torch.from_numpy(np.concatenate([e.values for e in encoded])).double()
+    lse = torch.from_numpy(np.concatenate([e.lse for e in encoded]))
+
+    size = int(np.prod(shape[1:])) if field == 'target_location' else shape[-1]
+    full = torch.zeros(indices.shape[0], size, dtype=torch.float64)
+    kept = torch.zeros(indices.shape[0], size, dtype=torch.bool)
+    full.scatter_(1, indices, values)
+    kept.scatter_(1, indices, True)
+
+    lse_kept = torch.logsumexp(full.masked_fill(~kept, -math.inf), dim=-1, keepdim=True)
+    dropped = (~kept).sum(dim=-1, keepdim=True)
+    fill = lse + torch.log(-torch.expm1(lse_kept - lse)) - torch.log(dropped.double())
+    # no mass left (in float64) for the dropped logits
+    fill = torch.where(torch.isfinite(fill), fill, lse + MASKED_LOGIT)
+
+    out = torch.where(kept, full, fill).to(torch.float32)
+
+    return out.view((len(encoded),) + tuple(shape[1:]))
+
+
+def encode_half(logits):
+    a = logits.detach().cpu().numpy()
+    large = np.abs(a) > FLOAT16_MAX
+    if not large.any():
+        return HalfLogits(values=a.astype(np.float16), large=None)
+
+    return HalfLogits(values=np.where(large, a / LARGE_SCALE, a).astype(np.float16), large=np.packbits(large))
+
+
+def decode_half(encoded):
+    """Decodes a list of HalfLogits of one shape [1, ...] into batched float32 logits."""
+    out = torch.from_numpy(np.concatenate([e.values for e in encoded])).float()
+    if any(e.large is not None for e in encoded):
+        size = encoded[0].values.size
+        large = np.concatenate([np.unpackbits(e.large, count=size).astype(bool) if e.large is not None
+                                else np.zeros(size, dtype=bool) for e in encoded])
+        out.view(-1)[torch.from_numpy(large)] *= LARGE_SCALE
+
+    return out
+
+
+def _cat_logits(field, steps):
+    if all(isinstance(s, TopKLogits) for s in steps):
+        return decode_top_k(field, steps)
+    return torch.cat([decode_top_k(field, [s]) if isinstance(s, TopKLogits) else s.float() for s in steps], dim=0)
+
+
+def _rows(batched):
+    return [batched[i:i + 1] for i in range(batched.shape[0])]
+
+
+class TrajectoryCodec(object):
+    '''
+        Compact encoding of the trajectory segments which are buffered by the learner:
+
+        state: the entity rows up to entity_num, as the flat indices and values of their
+            non-zero elements (the entity features are mostly one-hot); the one-hot map
+            planes as uint8 class indices, the height map as uint8; the scalars sparse.
+            All these are exact.
+        baseline_state: only the cumulative score, the others are the scalars of the state.
+        behavior_logits: the top_k logits of each head, the one of the taken action and the
+            logsumexp. The loss only uses the log probabilities of the taken actions (for
+            the v-trace and UPGO importance ratios), which are kept exactly.
+        teacher_logits: float16, the masked ones scaled (the KL loss needs the whole
+            distribution).
+
+        decode returns the trajectories of a batch with the states and the logits as views
+        of batched tensors, decoded in one pass for all the steps.
+    '''
+
+    def __init__(self, top_k=TOP_K, half_teacher=True, max_step_bytes=MAX_STEP_BYTES):
+        super().__init__()
+        self.top_k = top_k
+        self.half_teacher = half_teacher
+        self.max_step_bytes = max_step_bytes
+
+    def encode_state(self, state, entity_num=None):
+        rows = int(entity_num.reshape(-1)[0]) if entity_num is not None else None
+        return CompactState(entity_state=encode_sparse(state.entity_state, rows=rows),
+                            map_state=encode_map(state.map_state),
+                            statistical_state=[encode_sparse(s) for s in state.statistical_state])
+
+    def encode_baseline_state(self, baseline_state, state):
+        scalars = state.statistical_state
+        if len(baseline_state) == len(BASELINE_INDEX) + 1 and \
+                all(b is scalars[i] or torch.equal(b, scalars[i]) for b, i in zip(baseline_state, BASELINE_INDEX)):
+            return BaselineRef(cumulative_score=baseline_state[-1].detach().cpu().numpy())
+        return baseline_state
+
+    def encode_teacher_logits(self, logits):
+        if logits is None or not self.half_teacher:
+            return logits
+        return ArgsActionLogits(*[encode_half(l) for l in logits.toList()])
+
+    def encode_behavior_logits(self, logits, action):
+        if self.top_k is None:
+            return logits
+        actions = action.toList() if action is not None else [None] * len(ACTION_FIELDS)
+        return ArgsActionLogits(*[encode_top_k(field, l, a, self.top_k)
+                                  for field, l, a in zip(ACTION_FIELDS, logits.toList(), actions)])
+
+    def encode(self, trajectory):
+        """Encodes a segment (a stacked Trajectory, as the actors send to the learner)."""
+        steps = range(len(trajectory.state))
+        entity_num = trajectory.entity_num
+
+        return trajectory._replace(
+            state=[self.encode_state(trajectory.state[t], entity_num[t] if entity_num is not None else None)
+                   for t in steps],
+            baseline_state=[self.encode_baseline_state(trajectory.baseline_state[t], trajectory.state[t])
+                            for t in steps],
+            behavior_logits=[self.encode_behavior_logits(trajectory.behavior_logits[t], trajectory.action[t])
+                             for t in steps],
+            teacher_logits=[self.encode_teacher_logits(l) for l in trajectory.teacher_logits])
+
+    def decode(self, trajectories):
+        """Decodes a list of segments, as encode returns them."""
+        if len(trajectories) == 0:
+            return trajectories
+
+        # all the steps of the batch, segment by segment
+        def all_steps(field):
+            return [s for traj in trajectories for s in getattr(traj, field)]
+
+        states = all_steps('state')
+        if all(isinstance(s, CompactState) for s in states):
+            entity_state = _rows(decode_sparse([s.entity_state for s in states]))
+            map_state = _rows(decode_map([s.map_state for s in states]))
+            scalars = list(zip(*[_rows(decode_sparse(list(l))) for l in zip(*[s.statistical_state for s in states])]))
+            states = [MsState(entity_state=e, statistical_state=list(s), map_state=m)
+                      for e, m, s in zip(entity_state, map_state, scalars)]
+
+        baseline_states = [[state.statistical_state[i] for i in BASELINE_INDEX] + [torch.from_numpy(b.cumulative_score)]
+                           if isinstance(b, BaselineRef) else b
+                           for b, state in zip(all_steps('baseline_state'), states)]
+
+        behavior_logits = all_steps('behavior_logits')
+        if all(isinstance(l, ArgsActionLogits) for l in behavior_logits):
+            heads = [_rows(_cat_logits(field, list(l))) for field, l in zip(ACTION_FIELDS, zip(*[l.toList() for l in behavior_logits]))]
+            behavior_logits = [ArgsActionLogits(*l) for l in zip(*heads)]
+
+        teacher_logits = all_steps('teacher_logits')
+        if all(isinstance(l, ArgsActionLogits) for l in teacher_logits):
+            heads = [_rows(decode_half(list(l))) if isinstance(l[0], HalfLogits) else _rows(torch.cat(l, dim=0))
+                     for l in zip(*[l.toList() for l in teacher_logits])]
+            teacher_logits = [ArgsActionLogits(*l) for l in zip(*heads)]
+
+        decoded = []
+        begin = 0
+        for traj in trajectories:
+            end = begin + len(traj.state)
+            decoded.append(traj._replace(state=states[begin:end], baseline_state=baseline_states[begin:end],
+                                         behavior_logits=behavior_logits[begin:end],
+                                         teacher_logits=teacher_logits[begin:end]))
+            begin = end
+
+        return decoded
+
+    def bytes_per_step(self, trajectory, encoded=None):
+        """The bytes per step of each field of a segment, as {field: (raw, encoded)}."""
+        if encoded is None:
+            encoded = self.encode(trajectory)
+
+        steps = max(len(trajectory.state), 1)
+        return {field: (nbytes(getattr(trajectory, field)) / steps, nbytes(getattr(encoded, field)) / steps)
+                for field in trajectory._fields}
+
+    def report(self, trajectory):
+        r = self.bytes_per_step(trajectory)
+        raw, encoded = sum(v[0] for v in r.values()), sum(v[1] for v in r.values())
+        fields = ' | '.join('{}: {:.1f} -> {:.1f} KB'.format(field, v[0] / 1024, v[1] / 1024)
+                            for field, v in r.items() if v[0] >= 1024)
+        print('bytes per step: {:.1f} -> {:.1f} KB ({:.1f}x) | {}'.format(raw / 1024, encoded / 1024,
+                                                                          raw / max(encoded, 1), fields))
+
+        return r
+
+
+def nbytes(value):
+    """The bytes of the tensors and arrays in value, and of the pickle of the other objects."""
+    if value is None:
+        return 0
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, MsState):
+        return nbytes([value.entity_state, value.map_state] + list(value.statistical_state))
+    if isinstance(value, (ArgsAction, ArgsActionLogits)):
+        return nbytes(value.toList())
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(v) for v in value)
+
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def test():
+    import torch.nn.functional as F
+
+    from pysc2.env.sc2_env import AgentInterfaceFormat, Agent, Race, Bot, Difficulty, BotBuild
+
+    from alphastarmini.core.arch.agent import Agent as ASAgent
+    from alphastarmini.core.rl.mock_env import create_mock_env
+    from alphastarmini.core.rl.rl_utils import stack_namedtuple
+    from alphastarmini.core.rl.trajectory_buffer import TrajectoryRingBuffer
+    from alphastarmini.lib.hyper_parameters import AlphaStar_Agent_Interface_Format_Params as AAIFP
+
+    sequence_length = 4
+    players = [Agent(Race.protoss, 'player'), Bot([Race.terran], Difficulty(1), [BotBuild.random])]
+    env = create_mock_env(players, [AgentInterfaceFormat(**AAIFP._asdict())], num_units=48, episode_length=20)
+    home_obs = env.reset()[0]
+
+    rng = torch.Generator().manual_seed(1)
+
+    def get_logits():
+        units = torch.randn(1, 12, 512, generator=rng)
+        units[:, 9:] = MASKED_LOGIT / 0.8
+        return ArgsActionLogits(torch.randn(1, 564, generator=rng), torch.randn(1, 128, generator=rng),
+                                torch.randn(1, 2, generator=rng), units,
+                                torch.randn(1, 1, 512, generator=rng), torch.randn(1, 64, 64, generator=rng))
+
+    def get_step(obs, i):
+        state = ASAgent.preprocess_state_all(obs, build_order=[], last_list=[0, 0, 0])
+        action = ArgsAction(torch.tensor([[i * 7]]), torch.tensor([[i]]), torch.tensor([[1]]),
+                            torch.randint(0, 48, (1, 12, 1), generator=rng), torch.tensor([[[i]]]), torch.tensor([[i, 63 - i]]))
+        return Trajectory(state=state, baseline_state=ASAgent.get_baseline_state_from_multi_source_state(obs, state),
+                          baseline_state_op=None, memory=(torch.randn(1, 1, 8), torch.randn(1, 1, 8)), z=None,
+                          is_final=False, masks=[1, 1, 1, 1, 0, 1], unit_type_entity_mask=np.ones(512, dtype=bool),
+                          action=action, behavior_logits=get_logits(), teacher_logits=get_logits(), reward=0.,
+                          player_select_units_num=torch.tensor([9]), entity_num=torch.tensor([96]), build_order=[],
+                          z_build_order=None, unit_counts=None, z_unit_counts=None, game_loop=i * 8, last_list=[0, 0, 0])
+
+    segments = []
+    for k in range(3):
+        steps = []
+        for t in range(sequence_length):
+            steps.append(get_step(home_obs.observation, k * sequence_length + t))
+            home_obs = env.step([None])[0]
+        segments.append(stack_namedtuple(steps))
+
+    codec = TrajectoryCodec()
+    codec.report(segments[0])
+
+    decoded = codec.decode([codec.encode(s) for s in segments])
+    for raw, traj in zip(segments, decoded):
+        for t in range(sequence_length):
+            x, y = raw.state[t], traj.state[t]
+            assert torch.equal(x.entity_state, y.entity_state)
+            assert torch.equal(x.map_state, y.map_state)
+            assert all(torch.equal(a, b) for a, b in zip(x.statistical_state, y.statistical_state))
+            assert all(torch.equal(a, b) for a, b in zip(raw.baseline_state[t], traj.baseline_state[t]))
+
+            for field, a, b, action in zip(ACTION_FIELDS, raw.teacher_logits[t].toList(), traj.teacher_logits[t].toList(),
+                                           raw.action[t].toList()):
+                assert a.shape == b.shape and b.dtype == torch.float32
+                assert torch.allclose(a, b, atol=1e-2, rtol=1e-3), field
+                # no outliers in the KL loss
+                assert ((a - b).abs() < 1e8).all()
+
+            # the log probabilities of the taken actions
+            for field, a, b, action in zip(ACTION_FIELDS, raw.behavior_logits[t].toList(), traj.behavior_logits[t].toList(),
+                                           raw.action[t].toList()):
+                assert a.shape == b.shape
+                index = _action_index(field, action, a.shape[-1])
+                log_prob_a = F.log_softmax(_logits_rows(field, a).double(), dim=-1).gather(-1, index)
+                log_prob_b = F.log_softmax(_logits_rows(field, b).double(), dim=-1).gather(-1, index)
+                assert torch.allclose(log_prob_a, log_prob_b, atol=1e-4), field
+
+    # through the ring buffer of the learner
+    buffer = TrajectoryRingBuffer(4, sequence_length, codec=codec)
+    for s in segments:
+        buffer.put(s)
+    sampled = buffer.sample(3)
+    assert torch.equal(sampled[2].state[3].entity_state, segments[2].state[3].entity_state)
+    assert torch.equal(sampled[1].state[0].map_state, segments[1].state[0].map_state)
+
+    raw_buffer = TrajectoryRingBuffer(4, sequence_length)
+    raw_buffer.put(segments[0])
+    print('ring buffer bytes per step: {:.1f} KB, raw {:.1f} KB'.format(buffer.bytes_per_step() / 1024,
+                                                                        raw_buffer.bytes_per_step() / 1024))
+
+
+if __name__ == '__main__':
+    test()
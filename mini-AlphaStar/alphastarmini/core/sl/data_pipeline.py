@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" Input pipeline for sl training by tensor: global window sampler, prefetch workers and pinned batch buffers "
+
+import time
+import queue
+import threading
+
+import numpy as np
+
+import torch
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+
+class ReplayWindowSampler(object):
+    '''
+        Samples batches of windows (replay_index, start_index) over all the replays.
+        Each window of each replay has the same probability, so a replay is sampled
+        weighted by its length.
+    '''
+
+    def __init__(self, window_nums, batch_size, shuffle=True, replacement=False,
+                 num_batches=None, drop_last=False):
+        super().__init__()
+        self.window_nums = np.asarray(window_nums, dtype=np.int64)
+        self.window_offsets = np.concatenate([[0], np.cumsum(self.window_nums)])
+        self.total_windows = int(self.window_offsets[-1])
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.replacement = replacement
+        self.num_batches = num_batches
+        self.drop_last = drop_last
+
+    def _global_indices(self):
+        # use the torch random generator, so the checkpointed torch rng state also restores the sampling
+        if self.replacement:
+            num_samples = self.__len__() * self.batch_size
+            return torch.randint(self.total_windows, (num_samples,)).numpy()
+        if self.shuffle:
+            return torch.randperm(self.total_windows).numpy()
+        return np.arange(self.total_windows)
+
+    def to_windows(self, global_indices):
+        replay_indices = np.searchsorted(self.window_offsets, global_indices, side='right') - 1
+        start_indices = global_indices - self.window_offsets[replay_indices]
+        return np.stack([replay_indices, start_indices], axis=1)
+
+    def __iter__(self):
+        global_indices = self._global_indices()
+        for i in range(self.__len__()):
+            batch = global_indices[i * self.batch_size:(i + 1) * self.batch_size]
+            yield self.to_windows(batch)
+
+    def __len__(self):
+        if self.num_batches is not None:
+            return self.num_batches
+        if self.drop_last:
+            return self.total_windows // self.batch_size
+        return (self.total_windows + self.batch_size - 1) // self.batch_size
+
+
+class WindowBatchBuffer(object):
+    '''
+        Preallocated (pinned when asked) storage for one batch of windows.
+    '''
+
+    def __init__(self, tensors_list, batch_size, seq_len, pin_memory=False):
+        super().__init__()
+        self.tensors = []
+        for tensor in tensors_list[0]:
+            buffer = torch.empty((batch_size, seq_len) + tuple(tensor.shape[1:]), dtype=tensor.dtype)
+            self.tensors.append(buffer.pin_memory() if pin_memory else buffer)
+        self.size = 0
+
+    def assemble(self, tensors_list, windows, seq_len):
+        for j, buffer in enumerate(self.tensors):
+            for i, (replay_index, start_index) in enumerate(windows):
+                buffer[i].copy_(tensors_list[replay_index][j][start_index:start_index + seq_len])
+        self.size = len(windows)
+
+    def get(self):
+        return tuple(buffer[:self.size] for buffer in self.tensors)
+
+
+class ThroughputProbe(object):
+    '''
+        Measures batches/s and samples/s, and the time the training loop waits for data.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.time()
+        self.batch_num = 0
+        self.sample_num = 0
+        self.wait_time = 0.
+
+    def add(self, batch_size, wait_time=0.):
+        self.batch_num += 1
+        self.sample_num += batch_size
+        self.wait_time += wait_time
+
+    def report(self):
+        elapse_time = max(time.time() - self.start_time, 1e-9)
+        return {'batches_per_second': self.batch_num / elapse_time,
+                'samples_per_second': self.sample_num / elapse_time,
+                'wait_ratio': self.wait_time / elapse_time}
+
+    def __str__(self):
+        r = self.report()
+        return 'batches/s: {:.3f} | samples/s: {:.3f} | data wait: {:.1%}'.format(
+            r['batches_per_second'], r['samples_per_second'], r['wait_ratio'])
+
+
+class PrefetchLoader(object):
+    '''
+        Replaces ConcatDataset + DataLoader for ReplayTensorDatasets.
+
+        The batches are sampled over all replays by ReplayWindowSampler and assembled
+        by num_workers threads straight into prefetch_depth preallocated (pinned)
+        buffers, so the slicing and copying overlap with the forward and backward
+        pass (the copies release the GIL). On gpu the pinned buffer is copied with
+        non_blocking=True.
+
+        Note: a yielded batch on cpu is a view of a buffer which is reused after the next
+        batch is requested, clone it if it should be kept.
+    '''
+
+    def __init__(self, datasets, batch_size, shuffle=True, num_workers=2, prefetch_depth=4,
+                 pin_memory=False, device=None, replacement=False, num_batches=None,
+                 drop_last=False):
+        super().__init__()
+        assert len(datasets) > 0
+        self.tensors_list = [dataset.tensors for dataset in datasets]
+        self.seq_len = datasets[0].seq_len
+        self.batch_size = batch_size
+        self.num_workers = max(1, num_workers)
+        self.prefetch_depth = max(2, prefetch_depth)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.device = device
+        self.sampler = ReplayWindowSampler([len(dataset) for dataset in datasets], batch_size,
+                                           shuffle=shuffle, replacement=replacement,
+                                           num_batches=num_batches, drop_last=drop_last)
+        self.buffers = [WindowBatchBuffer(self.tensors_list, batch_size, self.seq_len, self.pin_memory)
+                        for _ in range(self.prefetch_depth)]
+        self.probe = ThroughputProbe()
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def _worker(self, task_queue, free_queue, ready_queue, stop_event, order_lock):
+        while not stop_event.is_set():
+            # tasks take the free buffers in batch order, so the batch the training loop
+            # waits for can not be starved by later batches
+            with order_lock:
+                task = task_queue.get()
+                if task is None:
+                    return
+                batch_idx, windows = task
+                buffer_idx = None
+                while buffer_idx is None and not stop_event.is_set():
+                    try:
+                        buffer_idx = free_queue.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+            if buffer_idx is None:
+                return
+            try:
+                self.buffers[buffer_idx].assemble(self.tensors_list, windows, self.seq_len)
+                ready_queue.put((batch_idx, buffer_idx, None))
+            except Exception as e:
+                ready_queue.put((batch_idx, buffer_idx, e))
+
+    def __iter__(self):
+        task_queue, free_queue, ready_queue = queue.Queue(), queue.Queue(), queue.Queue()
+        stop_event = threading.Event()
+        order_lock = threading.Lock()
+        for i in range(self.prefetch_depth):
+            free_queue.put(i)
+
+        batch_num = len(self.sampler)
+        for batch_idx, windows in enumerate(self.sampler):
+            task_queue.put((batch_idx, windows))
+        for _ in range(self.num_workers):
+            task_queue.put(None)
+
+        workers = [threading.Thread(target=self._worker,
+                                    args=(task_queue, free_queue, ready_queue, stop_event, order_lock),
+                                    daemon=True) for _ in range(self.num_workers)]
+        for w in workers:
+            w.start()
+
+        self.probe.reset()
+        ready = {}
+        last_buffer_idx, last_copy_event = None, None
+        try:
+            for batch_idx in range(batch_num):
+                # the buffer of the last batch is no longer used by the training loop (or the async copy)
+                if last_buffer_idx is not None:
+                    if last_copy_event is not None:
+                        last_copy_event.synchronize()
+                    free_queue.put(last_buffer_idx)
+                    last_buffer_idx, last_copy_event = None, None
+
+                wait_start = time.time()
+                while batch_idx not in ready:
+                    idx, buffer_idx, error = ready_queue.get()
+                    if error is not None:
+                        raise error
+                    ready[idx] = buffer_idx
+                buffer_idx = ready.pop(batch_idx)
+
+                batch = self.buffers[buffer_idx].get()
+                last_buffer_idx = buffer_idx
+                if self.device is not None and torch.device(self.device).type == 'cuda':
+                    batch = tuple(t.to(self.device, non_blocking=self.pin_memory) for t in batch)
+                    if self.pin_memory:
+                        last_copy_event = torch.cuda.Event()
+                        last_copy_event.record(torch.cuda.current_stream(self.device))
+                self.probe.add(len(batch[0]), time.time() - wait_start)
+
+                print('prefetch batch', batch_idx, 'buffer', buffer_idx) if debug else None
+                yield batch
+        finally:
+            stop_event.set()
+            for w in workers:
+                w.join()
+
+
+def test():
+    from alphastarmini.core.sl.dataset import ReplayTensorDataset
+
+    seq_len, batch_size = 4, 3
+    datasets = [ReplayTensorDataset(torch.arange(n * 2).float().reshape(n, 2), torch.arange(n).float().reshape(n, 1),
+                                    seq_len=seq_len) for n in (10, 20, 7)]
+    loader = PrefetchLoader(datasets, batch_size, shuffle=True, num_workers=2, prefetch_depth=3)
+
+    seen = 0
+    for features, labels in loader:
+        assert features.shape[1] == seq_len
+        assert torch.all(features[:, 1:, 0] - features[:, :-1, 0] == 2)
+        seen += features.shape[0]
+    assert seen == sum(len(d) for d in datasets)
+    print('PrefetchLoader', loader.probe)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+" Parallel replay featurization: SC2 processes on a shared replay queue, writing to a checkpointed chunked feature store "
+
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import shutil
+import tempfile
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+from pysc2.lib import protocol
+from pysc2.lib import remote_controller
+
+from alphastarmini.core.sl.dataset import ReplayTensorDataset
+
+__author__ = "Ruo-Ze Liu"
+
+debug = False
+
+CHECKPOINT_FILE = 'progress.json'
+CHUNK_PREFIX = 'chunk_'
+
+# a chunk is written when the replays of a process have this many rows (feature, label)
+CHUNK_ROWS = 8192
+
+# like replay_actions, relaunch SC2 after this many replays
+REPLAYS_PER_SC2 = 300
+
+PRINT_SECS = 10
+
+# the start method of all the processes of the repo
+CTX = mp.get_context('spawn')
+
+
+def replay_key(replay_path):
+    return os.path.basename(replay_path)
+
+
+class FeatureStore(object):
+    '''
+        A directory of chunks, each the (features, labels) of several replays concatenated,
+        as torch.save'd by transform_replay_data for one replay, and a checkpoint of the
+        committed chunks (the replays and their lengths) and of the skipped replays.
+
+        A chunk is written to a temporary file and renamed, then committed to the checkpoint,
+        which is also replaced atomically. A chunk file which is not in the checkpoint, eg after
+        a crash between the two, is removed on open and its replays are featurized again.
+    '''
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        self.chunks = {}  # chunk name -> [[replay, rows], ...]
+        self.skipped = {}  # replay -> reason
+        self.runs = 0
+
+        checkpoint_path = os.path.join(path, CHECKPOINT_FILE)
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+            self.chunks = checkpoint['chunks']
+            self.skipped = checkpoint['skipped']
+            self.runs = checkpoint['runs']
+
+        self._remove_uncommitted()
+
+    def _remove_uncommitted(self):
+        for name in os.listdir(self.path):
+            if name.startswith(CHUNK_PREFIX) and name not in self.chunks:
+                print('remove uncommitted chunk:', name)
+                os.remove(os.path.join(self.path, name))
+
+    def done(self):
+        return set(replay for replays in self.chunks.values() for replay, _ in replays)
+
+    def rows(self):
+        return sum(rows for replays in self.chunks.values() for _, rows in replays)
+
+    def remaining(self, replay_paths, retry_skipped=False):
+        done = self.done()
+        return [p for p in replay_paths
+                if replay_key(p) not in done and (retry_skipped or replay_key(p) not in self.skipped)]
+
+    def new_run(self):
+        self.runs += 1
+        self.save()
+        return self.runs
+
+    def commit(self, chunk_name, replays):
+        self.chunks[chunk_name] = replays
+        for replay, _ in replays:
+            self.skipped.pop(replay, None)
+
+    def skip(self, replay, reason):
+        self.skipped[replay] = reason
+
+    def save(self):
+        checkpoint = {'runs': self.runs, 'chunks': self.chunks, 'skipped': self.skipped}
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, os.path.join(self.path, CHECKPOINT_FILE))
+
+    def load_replays(self, replays=None):
+        # yields (replay, features, labels) of the committed replays (or of only these ones), chunk by chunk
+        for name in sorted(self.chunks):
+            if replays is not None and not any(replay in replays for replay, _ in self.chunks[name]):
+                continue
+            features, labels = torch.load(os.path.join(self.path, name))
+            start = 0
+            for replay, rows in self.chunks[name]:
+                if replays is None or replay in replays:
+                    yield replay, features[start:start + rows], labels[start:start + rows]
+                start += rows
+
+    def load_datasets(self, seq_len, from_index=0, end_index=None):
+        # the ReplayTensorDatasets of the replays [from_index:end_index] sorted by name, like the
+        # replay files of sl_train_by_tensor, and only the chunks of these replays are read
+        replays = set(sorted(self.done())[from_index:end_index])
+        replays = sorted(self.load_replays(replays), key=lambda r: r[0])
+        return [ReplayTensorDataset(features, labels, seq_len=seq_len) for _, features, labels in replays]
+
+
+class ChunkWriter(object):
+    '''
+        Buffers the replays of a process, and writes them as a chunk once they have chunk_rows rows.
+    '''
+
+    def __init__(self, path, prefix, chunk_rows=CHUNK_ROWS):
+        super().__init__()
+        self.path = path
+        self.prefix = prefix
+        self.chunk_rows = chunk_rows
+        self.chunk_num = 0
+        self._reset()
+
+    def _reset(self):
+        self.features, self.labels, self.replays = [], [], []
+        self.rows = 0
+
+    def add(self, replay, features, labels):
+        # returns the (name, replays) of the written chunk, or None
+        self.features.append(features)
+        self.labels.append(labels)
+        self.replays.append([replay, len(features)])
+        self.rows += len(features)
+        if self.rows >= self.chunk_rows:
+            return self.flush()
+        return None
+
+    def flush(self):
+        if not self.replays:
+            return None
+
+        name = '%s%05d.pt' % (self.prefix, self.chunk_num)
+        self.chunk_num += 1
+        tmp_path = os.path.join(self.path, name + '.tmp')
+        torch.save((torch.cat(self.features, dim=0), torch.cat(self.labels, dim=0)), tmp_path)
+        os.replace(tmp_path, os.path.join(self.path, name))
+
+        replays = self.replays
+        self._reset()
+        return name, replays
+
+
+class FeaturizerStats(object):
+    '''
+        Stats for a featurizer process.
+    '''
+
+    def __init__(self, proc_id):
+        super().__init__()
+        self.proc_id = proc_id
+        self.start_time = self.time = time.time()
+        self.stage = ""
+        self.replay = ""
+        self.replays = 0
+        self.skipped = 0
+        self.crashes = 0
+        self.steps = 0
+        self.rows = 0
+        self.chunks = 0
+
+    def update(self, stage):
+        self.time = time.time()
+        self.stage = stage
+
+    def __str__(self):
+        steps_per_second = self.steps / max(self.time - self.start_time, 1e-9)
+        return ("[%2d] replay: %10s, replays: %5d, skipped: %4d, crashes: %3d, steps: %8d, rows: %7d, "
+                "chunks: %4d, steps/s: %7.1f, last: %10s, %3d s ago" % (
+                    self.proc_id, self.replay, self.replays, self.skipped, self.crashes, self.steps,
+                    self.rows, self.chunks, steps_per_second, self.stage, time.time() - self.time))
+
+
+class ReplayFeaturizer(CTX.Process):
+    '''
+        A Process that pulls replays, featurizes them and writes the features to chunks, like
+        the ReplayProcessor of pysc2/bin/replay_actions.py.
+
+        featurize_fn(controller, run_config, replay_path) returns the (features, labels, steps)
+        of a replay, steps being its game steps observed, or None to skip it. It must be
+        picklable, eg a module function or a functools.partial of one. A None in the queue
+        ends the process, after it has written its last chunk.
+
+        The messages to the stats_queue are ('stats', FeaturizerStats), ('chunk', name, replays)
+        and ('skip', replay, reason).
+    '''
+
+    def __init__(self, proc_id, run_config, replay_queue, stats_queue, featurize_fn, store_path,
+                 prefix, chunk_rows=CHUNK_ROWS):
+        super().__init__()
+        self.stats = FeaturizerStats(proc_id)
+        self.run_config = run_config
+        self.replay_queue = replay_queue
+        self.stats_queue = stats_queue
+        self.featurize_fn = featurize_fn
+        self.store_path = store_path
+        self.prefix = prefix
+        self.chunk_rows = chunk_rows
+        self.daemon = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda a, b: sys.exit())  # Exit quietly.
+        self.writer = ChunkWriter(self.store_path, self.prefix, self.chunk_rows)
+        self._update_stage("spawn")
+        replay_path = None
+        while True:
+            self._print("Starting up a new SC2 instance.")
+            self._update_stage("launch")
+            try:
+                with self.run_config.start(want_rgb=False) as controller:
+                    for _ in range(REPLAYS_PER_SC2):
+                        replay_path = self.replay_queue.get()
+                        if replay_path is None:
+                            self._commit(self.writer.flush())
+                            self._update_stage("done")
+                            return
+                        self.process_replay(controller, replay_path)
+                        replay_path = None
+                    self._update_stage("shutdown")
+            except (protocol.ConnectionError, protocol.ProtocolError, remote_controller.RequestError):
+                self._print("SC2 crashed on %s, relaunching." % replay_path)
+                self.stats.crashes += 1
+                if replay_path is not None:
+                    self._skip(replay_path, 'crashed')
+                    replay_path = None
+            except KeyboardInterrupt:
+                return
+
+    def process_replay(self, controller, replay_path):
+        self.stats.replay = replay_key(replay_path)[:10]
+        self._update_stage("featurize")
+        try:
+            result = self.featurize_fn(controller, self.run_config, replay_path)
+        except (protocol.ConnectionError, protocol.ProtocolError, remote_controller.RequestError):
+            raise
+        except Exception as e:
+            traceback.print_exc()
+            self._skip(replay_path, 'error: %r' % e)
+            return
+
+        if result is None:
+            self._skip(replay_path, 'not featurized')
+            return
+
+        features, labels, steps = result
+        self.stats.replays += 1
+        self.stats.steps += steps
+        self.stats.rows += len(features)
+        self._update_stage("write")
+        self._commit(self.writer.add(replay_key(replay_path), features, labels))
+
+    def _commit(self, chunk):
+        if chunk is not None:
+            name, replays = chunk
+            self.stats.chunks += 1
+            self.stats_queue.put(('chunk', name, replays))
+
+    def _skip(self, replay_path, reason):
+        self._print("Skip %s: %s" % (replay_key(replay_path), reason))
+        self.stats.skipped += 1
+        self.stats_queue.put(('skip', replay_key(replay_path), reason))
+
+    def _print(self, s):
+        for line in str(s).strip().splitlines():
+            print("[%s] %s" % (self.stats.proc_id, line)) if debug else None
+
+    def _update_stage(self, stage):
+        self.stats.update(stage)
+        self.stats_queue.put(('stats', self.stats))
+
+
+def summarize(proc_stats, elapsed):
+    summary = {k: sum(getattr(s, k) for s in proc_stats)
+               for k in ('replays', 'skipped', 'crashes', 'steps', 'rows', 'chunks')}
+    summary['seconds'] = elapsed
+    summary['replays_per_hour'] = summary['replays'] * 3600 / max(elapsed, 1e-9)
+    summary['steps_per_second'] = summary['steps'] / max(elapsed, 1e-9)
+    return summary
+
+
+def format_summary(summary):
+    return ('replays: {replays} | skipped: {skipped} | crashes: {crashes} | steps: {steps} | rows: {rows} | '
+            'chunks: {chunks} | time: {seconds:.1f}s | replays/hour: {replays_per_hour:.1f} | '
+            'steps/s: {steps_per_second:.1f}'.format(**summary))
+
+
+def print_stats(proc_stats, elapsed, width=120):
+    print((" Summary %0d secs " % elapsed).center(width, "="))
+    print(format_summary(summarize(proc_stats, elapsed)))
+    print(" Process stats ".center(width, "-"))
+    print("\n".join(str(s) for s in proc_stats))
+    print("=" * width)
+
+
+def featurize(replay_paths, store_path, featurize_fn, run_config, parallel=1, chunk_rows=CHUNK_ROWS,
+              retry_skipped=False, print_secs=PRINT_SECS):
+    '''
+        Featurizes the replays which are not in the FeatureStore at store_path yet, on parallel
+        ReplayFeaturizer processes, each with its SC2.
+
+        The checkpoint of the store is updated as the chunks are written, so after a crash (of
+        the processes, or of this one) calling it again resumes: only the replays of the chunks
+        which were not committed are featurized again. The skipped replays are not retried
+        unless retry_skipped.
+
+        Returns the summary of this run, with the replays/hour and the steps/s.
+    '''
+    store = FeatureStore(store_path)
+    todo = store.remaining(replay_paths, retry_skipped=retry_skipped)
+    print('replays: %d, done: %d, skipped: %d, to do: %d' % (
+        len(replay_paths), len(store.done()), len(store.skipped), len(todo)))
+
+    proc_stats = [FeaturizerStats(i) for i in range(parallel)]
+    if not todo:
+        return summarize(proc_stats, 0)
+
+    run = store.new_run()
+
+    replay_queue = CTX.Queue()
+    stats_queue = CTX.Queue()
+    for replay_path in todo:
+        replay_queue.put(replay_path)
+
+    procs = []
+    for i in range(min(len(todo), parallel)):
+        replay_queue.put(None)
+        procs.append(ReplayFeaturizer(i, run_config, replay_queue, stats_queue, featurize_fn, store_path,
+                                      prefix='%sr%03d_p%02d_' % (CHUNK_PREFIX, run, i), chunk_rows=chunk_rows))
+
+    start_time = time.time()
+    print_time = start_time + print_secs
+    try:
+        for p in procs:
+            p.start()
+
+        while True:
+            try:
+                message = stats_queue.get(timeout=0.5)
+            except queue.Empty:
+                if not any(p.is_alive() for p in procs):
+                    break
+                message = None
+
+            if message is not None:
+                if message[0] == 'stats':
+                    proc_stats[message[1].proc_id] = message[1]
+                elif message[0] == 'chunk':
+                    store.commit(message[1], message[2])
+                    store.save()
+                elif message[0] == 'skip':
+                    store.skip(message[1], message[2])
+                    store.save()
+
+            if time.time() >= print_time:
+                print_stats(proc_stats, time.time() - start_time)
+                print_time += print_secs
+
+    except KeyboardInterrupt:
+        print("Caught KeyboardInterrupt, exiting.")
+
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+        store.save()
+
+    for p in procs:
+        if p.exitcode:
+            print('featurizer %d exited with %d, its uncommitted replays will be redone on resume' % (
+                p.stats.proc_id, p.exitcode))
+
+    elapsed = time.time() - start_time
+    print_stats(proc_stats, elapsed)
+    print('replays left:', len(store.remaining(replay_paths, retry_skipped=retry_skipped)))
+
+    return summarize(proc_stats, elapsed)
+
+
+class _FakeController(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        pass
+
+
+class _FakeRunConfig(object):
+
+    def start(self, want_rgb=False):
+        return _FakeController()
+
+
+def _fake_featurize(controller, run_config, replay_path, crash_path=None):
+    # replay "n_x" has n rows, "crash" kills its process the first time, "lost" loses SC2
+    name = replay_key(replay_path)
+    if name == 'crash' and crash_path is not None and not os.path.exists(crash_path):
+        open(crash_path, 'w').close()
+        os._exit(1)
+    if name == 'crash':
+        return None
+    if name == 'bad':
+        raise ValueError(name)
+    if name == 'lost':
+        raise protocol.ConnectionError(name)
+
+    time.sleep(0.01)
+    n = int(name.split('_')[0])
+    return torch.full((n, 3), float(n)), torch.full((n, 1), float(n)), n * 8
+
+
+def test():
+    import functools
+
+    path = tempfile.mkdtemp()
+    try:
+        store_path = os.path.join(path, 'store')
+        replay_paths = [os.path.join(path, '%d_replay' % n) for n in range(1, 41)]
+        replay_paths.insert(20, os.path.join(path, 'crash'))
+        replay_paths += [os.path.join(path, 'bad'), os.path.join(path, 'lost')]
+        featurize_fn = functools.partial(_fake_featurize, crash_path=os.path.join(path, 'crashed'))
+
+        # the first run loses the uncommitted replays of the process which crashes
+        summary = featurize(replay_paths, store_path, featurize_fn, _FakeRunConfig(), parallel=3,
+                            chunk_rows=50, print_secs=1)
+        print(format_summary(summary))
+        print('committed after the crash:', len(FeatureStore(store_path).done()))
+
+        # a chunk written but not committed is removed on resume
+        open(os.path.join(store_path, CHUNK_PREFIX + 'r001_p00_99999.pt'), 'w').close()
+
+        summary = featurize(replay_paths, store_path, featurize_fn, _FakeRunConfig(), parallel=3,
+                            chunk_rows=50, print_secs=1)
+        print(format_summary(summary))
+
+        store = FeatureStore(store_path)
+        assert sorted(store.done()) == sorted('%d_replay' % n for n in range(1, 41))
+        assert set(store.skipped) == {'crash', 'bad', 'lost'}
+        assert store.skipped['lost'] == 'crashed'
+        assert store.rows() == sum(range(1, 41))
+        for replay, features, labels in store.load_replays():
+            n = int(replay.split('_')[0])
+            assert features.shape == (n, 3) and torch.all(features == n) and torch.all(labels == n)
+        assert len(store.load_datasets(seq_len=1)) == 40
+        # the replays 13_replay ... 17_replay, sorted by name
+        datasets = store.load_datasets(seq_len=1, from_index=3, end_index=8)
+        assert [int(d.tensors[0][0, 0]) for d in datasets] == [13, 14, 15, 16, 17]
+        assert not featurize(replay_paths, store_path, featurize_fn, _FakeRunConfig())['replays']
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    test()
@@ -32,6 +32,8 @@ from alphastarmini.core.sl.feature import Feature
 from alphastarmini.core.sl.label import Label
 from alphastarmini.core.sl import sl_loss_multi_gpu as Loss
 from alphastarmini.core.sl.dataset import ReplayTensorDataset
+from alphastarmini.core.sl.data_pipeline import PrefetchLoader
+from alphastarmini.core.sl import replay_featurizer
 from alphastarmini.core.sl import sl_utils as SU
 
 from alphastarmini.lib.utils import load_latest_model, initial_model_state_dict
@@ -53,6 +55,8 @@ parser.add_argument("-m", "--model", choices=["sl", "rl"], default="sl", help="C
 parser.add_argument("-r", "--restore", action="store_true", default=False, help="whether to restore model or not")
 parser.add_argument("-c", "--clip", action="store_true", default=False, help="whether to use clipping")
 parser.add_argument('--num_workers', type=int, default=2, help='')
+parser.add_argument('--prefetch_depth', type=int, default=4, help='number of batches assembled ahead of training')
+parser.add_argument('--pin_memory', action="store_true", default=False, help='assemble batches in pinned memory')
 
 
 args = parser.parse_args()
@@ -69,6 +73,8 @@ MODEL = args.model
 RESTORE = args.restore
 CLIP = args.clip
 NUM_WORKERS = args.num_workers
+PREFETCH_DEPTH = args.prefetch_depth
+PIN_MEMORY = args.pin_memory
 
 MODEL_PATH = "./model/"
 if not os.path.exists(MODEL_PATH):
@@ -206,12 +212,20 @@ def main_worker(device):
 
     print('==> Preparing data..')
 
-    replay_files = os.listdir(PATH)
-    print('length of replay_files:', len(replay_files)) if debug else None
-    replay_files.sort()
+    if os.path.exists(os.path.join(PATH, replay_featurizer.CHECKPOINT_FILE)):
+        # the chunked feature store of transform_replay_data.parallel_test, its replays sorted by name
+        store = replay_featurizer.FeatureStore(PATH)
+        print('length of replays in the feature store:', len(store.done())) if debug else None
 
-    train_list = getReplayData(PATH, replay_files, from_index=TRAIN_FROM, end_index=TRAIN_FROM + TRAIN_NUM)
-    val_list = getReplayData(PATH, replay_files, from_index=VAL_FROM, end_index=VAL_FROM + VAL_NUM)
+        train_list = store.load_datasets(SEQ_LEN, from_index=TRAIN_FROM, end_index=TRAIN_FROM + TRAIN_NUM)
+        val_list = store.load_datasets(SEQ_LEN, from_index=VAL_FROM, end_index=VAL_FROM + VAL_NUM)
+    else:
+        replay_files = os.listdir(PATH)
+        print('length of replay_files:', len(replay_files)) if debug else None
+        replay_files.sort()
+
+        train_list = getReplayData(PATH, replay_files, from_index=TRAIN_FROM, end_index=TRAIN_FROM + TRAIN_NUM)
+        val_list = getReplayData(PATH, replay_files, from_index=VAL_FROM, end_index=VAL_FROM + VAL_NUM)
 
     print('len(train_list)', len(train_list)) if debug else None
     print('len(val_list)', len(val_list)) if debug else None
@@ -222,11 +236,12 @@ def main_worker(device):
     print('len(train_set)', len(train_set)) if debug else None
     print('len(val_set)', len(val_set)) if debug else None
 
-    train_loader = DataLoader(train_set, batch_size=BATCH_SIZE, shuffle=True, 
-                              num_workers=NUM_WORKERS, pin_memory=False)
+    # sample windows over all replays, assembled by prefetch workers into preallocated batch buffers
+    train_loader = PrefetchLoader(train_list, batch_size=BATCH_SIZE, shuffle=True, num_workers=NUM_WORKERS,
+                                  prefetch_depth=PREFETCH_DEPTH, pin_memory=PIN_MEMORY, device=device)
 
-    val_loader = DataLoader(val_set, batch_size=BATCH_SIZE, shuffle=False, 
-                            num_workers=NUM_WORKERS, pin_memory=False)   
+    val_loader = PrefetchLoader(val_list, batch_size=BATCH_SIZE, shuffle=False, num_workers=NUM_WORKERS,
+                                prefetch_depth=PREFETCH_DEPTH, pin_memory=PIN_MEMORY, device=device)
 
     print('len(train_loader)', len(train_loader)) if debug else None
     print('len(val_loader)', len(val_loader)) if debug else None
@@ -311,8 +326,9 @@ def train(net, optimizer, scheduler, train_set, train_loader, device,
 
             gc.collect()
 
-            print('Batch/Epoch: [{}/{}]| loss: {:.3f} | acc: {:.3f} | batch time: {:.3f}s '.format(
-                batch_iter, epoch, loss_value, action_accuracy, batch_time))
+            print('Batch/Epoch: [{}/{}]| loss: {:.3f} | acc: {:.3f} | batch time: {:.3f}s | {}'.format(
+                batch_iter, epoch, loss_value, action_accuracy, batch_time, train_loader.probe))
+            writer.add_scalar('OneBatch/batches_per_second', train_loader.probe.report()['batches_per_second'], batch_iter)
 
         if SAVE_STATE_DICT:
             save_path = SAVE_PATH + ".pth"
@@ -12,6 +12,7 @@ import random
 import pickle
 import enum
 import copy
+import functools
 
 import numpy as np
 
@@ -35,6 +36,7 @@ from s2clientprotocol import common_pb2 as com_pb
 from alphastarmini.core.arch.agent import Agent
 from alphastarmini.core.sl.feature import Feature
 from alphastarmini.core.sl.label import Label
+from alphastarmini.core.sl import replay_featurizer
 
 from alphastarmini.lib.hyper_parameters import Arch_Hyper_Parameters as AHP
 from alphastarmini.lib.hyper_parameters import AlphaStar_Agent_Interface_Format_Params as AAIFP
@@ -93,6 +95,10 @@ flags.DEFINE_string("no_server_replay_path", "D:/work/gitproject/mini-AlphaStar/
 flags.DEFINE_bool("save_data", False, "replays_save data or not")
 flags.DEFINE_string("save_path", "./data/replay_data/", "path to replays_save replay data")
 flags.DEFINE_string("save_path_tensor", "./data/replay_data_tensor_new_small/", "path to replays_save replay data tensor")
+
+flags.DEFINE_integer("parallel", 4, "How many SC2 processes featurize the replays in parallel_test.")
+flags.DEFINE_integer("chunk_rows", replay_featurizer.CHUNK_ROWS, "The rows of a chunk of the feature store.")
+flags.DEFINE_string("feature_store_path", "./data/replay_feature_store/", "path of the chunked feature store of parallel_test")
 FLAGS(sys.argv)
 
 
@@ -307,27 +313,7 @@ def getFuncCall(o, feat, obs, use_raw=True):
     return func_call
 
 
-def test(on_server=False):
-
-    if on_server:
-        REPLAY_PATH = P.replay_path  # "/home/liuruoze/data4/mini-AlphaStar/data/filtered_replays_1/" 
-        COPY_PATH = None
-        SAVE_PATH = "./result.csv"
-        max_steps_of_replay = FLAGS.max_steps_of_replay
-        max_replays = FLAGS.max_replays
-    else:
-        REPLAY_PATH = FLAGS.no_server_replay_path
-        COPY_PATH = None
-        SAVE_PATH = "./result.csv"
-        max_steps_of_replay = SMALL_MAX_STEPS  # 60 * 60 * 22.4  # 60 * 60 * 22.4
-        max_replays = 1  # not used
-
-    run_config = run_configs.get(version=FLAGS.replay_version)
-    print('REPLAY_PATH:', REPLAY_PATH)
-    replay_files = os.listdir(REPLAY_PATH)
-    print('length of replay_files:', len(replay_files))
-    replay_files.sort()
-
+def get_interface():
     screen_resolution = point.Point(FLAGS.screen_resolution, FLAGS.screen_resolution)
     minimap_resolution = point.Point(FLAGS.minimap_resolution, FLAGS.minimap_resolution)
     camera_width = 24
@@ -367,6 +353,308 @@ def test(on_server=False):
     minimap_resolution.assign_to(interface.feature_layer.minimap_resolution)
     interface.feature_layer.crop_to_playable_area = crop_to_playable_area
 
+    return interface
+
+
+def get_win_observe_id(replay_info):
+    print('replay_info', replay_info) if debug else None
+    print('type(replay_info)', type(replay_info)) if debug else None
+
+    print('replay_info.player_info：', replay_info.player_info) if debug else None
+    infos = replay_info.player_info
+
+    observe_id_list = []
+    observe_result_list = []
+    for info in infos:
+        print('info：', info) if debug else None
+        player_info = info.player_info
+        result = info.player_result.result
+        print('player_info', player_info) if debug else None
+        if player_info.race_actual == com_pb.Protoss:
+            observe_id_list.append(player_info.player_id)
+            observe_result_list.append(result)
+
+    print('observe_id_list', observe_id_list) if debug else None
+    print('observe_result_list', observe_result_list) if debug else None
+
+    win_observe_id = 0
+
+    for i, result in enumerate(observe_result_list):
+        if result == sc_pb.Victory:
+            win_observe_id = observe_id_list[i]
+            break
+
+    return win_observe_id
+
+
+def observe_replay(controller, replay_data, replay_info, interface, win_observe_id, max_steps_of_replay):
+    '''
+        Plays the replay from the view of win_observe_id, and returns the obs, func_call, delay
+        and build order lists of the steps to save, the number of no op, and the game steps.
+    '''
+    crop_to_playable_area = interface.feature_layer.crop_to_playable_area
+    raw_crop_to_playable_area = interface.raw_crop_to_playable_area
+
+    start_replay = sc_pb.RequestStartReplay(
+        replay_data=replay_data,
+        options=interface,
+        disable_fog=False,  # FLAGS.disable_fog
+        observed_player_id=win_observe_id,  # random.randint(1, 2),  # 1 or 2, wo random select it. FLAGS.observed_player
+        map_data=None,
+        realtime=False
+    )
+
+    print(" Replay info ".center(60, "-")) if 1 else None
+    print("replay_info", replay_info) if 1 else None
+    print("-" * 60) if debug else None
+    controller.start_replay(start_replay)
+    # The below several arguments are default set to False, so we shall enable them.
+
+    # use_feature_units: Whether to include feature_unit observations.
+
+    # use_raw_units: Whether to include raw unit data in observations. This
+    # differs from feature_units because it includes units outside the
+    # screen and hidden units, and because unit positions are given in
+    # terms of world units instead of screen units.
+
+    # use_raw_actions: [bool] Whether to use raw actions as the interface.
+    # Same as specifying action_space=ActionSpace.RAW.
+
+    # use_unit_counts: Whether to include unit_counts observation. Disabled by
+    # default since it gives information outside the visible area. 
+
+    '''
+    show_cloaked: Whether to show limited information for cloaked units.
+    show_burrowed_shadows: Whether to show limited information for burrowed
+          units that leave a shadow on the ground (ie widow mines and moving
+          roaches and infestors).
+    show_placeholders: Whether to show buildings that are queued for
+          construction.
+    '''
+
+    aif = AgentInterfaceFormat(**AAIFP._asdict())
+
+    feat = F.features_from_game_info(game_info=controller.game_info(),
+                                     raw_resolution=AAIFP.raw_resolution, 
+                                     crop_to_playable_area=crop_to_playable_area,
+                                     raw_crop_to_playable_area=raw_crop_to_playable_area,
+                                     hide_specific_actions=AAIFP.hide_specific_actions,
+                                     use_feature_units=True, use_raw_units=True,
+                                     use_unit_counts=True, use_raw_actions=True,
+                                     show_cloaked=True, show_burrowed_shadows=True, 
+                                     show_placeholders=True) 
+
+    # consistent with the SL and RL setting
+    # feat = F.features_from_game_info(game_info=controller.game_info(), agent_interface_format=aif)
+
+    print("feat obs spec:", feat.observation_spec()) if debug else None
+    print("feat action spec:", feat.action_spec()) if debug else None
+    prev_obs = None
+    prev_function = None
+    i = 0
+    record_i = 0
+    noop_count = 0
+    obs_list, func_call_list, z_list, delay_list = [], [], [], [] 
+
+    # initial build order
+    player_bo = []
+    player_ucb = []
+    bo_list = []
+
+    while True:
+        o = controller.observe()
+        try:
+            obs = feat.transform_obs(o)
+
+            try:
+                func_call = None
+                no_op = False
+                if o.actions:
+                    function_calls = getFuncCall(o, feat, obs)
+
+                    if function_calls is not None:
+                        # when remove no_op and other actions
+                        # we can only reserver for the only the first one action
+                        func_call = function_calls[0]
+
+                        if func_call.function.value == 0:
+                            no_op = True
+                            func_call = None
+                        elif func_call.function.value == RAW_FUNCTIONS.raw_move_camera.id.value:  # raw_move_camera
+                            if random.uniform(0, 1) > FLAGS.move_camera_threshold:
+                                func_call = None
+                        elif func_call.function.value == RAW_FUNCTIONS.Smart_pt.id.value:  # Smart_pt
+                            if random.uniform(0, 1) > FLAGS.Smart_pt_threshold:
+                                func_call = None
+                        elif func_call.function.value == RAW_FUNCTIONS.Smart_unit.id.value:  # Smart_unit
+                            if random.uniform(0, 1) > FLAGS.Smart_unit_threshold:
+                                func_call = None
+                        elif func_call.function.value == RAW_FUNCTIONS.Harvest_Gather_unit.id.value:  # Harvest_Gather_unit
+                            if random.uniform(0, 1) > FLAGS.Harvest_Gather_unit_threshold:
+                                func_call = None
+                        elif func_call.function.value == RAW_FUNCTIONS.Attack_pt.id.value:  # Harvest_Gather_unit
+                            if random.uniform(0, 1) > FLAGS.Attack_pt_threshold:
+                                func_call = None
+                else:
+                    no_op = True
+
+                if no_op:
+                    print('expert func: no op') if debug else None
+                    if random.uniform(0, 1) < FLAGS.no_op_threshold:
+                        print('get no op !') if debug else None
+                        noop_count += 1
+                        func_call = A.FunctionCall.init_with_validation("no_op", [], raw=True)
+
+                if func_call is not None:
+                    #z = [player_bo, player_ucb]
+
+                    delay = i - record_i
+                    print('two action dealy:', delay, 'steps!') if debug else None
+                    record_i = i
+
+                    obs_list.append(obs)
+
+                    func_call_list.append(func_call)
+                    print('func_call:', func_call) if 1 else None
+
+                    delay_list.append(delay)
+
+                    if prev_obs is not None:
+                        # calculate the build order
+                        player_bo = U.calculate_build_order(player_bo, prev_obs, obs)
+
+                        player_bo_show = [U.get_unit_tpye_name_and_race(U.get_unit_tpye_from_index(index))[0].name for index in player_bo]
+                        print("player build order:", player_bo_show) if debug else None
+
+                    bo_list.append(copy.deepcopy(player_bo))
+                    prev_obs = obs
+
+            except Exception as e:
+                traceback.print_exc()
+
+            if i >= max_steps_of_replay:  # test the first n frames
+                print("max frames test, break out!")
+                break
+
+            if o.player_result:  # end of game
+                print('o.player_result', o.player_result)
+                break
+
+        except Exception as inst:
+            traceback.print_exc() 
+
+        controller.step()
+
+        i += 1
+
+    # the last delay is 0
+    delay_list.append(0)
+    func_call_list.append(A.FunctionCall.init_with_validation("no_op", [], raw=True))
+
+    return obs_list, func_call_list, delay_list, bo_list, noop_count, i
+
+
+def get_feature_and_label_tensors(obs_list, func_call_list, delay_list, bo_list):
+    feature_list, label_list = [], []
+
+    length = len(obs_list)
+    for i in range(length):
+        obs = obs_list[i]
+        func_call = func_call_list[i]
+        bo = bo_list[i]
+
+        # delay should be the next,
+        # means when should we issue the next command from the time we give this command
+        last_delay = delay_list[i]
+        last_func_call = func_call_list[i - 1]
+        last_action_type = last_func_call.function.value
+        action_can_be_queued = U.action_can_be_queued(last_action_type)
+        last_repeat_queued = None
+        last_action_arguments = None
+        if action_can_be_queued:
+            last_action_arguments = last_func_call.arguments
+            last_repeat_queued = last_action_arguments[0][0].value  # the first argument is alway queue
+        else:
+            last_repeat_queued = 0
+
+        delay = delay_list[i + 1]
+
+        print('last_func_call', last_func_call) if debug else None
+        print('last_action_type', last_action_type) if debug else None
+        print('last_action_can_be_queued', action_can_be_queued) if debug else None
+        print('last_action_arguments', last_action_arguments) if debug else None
+        print('last_repeat_queued', last_repeat_queued) if debug else None
+        print('last_delay', last_delay) if debug else None
+
+        print('func_call', func_call) if debug else None
+        print('delay', delay) if debug else None
+
+        last_list = [last_delay, last_action_type, last_repeat_queued]
+
+        feature, label = getFeatureAndLabel_numpy(obs, func_call, delay, last_list, bo)
+
+        feature = torch.tensor(feature)
+        label = torch.tensor(label)
+        feature_list.append(feature)
+        label_list.append(label)
+
+    features = torch.cat(feature_list, dim=0)
+    labels = torch.cat(label_list, dim=0)
+    print('features.shape:', features.shape) if debug else None
+    print('labels.shape:', labels.shape) if debug else None
+
+    return features, labels
+
+
+def featurize_replay(controller, run_config, replay_path, max_steps_of_replay=SMALL_MAX_STEPS):
+    '''
+        The (features, labels, game steps) of a replay as saved in SaveType.torch_tensor, or
+        None if there is no winning protoss to observe. The featurize_fn of replay_featurizer.
+    '''
+    replay_data = run_config.replay_data(replay_path)
+    replay_info = controller.replay_info(replay_data)
+
+    win_observe_id = get_win_observe_id(replay_info)
+    print('win_observe_id', win_observe_id) if debug else None
+    if win_observe_id == 0:
+        return None
+
+    obs_list, func_call_list, delay_list, bo_list, _, game_steps = observe_replay(
+        controller, replay_data, replay_info, get_interface(), win_observe_id, max_steps_of_replay)
+    if not obs_list:
+        return None
+
+    features, labels = get_feature_and_label_tensors(obs_list, func_call_list, delay_list, bo_list)
+
+    return features, labels, game_steps
+
+
+def get_replay_path_and_max_steps(on_server):
+    if on_server:
+        REPLAY_PATH = P.replay_path  # "/home/liuruoze/data4/mini-AlphaStar/data/filtered_replays_1/" 
+        max_steps_of_replay = FLAGS.max_steps_of_replay
+    else:
+        REPLAY_PATH = FLAGS.no_server_replay_path
+        max_steps_of_replay = SMALL_MAX_STEPS  # 60 * 60 * 22.4  # 60 * 60 * 22.4
+
+    return REPLAY_PATH, max_steps_of_replay
+
+
+def test(on_server=False):
+
+    REPLAY_PATH, max_steps_of_replay = get_replay_path_and_max_steps(on_server)
+    COPY_PATH = None
+    SAVE_PATH = "./result.csv"
+    max_replays = FLAGS.max_replays if on_server else 1  # not used
+
+    run_config = run_configs.get(version=FLAGS.replay_version)
+    print('REPLAY_PATH:', REPLAY_PATH)
+    replay_files = os.listdir(REPLAY_PATH)
+    print('length of replay_files:', len(replay_files))
+    replay_files.sort()
+
+    interface = get_interface()
+
     agent = Agent()
     #j = 0
     replay_length_list = []
@@ -395,32 +683,7 @@ def test(on_server=False):
                 replay_data = run_config.replay_data(replay_path)
                 replay_info = controller.replay_info(replay_data)
 
-                print('replay_info', replay_info) if debug else None
-                print('type(replay_info)', type(replay_info)) if debug else None
-
-                print('replay_info.player_info：', replay_info.player_info) if debug else None
-                infos = replay_info.player_info
-
-                observe_id_list = []
-                observe_result_list = []
-                for info in infos:
-                    print('info：', info) if debug else None
-                    player_info = info.player_info
-                    result = info.player_result.result
-                    print('player_info', player_info) if debug else None
-                    if player_info.race_actual == com_pb.Protoss:
-                        observe_id_list.append(player_info.player_id)
-                        observe_result_list.append(result)
-
-                print('observe_id_list', observe_id_list) if debug else None
-                print('observe_result_list', observe_result_list) if debug else None
-
-                win_observe_id = 0
-
-                for i, result in enumerate(observe_result_list):
-                    if result == sc_pb.Victory:
-                        win_observe_id = observe_id_list[i]
-                        break
+                win_observe_id = get_win_observe_id(replay_info)
 
                 # we observe the winning one
                 print('win_observe_id', win_observe_id)
@@ -429,211 +692,17 @@ def test(on_server=False):
                     print('no win_observe_id found! continue')
                     continue
 
-                start_replay = sc_pb.RequestStartReplay(
-                    replay_data=replay_data,
-                    options=interface,
-                    disable_fog=False,  # FLAGS.disable_fog
-                    observed_player_id=win_observe_id,  # random.randint(1, 2),  # 1 or 2, wo random select it. FLAGS.observed_player
-                    map_data=None,
-                    realtime=False
-                )
-
-                print(" Replay info ".center(60, "-")) if 1 else None
-                print("replay_info", replay_info) if 1 else None
-                print("-" * 60) if debug else None
-                controller.start_replay(start_replay)
-                # The below several arguments are default set to False, so we shall enable them.
-
-                # use_feature_units: Whether to include feature_unit observations.
-
-                # use_raw_units: Whether to include raw unit data in observations. This
-                # differs from feature_units because it includes units outside the
-                # screen and hidden units, and because unit positions are given in
-                # terms of world units instead of screen units.
-
-                # use_raw_actions: [bool] Whether to use raw actions as the interface.
-                # Same as specifying action_space=ActionSpace.RAW.
-
-                # use_unit_counts: Whether to include unit_counts observation. Disabled by
-                # default since it gives information outside the visible area. 
-
-                '''
-                show_cloaked: Whether to show limited information for cloaked units.
-                show_burrowed_shadows: Whether to show limited information for burrowed
-                      units that leave a shadow on the ground (ie widow mines and moving
-                      roaches and infestors).
-                show_placeholders: Whether to show buildings that are queued for
-                      construction.
-                '''
-
-                aif = AgentInterfaceFormat(**AAIFP._asdict())
-
-                feat = F.features_from_game_info(game_info=controller.game_info(),
-                                                 raw_resolution=AAIFP.raw_resolution, 
-                                                 crop_to_playable_area=crop_to_playable_area,
-                                                 raw_crop_to_playable_area=raw_crop_to_playable_area,
-                                                 hide_specific_actions=AAIFP.hide_specific_actions,
-                                                 use_feature_units=True, use_raw_units=True,
-                                                 use_unit_counts=True, use_raw_actions=True,
-                                                 show_cloaked=True, show_burrowed_shadows=True, 
-                                                 show_placeholders=True) 
-
-                # consistent with the SL and RL setting
-                # feat = F.features_from_game_info(game_info=controller.game_info(), agent_interface_format=aif)
-
-                print("feat obs spec:", feat.observation_spec()) if debug else None
-                print("feat action spec:", feat.action_spec()) if debug else None
-                prev_obs = None
-                prev_function = None
-                i = 0
-                record_i = 0
-                save_steps = 0
-                noop_count = 0
-                obs_list, func_call_list, z_list, delay_list = [], [], [], [] 
-                feature_list, label_list = [], []
-                step_dict = {}
-
-                # initial build order
-                player_bo = []
-                player_ucb = []
-                bo_list = []
-
-                while True:
-                    o = controller.observe()
-                    try:
-                        obs = feat.transform_obs(o)
-
-                        try:
-                            func_call = None
-                            no_op = False
-                            if o.actions:
-                                function_calls = getFuncCall(o, feat, obs)
-
-                                if function_calls is not None:
-                                    # when remove no_op and other actions
-                                    # we can only reserver for the only the first one action
-                                    func_call = function_calls[0]
-
-                                    if func_call.function.value == 0:
-                                        no_op = True
-                                        func_call = None
-                                    elif func_call.function.value == RAW_FUNCTIONS.raw_move_camera.id.value:  # raw_move_camera
-                                        if random.uniform(0, 1) > FLAGS.move_camera_threshold:
-                                            func_call = None
-                                    elif func_call.function.value == RAW_FUNCTIONS.Smart_pt.id.value:  # Smart_pt
-                                        if random.uniform(0, 1) > FLAGS.Smart_pt_threshold:
-                                            func_call = None
-                                    elif func_call.function.value == RAW_FUNCTIONS.Smart_unit.id.value:  # Smart_unit
-                                        if random.uniform(0, 1) > FLAGS.Smart_unit_threshold:
-                                            func_call = None
-                                    elif func_call.function.value == RAW_FUNCTIONS.Harvest_Gather_unit.id.value:  # Harvest_Gather_unit
-                                        if random.uniform(0, 1) > FLAGS.Harvest_Gather_unit_threshold:
-                                            func_call = None
-                                    elif func_call.function.value == RAW_FUNCTIONS.Attack_pt.id.value:  # Harvest_Gather_unit
-                                        if random.uniform(0, 1) > FLAGS.Attack_pt_threshold:
-                                            func_call = None
-                            else:
-                                no_op = True
-
-                            if no_op:
-                                print('expert func: no op') if debug else None
-                                if random.uniform(0, 1) < FLAGS.no_op_threshold:
-                                    print('get no op !') if debug else None
-                                    noop_count += 1
-                                    func_call = A.FunctionCall.init_with_validation("no_op", [], raw=True)
-
-                            if func_call is not None:
-                                save_steps += 1
-                                #z = [player_bo, player_ucb]
-
-                                delay = i - record_i
-                                print('two action dealy:', delay, 'steps!') if debug else None
-                                record_i = i
-
-                                obs_list.append(obs)
-
-                                func_call_list.append(func_call)
-                                print('func_call:', func_call) if 1 else None
-
-                                delay_list.append(delay)
-
-                                if prev_obs is not None:
-                                    # calculate the build order
-                                    player_bo = U.calculate_build_order(player_bo, prev_obs, obs)
-
-                                    player_bo_show = [U.get_unit_tpye_name_and_race(U.get_unit_tpye_from_index(index))[0].name for index in player_bo]
-                                    print("player build order:", player_bo_show) if debug else None
-
-                                bo_list.append(copy.deepcopy(player_bo))
-                                prev_obs = obs
-
-                        except Exception as e:
-                            traceback.print_exc()
-
-                        if i >= max_steps_of_replay:  # test the first n frames
-                            print("max frames test, break out!")
-                            break
-
-                        if o.player_result:  # end of game
-                            print('o.player_result', o.player_result)
-                            break
-
-                    except Exception as inst:
-                        traceback.print_exc() 
-
-                    controller.step()
-
-                    i += 1
+                obs_list, func_call_list, delay_list, bo_list, noop_count, _ = observe_replay(
+                    controller, replay_data, replay_info, interface, win_observe_id, max_steps_of_replay)
+                save_steps = len(obs_list)
 
                 print('begin save!')
 
-                # the last delay is 0
-                delay_list.append(0)
-                func_call_list.append(A.FunctionCall.init_with_validation("no_op", [], raw=True))
-
                 if SAVE_TYPE == SaveType.torch_tensor:
-                    length = len(obs_list)
-                    for i in range(length):
-                        obs = obs_list[i]
-                        func_call = func_call_list[i]
-                        bo = bo_list[i]
-
-                        # delay should be the next,
-                        # means when should we issue the next command from the time we give this command
-                        last_delay = delay_list[i]
-                        last_func_call = func_call_list[i - 1]
-                        last_action_type = last_func_call.function.value
-                        action_can_be_queued = U.action_can_be_queued(last_action_type)
-                        last_repeat_queued = None
-                        last_action_arguments = None
-                        if action_can_be_queued:
-                            last_action_arguments = last_func_call.arguments
-                            last_repeat_queued = last_action_arguments[0][0].value  # the first argument is alway queue
-                        else:
-                            last_repeat_queued = 0
-
-                        delay = delay_list[i + 1]
-
-                        print('last_func_call', last_func_call) if debug else None
-                        print('last_action_type', last_action_type) if debug else None
-                        print('last_action_can_be_queued', action_can_be_queued) if debug else None
-                        print('last_action_arguments', last_action_arguments) if debug else None
-                        print('last_repeat_queued', last_repeat_queued) if debug else None
-                        print('last_delay', last_delay) if debug else None
-
-                        print('func_call', func_call) if debug else None
-                        print('delay', delay) if debug else None
-
-                        last_list = [last_delay, last_action_type, last_repeat_queued]
-
-                        feature, label = getFeatureAndLabel_numpy(obs, func_call, delay, last_list, bo)
-
-                        feature = torch.tensor(feature)
-                        label = torch.tensor(label)
-                        feature_list.append(feature)
-                        label_list.append(label)
+                    features, labels = get_feature_and_label_tensors(obs_list, func_call_list, delay_list, bo_list)
 
                 elif SAVE_TYPE == SaveType.python_pickle:
+                    step_dict = {}
                     length = len(obs_list)
                     for i in range(length):
                         obs = obs_list[i]
@@ -646,10 +715,6 @@ def test(on_server=False):
                     pass
 
                 if SAVE_TYPE == SaveType.torch_tensor:
-                    features = torch.cat(feature_list, dim=0)
-                    labels = torch.cat(label_list, dim=0)
-                    print('features.shape:', features.shape) if debug else None
-                    print('labels.shape:', labels.shape) if debug else None
                     #m = {'features': features, 'labels': labels}
                     m = (features, labels)
 
@@ -682,3 +747,26 @@ def test(on_server=False):
     print("end")
     print("replay_length_list:", replay_length_list)
     print("noop_length_list:", noop_length_list)
+
+
+def parallel_test(on_server=False, retry_skipped=False):
+    '''
+        Featurizes the replays like test() with SaveType.torch_tensor, but on FLAGS.parallel SC2
+        processes, into the chunked FeatureStore at FLAGS.feature_store_path (see
+        replay_featurizer). Run it again to resume after a crash.
+    '''
+    REPLAY_PATH, max_steps_of_replay = get_replay_path_and_max_steps(on_server)
+
+    run_config = run_configs.get(version=FLAGS.replay_version)
+    print('REPLAY_PATH:', REPLAY_PATH)
+    replay_files = sorted(os.listdir(REPLAY_PATH))
+    replay_paths = [REPLAY_PATH + replay_file for replay_file in replay_files[DATA_FROM:DATA_FROM + DATA_NUM]]
+    print('length of replay_paths:', len(replay_paths))
+
+    featurize_fn = functools.partial(featurize_replay, max_steps_of_replay=max_steps_of_replay)
+    summary = replay_featurizer.featurize(replay_paths, FLAGS.feature_store_path, featurize_fn, run_config,
+                                          parallel=FLAGS.parallel, chunk_rows=FLAGS.chunk_rows,
+                                          retry_skipped=retry_skipped)
+    print(replay_featurizer.format_summary(summary))
+
+    return summary
@@ -6,6 +6,10 @@
 import time
 import random
 
+import numpy as np
+
+import torch
+
 import Levenshtein
 
 __author__ = "Ruo-Ze Liu"
@@ -36,6 +40,112 @@ def hammingDist(s1, s2):
     return sum([ch1 != ch2 for ch1, ch2 in zip(s1, s2)])
 
 
+WORD_BITS = 64
+
+_ONE = np.uint64(1)
+_HIGH_SHIFT = np.uint64(WORD_BITS - 1)
+
+
+def pad_sequences(seqs, fill=-1):
+    '''
+    The int sequences as a [N, max_len] int64 array, padded by fill, and their lengths.
+    '''
+    lengths = np.array([len(s) for s in seqs], dtype=np.int64)
+    padded = np.full((len(seqs), max(int(lengths.max(initial=0)), 1)), fill, dtype=np.int64)
+    for i, s in enumerate(seqs):
+        padded[i, :lengths[i]] = s
+
+    return padded, lengths
+
+
+def levenshtein_batch(seqs_1, seqs_2, prefixes=None):
+    '''
+    The Levenshtein distances of all the pairs (seqs_1[i], seqs_2[i]) of int sequences
+    (e.g. build orders) at once, without a conversion to strings.
+
+    prefixes are the (i, len_1, len_2) of the pairs of prefixes seqs_1[i][:len_1] and
+    seqs_2[i][:len_2] whose distances are returned instead (all the pairs if None): one
+    pass over a pair gives the distances of all of its prefixes, so the pairs of sequences
+    which only grow (e.g. the build orders along a trajectory) take the pass of the last one.
+
+    It is the bit-parallel algorithm of Myers (1999), in the formulation of Hyyro (2003):
+    a step is one column of the DP matrices of all the pairs, whose vertical differences
+    are packed in the bits of 64 bits words (so a sequence longer than 64 takes more than
+    one word, with the carries of the addition and of the shifts across them). The
+    steps are as many as the longest sequence of the shorter side.
+    '''
+    a, len_a = pad_sequences(seqs_1, fill=-1)
+    b, len_b = pad_sequences(seqs_2, fill=-2)
+
+    if prefixes is None:
+        pair, end_a, end_b = np.arange(len(a)), len_a, len_b
+    else:
+        pair, end_a, end_b = np.array(prefixes, dtype=np.int64).reshape(-1, 3).T
+
+    # the distance is symmetric, the longer side is the one in the bits
+    if b.shape[1] > a.shape[1]:
+        a, b, end_a, end_b = b, a, end_b, end_a
+
+    n, m = a.shape
+    words = (m + WORD_BITS - 1) // WORD_BITS
+    a = np.pad(a, ((0, 0), (0, words * WORD_BITS - m)), constant_values=-1)
+
+    # the bit masks of the matches of each char of b in a, [n, len(b), words]
+    peq = np.packbits(a[:, None, :] == b[:, :, None], axis=2, bitorder='little').view(np.uint64)
+
+    pv = np.full((n, words), np.iinfo(np.uint64).max, dtype=np.uint64)
+    mv = np.zeros((n, words), dtype=np.uint64)
+
+    # the distances at the row end_a of the DP matrices, until the column end_b
+    score = end_a.copy()
+    row = np.maximum(end_a - 1, 0)
+    row_word, row_bit = row // WORD_BITS, (row % WORD_BITS).astype(np.uint64)
+
+    for j in range(int(end_b.max(initial=0))):
+        eq = peq[:, j]
+        xv = eq | mv
+
+        # (eq & pv) + pv, with the carry across the words
+        t = eq & pv
+        if words == 1:
+            s = t + pv
+        else:
+            s = np.empty_like(pv)
+            carry = np.zeros(n, dtype=np.uint64)
+            for w in range(words):
+                x = t[:, w] + pv[:, w]
+                y = x + carry
+                carry = ((x < pv[:, w]) | (y < x)).astype(np.uint64)
+                s[:, w] = y
+
+        xh = (s ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+
+        delta = ((ph[pair, row_word] >> row_bit) & _ONE).astype(np.int64) - \
+            ((mh[pair, row_word] >> row_bit) & _ONE).astype(np.int64)
+        score += delta * (j < end_b)
+
+        ph_shift, mh_shift = ph << _ONE, mh << _ONE
+        if words > 1:
+            ph_shift[:, 1:] |= ph[:, :-1] >> _HIGH_SHIFT
+            mh_shift[:, 1:] |= mh[:, :-1] >> _HIGH_SHIFT
+        ph_shift[:, 0] |= _ONE
+
+        pv = mh_shift | ~(xv | ph_shift)
+        mv = ph_shift & xv
+
+    return np.where(end_a == 0, end_b, score)
+
+
+def hamming_batch(x, y):
+    '''
+    The Hamming distances between x and y (e.g. [T, B, unit_counts_bow] tensors) along
+    the last dimension, as the Levenshtein.hamming of the strings of their ints.
+    '''
+    return (x.long() != y.long()).sum(dim=-1)
+
+
 def test():
     levenshtein = levenshtein_recur
 
@@ -86,6 +196,34 @@ def test():
     end = time.time() 
     print(f"Total runtime of the hammingDist is {end - begin}")
 
+    # the batched distances are the ones of Levenshtein on the strings
+    rng = np.random.RandomState(1)
+    seqs_1 = [rng.randint(0, Stop, size=rng.randint(0, 150)).tolist() for _ in range(200)]
+    seqs_2 = [rng.randint(0, Stop, size=rng.randint(0, 150)).tolist() for _ in range(200)]
+    seqs_1[0], seqs_2[1], seqs_2[2] = [], [], list(seqs_1[2])
+    seqs_1[3], seqs_2[3] = seqs_1[3][:64], seqs_1[3][:63] + [Stop]
+    seqs_1 += [[i % 7 for i in range(300)], [13, 23, 45]]
+    seqs_2 += [[i % 5 for i in range(200)], [13, 45, 564]]
+
+    def to_str(l):
+        return ''.join([chr(i) for i in l])
+
+    expected = [Levenshtein.distance(to_str(s_1), to_str(s_2)) for s_1, s_2 in zip(seqs_1, seqs_2)]
+    assert levenshtein_batch(seqs_1, seqs_2).tolist() == expected
+    assert levenshtein_batch(seqs_2, seqs_1).tolist() == expected
+    assert levenshtein_batch([[]], [[]]).tolist() == [0]
+
+    prefixes = [(i, len_1, len_2) for i in range(0, 200, 7) for len_1 in range(0, len(seqs_1[i]) + 1, 11)
+                for len_2 in range(0, len(seqs_2[i]) + 1, 13)]
+    expected = [Levenshtein.distance(to_str(seqs_1[i][:len_1]), to_str(seqs_2[i][:len_2])) for i, len_1, len_2 in prefixes]
+    assert levenshtein_batch(seqs_1, seqs_2, prefixes).tolist() == expected
+
+    x = torch.tensor(rng.randint(0, 3, size=(4, 3, 20)), dtype=torch.float32)
+    y = torch.tensor(rng.randint(0, 3, size=(4, 3, 20)), dtype=torch.float32)
+    expected = [[Levenshtein.hamming(to_str(a.long().tolist()), to_str(b.long().tolist())) for a, b in zip(x_t, y_t)]
+                for x_t, y_t in zip(x, y)]
+    assert hamming_batch(x, y).tolist() == expected
+
 
 if __name__ == '__main__':
     test()
@@ -113,6 +113,45 @@ for i in range(ConstSize.Actions_Size):
         del type_set, reorder_type_list
 
 
+def get_action_args_mask(arg_name):
+    """
+    bool tensor indexed by raw action id, true if the action has the argument arg_name
+    """
+    mask = torch.zeros(ConstSize.Actions_Size, dtype=torch.bool)
+    for i in range(ConstSize.Actions_Size):
+        mask[i] = any(arg.name == arg_name for arg in actions.RAW_FUNCTIONS[i].args)
+    return mask
+
+
+# built once at import, the mask functions below are a single gather on these tables
+ACTION_CAN_BE_QUEUED_MASK = get_action_args_mask('queued')
+ACTION_INVOLVE_SELECTING_UNITS_MASK = get_action_args_mask('unit_tags')
+ACTION_INVOLVE_TARGETING_UNIT_MASK = get_action_args_mask('target_unit_tag')
+ACTION_INVOLVE_TARGETING_LOCATION_MASK = get_action_args_mask('world')
+
+ACTION_MASK_TABLES = {
+    'queued': ACTION_CAN_BE_QUEUED_MASK,
+    'selecting_units': ACTION_INVOLVE_SELECTING_UNITS_MASK,
+    'targeting_unit': ACTION_INVOLVE_TARGETING_UNIT_MASK,
+    'targeting_location': ACTION_INVOLVE_TARGETING_LOCATION_MASK,
+    'selected_units_types': SELECTED_UNITS_TYPES_MASK,
+    'target_units_types': TARGET_UNITS_TYPES_MASK,
+}
+ACTION_MASK_TABLES_ON_DEVICE = {}
+
+
+def get_action_mask_table(name, device):
+    """
+    the table of ACTION_MASK_TABLES on the device, moved there on the first use
+    """
+    key = (name, torch.device(device))
+    table = ACTION_MASK_TABLES_ON_DEVICE.get(key, None)
+    if table is None:
+        table = ACTION_MASK_TABLES[name].to(device)
+        ACTION_MASK_TABLES_ON_DEVICE[key] = table
+    return table
+
+
 def unpackbits_for_largenumber(x, num_bits):
     if np.issubdtype(x.dtype, np.floating):
         raise ValueError("numpy data type needs to be int-like")
@@ -452,13 +491,7 @@ def action_can_be_queued(action_type):
     Inputs: action_type, int
     Outputs: true or false
     """
-    need_args = actions.RAW_FUNCTIONS[action_type].args
-    result = False
-    for arg in need_args:
-        if arg.name == 'queued':
-            result = True
-            break
-    return result 
+    return bool(ACTION_CAN_BE_QUEUED_MASK[action_type])
 
 
 def action_can_be_queued_mask(action_types):
@@ -468,16 +501,8 @@ def action_can_be_queued_mask(action_types):
     Inputs: action_types
     Outputs: mask
     """
-    mask = torch.zeros_like(action_types).bool()
-    action_types = action_types.cpu().detach().numpy()
-
-    for i, action_type in enumerate(action_types):
-        action_type_index = action_type.item()
-        print('i:', i, 'action_type_index:', action_type_index) if debug else None
-
-        mask[i] = action_can_be_queued(action_type_index)
-        del action_type, action_type_index
 
+    mask = get_action_mask_table('queued', action_types.device)[action_types.long()]
     del action_types
 
     return mask
@@ -491,13 +516,7 @@ def action_involve_selecting_units(action_type):
     Outputs: true or false
     """
 
-    need_args = actions.RAW_FUNCTIONS[action_type].args
-    result = False
-    for arg in need_args:
-        if arg.name == 'unit_tags':
-            result = True
-            break
-    return result 
+    return bool(ACTION_INVOLVE_SELECTING_UNITS_MASK[action_type])
 
 
 def action_involve_selecting_units_mask(action_types):
@@ -508,16 +527,7 @@ def action_involve_selecting_units_mask(action_types):
     Outputs: mask
     """
 
-    mask = torch.zeros_like(action_types).bool()
-    action_types = action_types.cpu().detach().numpy()
-
-    for i, action_type in enumerate(action_types):
-        action_type_index = action_type.item()
-        print('i:', i, 'action_type_index:', action_type_index) if debug else None
-
-        mask[i] = action_involve_selecting_units(action_type_index)
-        del action_type_index, action_type
-
+    mask = get_action_mask_table('selecting_units', action_types.device)[action_types.long()]
     del action_types
 
     return mask
@@ -530,13 +540,7 @@ def action_involve_targeting_unit(action_type):
     Inputs: action_type
     Outputs: true or false
     """
-    need_args = actions.RAW_FUNCTIONS[action_type].args
-    result = False
-    for arg in need_args:
-        if arg.name == 'target_unit_tag':
-            result = True
-            break
-    return result 
+    return bool(ACTION_INVOLVE_TARGETING_UNIT_MASK[action_type])
 
 
 def action_involve_targeting_unit_mask(action_types):
@@ -547,16 +551,7 @@ def action_involve_targeting_unit_mask(action_types):
     Outputs: mask
     """
 
-    mask = torch.zeros_like(action_types).bool()
-    action_types = action_types.cpu().detach().numpy()
-
-    for i, action_type in enumerate(action_types):
-        action_type_index = action_type.item()
-        print('i:', i, 'action_type_index:', action_type_index) if debug else None
-
-        mask[i] = action_involve_targeting_unit(action_type_index)
-        del action_type_index, action_type
-
+    mask = get_action_mask_table('targeting_unit', action_types.device)[action_types.long()]
     del action_types
 
     return mask
@@ -568,13 +563,7 @@ def action_involve_targeting_location(action_type):
     Inputs: action_type
     Outputs: true or false
     """
-    need_args = actions.RAW_FUNCTIONS[action_type].args
-    result = False
-    for arg in need_args:
-        if arg.name == 'world':
-            result = True
-            break
-    return result 
+    return bool(ACTION_INVOLVE_TARGETING_LOCATION_MASK[action_type])
 
 
 def action_involve_targeting_location_mask(action_types):
@@ -585,16 +574,7 @@ def action_involve_targeting_location_mask(action_types):
     Outputs: mask
     """
 
-    mask = torch.zeros_like(action_types).bool()
-    action_types = action_types.cpu().detach().numpy()
-
-    for i, action_type in enumerate(action_types):
-        action_type_index = action_type.item()
-        print('i:', i, 'action_type_index:', action_type_index) if debug else None
-
-        mask[i] = action_involve_targeting_location(action_type_index)
-        del action_type_index, action_type
-
+    mask = get_action_mask_table('targeting_location', action_types.device)[action_types.long()]
     del action_types
 
     return mask
@@ -654,7 +634,7 @@ def action_can_apply_to_selected_mask(action_types):
     Outputs: mask
     """
 
-    mask = SELECTED_UNITS_TYPES_MASK[action_types.squeeze(1)].to(action_types.device)
+    mask = get_action_mask_table('selected_units_types', action_types.device)[action_types.squeeze(1)]
     del action_types
 
     return mask
@@ -673,7 +653,7 @@ def action_can_apply_to_targeted_mask(action_types):
     Outputs: mask
     """
 
-    mask = TARGET_UNITS_TYPES_MASK[action_types.squeeze(1)].to(action_types.device)
+    mask = get_action_mask_table('target_units_types', action_types.device)[action_types.squeeze(1)]
     del action_types
 
     return mask
@@ -38,8 +38,8 @@ if __name__ == '__main__':
 
     # ------------------------
 
-    # 1. we transform the replays to pickle
+    # 1. we transform the replays to tensors, in the feature store read by sl_train_by_tensor
     from alphastarmini.core.sl import transform_replay_data
-    transform_replay_data.test(on_server=P.on_server)
+    transform_replay_data.parallel_test(on_server=P.on_server)
 
     print('run over')
@@ -3,6 +3,7 @@ import torch
 import json
 import os
 from pysc2.lib import actions
+from pysc2.lib import latency
 
 # Load Translation Mapping
 MAPPING_FILE = os.path.join(os.path.dirname(__file__), 'action_mapping.json')
@@ -33,6 +34,7 @@ def get_translation(name):
     # 3. Fallback: Return Clean Name
     return clean
 
+@latency.registry.decorate("action_to_cues")
 def action_to_cues(action_func_call, obs, internal_action=None):
     """Converts a PySC2 FunctionCall to visual cues."""
     cues = []